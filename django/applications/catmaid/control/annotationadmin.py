@@ -8,6 +8,7 @@ from django.shortcuts import render_to_response
 
 from formtools.wizard.views import SessionWizardView
 
+from catmaid.control.node import invalidate_node_list_cache
 from catmaid.models import Class, ClassInstance, ClassInstanceClassInstance
 from catmaid.models import Connector, Project, Relation, Treenode
 
@@ -309,3 +310,6 @@ def copy_annotations(source_pid, target_pid, import_treenodes=True,
         # TreenodeClassInstance
         # ConnectorClassInstance
         pass
+
+    # Nodes have been added with raw SQL
+    invalidate_node_list_cache(target_pid)
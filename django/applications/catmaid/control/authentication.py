@@ -3,6 +3,8 @@ from __future__ import unicode_literals
 
 import re
 import json
+import six
+import uuid
 
 from functools import wraps
 from itertools import groupby
@@ -20,7 +22,10 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth import authenticate, logout, login
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.forms import UserCreationForm
-from django.db import connection
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.core.exceptions import ObjectDoesNotExist
 from django.shortcuts import _get_queryset, render
@@ -28,6 +33,7 @@ from django.shortcuts import _get_queryset, render
 from rest_framework.authtoken import views as auth_views
 from rest_framework.authtoken.serializers import AuthTokenSerializer
 
+from catmaid.metrics import count_cache_access
 from catmaid.models import Project, UserRole, ClassInstance, \
         ClassInstanceClassInstance
 
@@ -95,33 +101,121 @@ def user_context_response(user, additional_fields=None):
     return JsonResponse(context)
 
 
-def check_user_role(user, project, roles):
-    """Check that a user has one of a set of roles for a project.
+# Permissions needed for each role, besides can_administer, which satisfies
+# all role requirements.
+ROLE_PERMISSIONS = {
+    UserRole.Annotate: 'can_annotate',
+    UserRole.Browse: 'can_browse',
+    UserRole.Import: 'can_import',
+}
 
-    Administrator role satisfies any requirement.
+PERMISSION_CACHE_GENERATION_KEY = 'catmaid-permissions:generation'
+
+
+def get_permission_cache():
+    """Return the cache configured for project permissions or None if
+    permissions shouldn't be cached across requests.
+    """
+    cache_name = getattr(settings, 'PERMISSION_CACHE', None)
+    return caches[cache_name] if cache_name else None
+
+
+def invalidate_permission_cache():
+    """Make all cached project permissions unreachable. Since group
+    memberships and permissions can affect many users and projects, this is
+    done for all of them at once.
+    """
+    permission_cache = get_permission_cache()
+    if permission_cache:
+        permission_cache.set(PERMISSION_CACHE_GENERATION_KEY, uuid.uuid4().hex, None)
+
+
+@receiver(post_save, sender=UserObjectPermission)
+@receiver(post_delete, sender=UserObjectPermission)
+@receiver(post_save, sender=GroupObjectPermission)
+@receiver(post_delete, sender=GroupObjectPermission)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Project)
+@receiver(m2m_changed, sender=User.groups.through)
+def on_permission_change(sender, **kwargs):
+    """Invalidate cached permissions right away and after the current
+    transaction is committed, so that no other request caches permissions
+    that were valid before the commit.
     """
+    invalidate_permission_cache()
+    transaction.on_commit(invalidate_permission_cache)
+
 
-    # Prefetch all user permissions for project.
-    checker = ObjectPermissionChecker(user)
+def get_project_permissions(user, project, request=None):
+    """Return the set of permission codenames a user has on a project, which
+    can be passed in as object or ID. Results are memoized for the passed in
+    request and, if PERMISSION_CACHE is set, cached for
+    PERMISSION_CACHE_TIMEOUT seconds across requests.
+    """
+    project_id = project if isinstance(project, six.integer_types + string_types) \
+            else project.id
+    project_id = int(project_id)
+
+    memo = None
+    if request is not None:
+        # Django REST framework wraps the original request
+        request = getattr(request, '_request', request)
+        memo = getattr(request, '_catmaid_project_permissions', None)
+        if memo is None:
+            memo = {}
+            request._catmaid_project_permissions = memo
+        memo_key = (user.pk, project_id)
+        if memo_key in memo:
+            return memo[memo_key]
+
+    permission_cache = get_permission_cache() if user.pk is not None else None
+    permissions = None
+    if permission_cache:
+        generation = permission_cache.get(PERMISSION_CACHE_GENERATION_KEY)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            if not permission_cache.add(PERMISSION_CACHE_GENERATION_KEY, generation, None):
+                generation = permission_cache.get(PERMISSION_CACHE_GENERATION_KEY)
+        # Active and superuser state are part of the key, because they
+        # influence permission checks without changing any permission.
+        cache_key = 'catmaid-permissions:{}:{}:{}:{}:{}'.format(generation,
+                user.pk, project_id, int(user.is_active), int(user.is_superuser))
+        permissions = permission_cache.get(cache_key)
+        count_cache_access('permissions', permissions is not None)
+
+    if permissions is None:
+        if isinstance(project, Project):
+            p = project
+        else:
+            p = Project.objects.get(pk=project_id)
+        permissions = frozenset(ObjectPermissionChecker(user).get_perms(p))
+        if permission_cache:
+            permission_cache.set(cache_key, permissions,
+                    getattr(settings, 'PERMISSION_CACHE_TIMEOUT', 60))
+
+    if memo is not None:
+        memo[memo_key] = permissions
+
+    return permissions
+
+
+def check_user_role(user, project, roles, request=None):
+    """Check that a user has one of a set of roles for a project, which can be
+    passed in as object or ID. If a request is passed in, permissions are
+    memoized for it.
+
+    Administrator role satisfies any requirement.
+    """
+    permissions = get_project_permissions(user, project, request)
 
     # Check for admin privs in all cases.
-    has_role = checker.has_perm('can_administer', project)
-
-    if not has_role:
-        # Check the indicated role(s)
-        if isinstance(roles, string_types):
-            roles = [roles]
-        for role in roles:
-            if role == UserRole.Annotate:
-                has_role = checker.has_perm('can_annotate', project)
-            elif role == UserRole.Browse:
-                has_role = checker.has_perm('can_browse', project)
-            elif role == UserRole.Import:
-                has_role = checker.has_perm('can_import', project)
-            if has_role:
-                break
+    if 'can_administer' in permissions:
+        return True
 
-    return has_role
+    # Check the indicated role(s)
+    if isinstance(roles, string_types):
+        roles = [roles]
+    return any(ROLE_PERMISSIONS.get(role) in permissions for role in roles)
 
 
 def requires_user_role(roles):
@@ -132,10 +226,9 @@ def requires_user_role(roles):
 
     def decorated_with_requires_user_role(f):
         def inner_decorator(request, roles=roles, *args, **kwargs):
-            p = Project.objects.get(pk=kwargs['project_id'])
             u = request.user
 
-            has_role = check_user_role(u, p, roles)
+            has_role = check_user_role(u, kwargs['project_id'], roles, request)
 
             if has_role:
                 # The user can execute the function.
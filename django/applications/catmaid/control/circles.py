@@ -4,41 +4,176 @@ from __future__ import unicode_literals
 import json
 import six
 import networkx as nx
+import numpy as np
 
 from itertools import combinations
-from collections import defaultdict
-from functools import partial
 
 from django.db import connection
 from django.http import HttpResponse
 
+from catmaid.metrics import count_cache_access
 from catmaid.models import UserRole
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import get_relation_to_id_map
 from catmaid.control.skeleton import _neuronnames
 
-def _next_circle(skeleton_set, relations, cursor):
-    """ Return a dictionary of skeleton IDs in the skeleton_set vs a dictionary of connected skeletons vs how many connections."""
-    pre = relations['presynaptic_to']
-    post = relations['postsynaptic_to']
+# Skeletons with changed connectivity are reloaded individually, unless there
+# are more of them than this.
+MAX_INCREMENTAL_UPDATE = 10000
+
+class SynapseGraph(object):
+    """ A directed graph of the synaptic connections between the skeletons of
+    a project. Edges point from presynaptic to postsynaptic skeletons and are
+    weighted with the number of synapses. They are stored as compressed sparse
+    rows (CSR) of NumPy arrays, once by source and once by target, which allows
+    to expand a whole set of skeletons with a few array operations. Skeletons
+    are referred to by their index in skeleton_ids. A graph isn't changed after
+    it has been created, updates return a new graph.
+    """
+
+    def __init__(self, sources, targets, counts, watermark=None):
+        self.sources = np.asarray(sources, dtype=np.int64)
+        self.targets = np.asarray(targets, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        # The oldest transaction that was running when the graph was loaded
+        self.watermark = watermark
+        self.skeleton_ids = np.unique(np.concatenate((self.sources, self.targets)))
+
+        n = len(self.skeleton_ids)
+        source_index = np.searchsorted(self.skeleton_ids, self.sources)
+        target_index = np.searchsorted(self.skeleton_ids, self.targets)
+        self.out_offsets, self.out_targets, self.out_counts = \
+                _to_csr(source_index, target_index, self.counts, n)
+        self.in_offsets, self.in_sources, self.in_counts = \
+                _to_csr(target_index, source_index, self.counts, n)
+
+    def __len__(self):
+        return len(self.skeleton_ids)
+
+    def indices(self, skeleton_ids):
+        """ Return the indices of the passed in skeleton IDs, skeletons without
+        synaptic connections are ignored.
+        """
+        skeleton_ids = np.fromiter(skeleton_ids, dtype=np.int64)
+        if 0 == len(self.skeleton_ids):
+            return np.empty(0, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.skeleton_ids, skeleton_ids),
+                len(self.skeleton_ids) - 1)
+        return np.unique(positions[self.skeleton_ids[positions] == skeleton_ids])
+
+    def expand(self, frontier, min_count, incoming=False):
+        """ Return all edges from (or to, if incoming is true) the skeletons
+        of the passed in index array that have at least min_count synapses, as
+        an array of frontier indices and an array of partner indices.
+        """
+        if incoming:
+            offsets, partners, counts = self.in_offsets, self.in_sources, self.in_counts
+        else:
+            offsets, partners, counts = self.out_offsets, self.out_targets, self.out_counts
+        frontier = np.asarray(frontier, dtype=np.int64)
+        starts = offsets[frontier]
+        lengths = offsets[frontier + 1] - starts
+        # The CSR positions of all edges of all frontier skeletons
+        positions = np.arange(lengths.sum()) + \
+                np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        strong = counts[positions] >= min_count
+        return np.repeat(frontier, lengths)[strong], partners[positions[strong]]
+
+    def update(self, skeleton_ids, sources, targets, counts, watermark):
+        """ Return a new graph in which all edges of the passed in skeletons
+        are replaced with the passed in edges.
+        """
+        changed = np.fromiter(skeleton_ids, dtype=np.int64)
+        keep = ~(np.in1d(self.sources, changed) | np.in1d(self.targets, changed))
+        return SynapseGraph(
+                np.concatenate((self.sources[keep], sources)),
+                np.concatenate((self.targets[keep], targets)),
+                np.concatenate((self.counts[keep], counts)), watermark)
+
+def _to_csr(rows, columns, weights, n):
+    order = np.argsort(rows, kind='mergesort')
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(rows, minlength=n))
+    return offsets, columns[order], weights[order]
+
+def _load_synapse_edges(cursor, project_id, relations, skeleton_ids=None):
+    """ Return the synaptic connections of a project, optionally constrained
+    to connections from or to the passed in skeletons, as arrays of
+    presynaptic skeleton IDs, postsynaptic skeleton IDs and synapse counts.
+    """
+    params = {
+        'project_id': int(project_id),
+        'pre': relations['presynaptic_to'],
+        'post': relations['postsynaptic_to'],
+    }
+    constraint = ''
+    if skeleton_ids is not None:
+        params['skids'] = [int(s) for s in skeleton_ids]
+        constraint = '''
+      AND (skeleton_a = ANY(%(skids)s::integer[])
+        OR skeleton_b = ANY(%(skids)s::integer[]))'''
     cursor.execute('''
-    SELECT tc1.skeleton_id, tc1.relation_id, tc2.skeleton_id
-    FROM treenode_connector tc1,
-         treenode_connector tc2
-    WHERE tc1.skeleton_id in (%s)
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.skeleton_id != tc2.skeleton_id
-      AND tc1.relation_id != tc2.relation_id
-      AND (tc1.relation_id = %s OR tc1.relation_id = %s)
-      AND (tc2.relation_id = %s OR tc2.relation_id = %s)
-    ''' % (','.join(map(str, skeleton_set)), pre, post, pre, post))
-    connections = defaultdict(partial(defaultdict, partial(defaultdict, int)))
-    for row in cursor.fetchall():
-        connections[row[0]][row[1]][row[2]] += 1
-    return connections
+    SELECT skeleton_a, skeleton_b, SUM(count)
+    FROM catmaid_skeleton_connectivity
+    WHERE project_id = %(project_id)s
+      AND relation_a = %(pre)s
+      AND relation_b = %(post)s
+      AND skeleton_a != skeleton_b{}
+    GROUP BY skeleton_a, skeleton_b
+    '''.format(constraint), params)
+    edges = np.array(cursor.fetchall(), dtype=np.int64).reshape((-1, 3))
+    return edges[:, 0], edges[:, 1], edges[:, 2]
+
+# The synapse graph of each project, cached in this process
+_synapse_graphs = {}
+
+def get_synapse_graph(project_id, relations, cursor):
+    """ Return the SynapseGraph of a project. Skeletons whose connectivity
+    was changed by a transaction that was still running (or not started) when
+    the cached graph was loaded are reloaded.
+    """
+    project_id = int(project_id)
+    # Read the watermark first, transactions that commit afterwards are
+    # seen again during the next update.
+    cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+    watermark = cursor.fetchone()[0]
+
+    graph = _synapse_graphs.get(project_id)
+    if graph is not None:
+        cursor.execute('''
+        SELECT skeleton_id FROM catmaid_skeleton_connectivity_version
+        WHERE project_id = %s AND txid >= %s
+        ''', (project_id, graph.watermark))
+        changed = [row[0] for row in cursor.fetchall()]
+        if not changed:
+            count_cache_access('synapse_graph', True)
+            return graph
+        if len(changed) <= MAX_INCREMENTAL_UPDATE:
+            edges = _load_synapse_edges(cursor, project_id, relations, changed)
+            graph = graph.update(changed, *edges, watermark=watermark)
+        else:
+            graph = None
+
+    # Incrementally updated graphs count as cache hits
+    count_cache_access('synapse_graph', graph is not None)
+    if graph is None:
+        edges = _load_synapse_edges(cursor, project_id, relations)
+        graph = SynapseGraph(*edges, watermark=watermark)
+
+    _synapse_graphs[project_id] = graph
+    return graph
+
+def clear_synapse_graph_cache(project_id=None):
+    """ Remove the cached synapse graph of a project or of all projects, if
+    no project ID is passed in.
+    """
+    if project_id is None:
+        _synapse_graphs.clear()
+    else:
+        _synapse_graphs.pop(int(project_id), None)
 
 def _relations(cursor, project_id):
-    cursor.execute("SELECT relation_name, id FROM relation WHERE project_id = %s AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')" % int(project_id))
-    return dict(cursor.fetchall())
+    return get_relation_to_id_map(project_id, ('presynaptic_to', 'postsynaptic_to'), cursor)
 
 def _clean_mins(request, cursor, project_id):
     min_pre  = int(request.POST.get('min_pre',  -1))
@@ -75,18 +210,23 @@ def circles_of_hell(request, project_id=None):
     cursor = connection.cursor()
     mins, relations = _clean_mins(request, cursor, int(project_id))
 
-    current_circle = first_circle
-    all_circles = first_circle
+    synapse_graph = get_synapse_graph(project_id, relations, cursor)
+    pre = relations['presynaptic_to']
+    post = relations['postsynaptic_to']
 
-    while n_circles > 0 and current_circle:
+    current_circle = synapse_graph.indices(first_circle)
+    all_circles = current_circle
+
+    while n_circles > 0 and len(current_circle):
         n_circles -= 1
-        connections = _next_circle(current_circle, relations, cursor)
-        next_circle = set(skID for c in six.itervalues(connections) \
-                          for relationID, cs in six.iteritems(c) \
-                          for skID, count in six.iteritems(cs) if count >= mins[relationID])
-        current_circle = next_circle - all_circles
-        all_circles = all_circles.union(next_circle)
+        _, post_partners = synapse_graph.expand(current_circle, mins[pre])
+        _, pre_partners = synapse_graph.expand(current_circle, mins[post],
+                incoming=True)
+        next_circle = np.union1d(post_partners, pre_partners)
+        current_circle = np.setdiff1d(next_circle, all_circles)
+        all_circles = np.union1d(all_circles, next_circle)
 
+    all_circles = set(synapse_graph.skeleton_ids[all_circles].tolist())
     skeleton_ids = tuple(all_circles - first_circle)
     return HttpResponse(json.dumps([skeleton_ids, _neuronnames(skeleton_ids, project_id)]))
 
@@ -107,52 +247,32 @@ def find_directed_paths(request, project_id=None):
 
     relations = _relations(cursor, project_id)
 
-    def next_level(skids, rel1, rel2):
-        cursor.execute('''
-        SELECT tc1.skeleton_id, tc2.skeleton_id
-        FROM treenode_connector tc1,
-             treenode_connector tc2
-        WHERE tc1.skeleton_id in (%s)
-          AND tc1.connector_id = tc2.connector_id
-          AND tc1.skeleton_id != tc2.skeleton_id
-          AND tc1.relation_id = %s
-          AND tc2.relation_id = %s
-        GROUP BY tc1.skeleton_id, tc2.skeleton_id
-        HAVING count(*) >= %s
-        ''' % (','.join(str(skid) for skid in skids),
-               rel1,
-               rel2,
-               min))
-        return cursor.fetchall()
+    synapse_graph = get_synapse_graph(project_id, relations, cursor)
+    skeleton_ids = synapse_graph.skeleton_ids
 
+    def add_edges(pre_index, post_index):
+        graph.add_edges_from(zip(skeleton_ids[pre_index].tolist(),
+                skeleton_ids[post_index].tolist()))
 
     # bidirectional search
     i = 0
     middle = path_length / 2
-    s1 = sources
-    t1 = targets
+    s1 = synapse_graph.indices(sources)
+    t1 = synapse_graph.indices(targets)
     graph = nx.DiGraph()
-    pre = relations['presynaptic_to']
-    post = relations['postsynaptic_to']
 
     while i <= middle:
         if 0 == len(s1):
             break
-        s2 = set()
-        for pre_skid, post_skid in next_level(s1, pre, post):
-            graph.add_edge(pre_skid, post_skid)
-            if not post_skid in s1:
-                s2.add(post_skid)
-        s1 = s2
+        pre_index, post_index = synapse_graph.expand(s1, min)
+        add_edges(pre_index, post_index)
+        s1 = np.setdiff1d(post_index, s1)
         i += 1
         if i < middle and len(t1) > 0:
-            t2 = set()
-            for post_skid, pre_skid in next_level(t1, post, pre):
-                graph.add_edge(pre_skid, post_skid)
-                if not pre_skid in t1:
-                    t2.add(pre_skid)
-            t1 = t2
- 
+            post_index, pre_index = synapse_graph.expand(t1, min, incoming=True)
+            add_edges(pre_index, post_index)
+            t1 = np.setdiff1d(pre_index, t1)
+
     # Nodes will not be in the graph if they didn't have further connections,
     # like for example will happen for placeholder skeletons e.g. at unmerged postsynaptic sites.
     all_paths = []
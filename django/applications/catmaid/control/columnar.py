@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import struct
+import numpy as np
+
+from datetime import datetime
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+
+# A binary, columnar response format, which can be requested from some
+# performance critical endpoints through the "format" parameter. Each response
+# consists of a fixed size preamble, a JSON header and a data section:
+#
+# - 8 bytes magic string "CATMAIDC"
+# - 4 bytes format version (unsigned little endian integer)
+# - 4 bytes length of the JSON header in bytes (unsigned little endian integer)
+# - UTF-8 encoded JSON header, padded with spaces to a multiple of 8 bytes
+# - Data section with one binary buffer per column
+#
+# The JSON header has the form {"tables": [table], "data": object}, with
+# "data" containing additional non-tabular data of the response. Each table
+# has the form {"name": string, "length": int, "columns": [column]} and each
+# column the form {"name": string, "dtype": string, "offset": int, "nbytes":
+# int}. The offset is relative to the beginning of the data section and always
+# a multiple of 8, which allows clients to create typed arrays on top of the
+# response buffer without copying data. Data types are NumPy type strings,
+# NULL values are encoded as -1 in integer columns and NaN in float columns.
+
+MAGIC = b'CATMAIDC'
+VERSION = 1
+ALIGNMENT = 8
+CONTENT_TYPE = 'application/octet-stream'
+
+# All supported response formats
+RESPONSE_FORMATS = ('json', 'binary')
+
+
+def get_request_format(request, default='json'):
+    """Read the requested response format from the "format" parameter of a GET
+    or POST request. Raise a ValueError if it isn't supported.
+    """
+    response_format = request.GET.get('format',
+            request.POST.get('format', default))
+    if response_format not in RESPONSE_FORMATS:
+        raise ValueError('Unknown response format: {}, expected one of: {}'.format(
+                response_format, ', '.join(RESPONSE_FORMATS)))
+    return response_format
+
+
+def to_epoch(value):
+    """Convert a datetime into seconds since the epoch. Numbers are returned
+    unchanged.
+    """
+    if isinstance(value, datetime):
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value, timezone.utc)
+        return (value - datetime(1970, 1, 1, tzinfo=timezone.utc)).total_seconds()
+    return value
+
+
+class Table(object):
+    """A named list of equally long NumPy arrays.
+    """
+
+    def __init__(self, name, columns):
+        self.name = name
+        self.columns = columns
+        self.length = len(columns[0][1]) if columns else 0
+
+    @classmethod
+    def from_rows(cls, name, rows, columns):
+        """Create a table from a sequence of row tuples. Each column is
+        defined by a tuple of the form (name, index, dtype). The index can be
+        either an integer index into each row or a callable, which gets the
+        row passed in. NULL values are replaced by -1 for integer and NaN for
+        float columns.
+        """
+        n = len(rows)
+        arrays = []
+        for col_name, index, dtype in columns:
+            dtype = np.dtype(dtype)
+            null_value = np.nan if dtype.kind == 'f' else -1
+            getter = index if callable(index) else (lambda r, i=index: r[i])
+            values = np.fromiter((null_value if v is None else v for v in
+                    (getter(r) for r in rows)), dtype=dtype, count=n)
+            arrays.append((col_name, values))
+        return cls(name, arrays)
+
+
+def _padding(n):
+    return (ALIGNMENT - n % ALIGNMENT) % ALIGNMENT
+
+
+def encode(tables, data=None):
+    """Return a generator of byte strings, which together form the binary
+    representation of the passed in tables and additional data.
+    """
+    table_meta = []
+    buffers = []
+    offset = 0
+    for table in tables:
+        column_meta = []
+        for col_name, values in table.columns:
+            # Make sure data is stored in little endian byte order
+            values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+            column_meta.append({
+                'name': col_name,
+                'dtype': values.dtype.str,
+                'offset': offset,
+                'nbytes': values.nbytes
+            })
+            buffers.append(values)
+            offset += values.nbytes + _padding(values.nbytes)
+        table_meta.append({
+            'name': table.name,
+            'length': table.length,
+            'columns': column_meta
+        })
+
+    header = json.dumps({
+        'tables': table_meta,
+        'data': data or {},
+    }, separators=(',', ':')).encode('utf-8')
+    header += b' ' * _padding(len(header))
+
+    yield MAGIC + struct.pack('<II', VERSION, len(header))
+    yield header
+    for values in buffers:
+        yield values.tobytes()
+        padding = _padding(values.nbytes)
+        if padding:
+            yield b'\x00' * padding
+
+
+def response(tables, data=None):
+    """Create a streaming HTTP response with the binary representation of the
+    passed in tables.
+    """
+    return StreamingHttpResponse(encode(tables, data), content_type=CONTENT_TYPE)
+
+
+def decode(content):
+    """Parse the binary representation of a response into a dictionary of the
+    form {"tables": {name: {column: array}}, "data": object}. This is mainly
+    useful for Python clients and tests.
+    """
+    if content[:len(MAGIC)] != MAGIC:
+        raise ValueError("Unknown binary format")
+    version, header_length = struct.unpack('<II', content[8:16])
+    if version != VERSION:
+        raise ValueError("Unsupported format version: {}".format(version))
+    header = json.loads(content[16:16 + header_length].decode('utf-8'))
+    data_start = 16 + header_length
+    tables = {}
+    for table in header['tables']:
+        columns = {}
+        for c in table['columns']:
+            start = data_start + c['offset']
+            columns[c['name']] = np.frombuffer(content[start:start + c['nbytes']],
+                    dtype=np.dtype(c['dtype']))
+        tables[table['name']] = columns
+    return {
+        'tables': tables,
+        'data': header['data']
+    }
@@ -5,10 +5,16 @@ import string
 import random
 import json
 import six
+import uuid
 
 from collections import defaultdict
+from time import time
 
 from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.http import HttpResponse
 
 from catmaid.fields import Double3D
@@ -281,45 +287,131 @@ def cursor_fetch_dictionary(cursor):
             for row in cursor.fetchall()
             ]
 
+# Process wide caches of relation and class name to ID maps, one map per
+# project. Relations and classes practically never change, but are looked up
+# by most requests. Each entry is a tuple of the map, its expiration time, the
+# version of the project's maps it was loaded with and the set of requested
+# names that weren't found in the loaded map. Maps are dropped by
+# post_save and post_delete signals of the respective models and expire after
+# ID_MAP_CACHE_TIMEOUT seconds. If ID_MAP_CACHE is set, the signal handlers
+# also change the version of the project's maps in this shared cache, which
+# makes other processes reload them.
+_relation_id_maps = {}
+_class_id_maps = {}
+
+ID_MAP_VERSION_KEY = 'catmaid-id-maps:{}'
+
+
+def get_id_map_version_cache():
+    """Return the cache configured for versions of ID maps or None if ID maps
+    are only invalidated within a process.
+    """
+    cache_name = getattr(settings, 'ID_MAP_CACHE', None)
+    return caches[cache_name] if cache_name else None
+
+
+def _get_id_map_version(project_id):
+    version_cache = get_id_map_version_cache()
+    if not version_cache:
+        return None
+    key = ID_MAP_VERSION_KEY.format(project_id)
+    version = version_cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not version_cache.add(key, version, None):
+            version = version_cache.get(key)
+    return version
+
+
+def _get_id_map(id_maps, project_id, name_constraints, fetch):
+    """Return a (constrained) copy of the cached ID map of a project. If the
+    map isn't cached yet, is expired or outdated or if a requested name is
+    missing (e.g. because it was created in another process), it is loaded
+    with <fetch>. Names that are still missing afterwards are remembered with
+    the map, so that they don't cause reloads until the map is outdated.
+    """
+    project_id = int(project_id)
+    version = _get_id_map_version(project_id)
+    now = time()
+    entry = id_maps.get(project_id)
+    if entry is None or entry[1] < now or entry[2] != version or \
+            (name_constraints and any(name not in entry[0] and
+                name not in entry[3] for name in name_constraints)):
+        id_map = fetch(project_id)
+        missing = set()
+        id_maps[project_id] = (id_map, now + getattr(settings,
+                'ID_MAP_CACHE_TIMEOUT', 60), version, missing)
+    else:
+        id_map, missing = entry[0], entry[3]
+    if name_constraints:
+        missing.update(name for name in name_constraints if name not in id_map)
+        return {name: id_map[name] for name in name_constraints if name in id_map}
+    return dict(id_map)
+
+
 def get_relation_to_id_map(project_id, name_constraints=None, cursor=None):
     """
     Return a mapping of relation names to relation IDs. If a list of names is
     provided, only relations with those names will be included. If a cursor is
-    provided, this cursor will be used.
+    provided, this cursor will be used. Results are cached per project.
     """
-    if cursor:
-        query = "SELECT relation_name, id  FROM relation WHERE project_id = %s"
-        params = [int(project_id)]
-        if name_constraints:
-            query += " AND (%s)" % ' OR '.join(('relation_name = %s',) * len(name_constraints))
-            params += (name_constraints)
-        cursor.execute(query, params)
-        return dict(cursor.fetchall())
-    else:
-        query = Relation.objects.filter(project=project_id)
-        if name_constraints:
-            query = query.filter(relation_name__in=name_constraints)
-        return {rname: ID for rname, ID in query.values_list("relation_name", "id")}
+    def fetch(project_id):
+        if cursor:
+            cursor.execute("SELECT relation_name, id FROM relation WHERE project_id = %s",
+                    (project_id,))
+            return dict(cursor.fetchall())
+        return dict(Relation.objects.filter(project=project_id).values_list(
+                "relation_name", "id"))
+
+    return _get_id_map(_relation_id_maps, project_id, name_constraints, fetch)
 
 def get_class_to_id_map(project_id, name_constraints=None, cursor=None):
     """
     Return a mapping of class names to relation IDs. If a list of names is
     provided, only classes with those names will be included. If a cursor is
-    provided, this cursor will be used.
+    provided, this cursor will be used. Results are cached per project.
     """
-    if cursor:
-        query = "SELECT class_name, id  FROM class WHERE project_id = %s"
-        params = [int(project_id)]
-        if name_constraints:
-            query += " AND (%s)" % ' OR '.join(('class_name = %s',) * len(name_constraints))
-            params += (name_constraints)
-        cursor.execute(query, params)
-        return dict(cursor.fetchall())
-    else:
-        query = Class.objects.filter(project=project_id)
-        if name_constraints:
-            query = query.filter(class_name__in=name_constraints)
-        return {cname: ID for cname, ID in query.values_list("class_name", "id")}
+    def fetch(project_id):
+        if cursor:
+            cursor.execute("SELECT class_name, id FROM class WHERE project_id = %s",
+                    (project_id,))
+            return dict(cursor.fetchall())
+        return dict(Class.objects.filter(project=project_id).values_list(
+                "class_name", "id"))
+
+    return _get_id_map(_class_id_maps, project_id, name_constraints, fetch)
+
+def clear_id_map_caches(project_id=None):
+    """Remove the cached relation and class ID maps of a project or of all
+    projects, if no project ID is passed in.
+    """
+    for id_maps in (_relation_id_maps, _class_id_maps):
+        if project_id is None:
+            id_maps.clear()
+        else:
+            id_maps.pop(int(project_id), None)
+
+@receiver(post_save, sender=Relation)
+@receiver(post_delete, sender=Relation)
+@receiver(post_save, sender=Class)
+@receiver(post_delete, sender=Class)
+def invalidate_id_map_cache(sender, instance, **kwargs):
+    """Drop cached ID maps of the changed project. This is done again after
+    the transaction is committed, so that no map that includes uncommitted
+    or rolled back data remains cached.
+    """
+    id_maps = _relation_id_maps if sender == Relation else _class_id_maps
+    project_id = instance.project_id
+
+    def invalidate():
+        id_maps.pop(project_id, None)
+        version_cache = get_id_map_version_cache()
+        if version_cache:
+            version_cache.set(ID_MAP_VERSION_KEY.format(project_id),
+                    uuid.uuid4().hex, None)
+
+    invalidate()
+    transaction.on_commit(invalidate)
 
 def urljoin(a, b):
     """ Joins to URL parts a and b while making sure this
@@ -21,6 +21,7 @@ from catmaid.models import Project, Stack, ProjectStack, Connector, \
         ConnectorClassInstance, Treenode, TreenodeConnector, UserRole
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
 from catmaid.control.link import create_treenode_links
+from catmaid.control.node import invalidate_node_list_cache
 from catmaid.control.common import cursor_fetch_dictionary, \
         get_relation_to_id_map, get_request_list
 
@@ -435,6 +436,8 @@ def create_connector(request, project_id=None):
     else:
         created_links = []
 
+    invalidate_node_list_cache(project_id, [new_connector.id], cursor=cursor)
+
     return JsonResponse({
         'connector_id': new_connector.id,
         'connector_edition_time': new_connector.edition_time,
@@ -468,6 +471,7 @@ def delete_connector(request, project_id=None):
         'confidence': p.confidence,
         'link_id': p.id
     } for p in connector.treenodeconnector_set.all()]
+    invalidate_node_list_cache(project_id, [connector_id], cursor=cursor)
     connector.delete()
     return JsonResponse({
         'message': 'Removed connector and class_instances',
@@ -9,6 +9,7 @@ from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from django.contrib.auth.decorators import login_required
 
+from catmaid.metrics import count_cache_access
 from catmaid.models import Stack, Project, ProjectStack, Message, User
 from catmaid.control.common import id_generator, json_error_response
 
@@ -20,9 +21,17 @@ except ImportError:
     # Python 2
     from urllib2 import urlopen, HTTPError, URLError
 
+import numpy as np
 import requests
 import os.path
 import glob
+import six
+import struct
+import threading
+from collections import OrderedDict
+from fractions import Fraction
+from multiprocessing.pool import ThreadPool
+from six import BytesIO
 from time import time
 from math import cos, sin, radians
 
@@ -38,6 +47,13 @@ except ImportError:
     logger.warning("CATMAID was unable to load the pgmagick module. "
         "Cropping will not be available")
 
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+    logger.warning("CATMAID was unable to load the PIL/pillow library. "
+        "Cropping will use pgmagick to composite images.")
+
 from celery.task import task
 
 # Prefix for stored microstacks
@@ -52,11 +68,12 @@ class CropJob:
     """ A small container class to keep information about the cropping
     job to be done. Stack ids can be passed as single integer, a list of
     integers. If no output_path is given, a random one (based on the
-    settings) is generated.
+    settings) is generated. Tile requests are recorded in tile_stats, which
+    can be shared by multiple jobs.
     """
     def __init__(self, user, project_id, stack_ids, x_min, x_max, y_min, y_max,
                  z_min, z_max, rotation_cw, zoom_level, single_channel=False,
-                 output_path=None):
+                 output_path=None, tile_stats=None):
         self.user = user
         self.project_id = int(project_id)
         self.project = get_object_or_404(Project, pk=project_id)
@@ -85,6 +102,7 @@ class CropJob:
             output_path = os.path.join(crop_output_path, file_name)
         self.single_channel = single_channel
         self.output_path = output_path
+        self.tile_stats = TileStats() if tile_stats is None else tile_stats
         # State that extra initialization is needed
         self.needs_initialization = True
 
@@ -93,20 +111,29 @@ class CropJob:
         to the tiles of the stacks used. It needs to be called from the
         process that actually does the cropping (e.g. a celery task), because
         serializing function pointers isn't allowed. This would be needed if
-        this was done in the constructor of the job.
+        this was done in the constructor of the job. The tile fetcher of the
+        process, the mirror used for each stack and each stack's translation
+        are looked up here as well.
         """
+        self.tile_fetcher = get_tile_fetcher()
         # Setup tile source specific path creation functions for each stack
         self.stack_specific_path_getters = {}
+        self.stack_mirrors = {}
+        self.stack_translations = {}
         for s in self.stacks:
-            if s.tile_source_type == 1:
+            mirror = s.stackmirror_set.all()[0]
+            if mirror.tile_source_type == 1:
                 getter = self.get_tile_path_1
-            elif s.tile_source_type == 4:
+            elif mirror.tile_source_type == 4:
                 getter = self.get_tile_path_4
-            elif s.tile_source_type == 5:
+            elif mirror.tile_source_type == 5:
                 getter = self.get_tile_path_5
             else:
                 getter = self.get_tile_path_unavailable
             self.stack_specific_path_getters[s.id] = getter
+            self.stack_mirrors[s.id] = mirror
+            self.stack_translations[s.id] = ProjectStack.objects.get(
+                    project_id=self.project_id, stack_id=s.id).translation
         # Attach actual path getter
         self.get_tile_path = self.get_tile_path_initialized
         # Initialization is done
@@ -123,7 +150,7 @@ class CropJob:
         """ This method will be used when get_tile_path is called after the crop
         job has been initialized.
         """
-        return self.stack_specific_path_getters[stack.id](mirror, tile_coords)
+        return self.stack_specific_path_getters[mirror.stack_id](mirror, tile_coords)
 
     def get_tile_path_1(self, mirror, tile_coords):
         """ Creates the full path to the tile at the specified coordinate index
@@ -177,6 +204,154 @@ class ImageRetrievalError(IOError):
         self.path = path
         self.error = error
 
+class TileStats:
+    """ Counts how many tiles (and Bytes) a job fetched and how many of them
+    were found in the tile cache.
+    """
+    def __init__(self):
+        self.fetched = 0
+        self.cache_hits = 0
+        self.bytes_fetched = 0
+        self.bytes_from_cache = 0
+
+    def add(self, n_bytes, from_cache):
+        count_cache_access('tiles', from_cache)
+        if from_cache:
+            self.cache_hits += 1
+            self.bytes_from_cache += n_bytes
+        else:
+            self.fetched += 1
+            self.bytes_fetched += n_bytes
+
+    def as_dict(self):
+        return {
+            'fetched': self.fetched,
+            'cache_hits': self.cache_hits,
+            'bytes_fetched': self.bytes_fetched,
+            'bytes_from_cache': self.bytes_from_cache,
+        }
+
+    def __str__(self):
+        return "%s tiles fetched (%s Bytes), %s tiles read from cache " \
+                "(%s Bytes)" % (self.fetched, self.bytes_fetched,
+                self.cache_hits, self.bytes_from_cache)
+
+class TileCache:
+    """ A thread safe LRU cache of encoded tile data, which is keyed by tile
+    URL. The least recently used tiles are evicted once the cached data
+    exceeds max_bytes.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        with self._lock:
+            data = self._tiles.pop(url, None)
+            if data is not None:
+                # Mark as most recently used
+                self._tiles[url] = data
+            return data
+
+    def add(self, url, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old_data = self._tiles.pop(url, None)
+            if old_data is not None:
+                self.size -= len(old_data)
+            self._tiles[url] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted_data = self._tiles.popitem(last=False)
+                self.size -= len(evicted_data)
+
+class TileFetcher:
+    """ Fetches tiles concurrently with a bounded pool of threads, which share
+    a pool of keep-alive HTTP connections and a tile cache.
+    """
+    def __init__(self, max_workers=8, cache_size=268435456, timeout=30):
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.cache = TileCache(cache_size)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+                pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # The thread pool is created when it is needed first
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def download(self, url):
+        """ Retrieve the data of a single tile without using the cache.
+        """
+        if url.startswith('http://') or url.startswith('https://'):
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except requests.RequestException as e:
+                raise ImageRetrievalError(url, str(e))
+            if response.status_code >= 400:
+                raise ImageRetrievalError(url, "Error code: %s" % response.status_code)
+            return response.content
+        # Other URLs, e.g. local files, are opened directly
+        try:
+            return urlopen(url).read()
+        except HTTPError as e:
+            raise ImageRetrievalError(url, "Error code: %s" % e.code)
+        except URLError as e:
+            raise ImageRetrievalError(url, e.reason)
+
+    def fetch(self, url):
+        """ Return the data of a tile and whether it was read from the cache.
+        """
+        data = self.cache.get(url)
+        if data is not None:
+            return data, True
+        data = self.download(url)
+        self.cache.add(url, data)
+        return data, False
+
+    def fetch_all(self, urls, stats=None):
+        """ Fetch all passed in tiles concurrently and return a dictionary of
+        URL vs tile data. Optionally, record all requests in a TileStats
+        object.
+        """
+        unique_urls = list(OrderedDict.fromkeys(urls))
+        if len(unique_urls) > 1 and self.max_workers > 1:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ThreadPool(self.max_workers)
+            results = self._pool.map(self.fetch, unique_urls)
+        else:
+            results = [self.fetch(url) for url in unique_urls]
+
+        tiles = {}
+        for url, (data, from_cache) in zip(unique_urls, results):
+            tiles[url] = data
+            if stats is not None:
+                stats.add(len(data), from_cache)
+        return tiles
+
+_tile_fetcher = None
+_tile_fetcher_lock = threading.Lock()
+
+def get_tile_fetcher():
+    """ Return the tile fetcher that is shared by all crop and export jobs of
+    this process. It is configured by the TILE_FETCH_WORKERS,
+    TILE_FETCH_TIMEOUT and TILE_CACHE_SIZE settings.
+    """
+    global _tile_fetcher
+    with _tile_fetcher_lock:
+        if _tile_fetcher is None:
+            _tile_fetcher = TileFetcher(
+                    getattr(settings, 'TILE_FETCH_WORKERS', 8),
+                    getattr(settings, 'TILE_CACHE_SIZE', 268435456),
+                    getattr(settings, 'TILE_FETCH_TIMEOUT', 30))
+    return _tile_fetcher
+
 class ImagePart:
     """ A part of a 2D image where height and width are not necessarily
     of the same size. Provides readout of the defined sub-area of the image.
@@ -197,16 +372,11 @@ class ImagePart:
             raise ValueError( "An image part must have an area, hence no " \
                     "extent should be zero!" )
 
-    def get_image( self ):
-        # Open the image
-        try:
-            img_file = urlopen( self.path )
-            img_data = img_file.read()
-            bytes_read = len(img_data)
-        except HTTPError as e:
-            raise ImageRetrievalError(self.path, "Error code: %s" % e.code)
-        except URLError as e:
-            raise ImageRetrievalError(self.path, e.reason)
+    def get_image( self, img_data=None ):
+        # Fetch the image, unless its data has been passed in already
+        if img_data is None:
+            img_data, _ = get_tile_fetcher().fetch( self.path )
+        bytes_read = len(img_data)
 
         blob = Blob( img_data )
         image = Image( blob )
@@ -251,6 +421,26 @@ def to_z_index( z, job, enforce_bounds=True ):
         section = min(max(section, 0.0), job.ref_stack.dimension.z - 1.0)
     return int( section )
 
+def get_imagej_description( job, n_images ):
+    """ Returns ImageJ specific meta data to allow easy embedding of units and
+    display options for an image with n_images pages.
+    """
+    ij_version= "1.45p"
+    unit = "nm"
+    newline = "\n"
+
+    # sample with (the actual is a line break instead of a .):
+    # ImageJ=1.45p.images={0}.channels=1.slices=2.hyperstack=true.mode=color.unit=micron.finterval=1.spacing=1.5.loop=false.min=0.0.max=4095.0.
+    ij_data = "ImageJ={1}{0}unit={2}{0}".format( newline, ij_version, unit)
+    if n_images > 1:
+        n_channels = len(job.stacks)
+        if n_images % n_channels != 0:
+            raise ValueError( "Meta data creation: the number of images " \
+                    "modulo the channel count is not zero" )
+        n_slices = n_images // n_channels
+        ij_data += "images={1}{0}channels={2}{0}slices={3}{0}hyperstack=true{0}mode=color{0}".format( newline, str(n_images), str(n_channels), str(n_slices) )
+    return ij_data
+
 def addMetaData( path, job, result ):
     """ Use this method to add meta data to the image. Due to a bug in
     exiv2, its python wrapper pyexiv2 is of no use to us. This bug
@@ -271,20 +461,7 @@ def addMetaData( path, job, result ):
     # ImageJ specific meta data to allow easy embedding of units and
     # display options.
     n_images = len( result )
-    ij_version= "1.45p"
-    unit = "nm"
-    newline = "\n"
-
-    # sample with (the actual is a line break instead of a .):
-    # ImageJ=1.45p.images={0}.channels=1.slices=2.hyperstack=true.mode=color.unit=micron.finterval=1.spacing=1.5.loop=false.min=0.0.max=4095.0.
-    ij_data = "ImageJ={1}{0}unit={2}{0}".format( newline, ij_version, unit)
-    if n_images > 1:
-        n_channels = len(job.stacks)
-        if n_images % n_channels != 0:
-            raise ValueError( "Meta data creation: the number of images " \
-                    "modulo the channel count is not zero" )
-        n_slices = n_images / n_channels
-        ij_data += "images={1}{0}channels={2}{0}slices={3}{0}hyperstack=true{0}mode=color{0}".format( newline, str(n_images), str(n_channels), str(n_slices) )
+    ij_data = get_imagej_description( job, n_images )
     ij_args = "-EXIF:ImageDescription=\"{0}\"".format( ij_data )
 
     # Information about the software used
@@ -415,21 +592,18 @@ def extract_substack( job ):
 
     return cropped_stack
 
-def extract_substack_no_rotation( job ):
-    """ Extracts a sub-stack as specified in the passed job without respecting
-    rotation requests. A list of pgmagick images is returned -- one for each
-    slice, starting on top.
+def get_stack_bounding_boxes( job ):
+    """ Returns a dictionary of stack ID vs. the pixel bounding box of the
+    job in this stack.
     """
-
     # The actual bounding boxes used for creating the images of each stack
     # depend not only on the request, but also on the translation of the stack
     # wrt. the project. Therefore, a dictionary with bounding box information for
     # each stack is created.
     s_to_bb = {}
     for stack in job.stacks:
-        # Retrieve translation relative to current project
-        translation = ProjectStack.objects.get(
-                project_id=job.project_id, stack_id=stack.id).translation
+        # Translation relative to current project
+        translation = job.stack_translations[stack.id]
         x_min_t = job.x_min - translation.x
         x_max_t = job.x_max - translation.x
         y_min_t = job.y_min - translation.y
@@ -471,6 +645,16 @@ def extract_substack_no_rotation( job ):
         bb.height = height
         s_to_bb[stack.id] = bb
 
+    return s_to_bb
+
+def extract_substack_no_rotation( job ):
+    """ Extracts a sub-stack as specified in the passed job without respecting
+    rotation requests. A list of pgmagick images is returned -- one for each
+    slice, starting on top.
+    """
+
+    s_to_bb = get_stack_bounding_boxes( job )
+
     # Get number of wanted slices
     px_z_min = to_z_index(job.z_min, job)
     px_z_max = to_z_index(job.z_max, job)
@@ -487,8 +671,11 @@ def extract_substack_no_rotation( job ):
     estimated_total_size = 0
     # Iterate over all slices
     for nz in range(n_slices):
+        # Define the image parts of all stacks (channels) first, so that all
+        # tiles of a slice can be fetched at once.
+        stack_image_parts = []
         for stack in job.stacks:
-            mirror = s.stackmirror_set.filter(position=0)[0]
+            mirror = job.stack_mirrors[stack.id]
             bb = s_to_bb[stack.id]
             # Shortcut for tile width and height
             tile_width = mirror.tile_width
@@ -537,12 +724,20 @@ def extract_substack_no_rotation( job ):
                 # Update x component of destination position
                 x_dst += cur_px_x_max - cur_px_x_min
 
+            stack_image_parts.append((bb, image_parts))
+
+        # Fetch all tiles of this slice concurrently
+        tiles = job.tile_fetcher.fetch_all([ip.path
+                for bb, image_parts in stack_image_parts
+                for ip in image_parts], job.tile_stats)
+
+        for bb, image_parts in stack_image_parts:
             # Write out the image parts and make sure the maximum allowed file
             # size isn't exceeded.
             cropped_slice = None
             for ip in image_parts:
                 # Get (correctly cropped) image
-                image = ip.get_image()
+                image = ip.get_image(tiles[ip.path])
 
                 # Estimate total file size and abort if this exceeds the
                 # maximum allowed file size.
@@ -578,6 +773,291 @@ def extract_substack_no_rotation( job ):
 
     return cropped_stack
 
+def use_numpy_backend():
+    """ Whether crop jobs should be composited with NumPy rather than
+    pgmagick. This is configured by the CROPPING_BACKEND setting and requires
+    pillow to decode tiles.
+    """
+    backend = getattr(settings, 'CROPPING_BACKEND', 'numpy')
+    return backend == 'numpy' and PILImage is not None
+
+def tile_ranges( px_min, px_max, tile_size ):
+    """ Yields a tuple (tile index, first pixel in tile, last pixel in tile
+    (exclusive), offset in result) for every tile that is needed to cover the
+    pixel range [px_min, px_max).
+    """
+    if px_max <= px_min:
+        return
+    for t in range(px_min // tile_size, (px_max - 1) // tile_size + 1):
+        start = max(px_min, t * tile_size)
+        end = min(px_max, (t + 1) * tile_size)
+        yield t, start - t * tile_size, end - t * tile_size, start - px_min
+
+def decode_tile( data, mode=None ):
+    """ Decodes the passed in encoded tile data into a NumPy array. If mode is
+    "L", the result is a 2D gray scale array, "R" returns only the red channel
+    as 2D array and "RGB" a 3D array with the color channels in the last
+    dimension. Without a mode, gray scale tiles are returned as 2D and all
+    others as RGB arrays.
+    """
+    image = PILImage.open( BytesIO( data ) )
+    if mode == "R":
+        if image.mode != "L":
+            return np.asarray( image.convert("RGB") )[:, :, 0]
+    elif mode == "L" or (mode is None and image.mode == "L"):
+        if image.mode != "L":
+            image = image.convert("L")
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.asarray( image )
+
+def extract_substack_array_no_rotation( job ):
+    """ Extracts a sub-stack as specified in the passed job without respecting
+    rotation requests. A (z, c, y, x) uint8 array is returned, each stack is
+    represented by one channel or, if its tiles have colors, by three
+    consecutive channels. If no part of the stacks is within the job's
+    bounding box, None is returned.
+    """
+    s_to_bb = get_stack_bounding_boxes( job )
+
+    # Get number of wanted slices
+    px_z_min = to_z_index(job.z_min, job)
+    px_z_max = to_z_index(job.z_max, job)
+    n_slices = px_z_max + 1 - px_z_min
+    n_stacks = len(job.stacks)
+    width = max(bb.width for bb in six.itervalues(s_to_bb))
+    height = max(bb.height for bb in six.itervalues(s_to_bb))
+
+    def check_size(n_samples):
+        size = n_slices * n_stacks * n_samples * width * height
+        if size > settings.GENERATED_FILES_MAXIMUM_SIZE:
+            raise ValueError("The size of the requested image region is "
+                             "larger than the maximum allowed file size: "
+                             "%s > %s Bytes" % (size,
+                             settings.GENERATED_FILES_MAXIMUM_SIZE))
+
+    # Fail early, before any tile is fetched
+    check_size(1)
+
+    # The buffer is allocated when the first tile has been decoded and the
+    # number of color channels is known.
+    result = None
+    mode = "R" if job.single_channel else None
+    n_samples = 1
+    for nz in range(n_slices):
+        # Collect all tile parts of this slice in all stacks, so that their
+        # tiles can be fetched at once.
+        parts = []
+        for c, stack in enumerate(job.stacks):
+            mirror = job.stack_mirrors[stack.id]
+            bb = s_to_bb[stack.id]
+            z = bb.px_z_min + nz
+            x_tiles = list(tile_ranges(bb.px_x_min, bb.px_x_max, mirror.tile_width))
+            y_tiles = list(tile_ranges(bb.px_y_min, bb.px_y_max, mirror.tile_height))
+            for x, x_start, x_end, x_dst in x_tiles:
+                for y, y_start, y_end, y_dst in y_tiles:
+                    path = job.get_tile_path(mirror, (x, y, z))
+                    parts.append((c, path, x_start, x_end, y_start, y_end,
+                            bb.px_x_offset + x_dst, bb.px_y_offset + y_dst))
+
+        tiles = job.tile_fetcher.fetch_all([p[1] for p in parts], job.tile_stats)
+
+        for c, path, x_start, x_end, y_start, y_end, x_dst, y_dst in parts:
+            tile = decode_tile(tiles[path], mode)
+            if result is None:
+                # All other tiles are decoded like the first one
+                n_samples = 3 if tile.ndim == 3 else 1
+                mode = mode or ("RGB" if 3 == n_samples else "L")
+                check_size(n_samples)
+                result = np.zeros((n_slices, n_stacks * n_samples, height, width),
+                        dtype=np.uint8)
+            # Tiles at the stack border can be smaller than the tile size
+            part = tile[y_start:y_end, x_start:x_end]
+            part_height, part_width = part.shape[:2]
+            if 0 == part_height or 0 == part_width:
+                continue
+            target = result[nz, c * n_samples:(c + 1) * n_samples,
+                    y_dst:y_dst + part_height, x_dst:x_dst + part_width]
+            if 3 == n_samples:
+                target[:] = np.rollaxis(part, 2)
+            else:
+                target[0] = part
+
+    return result
+
+def rotate_array( stack, rotation_cw, width, height ):
+    """ Rotates every image of a (z, c, y, x) array counter-clockwise by
+    rotation_cw degrees around its center, like the rotation done by
+    extract_substack(). The result has the passed in width and height and is
+    resampled with bilinear interpolation, pixels outside the source are
+    black.
+    """
+    n_z, n_c, src_height, src_width = stack.shape
+    # For each target pixel, find its source location by rotating it back
+    # (i.e. clockwise) around the center.
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float64)
+    u = xs - (width - 1) * 0.5
+    v = ys - (height - 1) * 0.5
+    angle = radians(rotation_cw)
+    src_x = (src_width - 1) * 0.5 + u * cos(angle) - v * sin(angle)
+    src_y = (src_height - 1) * 0.5 + u * sin(angle) + v * cos(angle)
+
+    # Allow for rounding errors at the border
+    eps = 1e-6
+    inside = (src_x >= -eps) & (src_x <= src_width - 1 + eps) & \
+             (src_y >= -eps) & (src_y <= src_height - 1 + eps)
+    x0 = np.clip(np.floor(src_x).astype(np.int64), 0, max(src_width - 2, 0))
+    y0 = np.clip(np.floor(src_y).astype(np.int64), 0, max(src_height - 2, 0))
+    x1 = np.minimum(x0 + 1, src_width - 1)
+    y1 = np.minimum(y0 + 1, src_height - 1)
+    fx = np.clip(src_x - x0, 0, 1)
+    fy = np.clip(src_y - y0, 0, 1)
+
+    result = np.zeros((n_z, n_c, height, width), dtype=np.uint8)
+    for z in range(n_z):
+        for c in range(n_c):
+            image = stack[z, c].astype(np.float32)
+            top = image[y0, x0] * (1 - fx) + image[y0, x1] * fx
+            bottom = image[y1, x0] * (1 - fx) + image[y1, x1] * fx
+            rotated = top * (1 - fy) + bottom * fy
+            result[z, c] = np.where(inside, np.rint(rotated), 0).astype(np.uint8)
+    return result
+
+def extract_substack_array( job ):
+    """ Extracts a sub-stack as specified in the passed job while respecting
+    rotation requests. A (z, c, y, x) uint8 array is returned (see
+    extract_substack_array_no_rotation()) or None if the job's bounding box
+    is outside of all stacks.
+    """
+    # Make sure tile source getters have been initialized on the job
+    if job.needs_initialization:
+        job.initialize()
+
+    # Multiples of 90 degree are simple rotations of the cropped stack
+    for n_rotations, angle in enumerate((0.0, 90.0, 180.0, 270.0)):
+        if abs(job.rotation_cw - angle) < 0.00001:
+            cropped_stack = extract_substack_array_no_rotation( job )
+            if cropped_stack is None or 0 == n_rotations:
+                return cropped_stack
+            return np.rot90(cropped_stack, n_rotations, axes=(2, 3))
+
+    # Otherwise, crop the bounding box of the rotated box and resample the
+    # rotated box from it.
+    real_x_min = job.x_min
+    real_x_max = job.x_max
+    real_y_min = job.y_min
+    real_y_max = job.y_max
+    width = to_x_index(real_x_max, job, False) - to_x_index(real_x_min, job, False)
+    height = to_y_index(real_y_max, job, False) - to_y_index(real_y_min, job, False)
+    center = [0.5 * (job.x_max + job.x_min),
+        0.5 * (job.y_max + job.y_min)]
+    corners = [rotate2d(360.0 - job.rotation_cw, p, center) for p in (
+        [real_x_min, real_y_min], [real_x_min, real_y_max],
+        [real_x_max, real_y_max], [real_x_max, real_y_min])]
+    try:
+        job.x_min = min(p[0] for p in corners)
+        job.y_min = min(p[1] for p in corners)
+        job.x_max = max(p[0] for p in corners)
+        job.y_max = max(p[1] for p in corners)
+        cropped_stack = extract_substack_array_no_rotation( job )
+    finally:
+        # Reset the original job parameters
+        job.x_min = real_x_min
+        job.x_max = real_x_max
+        job.y_min = real_y_min
+        job.y_max = real_y_max
+
+    if cropped_stack is None:
+        return None
+    return rotate_array(cropped_stack, job.rotation_cw, width, height)
+
+def get_pages( job, cropped_stack ):
+    """ Returns the images of a (z, c, y, x) array in XYCZ order, i.e. the
+    images of all stacks of a slice, followed by the next slice. Images are
+    2D arrays or, if they have colors, (y, x, 3) arrays.
+    """
+    n_samples = cropped_stack.shape[1] // len(job.stacks)
+    pages = []
+    for z in range(cropped_stack.shape[0]):
+        for c in range(len(job.stacks)):
+            image = cropped_stack[z, c * n_samples:(c + 1) * n_samples]
+            pages.append(image[0] if 1 == n_samples else
+                    np.transpose(image, (1, 2, 0)))
+    return pages
+
+def write_tiff( path, job, pages ):
+    """ Writes the passed in images (2D or (y, x, 3) uint8 arrays) as
+    uncompressed multi-page TIFF file. Resolution and ImageJ meta data are
+    added along the way, which makes the post-processing of addMetaData()
+    unnecessary.
+    """
+    # Resolution in pixel per nanometer, the stack resolution refers to zoom
+    # level zero.
+    res_x = Fraction(1.0 / (job.ref_stack.resolution.x * 2**job.zoom_level)) \
+            .limit_denominator(2**16)
+    res_y = Fraction(1.0 / (job.ref_stack.resolution.y * 2**job.zoom_level)) \
+            .limit_denominator(2**16)
+    description = get_imagej_description(job, len(pages)).encode('ascii') + b'\0'
+    software = b"Created with CATMAID\0"
+
+    with open(path, 'wb') as f:
+        # Little endian header, the first IFD follows directly
+        f.write(struct.pack('<2sHI', b'II', 42, 8))
+        for n, page in enumerate(pages):
+            page = np.ascontiguousarray(page, dtype=np.uint8)
+            height, width = page.shape[:2]
+            n_samples = page.shape[2] if page.ndim == 3 else 1
+            # Collect tags as (tag, type, count, value or data), values that
+            # don't fit into four bytes are stored after the IFD.
+            tags = [
+                (254, 4, 1, 0),
+                (256, 4, 1, width),
+                (257, 4, 1, height),
+                (258, 3, n_samples, 8 if 1 == n_samples else
+                    struct.pack('<%sH' % n_samples, *([8] * n_samples))),
+                (259, 3, 1, 1),
+                (262, 3, 1, 1 if 1 == n_samples else 2),
+                (270, 2, len(description), description),
+                (273, 4, 1, None),
+                (277, 3, 1, n_samples),
+                (278, 4, 1, height),
+                (279, 4, 1, page.nbytes),
+                (282, 5, 1, struct.pack('<2I', res_x.numerator, res_x.denominator)),
+                (283, 5, 1, struct.pack('<2I', res_y.numerator, res_y.denominator)),
+                (284, 3, 1, 1),
+                (296, 3, 1, 1),
+                (305, 2, len(software), software),
+            ]
+            ifd_offset = f.tell()
+            data_offset = ifd_offset + 2 + 12 * len(tags) + 4
+            extra_data = []
+            for tag, tag_type, count, value in tags:
+                if isinstance(value, bytes):
+                    # Offsets have to be on word boundaries
+                    extra_data.append(value + b'\0' * (len(value) % 2))
+                    data_offset += len(extra_data[-1])
+            image_offset = data_offset
+            next_ifd_offset = 0 if n == len(pages) - 1 else \
+                    image_offset + page.nbytes + page.nbytes % 2
+
+            f.write(struct.pack('<H', len(tags)))
+            extra_offset = ifd_offset + 2 + 12 * len(tags) + 4
+            for tag, tag_type, count, value in tags:
+                if tag == 273:
+                    value = image_offset
+                if isinstance(value, bytes):
+                    f.write(struct.pack('<HHII', tag, tag_type, count, extra_offset))
+                    extra_offset += len(value) + len(value) % 2
+                elif tag_type == 3:
+                    f.write(struct.pack('<HHIHH', tag, tag_type, count, value, 0))
+                else:
+                    f.write(struct.pack('<HHII', tag, tag_type, count, value))
+            f.write(struct.pack('<I', next_ifd_offset))
+            for value in extra_data:
+                f.write(value)
+            f.write(page.tobytes())
+            f.write(b'\0' * (page.nbytes % 2))
+
 def rotate2d(degrees, point, origin):
     """ A rotation function that rotates a point counter-clockwise around
     a point. To rotate around the origin use [0,0].
@@ -598,23 +1078,33 @@ def process_crop_job(job, create_message=True):
     and the creation of the sub-stack. It can be executed as Celery task.
     """
     try:
-        # Create the sub-stack
-        cropped_stack = extract_substack( job )
-
-        # Create tho output image
-        outputImage = ImageList()
-        for img in cropped_stack:
-            outputImage.append( img )
-
-        # Save the resulting micro_stack to a temporary location
         no_error_occured = True
         error_message = ""
-        # Only produce an image if parts of stacks are within the output
-        if len( cropped_stack ) > 0:
-            outputImage.writeImages( job.output_path )
-            # Add some meta data to the image
-            addMetaData( job.output_path, job, cropped_stack )
+        if use_numpy_backend():
+            # Create the sub-stack and write it, including its meta data, in
+            # one pass.
+            cropped_stack = extract_substack_array( job )
+            if cropped_stack is not None:
+                write_tiff( job.output_path, job, get_pages( job, cropped_stack ) )
         else:
+            # Create the sub-stack
+            cropped_stack = extract_substack( job )
+
+            # Create tho output image
+            outputImage = ImageList()
+            for img in cropped_stack:
+                outputImage.append( img )
+
+            # Save the resulting micro_stack to a temporary location, but only
+            # produce an image if parts of stacks are within the output
+            if len( cropped_stack ) > 0:
+                outputImage.writeImages( job.output_path )
+                # Add some meta data to the image
+                addMetaData( job.output_path, job, cropped_stack )
+            else:
+                cropped_stack = None
+
+        if cropped_stack is None:
             no_error_occured = False
             error_message = "A region outside the stack has been selected. " \
                     "Therefore, no image was produced."
@@ -625,6 +1115,8 @@ def process_crop_job(job, create_message=True):
         if os.path.exists( job.output_path ):
             os.remove( job.output_path )
 
+    logger.info("Crop job %s: %s" % (job.output_path, job.tile_stats))
+
     if create_message:
         # Create a notification message
         bb_text = "( %s, %s, %s ) -> ( %s, %s, %s )" % (job.x_min, job.y_min, \
@@ -638,8 +1130,8 @@ def process_crop_job(job, create_message=True):
             url = os.path.join( settings.CATMAID_URL, "crop/download/" + file_name + "/")
             msg.title = "Microstack finished"
             msg.text = "The requested microstack %s is finished. You can " \
-                    "download it from this location: <a href='%s'>%s</a>" % \
-                    (bb_text, url, url)
+                    "download it from this location: <a href='%s'>%s</a> " \
+                    "(%s)." % (bb_text, url, url, job.tile_stats)
             msg.action = url
         else:
             msg.title = "Microstack could not be created"
@@ -16,6 +16,8 @@ import time
 import six
 
 from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
 from six.moves import range
 
 
@@ -209,15 +211,9 @@ class State:
 def make_arbors(neuron_names, all_treenodes, cellIDs, scale, state):
     """ Consume all_treenodes lazily. Assumes treenodes are sorted by skeleton_id.
     Accumulates new cell IDs in cellIDs (the skeletonID is used). """
-    i = 0
-    length = len(all_treenodes)
-    while i < length:
-        skeletonID = all_treenodes[i][6]
-        treenodes = []
-        while i < length and all_treenodes[i][6] == skeletonID:
-            t = all_treenodes[i]
-            treenodes.append((t[0], t[1], map(float, (t[2], t[3], t[4])), t[5]))
-            i += 1
+    for skeletonID, rows in groupby(all_treenodes, itemgetter(6)):
+        treenodes = [(t[0], t[1], (float(t[2]), float(t[3]), float(t[4])), t[5])
+                     for t in rows]
         cellIDs.append(skeletonID)
         for line in make_arbor(neuron_name(skeletonID, neuron_names), treenodes, scale, state):
             yield line
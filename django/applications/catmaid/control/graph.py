@@ -11,8 +11,6 @@ from networkx.algorithms import weakly_connected_component_subgraphs
 from collections import defaultdict
 from itertools import chain
 from functools import partial
-from numpy import subtract
-from numpy.linalg import norm
 from math import sqrt
 
 from django.db import connection
@@ -22,9 +20,9 @@ from catmaid.models import Relation, UserRole
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map
 from catmaid.control.review import get_treenodes_to_reviews
-from catmaid.control.tree_util import simplify, find_root, reroot, partition, \
-        spanning_tree, cable_length
-from catmaid.control.synapseclustering import  tree_max_density
+from catmaid.control.tree_util import simplify, spanning_tree, cable_length, \
+        edge_lengths, Arbor
+from catmaid.control.synapseclustering import arbor_max_density
 
 from six.moves import filter
 
@@ -84,14 +82,11 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
                 subdomains.append(graph)
                 continue
 
-            for parent_id, treenode_id in graph.edges_iter():
-                loc0 = locations[treenode_id]
-                loc1 = locations[parent_id]
-                graph[parent_id][treenode_id]['weight'] = norm(subtract(loc0, loc1))
+            arbor = Arbor.from_graph(graph)
 
             # Invoke Casey's magic
-            max_density = tree_max_density(graph.to_undirected(), treenode_ids,
-                    connector_ids, relation_ids, [bandwidth])
+            max_density = arbor_max_density(arbor, edge_lengths(arbor, locations),
+                    treenode_ids, connector_ids, relation_ids, [bandwidth])
             synapse_group = next(six.itervalues(max_density))
             # The list of nodes of each synapse_group contains only nodes that have connectors
             # A local_max is the skeleton node most central to a synapse_group
@@ -102,7 +97,7 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
                 subdomains.append(g)
                 anchors[domain.local_max] = g
             # Define edges between domains: create a simplified graph
-            mini = simplify(graph, anchors.keys())
+            mini = simplify(graph, anchors.keys(), arbor)
             # Replace each node by the corresponding graph, or a graph of a single node
             for node in mini.nodes_iter():
                 g = anchors.get(node)
@@ -407,14 +402,14 @@ def _node_centrality_by_synapse(tree, nodes, totalOutputs, totalInputs):
             counts.synapse_centrality = -1
         return
 
-    if len(tree.successors(find_root(tree))) > 1:
+    arbor = Arbor.from_graph(tree)
+    if len(arbor.child_ids(arbor.root)) > 1:
         # Reroot at the first end node found
-        tree = tree.copy()
-        endNode = (nodeID for nodeID in six.iterkeys(nodes) if not tree.successors(nodeID)).next()
-        reroot(tree, endNode)
+        endNode = next(nodeID for nodeID in six.iterkeys(nodes) if not tree.successors(nodeID))
+        arbor.reroot(endNode)
 
     # 2. Partition into sequences, sorted from small to large
-    sequences = sorted(partition(tree), key=len)
+    sequences = sorted(arbor.partition(), key=len)
 
     # 3. Traverse all partitions counting synapses seen
     for seq in sequences:
@@ -9,8 +9,6 @@ from networkx.algorithms import weakly_connected_component_subgraphs
 from collections import defaultdict
 from itertools import count
 from functools import partial
-from numpy import subtract
-from numpy.linalg import norm
 
 from django.db import connection
 from django.http import HttpResponse
@@ -20,8 +18,8 @@ from rest_framework.decorators import api_view
 from catmaid.models import UserRole
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map
-from catmaid.control.tree_util import simplify
-from catmaid.control.synapseclustering import tree_max_density
+from catmaid.control.tree_util import simplify, edge_lengths, Arbor
+from catmaid.control.synapseclustering import arbor_max_density
 
 from six.moves import range, zip as izip
 
@@ -39,21 +37,19 @@ def basic_graph(project_id, skeleton_ids):
     preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
 
     cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id, LEAST(t1.confidence, t2.confidence)
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%(skids)s)
-      AND t1.relation_id = %(pre)s
-      AND t1.connector_id = t2.connector_id
-      AND t2.skeleton_id IN (%(skids)s)
-      AND t2.relation_id = %(post)s
-    ''' % {'skids': ','.join(map(str, skeleton_ids)),
-           'pre': preID,
-           'post': postID})
+    SELECT skeleton_a, skeleton_b, confidence, count
+    FROM catmaid_skeleton_connectivity
+    WHERE skeleton_a = ANY(%(skids)s::integer[])
+      AND relation_a = %(pre)s
+      AND skeleton_b = ANY(%(skids)s::integer[])
+      AND relation_b = %(post)s
+    ''', {'skids': [int(s) for s in skeleton_ids],
+          'pre': preID,
+          'post': postID})
 
     edges = defaultdict(partial(defaultdict, newSynapseCounts))
     for row in cursor.fetchall():
-        edges[row[0]][row[1]][row[2] - 1] += 1
+        edges[row[0]][row[1]][row[2] - 1] += row[3]
 
     return {'edges': tuple((pre, post, count) for pre, edge in six.iteritems(edges) for post, count in six.iteritems(edge))}
 
@@ -329,10 +325,6 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
     chunks, chunkIDs = subgraphs(digraph, skeleton_id)
 
     for i, chunkID, chunk in izip(count(start=1), chunkIDs, chunks):
-        # Populate edge properties with the weight
-        for parent, child in chunk.edges_iter():
-            chunk[parent][child]['weight'] = norm(subtract(locations[child], locations[parent]))
-
         # Check if need to expand at all
         blob = tuple(c for c in cs if c[0] in chunk)
         if 0 == len(blob):
@@ -346,8 +338,9 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
             continue
 
         # Invoke Casey's magic: split by synapse domain
-        max_density = tree_max_density(chunk.to_undirected(), treenode_ids,
-                connector_ids, relation_ids, [bandwidth])
+        arbor = Arbor.from_graph(chunk)
+        max_density = arbor_max_density(arbor, edge_lengths(arbor, locations),
+                treenode_ids, connector_ids, relation_ids, [bandwidth])
         # Get first element of max_density
         domains = next(six.itervalues(max_density))
 
@@ -364,7 +357,7 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
         anchors = {d.node_ids[0]: (i+k, d) for k, d in six.iteritems(domains)}
 
         # Create new Graph where the edges are the edges among synapse domains
-        mini = simplify(chunk, six.iterkeys(anchors))
+        mini = simplify(chunk, six.iterkeys(anchors), arbor)
 
         # Many side effects:
         # * add internal edges to intraedges
@@ -16,6 +16,7 @@ from catmaid.models import Project, Class, ClassInstance, Relation, Connector, \
         ChangeRequest
 from catmaid.control.authentication import (requires_user_role, can_edit_or_fail,
         PermissionError)
+from catmaid.control.node import invalidate_node_list_cache
 from catmaid.fields import Double3D
 
 
@@ -223,6 +224,9 @@ def label_update(request, project_id=None, location_id=None, ntype=None):
     if not table:
         raise Http404('Unknown node type: "%s"' % (ntype,))
 
+    # Labels are part of node list responses
+    invalidate_node_list_cache(project_id, [location_id])
+
     # Get the existing list of tags for the tree node/connector and delete any
     # that are not in the new list.
     existing_labels = table.objects.filter(**kwargs).select_related('class_instance')
@@ -392,6 +396,7 @@ def remove_label_link(request, project_id, ntype, location_id):
                          (location_id, label))
 
     if remove_label(link_id, ntype):
+        invalidate_node_list_cache(project_id, [location_id])
         return JsonResponse({
             'deleted_link': link_id,
             'message': 'success'
@@ -11,6 +11,7 @@ from catmaid import state
 from catmaid.models import UserRole, Project, Relation, Treenode, Connector, \
         TreenodeConnector, ClassInstance
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
+from catmaid.control.node import invalidate_node_list_cache
 
 @requires_user_role(UserRole.Annotate)
 def create_link(request, project_id=None):
@@ -97,6 +98,8 @@ def create_link(request, project_id=None):
     )
     link.save()
 
+    invalidate_node_list_cache(project_id, [to_id], cursor=cursor)
+
     result['message'] = 'success'
     result['link_id'] = link.id
     result['link_edition_time'] = link.edition_time
@@ -128,6 +131,8 @@ def delete_link(request, project_id=None):
     # and the user_id not matching or not being superuser.
     can_edit_or_fail(request.user, link.id, 'treenode_connector')
 
+    invalidate_node_list_cache(project_id, [connector_id], cursor=cursor)
+
     deleted_link_id = link.id
     link.delete()
     return HttpResponse(json.dumps({
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from catmaid.control.authentication import PermissionError
+from catmaid.metrics import get_metrics_store, render_metrics
+
+
+def metrics(request):
+    """Return the request and cache metrics of all server processes in
+    Prometheus' text format. Only superusers and users listed in METRICS_USERS
+    can read them, e.g. with an API token.
+    """
+    allowed_users = getattr(settings, 'METRICS_USERS', ())
+    if not request.user.is_superuser and \
+            request.user.username not in allowed_users:
+        raise PermissionError("Metrics are only available to superusers and "
+                "users in METRICS_USERS")
+    counters, histograms = get_metrics_store().collect()
+    return HttpResponse(render_metrics(counters, histograms),
+            content_type='text/plain; version=0.0.4; charset=utf-8')
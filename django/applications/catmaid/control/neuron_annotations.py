@@ -10,6 +10,7 @@ from django.db import connection
 
 from rest_framework.decorators import api_view
 
+from catmaid.metrics import count_cache_access
 from catmaid.models import UserRole, Project, Class, ClassInstance, \
         ClassInstanceClassInstance, Relation, ReviewerWhitelist
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
@@ -107,6 +108,84 @@ def create_basic_annotated_entity_query(project, params, relations, classes,
     # all instances of the given set of allowed classes.
     return entities
 
+class AnnotationHierarchy(object):
+    """ The annotation hierarchy of a project: all annotations that are
+    annotated with other annotations. Sub-annotations are computed on demand
+    and are kept for later use.
+    """
+
+    def __init__(self, version, links):
+        self.version = version
+        # Map each annotation to the annotations it is annotating
+        self.children = {}
+        for parent_id, child_id in links:
+            children = self.children.get(parent_id)
+            if children is None:
+                children = self.children[parent_id] = set()
+            children.add(child_id)
+        self.sub_annotation_ids = {}
+
+    def get_sub_annotation_ids(self, annotation_id):
+        """ Return a frozenset of all annotations that are annotated with the
+        passed in annotation, directly or transitively.
+        """
+        sub_annotation_ids = self.sub_annotation_ids.get(annotation_id)
+        if sub_annotation_ids is not None:
+            return sub_annotation_ids
+
+        result = set()
+        working_set = [annotation_id]
+        while working_set:
+            parent_id = working_set.pop()
+            for child_id in self.children.get(parent_id, ()):
+                if child_id in result:
+                    continue
+                result.add(child_id)
+                # Sub-annotations that are known already don't need to be
+                # followed.
+                known_ids = self.sub_annotation_ids.get(child_id)
+                if known_ids is None:
+                    working_set.append(child_id)
+                else:
+                    result.update(known_ids)
+
+        sub_annotation_ids = frozenset(result)
+        self.sub_annotation_ids[annotation_id] = sub_annotation_ids
+        return sub_annotation_ids
+
+# The annotation hierarchy of each project, cached in this process
+_annotation_hierarchies = {}
+
+def get_annotation_hierarchy(project_id, relations, classes):
+    """ Return the AnnotationHierarchy of a project. It is reloaded if the
+    version of the hierarchy in the database, which is updated by a trigger,
+    differs from the cached one.
+    """
+    project_id = int(project_id)
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT version FROM catmaid_annotation_hierarchy_version
+        WHERE project_id = %s
+    """, (project_id,))
+    row = cursor.fetchone()
+    version = row[0] if row else 0
+
+    hierarchy = _annotation_hierarchies.get(project_id)
+    is_cached = hierarchy is not None and hierarchy.version == version
+    count_cache_access('annotation_hierarchy', is_cached)
+    if not is_cached:
+        links = ClassInstanceClassInstance.objects.filter(
+                project_id=project_id,
+                class_instance_a__class_column=classes['annotation'],
+                class_instance_b__class_column=classes['annotation'],
+                relation_id = relations['annotated_with']).values_list(
+                        'class_instance_b', 'class_instance_a')
+        # The version is read first. Should the hierarchy change in the
+        # meantime, it will just be loaded again next time.
+        hierarchy = AnnotationHierarchy(version, links)
+        _annotation_hierarchies[project_id] = hierarchy
+    return hierarchy
+
 def get_sub_annotation_ids(project_id, annotation_sets, relations, classes):
     """ Sub-annotations are annotations that are annotated with an annotation
     from the annotation_set passed. Additionally, transivitely annotated
@@ -116,45 +195,15 @@ def get_sub_annotation_ids(project_id, annotation_sets, relations, classes):
     if not annotation_sets:
         return {}
 
-    aaa_tuples = ClassInstanceClassInstance.objects.filter(
-            project_id=project_id,
-            class_instance_a__class_column=classes['annotation'],
-            class_instance_b__class_column=classes['annotation'],
-            relation_id = relations['annotated_with']).values_list(
-                    'class_instance_b', 'class_instance_a')
-
-    # A set wrapper to keep a set in a dictionary
-    class set_wrapper:
-        def __init__(self):
-            self.data = set()
-
-    # Create a dictionary of all annotations annotating a set of annotations
-    aaa = {}
-    for aa in aaa_tuples:
-        sa_set = aaa.get(aa[0])
-        if sa_set is None:
-            sa_set = set_wrapper()
-            aaa[aa[0]] = sa_set
-        sa_set.data.add(aa[1])
+    hierarchy = get_annotation_hierarchy(project_id, relations, classes)
 
     # Collect all sub-annotations by following the annotation hierarchy for
     # every annotation in the annotation set passed.
     sa_ids = {}
     for annotation_set in annotation_sets:
-        # Start with an empty result set for each requested annotation set
         ls = set()
         for a in annotation_set:
-            working_set = set([a])
-            while working_set:
-                parent_id = working_set.pop()
-                # Try to get the sub-annotations for this parent
-                child_ids = aaa.get(parent_id) or set_wrapper()
-                for child_id in child_ids.data:
-                    if child_id not in sa_ids:
-                        if child_id not in ls:
-                            # Add all children as sub annotations
-                            ls.add(child_id)
-                            working_set.add(child_id)
+            ls.update(hierarchy.get_sub_annotation_ids(a))
         # Store the result list for this ID
         sa_ids[annotation_set] = list(ls)
 
@@ -1227,8 +1276,8 @@ def annotations_for_skeletons(request, project_id=None):
     """
     skids = tuple(get_request_list(request.POST, 'skeleton_ids', [], map_fn=int))
     cursor = connection.cursor()
-    cursor.execute("SELECT id FROM relation WHERE project_id=%s AND relation_name='annotated_with'" % int(project_id))
-    annotated_with_id = cursor.fetchone()[0]
+    annotated_with_id = get_relation_to_id_map(project_id,
+            ('annotated_with',), cursor)['annotated_with']
 
     # Select pairs of skeleton_id vs annotation name
     cursor.execute('''
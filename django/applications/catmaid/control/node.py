@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import hashlib
 import json
+import math
+import six
 import ujson
+import uuid
 
 from collections import defaultdict
 
+from django.core.cache import caches
 from django.core.serializers.json import DjangoJSONEncoder
 from django.conf import settings
-from django.db import connection
+from django.db import connection, transaction
 from django.http import HttpResponse, JsonResponse
 from django.utils import timezone
 from django.shortcuts import get_object_or_404
@@ -16,6 +21,8 @@ from django.shortcuts import get_object_or_404
 from rest_framework.decorators import api_view
 
 from catmaid import state
+from catmaid.metrics import count_cache_access
+from catmaid.control import columnar
 from catmaid.models import UserRole, Treenode, \
         ClassInstanceClassInstance, Review
 from catmaid.control.authentication import requires_user_role, \
@@ -467,6 +474,212 @@ def prepare_db_statements(connection):
     get_provider().prepare_db_statements(connection)
 
 
+class NodeListCache(object):
+    """Store encoded node/list responses in a Django cache. Space is divided
+    into the cells of a regular grid, each with a version token, which is part
+    of the cache key of all entries whose bounding box intersects this cell.
+    Edits replace the version tokens of all cells they touch, which makes only
+    the affected cache entries unreachable. Entries are cached for their exact
+    bounding box, responses therefore never contain more nodes than an
+    uncached query would. Entries that would span too many cells are not
+    cached.
+    """
+
+    key_prefix = 'catmaid-node-list'
+
+    def __init__(self, cache_name, grid, max_cells, timeout):
+        self.cache_name = cache_name
+        self.grid = tuple(float(g) for g in grid)
+        self.max_cells = max_cells
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.cache_name]
+
+    def cell_range(self, min_x, min_y, min_z, max_x, max_y, max_z):
+        """Return the inclusive grid index ranges covered by a bounding box.
+        """
+        gx, gy, gz = self.grid
+        return (
+            (int(math.floor(min_x / gx)), int(math.floor(max_x / gx))),
+            (int(math.floor(min_y / gy)), int(math.floor(max_y / gy))),
+            (int(math.floor(min_z / gz)), int(math.floor(max_z / gz))))
+
+    def cell_count(self, ranges):
+        n = 1
+        for r_min, r_max in ranges:
+            n *= r_max - r_min + 1
+        return n
+
+    def cell_keys(self, project_id, ranges):
+        (x_min, x_max), (y_min, y_max), (z_min, z_max) = ranges
+        return ['{}:cell:{}:{}:{}:{}'.format(self.key_prefix, project_id, x, y, z)
+                for x in range(x_min, x_max + 1)
+                for y in range(y_min, y_max + 1)
+                for z in range(z_min, z_max + 1)]
+
+    def generation_key(self, project_id):
+        return '{}:generation:{}'.format(self.key_prefix, project_id)
+
+    def stats_key(self, project_id, name):
+        return '{}:stats:{}:{}'.format(self.key_prefix, project_id, name)
+
+    def get_key(self, project_id, params, treenode_ids, connector_ids,
+            include_labels, response_format='json'):
+        """Return the cache key for a query with the passed in parameters or
+        None if the query shouldn't be cached. Version tokens
+        are read before the database is queried, so that data committed
+        after an invalidation is never stored under an outdated key.
+        """
+        ranges = self.cell_range(params['left'], params['top'], params['z1'],
+                params['right'], params['bottom'], params['z2'])
+        if self.cell_count(ranges) > self.max_cells:
+            return None
+
+        version_keys = [self.generation_key(project_id)] + \
+                self.cell_keys(project_id, ranges)
+        versions = self.cache.get_many(version_keys)
+        # Cells without a version (never edited or evicted) get a new one.
+        # This prevents entries cached before an eviction from becoming valid
+        # again.
+        missing = {k: uuid.uuid4().hex for k in version_keys if k not in versions}
+        if missing:
+            self.cache.set_many(missing, None)
+            versions.update(missing)
+
+        key_data = ujson.dumps([settings.NODE_PROVIDER, project_id,
+                [params[p] for p in ('left', 'top', 'z1', 'right', 'bottom', 'z2')],
+                params['limit'], sorted(treenode_ids), sorted(connector_ids),
+                include_labels, response_format,
+                [versions[k] for k in version_keys]])
+        return '{}:entry:{}'.format(self.key_prefix,
+                hashlib.md5(key_data.encode('utf-8')).hexdigest())
+
+    def get(self, project_id, key):
+        content = self.cache.get(key)
+        self._count(project_id, 'hits' if content is not None else 'misses')
+        count_cache_access('node_list', content is not None)
+        return content
+
+    def set(self, key, content):
+        self.cache.set(key, content, self.timeout)
+
+    def _count(self, project_id, name):
+        key = self.stats_key(project_id, name)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            # The counter doesn't exist yet
+            if not self.cache.add(key, 1, None):
+                self.cache.incr(key)
+
+    def get_stats(self, project_id):
+        keys = {name: self.stats_key(project_id, name) for name in ('hits', 'misses')}
+        counts = self.cache.get_many(keys.values())
+        return {name: counts.get(key, 0) for name, key in six.iteritems(keys)}
+
+    def invalidate(self, project_id, bounding_boxes, max_invalidation_cells=4096):
+        """Replace the version tokens of all grid cells intersecting the passed
+        in bounding boxes, each one of the form (min_x, min_y, min_z, max_x,
+        max_y, max_z). If too many cells are affected, the whole project is
+        invalidated instead.
+        """
+        cell_keys = set()
+        for bb in bounding_boxes:
+            ranges = self.cell_range(*bb)
+            if len(cell_keys) + self.cell_count(ranges) > max_invalidation_cells:
+                cell_keys = set([self.generation_key(project_id)])
+                break
+            cell_keys.update(self.cell_keys(project_id, ranges))
+        if cell_keys:
+            token = uuid.uuid4().hex
+            self.cache.set_many({k: token for k in cell_keys}, None)
+
+    def invalidate_project(self, project_id):
+        """Make all cached entries of a project unreachable."""
+        self.cache.set(self.generation_key(project_id), uuid.uuid4().hex, None)
+
+
+def get_node_list_cache():
+    """Return the configured node list cache or None, if caching is disabled.
+    """
+    cache_name = getattr(settings, 'NODE_LIST_CACHE', None)
+    if not cache_name:
+        return None
+    return NodeListCache(cache_name,
+            getattr(settings, 'NODE_LIST_CACHE_GRID', (4096, 4096, 200)),
+            getattr(settings, 'NODE_LIST_CACHE_MAX_CELLS', 64),
+            getattr(settings, 'NODE_LIST_CACHE_TIMEOUT', 300))
+
+
+def invalidate_node_list_cache(project_id, node_ids=None,
+        previous_locations=None, cursor=None):
+    """Invalidate cached node/list responses that can be affected by a change
+    of the passed in treenodes or connectors. If no node IDs are passed in,
+    all cached responses of the project are invalidated, which is useful for
+    operations that change whole skeletons. Besides the nodes themselves,
+    this respects the edges to parent and child nodes as well as connector
+    links. Since these need to be known, this has to be called before nodes
+    are deleted. If nodes are moved, a dictionary mapping node IDs to their
+    previous (x, y, z) locations can be passed in to also invalidate the
+    space previous edges intersected. The cache itself is only updated once
+    the current transaction is committed.
+    """
+    node_cache = get_node_list_cache()
+    if not node_cache:
+        return
+    if node_ids is None:
+        transaction.on_commit(lambda: node_cache.invalidate_project(project_id))
+        return
+    node_ids = list(imap(int, node_ids))
+    previous_locations = previous_locations or {}
+    bounding_boxes = []
+    if node_ids:
+        cursor = cursor or connection.cursor()
+        cursor.execute("""
+            SELECT affected.node_id,
+                   min(l.location_x), min(l.location_y), min(l.location_z),
+                   max(l.location_x), max(l.location_y), max(l.location_z)
+            FROM (
+                SELECT n.id AS node_id, n.id AS location_id
+                FROM location n
+                WHERE n.id = ANY(%(node_ids)s::bigint[])
+                UNION ALL
+                SELECT t.id, t.parent_id
+                FROM treenode t
+                WHERE t.id = ANY(%(node_ids)s::bigint[])
+                  AND t.parent_id IS NOT NULL
+                UNION ALL
+                SELECT c.parent_id, c.id
+                FROM treenode c
+                WHERE c.parent_id = ANY(%(node_ids)s::bigint[])
+                UNION ALL
+                SELECT tc.treenode_id, tc.connector_id
+                FROM treenode_connector tc
+                WHERE tc.treenode_id = ANY(%(node_ids)s::bigint[])
+                UNION ALL
+                SELECT tc.connector_id, tc.treenode_id
+                FROM treenode_connector tc
+                WHERE tc.connector_id = ANY(%(node_ids)s::bigint[])
+            ) affected
+            JOIN location l
+              ON l.id = affected.location_id
+            GROUP BY affected.node_id
+        """, {'node_ids': node_ids})
+        for row in cursor.fetchall():
+            bb = list(row[1:])
+            previous = previous_locations.get(row[0])
+            if previous:
+                bb[0:3] = [min(a, b) for a, b in zip(bb[0:3], previous)]
+                bb[3:6] = [max(a, b) for a, b in zip(bb[3:6], previous)]
+            bounding_boxes.append(bb)
+
+    if bounding_boxes:
+        transaction.on_commit(lambda: node_cache.invalidate(project_id,
+                bounding_boxes))
+
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def node_list_tuples(request, project_id=None, provider=None):
     '''Retrieve all nodes intersecting a bounding box
@@ -505,6 +718,12 @@ def node_list_tuples(request, project_id=None, provider=None):
     relations are mapped to their textural representations:
 
     {relation_id: relation_name}
+
+    If the "format" parameter is set to "binary", the same data is returned in
+    the columnar binary format described in catmaid.control.columnar. It
+    contains the tables "treenodes", "connectors" and "connector_links" with
+    one column per field listed above. Labels, node_limit_reached and the
+    relation map are part of the additional header data.
     ---
     parameters:
     - name: treenode_ids
@@ -566,6 +785,14 @@ def node_list_tuples(request, project_id=None, provider=None):
       required: true
       type: float
       paramType: form
+    - name: format
+      description: |
+        Either "json" (default) or "binary" for a columnar binary response.
+      required: false
+      type: string
+      enum: [json, binary]
+      defaultValue: json
+      paramType: form
     type:
     - type: array
       items:
@@ -583,25 +810,53 @@ def node_list_tuples(request, project_id=None, provider=None):
     params['limit'] = settings.NODE_LIST_MAXIMUM_COUNT
     params['project_id'] = project_id
     include_labels = (request.POST.get('labels', None) == 'true')
+    response_format = columnar.get_request_format(request)
+
+    node_cache = get_node_list_cache()
+    if node_cache:
+        cache_key = node_cache.get_key(project_id, params, treenode_ids,
+                connector_ids, include_labels, response_format)
+        if cache_key:
+            content = node_cache.get(project_id, cache_key)
+            if content is not None:
+                content_type = columnar.CONTENT_TYPE \
+                        if response_format == 'binary' else 'application/json'
+                return HttpResponse(content, content_type=content_type)
+    else:
+        cache_key = None
+
+    response = node_list_tuples_query(params, project_id, get_provider(),
+            treenode_ids, connector_ids, include_labels, response_format)
 
-    return node_list_tuples_query(params, project_id, get_provider(),
-            treenode_ids, connector_ids, include_labels)
+    if cache_key:
+        node_cache.set(cache_key, response.content)
+
+    return response
+
+
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def node_list_cache_stats(request, project_id=None):
+    """Return the number of cache hits and misses of node list queries for
+    this project. If the node list cache is disabled, an error is returned.
+    """
+    node_cache = get_node_list_cache()
+    if not node_cache:
+        raise ValueError("The node list cache is disabled")
+    return JsonResponse(node_cache.get_stats(int(project_id)))
 
 
 def node_list_tuples_query(params, project_id, node_provider, explicit_treenode_ids=tuple(),
-        explicit_connector_ids=tuple(), include_labels=False):
+        explicit_connector_ids=tuple(), include_labels=False, response_format='json'):
     """The returned JSON data is sensitive to indices in the array, so care
     must be taken never to alter the order of the variables in the SQL
     statements without modifying the accesses to said data both in this
-    function and in the client that consumes it.
+    function and in the client that consumes it. If <response_format> is
+    "binary", the result is encoded in the columnar binary format instead.
     """
     try:
         cursor = connection.cursor()
 
-        cursor.execute('''
-        SELECT relation_name, id FROM relation WHERE project_id=%s
-        ''' % project_id)
-        relation_map = dict(cursor.fetchall())
+        relation_map = get_relation_to_id_map(project_id, cursor=cursor)
         id_to_relation = {v: k for k, v in relation_map.items()}
 
         # A set of extra treenode and connector IDs
@@ -700,6 +955,11 @@ def node_list_tuples_query(params, project_id, node_provider, explicit_treenode_
                     labels[row[0]].append(row[1])
 
         used_rel_map = {r:id_to_relation[r] for r in used_relations}
+
+        if response_format == 'binary':
+            return _node_list_binary_response(treenodes, connectors, labels,
+                    n_retrieved_nodes == params['limit'], used_rel_map)
+
         return HttpResponse(ujson.dumps((
             treenodes, connectors, labels,
             n_retrieved_nodes == params['limit'],
@@ -710,6 +970,51 @@ def node_list_tuples_query(params, project_id, node_provider, explicit_treenode_
         raise Exception(response_on_error + ':' + str(e))
 
 
+def _node_list_binary_response(treenodes, connectors, labels, limit_reached,
+        relation_map):
+    """Encode a node list query result in the columnar binary format. The
+    result is small enough to not require streaming and can be cached as is.
+    """
+    treenode_table = columnar.Table.from_rows('treenodes', treenodes, [
+        ('id', 0, '<i8'),
+        ('parent_id', 1, '<i8'),
+        ('location_x', 2, '<f4'),
+        ('location_y', 3, '<f4'),
+        ('location_z', 4, '<f4'),
+        ('confidence', 5, 'u1'),
+        ('radius', 6, '<f4'),
+        ('skeleton_id', 7, '<i8'),
+        ('edition_time', 8, '<f8'),
+        ('user_id', 9, '<i4'),
+    ])
+    connector_table = columnar.Table.from_rows('connectors', connectors, [
+        ('id', 0, '<i8'),
+        ('location_x', 1, '<f4'),
+        ('location_y', 2, '<f4'),
+        ('location_z', 3, '<f4'),
+        ('confidence', 4, 'u1'),
+        ('edition_time', 5, '<f8'),
+        ('user_id', 6, '<i4'),
+    ])
+    # Connector links are flattened into their own table
+    link_rows = [(c[0],) + tuple(l) for c in connectors for l in c[7]]
+    link_table = columnar.Table.from_rows('connector_links', link_rows, [
+        ('connector_id', 0, '<i8'),
+        ('treenode_id', 1, '<i8'),
+        ('relation_id', 2, '<i8'),
+        ('confidence', 3, 'u1'),
+        ('edition_time', 4, '<f8'),
+        ('link_id', 5, '<i8'),
+    ])
+    content = b''.join(columnar.encode(
+            [treenode_table, connector_table, link_table], {
+                'labels': labels,
+                'node_limit_reached': limit_reached,
+                'relation_map': relation_map,
+            }))
+    return HttpResponse(content, content_type=columnar.CONTENT_TYPE)
+
+
 @requires_user_role(UserRole.Annotate)
 def update_location_reviewer(request, project_id=None, node_id=None):
     """ Updates the reviewer id and review time of a node """
@@ -759,7 +1064,7 @@ def most_recent_treenode(request, project_id=None):
     })
 
 
-def _update_location(table, nodes, now, user, cursor):
+def _update_location(table, nodes, now, user, cursor, project_id=None):
     if not nodes:
         return
     # 0: id
@@ -794,6 +1099,11 @@ def _update_location(table, nodes, now, user, cursor):
         raise ValueError('Coudn\'t update node ' +
                          ','.join(frozenset([str(r[0]) for r in nodes]) -
                                   frozenset([str(r[0]) for r in updated_rows])))
+
+    if project_id is not None:
+        invalidate_node_list_cache(project_id, [r[0] for r in updated_rows],
+                {r[0]: r[2:5] for r in updated_rows}, cursor)
+
     return updated_rows
 
 
@@ -810,8 +1120,10 @@ def node_update(request, project_id=None):
                 multinode=True, lock=True, cursor=cursor)
 
     now = timezone.now()
-    old_treenodes = _update_location("treenode", treenodes, now, request.user, cursor)
-    old_connectors = _update_location("connector", connectors, now, request.user, cursor)
+    old_treenodes = _update_location("treenode", treenodes, now, request.user,
+            cursor, project_id)
+    old_connectors = _update_location("connector", connectors, now, request.user,
+            cursor, project_id)
 
     num_updated_nodes = len(treenodes) + len(connectors)
     return JsonResponse({
@@ -70,11 +70,10 @@ def get_review_count(skeleton_ids):
     # Count nodes that have been reviewed by each user in each partner skeleton
     cursor = connection.cursor()
     cursor.execute('''
-    SELECT skeleton_id, reviewer_id, count(*)
-    FROM review
-    WHERE skeleton_id IN (%s)
-    GROUP BY reviewer_id, skeleton_id
-    ''' % ",".join(map(str, skeleton_ids)))
+    SELECT skeleton_id, reviewer_id, num_reviewed_nodes
+    FROM catmaid_skeleton_review_summary
+    WHERE skeleton_id = ANY(%s::integer[])
+    ''', (list(skeleton_ids),))
     # Build dictionary
     reviews = defaultdict(lambda: defaultdict(int))
     for row in cursor.fetchall():
@@ -103,15 +102,37 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
 
     skids_string = ','.join(map(str, skeleton_ids))
 
-    # Count nodes of each skeleton
+    # Node counts and the number of nodes reviewed by anyone are available
+    # from the skeleton summary.
     cursor.execute('''
-    SELECT skeleton_id, count(skeleton_id)
-    FROM treenode
-    WHERE skeleton_id IN (%s)
-    GROUP BY skeleton_id
-    ''' % skids_string)
-    for row in cursor.fetchall():
-        skeletons[row[0]] = [row[1], 0]
+    SELECT skeleton_id, num_nodes, num_reviewed_nodes
+    FROM catmaid_skeleton_summary
+    WHERE skeleton_id = ANY(%s::integer[])
+      AND num_nodes > 0
+    ''', (list(skeleton_ids),))
+    summaries = cursor.fetchall()
+
+    if not (whitelist_id or user_ids or excluding_user_ids):
+        for skeleton_id, num_nodes, num_reviewed_nodes in summaries:
+            skeletons[skeleton_id] = [num_nodes, num_reviewed_nodes]
+        return skeletons
+
+    for skeleton_id, num_nodes, _ in summaries:
+        skeletons[skeleton_id] = [num_nodes, 0]
+
+    if user_ids and len(user_ids) == 1:
+        # The review summary has the number of nodes reviewed by each
+        # individual user.
+        cursor.execute('''
+        SELECT skeleton_id, num_reviewed_nodes
+        FROM catmaid_skeleton_review_summary
+        WHERE skeleton_id = ANY(%s::integer[])
+          AND reviewer_id = %s
+        ''', (list(skeleton_ids), int(next(iter(user_ids)))))
+        for row in cursor.fetchall():
+            if row[0] in skeletons:
+                skeletons[row[0]][1] = row[1]
+        return skeletons
 
     query_joins = ""
     # Optionally, add a filter
@@ -128,15 +149,11 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
         # per skeleton.
         user_filter = " AND r.reviewer_id IN (%s)" % \
             ",".join(map(str, user_ids))
-    elif excluding_user_ids:
+    else:
         # Count number of nodes reviewed by all users excluding the
         # specified ones, per skeleton.
         user_filter = " AND r.reviewer_id NOT IN (%s)" % \
             ",".join(map(str, excluding_user_ids))
-    else:
-        # Count total number of reviewed nodes per skeleton, regardless
-        # of reviewer.
-        user_filter = ""
 
     cursor.execute('''
     SELECT skeleton_id, count(*)
@@ -218,13 +218,21 @@ def create_roi_image_task(user, project_id, roi_id, file_path):
         job = cropping.CropJob(user, project_id, [roi.stack.id],
             x_min, x_max, y_min, y_max, z_min, z_max, roi.rotation_cw,
             roi.zoom_level, single_channel)
-        # Create the pgmagick images
-        cropped_stacks = cropping.extract_substack( job )
-        if len(cropped_stacks) == 0:
-            raise StandardError("Couldn't create ROI image")
-        # There is only one image here
-        img = cropped_stacks[0]
-        img.write(str(file_path))
+        if cropping.use_numpy_backend():
+            cropped_stack = cropping.extract_substack_array( job )
+            if cropped_stack is None:
+                raise ValueError("Couldn't create ROI image")
+            # There is only one image here
+            img = cropping.get_pages( job, cropped_stack )[0]
+            cropping.PILImage.fromarray(img).save(file_path)
+        else:
+            # Create the pgmagick images
+            cropped_stacks = cropping.extract_substack( job )
+            if len(cropped_stacks) == 0:
+                raise StandardError("Couldn't create ROI image")
+            # There is only one image here
+            img = cropped_stacks[0]
+            img.write(str(file_path))
     finally:
         release_lock()
 
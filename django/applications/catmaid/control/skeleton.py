@@ -32,12 +32,28 @@ from catmaid.control.authentication import requires_user_role, \
 from catmaid.control.common import insert_into_log, get_class_to_id_map, \
         get_relation_to_id_map, _create_relation, get_request_list
 from catmaid.control.neuron import _delete_if_empty
+from catmaid.control.node import invalidate_node_list_cache
 from catmaid.control.neuron_annotations import create_annotation_query, \
         _annotate_entities, _update_neuron_annotations
 from catmaid.control.review import get_review_status
 from catmaid.control.tree_util import find_root, reroot, edge_count_to_root
 
 
+# A recursive common table expression of the IDs of all treenodes downstream
+# of the node with the ID passed in as treenode_id parameter, including itself.
+# UNION discards nodes that were seen already, which ends the recursion if
+# parent links form a cycle.
+DOWNSTREAM_NODES = """
+    WITH RECURSIVE downstream(id) AS (
+        SELECT %(treenode_id)s::bigint
+        UNION
+        SELECT t.id
+        FROM downstream d
+        JOIN treenode t ON t.parent_id = d.id
+    )
+"""
+
+
 def get_skeleton_permissions(request, project_id, skeleton_id):
     """ Tests editing permissions of a user on a skeleton and returns the
     result as JSON object."""
@@ -229,8 +245,7 @@ def find_labels(request, project_id=None, skeleton_id=None):
     label_regex = str(request.POST['label_regex'])
     cursor = connection.cursor()
 
-    cursor.execute("SELECT id FROM relation WHERE project_id=%s AND relation_name='labeled_as'" % int(project_id))
-    labeled_as = cursor.fetchone()[0]
+    labeled_as = get_relation_to_id_map(project_id, ('labeled_as',), cursor)['labeled_as']
 
     # Select all nodes in the skeleton and any matching labels
     cursor.execute('''
@@ -506,8 +521,13 @@ def node_count(request, project_id=None, skeleton_id=None, treenode_id=None):
     if not skeleton_id:
         skeleton_id = Treenode.objects.get(pk=treenode_id).skeleton_id
     skeleton_id = int(skeleton_id)
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT num_nodes FROM catmaid_skeleton_summary WHERE skeleton_id = %s
+    ''', (skeleton_id,))
+    row = cursor.fetchone()
     return JsonResponse({
-        'count': Treenode.objects.filter(skeleton_id=skeleton_id).count(),
+        'count': row[0] if row else 0,
         'skeleton_id': skeleton_id})
 
 def _get_neuronname_from_skeletonid( project_id, skeleton_id ):
@@ -639,33 +659,23 @@ def split_skeleton(request, project_id=None):
     upstream_annotation_map = make_annotation_map(upstream_annotation_map, neuron.id, cursor)
     downstream_annotation_map = make_annotation_map(downstream_annotation_map, neuron.id, cursor)
 
-    # Retrieve the id, parent_id of all nodes in the skeleton. Also
-    # pre-emptively lock all treenodes and connectors in the skeleton to prevent
-    # race conditions resulting in inconsistent skeleton IDs from, e.g., node
-    # creation or update.
+    # Pre-emptively lock all treenodes and connector links downstream of the
+    # split node to prevent race conditions resulting in inconsistent skeleton
+    # IDs from, e.g., node creation or update. The rest of the skeleton isn't
+    # changed and doesn't need to be read.
     cursor.execute('''
-        SELECT 1 FROM treenode_connector tc WHERE tc.skeleton_id = %s
+        {downstream}
+        SELECT 1 FROM treenode_connector tc
+        WHERE tc.treenode_id IN (SELECT id FROM downstream)
         ORDER BY tc.id
         FOR NO KEY UPDATE OF tc;
-        SELECT t.id, t.parent_id FROM treenode t WHERE t.skeleton_id = %s
+        {downstream}
+        SELECT 1 FROM treenode t
+        WHERE t.id IN (SELECT id FROM downstream)
         ORDER BY t.id
         FOR NO KEY UPDATE OF t
-        ''', (skeleton_id, skeleton_id)) # no need to sanitize
-    # build the networkx graph from it
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        graph.add_node( row[0] )
-        if row[1]:
-            # edge from parent_id to id
-            graph.add_edge( row[1], row[0] )
-    # find downstream nodes starting from target treenode_id
-    # and generate the list of IDs to change, starting at treenode_id (inclusive)
-    change_list = nx.bfs_tree(graph, treenode_id).nodes()
-    if not change_list:
-        # When splitting an end node, the bfs_tree doesn't return any nodes,
-        # which is surprising, because when the splitted tree has 2 or more nodes
-        # the node at which the split is made is included in the list.
-        change_list.append(treenode_id)
+        '''.format(downstream=DOWNSTREAM_NODES), {'treenode_id': treenode_id})
+
     # create a new skeleton
     new_skeleton = ClassInstance()
     new_skeleton.name = 'Skeleton'
@@ -694,22 +704,40 @@ def split_skeleton(request, project_id=None):
     cici.project_id = project_id
     cici.save()
 
-    # Update skeleton IDs for treenodes, treenode_connectors, and reviews.
+    # Update skeleton IDs for treenodes, treenode_connectors, and reviews. The
+    # downstream part of the skeleton is collected on the server, only these
+    # nodes are read and updated. Links and reviews are found through the
+    # treenodes, which have the new skeleton ID at this point.
     cursor.execute("""
-        UPDATE treenode
+        {downstream}
+        UPDATE treenode t
           SET skeleton_id = %(new_skeleton_id)s
-          WHERE id = ANY(%(change_list)s::bigint[]);
-        UPDATE treenode_connector
+          FROM downstream d
+          WHERE t.id = d.id;
+        UPDATE treenode_connector tc
           SET skeleton_id = %(new_skeleton_id)s
-          WHERE treenode_id = ANY(%(change_list)s::bigint[]);
-        UPDATE review
+          FROM treenode t
+          WHERE tc.skeleton_id = %(skeleton_id)s
+            AND t.id = tc.treenode_id
+            AND t.skeleton_id = %(new_skeleton_id)s;
+        UPDATE review r
           SET skeleton_id = %(new_skeleton_id)s
-          WHERE treenode_id = ANY(%(change_list)s::bigint[]);
-        """, {'new_skeleton_id': new_skeleton.id, 'change_list': change_list})
+          FROM treenode t
+          WHERE r.skeleton_id = %(skeleton_id)s
+            AND t.id = r.treenode_id
+            AND t.skeleton_id = %(new_skeleton_id)s;
+        """.format(downstream=DOWNSTREAM_NODES), {
+            'treenode_id': treenode_id,
+            'skeleton_id': skeleton_id,
+            'new_skeleton_id': new_skeleton.id
+        })
 
     # setting new root treenode's parent to null
     Treenode.objects.filter(id=treenode_id).update(parent=None, editor=request.user)
 
+    # Skeleton IDs of potentially many nodes changed
+    invalidate_node_list_cache(project_id)
+
     # Update annotations of existing neuron to have only over set
     _update_neuron_annotations(project_id, request.user, neuron.id,
             upstream_annotation_map)
@@ -847,24 +875,36 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2,
 
     # Obtain the synapses made by all skeleton_ids considering the desired
     # direction of the synapse, as specified by relation_id_1 and relation_id_2:
-    cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id, LEAST(t1.confidence, t2.confidence),
-        t1.treenode_id, t2.treenode_id
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id = ANY(%s::integer[])
-      AND t1.relation_id = %s
-      AND t1.connector_id = t2.connector_id
-      AND t1.id != t2.id
-      AND t2.relation_id = %s
-    ''', (list(skeleton_ids), int(relation_id_1), int(relation_id_2)))
-
-    # Sum the number of synapses
-    for srcID, partnerID, confidence, tn1, tn2 in cursor.fetchall():
-        partner = partners[partnerID]
-        partner.skids[srcID][confidence - 1] += 1
-        if with_nodes:
+    if with_nodes:
+        cursor.execute('''
+        SELECT t1.skeleton_id, t2.skeleton_id, LEAST(t1.confidence, t2.confidence),
+            t1.treenode_id, t2.treenode_id
+        FROM treenode_connector t1,
+             treenode_connector t2
+        WHERE t1.skeleton_id = ANY(%s::integer[])
+          AND t1.relation_id = %s
+          AND t1.connector_id = t2.connector_id
+          AND t1.id != t2.id
+          AND t2.relation_id = %s
+        ''', (list(skeleton_ids), int(relation_id_1), int(relation_id_2)))
+
+        # Sum the number of synapses
+        for srcID, partnerID, confidence, tn1, tn2 in cursor.fetchall():
+            partner = partners[partnerID]
+            partner.skids[srcID][confidence - 1] += 1
             partner.links.append([tn1, tn2, srcID])
+    else:
+        # Without individual links, the materialized synapse counts are enough
+        cursor.execute('''
+        SELECT skeleton_a, skeleton_b, confidence, count
+        FROM catmaid_skeleton_connectivity
+        WHERE skeleton_a = ANY(%s::integer[])
+          AND relation_a = %s
+          AND relation_b = %s
+        ''', (list(skeleton_ids), int(relation_id_1), int(relation_id_2)))
+
+        for srcID, partnerID, confidence, count in cursor.fetchall():
+            partners[partnerID].skids[srcID][confidence - 1] += count
 
     # There may not be any synapses
     if not partners:
@@ -885,10 +925,9 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2,
 
     # Count nodes of each partner skeleton
     cursor.execute('''
-    SELECT skeleton_id, count(skeleton_id)
-    FROM treenode
+    SELECT skeleton_id, num_nodes
+    FROM catmaid_skeleton_summary
     WHERE skeleton_id = ANY(%s::integer[])
-    GROUP BY skeleton_id
     ''', (partner_skids,))
     for row in cursor.fetchall():
         partners[row[0]].num_nodes = row[1]
@@ -1090,33 +1129,56 @@ def get_connectivity_matrix(project_id, row_skeleton_ids, col_skeleton_ids):
     post_rel_id = relation_map['postsynaptic_to']
     pre_rel_id = relation_map['presynaptic_to']
 
-    # Obtain all synapses made between row skeletons and column skeletons.
+    # Obtain the number of synapses made between row skeletons and column
+    # skeletons.
     cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%s)
-      AND t2.skeleton_id IN (%s)
-      AND t1.connector_id = t2.connector_id
-      AND t1.relation_id = %s
-      AND t2.relation_id = %s
-    ''' % (','.join(map(str, row_skeleton_ids)),
-           ','.join(map(str, col_skeleton_ids)),
+    SELECT skeleton_a, skeleton_b, SUM(count)
+    FROM catmaid_skeleton_connectivity
+    WHERE skeleton_a = ANY(%s::integer[])
+      AND skeleton_b = ANY(%s::integer[])
+      AND relation_a = %s
+      AND relation_b = %s
+    GROUP BY skeleton_a, skeleton_b
+    ''', ([int(s) for s in row_skeleton_ids], [int(s) for s in col_skeleton_ids],
            pre_rel_id, post_rel_id))
 
     # Build a sparse connectivity representation. For all skeletons requested
     # map a dictionary of partner skeletons and the number of synapses
     # connecting to each partner.
     outgoing = defaultdict(dict)
-    for r in cursor.fetchall():
-        source, target = r[0], r[1]
-        mapping = outgoing[source]
-        count = mapping.get(target, 0)
-        mapping[target] = count + 1
+    for source, target, count in cursor.fetchall():
+        outgoing[source][target] = int(count)
 
     return outgoing
 
 
+def rebuild_skeleton_connectivity(cursor, project_id):
+    """Replace the skeleton connectivity of the passed in project with newly
+    computed one.
+    """
+    cursor.execute('''
+        DELETE FROM catmaid_skeleton_connectivity
+        WHERE project_id = %(project_id)s;
+
+        INSERT INTO catmaid_skeleton_connectivity
+            SELECT tc1.project_id, tc1.skeleton_id, tc1.relation_id,
+                tc2.skeleton_id, tc2.relation_id,
+                LEAST(tc1.confidence, tc2.confidence), count(*)
+            FROM treenode_connector tc1
+            JOIN treenode_connector tc2
+                ON tc1.connector_id = tc2.connector_id
+                AND tc1.id <> tc2.id
+            WHERE tc1.project_id = %(project_id)s
+              AND tc1.skeleton_id IS NOT NULL
+              AND tc2.skeleton_id IS NOT NULL
+            GROUP BY tc1.project_id, tc1.skeleton_id, tc1.relation_id,
+                tc2.skeleton_id, tc2.relation_id,
+                LEAST(tc1.confidence, tc2.confidence);
+    ''', {
+        'project_id': project_id
+    })
+
+
 @api_view(['POST'])
 @requires_user_role([UserRole.Browse, UserRole.Annotate])
 def review_status(request, project_id=None):
@@ -1221,45 +1283,51 @@ def _reroot_skeleton(treenode_id, project_id):
             return False
 
         response_on_error = 'An error occured while rerooting.'
-        q_treenode = Treenode.objects.filter(
-                skeleton_id=rootnode.skeleton_id,
-                project=project_id).values_list('id', 'parent_id', 'confidence')
-        nodes = {tnid: (parent_id, confidence) for (tnid, parent_id, confidence) in list(q_treenode)}
-
-        # Traverse up the chain of parents, reversing the parent relationships so
-        # that the selected treenode (with ID treenode_id) becomes the root.
-        new_parents = []
-        new_parent = rootnode.id
-        new_confidence = rootnode.confidence
-        node = first_parent
-
-        while True:
-            # Store current values to be used in next iteration
-            parent, confidence = nodes[node]
-
-            # Set new values
-            new_parents.append((node, new_parent, new_confidence))
-
-            if parent is None:
-                # Root has been reached
-                break
-            else:
-                # Prepare next iteration
-                new_parent = node
-                new_confidence = confidence
-                node = parent
-
-        # Finally make treenode root
-        new_parents.append((rootnode.id, 'NULL', 5)) # Reset to maximum confidence.
-
+        # Reverse the parent relationships on the path from the selected
+        # treenode up to the current root, so that the selected treenode
+        # becomes the root. Each node on the path gets the node below it as
+        # new parent, along with the confidence of the edge between both. The
+        # path is followed on the server, no other nodes are read or updated.
+        # A path can't be longer than the skeleton has nodes, if it is, parent
+        # links form a cycle and nothing is updated.
         cursor = connection.cursor()
         cursor.execute('''
-                UPDATE treenode
-                SET parent_id = v.parent_id,
-                    confidence = v.confidence
-                FROM (VALUES %s) v(id, parent_id, confidence)
-                WHERE treenode.id = v.id
-                ''' % ','.join(['(%s,%s,%s)' % node for node in new_parents]))
+            WITH RECURSIVE max_depth(depth) AS (
+                SELECT count(*) FROM treenode
+                WHERE skeleton_id = %(skeleton_id)s
+            ), path(id, parent_id, confidence, depth) AS (
+                SELECT id, parent_id, confidence, 0
+                FROM treenode
+                WHERE id = %(treenode_id)s
+                UNION ALL
+                SELECT t.id, t.parent_id, t.confidence, p.depth + 1
+                FROM path p
+                JOIN treenode t ON t.id = p.parent_id
+                WHERE p.depth < (SELECT depth FROM max_depth)
+            ), new_parent AS (
+                SELECT id, lag(id) OVER w AS parent_id,
+                    -- Reset the new root to maximum confidence
+                    COALESCE(lag(confidence) OVER w, 5) AS confidence
+                FROM path
+                WINDOW w AS (ORDER BY depth)
+            )
+            UPDATE treenode t
+            SET parent_id = np.parent_id,
+                confidence = np.confidence
+            FROM new_parent np
+            WHERE t.id = np.id
+              AND NOT EXISTS (
+                SELECT 1 FROM path
+                WHERE depth >= (SELECT depth FROM max_depth))
+            ''', {
+                'treenode_id': rootnode.id,
+                'skeleton_id': rootnode.skeleton_id,
+            })
+        if 0 == cursor.rowcount:
+            raise Exception('The parent links of skeleton %s form a cycle' % \
+                    rootnode.skeleton_id)
+
+        invalidate_node_list_cache(project_id)
 
         return rootnode
 
@@ -1471,6 +1539,8 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
         # Remove the 'losing' neuron if it is empty
         _delete_if_empty(to_neuron['neuronid'])
 
+        invalidate_node_list_cache(project_id)
+
         from_location = (from_treenode.location_x, from_treenode.location_y,
                          from_treenode.location_z)
         insert_into_log(project_id, user.id, 'join_skeleton',
@@ -1686,6 +1756,7 @@ def _import_skeleton(user, project_id, arborescence, neuron_id=None, name=None):
         FROM (VALUES (%s)) AS v(id, x, y, z, parent_id, radius)
         WHERE treenode.id = v.id AND treenode.skeleton_id = %s
         """ % (treenode_values, new_skeleton.id)) # Include skeleton ID for index performance.
+    invalidate_node_list_cache(project_id, treenode_ids, cursor=cursor)
 
     # Log import.
     insert_into_log(project_id, user.id, 'create_neuron',
@@ -1904,11 +1975,18 @@ def _list_skeletons(project_id, created_by=None, reviewed_by=None, from_date=Non
 
     if reviewed_by:
         params = [project_id, reviewed_by]
-        query = '''
-            SELECT DISTINCT r.skeleton_id
-            FROM review r
-            WHERE r.project_id=%s AND r.reviewer_id=%s
-        '''
+        if from_date or to_date:
+            query = '''
+                SELECT DISTINCT r.skeleton_id
+                FROM review r
+                WHERE r.project_id=%s AND r.reviewer_id=%s
+            '''
+        else:
+            query = '''
+                SELECT rs.skeleton_id
+                FROM catmaid_skeleton_review_summary rs
+                WHERE rs.project_id=%s AND rs.reviewer_id=%s
+            '''
 
         if from_date:
             params.append(from_date.isoformat())
@@ -1917,13 +1995,20 @@ def _list_skeletons(project_id, created_by=None, reviewed_by=None, from_date=Non
             to_date = to_date + timedelta(days=1)
             params.append(to_date.isoformat())
             query += " AND r.review_time < %s"
-    else:
+    elif created_by:
         params = [project_id]
         query = '''
             SELECT DISTINCT skeleton_id
             FROM treenode t
             WHERE t.project_id=%s
         '''
+    else:
+        params = [project_id]
+        query = '''
+            SELECT ss.skeleton_id
+            FROM catmaid_skeleton_summary ss
+            WHERE ss.project_id=%s AND ss.num_nodes > 0
+        '''
 
     if created_by:
         params.append(created_by)
@@ -1940,12 +2025,10 @@ def _list_skeletons(project_id, created_by=None, reviewed_by=None, from_date=Non
     if nodecount_gt > 0:
         params.append(nodecount_gt)
         query = '''
-            SELECT sub.skeleton_id
-            FROM (
-                SELECT t.skeleton_id AS skeleton_id, COUNT(*) AS count
-                FROM (%s) q JOIN treenode t ON q.skeleton_id = t.skeleton_id
-                GROUP BY t.skeleton_id
-            ) AS sub WHERE sub.count > %%s
+            SELECT q.skeleton_id
+            FROM (%s) q
+            JOIN catmaid_skeleton_summary ss ON q.skeleton_id = ss.skeleton_id
+            WHERE ss.num_nodes > %%s
         ''' % query
 
     cursor = connection.cursor()
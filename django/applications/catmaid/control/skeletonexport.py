@@ -4,34 +4,38 @@ from __future__ import unicode_literals
 import json
 import logging
 import networkx as nx
+import numpy as np
 import pytz
 import six
+import struct
+import time
+import zlib
 
 from functools import partial
 from collections import defaultdict, deque
-from math import sqrt
 from datetime import datetime
 
+from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import connection
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 
 from rest_framework.decorators import api_view
 
 from catmaid.models import UserRole, ClassInstance, Treenode, \
         TreenodeClassInstance, ConnectorClassInstance, Review
-from catmaid.control import export_NeuroML_Level3
+from catmaid.control import export_NeuroML_Level3, columnar
 from catmaid.control.authentication import requires_user_role
-from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.common import get_relation_to_id_map, get_request_list
 from catmaid.control.review import get_treenodes_to_reviews, \
         get_treenodes_to_reviews_with_time
 
 from psycopg2.extras import DateTimeTZRange
 
-from catmaid.control.tree_util import edge_count_to_root, partition
+from catmaid.control.tree_util import edge_count_to_root, Arbor
 
 # Python 2 and 3 compatible map iterator
-from six.moves import map
+from six.moves import map, range
 
 try:
     from exportneuroml import neuroml_single_cell, neuroml_network
@@ -110,14 +114,233 @@ def get_swc_string(treenodes_qs, linearize_ids=False):
         result += " ".join(map(str, row)) + "\n"
     return result
 
+
+def _swc_line(node_id, x, y, z, radius, parent_id):
+    """Format a single node the same way get_swc_string() does."""
+    return " ".join(map(str, (node_id, 0, x, y, z, max(radius, 0),
+            -1 if parent_id is None else parent_id))) + "\n"
+
+
+def _stream_rows(query, params=None, batch_size=None):
+    """Execute a query in a server side cursor and yield its result rows, of
+    which only batch_size rows are held in memory at any time. Responses are
+    streamed after the request ended, possibly slowly and interleaved with
+    other generators. The cursor is therefore read in a transaction of its
+    own database connection, which is closed when all rows are read or the
+    generator is closed.
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'STREAMING_EXPORT_BATCH_SIZE', 10000)
+    stream_connection = connection.get_new_connection(
+            connection.get_connection_params())
+    try:
+        cursor = stream_connection.cursor(name='catmaid_export')
+        cursor.itersize = batch_size
+        cursor.execute(query, params)
+        for row in cursor:
+            yield row
+    finally:
+        # Ends the transaction and with it the cursor
+        stream_connection.close()
+
+
+def _breadth_first_ids(arbor):
+    """Map each node index of the passed in arbor to a new ID, counting from 1
+    in breadth-first order from the root. Children of the same parent are
+    visited in the order of their node IDs, like get_swc_string() does.
+    """
+    new_ids = np.zeros(len(arbor), dtype=np.int64)
+    next_id = 1
+    for level in arbor.levels():
+        parents = arbor.parents[level]
+        parent_ids = np.where(parents == -1, 0, new_ids[parents])
+        level = level[np.lexsort((arbor.node_ids[level], parent_ids))]
+        new_ids[level] = np.arange(next_id, next_id + len(level))
+        next_id += len(level)
+    return new_ids
+
+
+def swc_lines(skeleton_id, linearize_ids=False, batch_size=None):
+    """Generate the SWC representation of a skeleton line by line. The result
+    is the same get_swc_string() returns, but nodes are read in batches of
+    batch_size nodes. If IDs are linearized, only node and parent IDs of the
+    whole skeleton are held in memory.
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'STREAMING_EXPORT_BATCH_SIZE', 10000)
+    skeleton_id = int(skeleton_id)
+
+    if not linearize_ids:
+        rows = _stream_rows('''
+            SELECT id, location_x, location_y, location_z, radius, parent_id
+            FROM treenode
+            WHERE skeleton_id = %s
+            ORDER BY id
+        ''', (skeleton_id,), batch_size)
+        for row in rows:
+            yield _swc_line(*row)
+        return
+
+    arbor = Arbor.from_skeleton(skeleton_id)
+    new_ids = _breadth_first_ids(arbor)
+    order = np.argsort(new_ids)
+    cursor = connection.cursor()
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        cursor.execute('''
+            SELECT id, location_x, location_y, location_z, radius
+            FROM treenode
+            WHERE id = ANY(%s::bigint[])
+        ''', (arbor.node_ids[batch].tolist(),))
+        rows = {row[0]: row for row in cursor.fetchall()}
+        for index in batch:
+            row = rows[arbor.node_ids[index]]
+            parent = arbor.parents[index]
+            yield _swc_line(int(new_ids[index]), row[1], row[2], row[3],
+                    row[4], None if parent == -1 else int(new_ids[parent]))
+
+
+class _StreamingZipArchive(object):
+    """Create a zip archive incrementally. Members are deflated while their
+    data is added and each method returns the archive data that is ready to be
+    sent. The CRC and sizes of a member follow its data in a data descriptor,
+    so that no header has to be rewritten. Python's zipfile module can't
+    write members incrementally before Python 3.6. Archives larger than 4 GiB
+    or with more than 65535 members use ZIP64 records in the central
+    directory. Like with Python's zipfile module, the sizes of each member
+    have to be known in advance to use ZIP64 for them, larger members than 4
+    GiB therefore raise a ValueError.
+    """
+
+    # Members are deflated and have UTF-8 names and a data descriptor
+    FLAGS = 0x808
+    DEFLATED = 8
+    VERSION = 20
+    ZIP64_VERSION = 45
+    # Sizes and offsets (in Bytes) and the number of members from which on
+    # ZIP64 records are needed.
+    ZIP64_LIMIT = (1 << 32) - 1
+    FILECOUNT_LIMIT = (1 << 16) - 1
+
+    def __init__(self):
+        self._offset = 0
+        self._members = []
+        self._member = None
+        self._compressor = None
+        year, month, day, hour, minute, second = time.localtime()[:6]
+        self._date = (year - 1980) << 9 | month << 5 | day
+        self._time = hour << 11 | minute << 5 | second // 2
+
+    def _emit(self, data):
+        self._offset += len(data)
+        return data
+
+    def start_member(self, name):
+        name = name.encode('utf-8')
+        self._member = {
+            'name': name,
+            'offset': self._offset,
+            'crc': 0,
+            'size': 0,
+            'compressed_size': 0,
+        }
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                zlib.DEFLATED, -15)
+        return self._emit(struct.pack('<4s5H3L2H', b'PK\x03\x04',
+                self.VERSION, self.FLAGS, self.DEFLATED, self._time,
+                self._date, 0, 0, 0, len(name), 0) + name)
+
+    def write(self, data):
+        member = self._member
+        member['crc'] = zlib.crc32(data, member['crc']) & 0xffffffff
+        member['size'] += len(data)
+        compressed = self._compressor.compress(data)
+        member['compressed_size'] += len(compressed)
+        self._check_size(member)
+        return self._emit(compressed)
+
+    def end_member(self):
+        member = self._member
+        compressed = self._compressor.flush()
+        member['compressed_size'] += len(compressed)
+        self._check_size(member)
+        self._members.append(member)
+        self._member = self._compressor = None
+        return self._emit(compressed + struct.pack('<4s3L', b'PK\x07\x08',
+                member['crc'], member['compressed_size'], member['size']))
+
+    def _check_size(self, member):
+        if max(member['size'], member['compressed_size']) >= self.ZIP64_LIMIT:
+            raise ValueError("Archive member {} is larger than 4 GiB".format(
+                    member['name'].decode('utf-8')))
+
+    def _directory_entry(self, member):
+        """Return the central directory entry of a member. Offsets that don't
+        fit into four Bytes are stored in a ZIP64 extra field."""
+        offset, version, extra = member['offset'], self.VERSION, b''
+        if offset >= self.ZIP64_LIMIT:
+            extra = struct.pack('<2HQ', 1, 8, offset)
+            offset, version = 0xffffffff, self.ZIP64_VERSION
+        return struct.pack('<4s6H3L5H2L', b'PK\x01\x02', version, version,
+                self.FLAGS, self.DEFLATED, self._time, self._date,
+                member['crc'], member['compressed_size'], member['size'],
+                len(member['name']), len(extra), 0, 0, 0, 0, offset) + \
+                member['name'] + extra
+
+    def close(self):
+        """Return the central directory, which ends the archive. If there
+        are too many members or the archive is too large, a ZIP64 end of
+        central directory record and locator precede the regular end record,
+        whose values are then replaced with placeholders.
+        """
+        start = self._offset
+        directory = b''.join(self._directory_entry(m) for m in self._members)
+        count, size = len(self._members), len(directory)
+        end = b''
+        if count > self.FILECOUNT_LIMIT or size >= self.ZIP64_LIMIT or \
+                start >= self.ZIP64_LIMIT:
+            zip64_end_offset = start + size
+            end = struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44,
+                    self.ZIP64_VERSION, self.ZIP64_VERSION, 0, 0, count,
+                    count, size, start) + \
+                    struct.pack('<4sLQL', b'PK\x06\x07', 0, zip64_end_offset, 1)
+            count = min(count, 0xffff)
+            size = min(size, 0xffffffff)
+            start = min(start, 0xffffffff)
+        end += struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, count, count,
+                size, start, 0)
+        return self._emit(directory + end)
+
+
+def _swc_zip_stream(skeleton_ids, linearize_ids=False):
+    """Generate a zip archive with one SWC file per skeleton. SWC lines are
+    compressed as they are read from the database, neither a whole skeleton
+    nor the archive are held in memory.
+    """
+    archive = _StreamingZipArchive()
+    for skeleton_id in skeleton_ids:
+        yield archive.start_member('{}.swc'.format(skeleton_id))
+        for line in swc_lines(skeleton_id, linearize_ids):
+            data = archive.write(line.encode('utf-8'))
+            if data:
+                yield data
+        yield archive.end_member()
+    yield archive.close()
+
+
 def export_skeleton_response(request, project_id=None, skeleton_id=None, format=None):
+    if format == 'swc':
+        linearize_ids = request.GET.get('linearize_ids', 'false') == 'true'
+        if request.GET.get('stream', 'false') == 'true':
+            return StreamingHttpResponse(swc_lines(skeleton_id, linearize_ids),
+                    content_type='text/plain')
+
     treenode_qs, labels_qs, labelconnector_qs = get_treenodes_qs(project_id, skeleton_id)
 
     # Make sure we export in consistent order
     treenode_qs = treenode_qs.order_by('id')
 
     if format == 'swc':
-        linearize_ids = request.GET.get('linearize_ids', 'false') == 'true'
         return HttpResponse(get_swc_string(treenode_qs, linearize_ids), content_type='text/plain')
     elif format == 'json':
         return JsonResponse(treenode_qs)
@@ -154,6 +377,11 @@ def compact_skeleton_detail(request, project_id=None, skeleton_id=None):
     data. This requires the client to do slightly more work, but unfortunately
     the original creation time is needed for data that was created without
     history tables enabled.
+
+    If the "format" parameter is set to "binary", the same data is returned in
+    the columnar binary format described in catmaid.control.columnar, with the
+    tables "nodes" and "connectors" and the tags as additional header data.
+    Validity intervals are encoded as seconds since the epoch.
     ---
     parameters:
     - name: with_connectors
@@ -184,6 +412,14 @@ def compact_skeleton_detail(request, project_id=None, skeleton_id=None):
       type: boolean
       defaultValue: "false"
       paramType: form
+    - name: format
+      description: |
+        Either "json" (default) or "binary" for a columnar binary response.
+      required: false
+      type: string
+      enum: [json, binary]
+      defaultValue: json
+      paramType: form
     type:
     - type: array
       items:
@@ -198,14 +434,12 @@ def compact_skeleton_detail(request, project_id=None, skeleton_id=None):
     with_history = request.GET.get("with_history", "false") == "true"
     with_merge_history = request.GET.get("with_merge_history", "false") == "true"
 
+    response_format = columnar.get_request_format(request)
+
     result = _compact_skeleton(project_id, skeleton_id, with_connectors,
                                with_tags, with_history, with_merge_history)
 
-    return JsonResponse(result, safe=False,
-            json_dumps_params={
-                'separators': (',', ':'),
-                'default': default
-            })
+    return _compact_skeleton_response(result, with_history, response_format)
 
 @requires_user_role(UserRole.Browse)
 def compact_skeleton(request, project_id=None, skeleton_id=None, with_connectors=None, with_tags=None):
@@ -225,9 +459,145 @@ def compact_skeleton(request, project_id=None, skeleton_id=None, with_connectors
     # history is returned. Ignored if history is not retrieved.
     with_merge_history = request.GET.get("with_merge_history", "false") == "true"
 
+    response_format = columnar.get_request_format(request)
+
     result = _compact_skeleton(project_id, skeleton_id, with_connectors,
                                with_tags, with_history, with_merge_history)
 
+    return _compact_skeleton_response(result, with_history, response_format)
+
+
+@api_view(['POST'])
+@requires_user_role(UserRole.Browse)
+def compact_skeletons(request, project_id=None):
+    """Get a compact treenode representation of multiple skeletons, optionally
+    with the history of individual nodes and connectors.
+
+    This returns the same data as the compact-detail endpoint of a single
+    skeleton, but for many skeletons at once. The result is a JSON object
+    mapping each skeleton ID to an array [[nodes], [connectors], {nodeID:
+    [tags]}]. Skeletons are queried in batches and the response is streamed
+    while it is generated, which makes this the preferred way to load many
+    skeletons.
+    ---
+    parameters:
+    - name: skeleton_ids
+      description: |
+        IDs of the skeletons to return.
+      required: true
+      type: array
+      items:
+        type: integer
+      paramType: form
+    - name: with_connectors
+      description: |
+        Whether linked connectors should be returned.
+      required: false
+      type: boolean
+      defaultValue: "false"
+      paramType: form
+    - name: with_tags
+      description: |
+        Whether tags should be returned.
+      required: false
+      type: boolean
+      defaultValue: "false"
+      paramType: form
+    - name: with_history
+      description: |
+        Whether history information should be returned for each treenode and connector.
+      required: false
+      type: boolean
+      defaultValue: "false"
+      paramType: form
+    - name: with_merge_history
+      description: |
+        Whether the history of arbors merged into the requested skeletons should be returned. Only used if history is returned.
+      required: false
+      type: boolean
+      defaultValue: "false"
+      paramType: form
+    type:
+      '{skeleton_id}':
+        type: array
+        items:
+          type: string
+        required: true
+    """
+    project_id = int(project_id)
+    skeleton_ids = get_request_list(request.POST, 'skeleton_ids', map_fn=int)
+    if not skeleton_ids:
+        raise ValueError("Need at least one skeleton ID")
+    # Remove duplicates, but keep the order
+    seen = set()
+    skeleton_ids = [skid for skid in skeleton_ids
+            if not (skid in seen or seen.add(skid))]
+    with_connectors = request.POST.get("with_connectors", "false") == "true"
+    with_tags = request.POST.get("with_tags", "false") == "true"
+    with_history = request.POST.get("with_history", "false") == "true"
+    with_merge_history = request.POST.get("with_merge_history", "false") == "true"
+
+    # Make sure all skeletons exist before the response is streamed
+    existing = set(ClassInstance.objects.filter(project_id=project_id,
+            pk__in=skeleton_ids).values_list('id', flat=True))
+    missing = [skid for skid in skeleton_ids if skid not in existing]
+    if missing:
+        raise ValueError("Skeletons don't exist: {}".format(
+                ", ".join(map(str, missing))))
+
+    results = _compact_skeletons(project_id, skeleton_ids, with_connectors,
+            with_tags, with_history, with_merge_history)
+
+    def stream():
+        yield '{'
+        for n, (skeleton_id, result) in enumerate(results):
+            yield '{}"{}":{}'.format(',' if n else '', skeleton_id,
+                    json.dumps(result, separators=(',', ':'), default=default))
+        yield '}'
+
+    return StreamingHttpResponse(stream(), content_type='application/json')
+
+
+def _compact_skeleton_response(result, with_history=False, response_format='json'):
+    """Create a response for the result of _compact_skeleton(), either as
+    JSON or in the columnar binary format.
+    """
+    if response_format == 'binary':
+        nodes, connectors, tags = result
+        node_columns = [
+            ('id', 0, '<i8'),
+            ('parent_id', 1, '<i8'),
+            ('user_id', 2, '<i4'),
+            ('location_x', 3, '<f4'),
+            ('location_y', 4, '<f4'),
+            ('location_z', 5, '<f4'),
+            ('radius', 6, '<f4'),
+            ('confidence', 7, 'u1'),
+        ]
+        connector_columns = [
+            ('treenode_id', 0, '<i8'),
+            ('connector_id', 1, '<i8'),
+            ('relation', 2, '<i1'),
+            ('location_x', 3, '<f4'),
+            ('location_y', 4, '<f4'),
+            ('location_z', 5, '<f4'),
+        ]
+        if with_history:
+            node_columns.extend([
+                ('valid_from', lambda r: columnar.to_epoch(r[8]), '<f8'),
+                ('valid_to', lambda r: columnar.to_epoch(r[9]), '<f8'),
+            ])
+            connector_columns.extend([
+                ('valid_from', lambda r: columnar.to_epoch(r[6]), '<f8'),
+                ('valid_to', lambda r: columnar.to_epoch(r[7]), '<f8'),
+            ])
+        return columnar.response([
+            columnar.Table.from_rows('nodes', nodes, node_columns),
+            columnar.Table.from_rows('connectors', connectors, connector_columns),
+        ], {
+            'tags': tags
+        })
+
     return JsonResponse(result, safe=False,
             json_dumps_params={
                 'separators': (',', ':'),
@@ -255,28 +625,86 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True, with_tags=T
     history tables enabled.
     """
 
+    skeleton_id = int(skeleton_id)
+    _, result = next(_compact_skeletons(project_id, [skeleton_id],
+            with_connectors, with_tags, with_history, with_merge_history))
+
+    if 0 == len(result[0]):
+        # Check if the skeleton exists
+        if 0 == ClassInstance.objects.filter(pk=skeleton_id).count():
+            raise Exception("Skeleton #%s doesn't exist" % skeleton_id)
+        # Otherwise returns an empty list of nodes
+
+    return result
+
+
+def _compact_skeletons(project_id, skeleton_ids, with_connectors=True,
+        with_tags=True, with_history=False, with_merge_history=True,
+        batch_size=None):
+    """Generate compact treenode representations of multiple skeletons, as
+    returned by _compact_skeleton(), in the order of the passed in skeleton
+    IDs. Yields (skeleton_id, [nodes, connectors, tags]) tuples. Skeletons are
+    queried in batches of <batch_size> skeletons, using one query per table
+    and batch. This keeps the number of queries low while not requiring all
+    data to be loaded at once. Skeletons without nodes yield empty results.
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'COMPACT_SKELETON_BATCH_SIZE', 500)
+    skeleton_ids = [int(skid) for skid in skeleton_ids]
+
     cursor = connection.cursor()
 
+    if with_connectors or with_tags:
+        relations = get_relation_to_id_map(project_id, cursor=cursor)
+
+    for i in range(0, len(skeleton_ids), batch_size):
+        batch = skeleton_ids[i:i + batch_size]
+        nodes = _compact_skeleton_nodes(cursor, batch, with_history,
+                with_merge_history)
+
+        connectors = {}
+        if with_connectors:
+            connectors = _compact_skeleton_connectors(cursor, batch,
+                    relations, with_history, with_merge_history)
+
+        tags = {}
+        if with_tags:
+            tags = _compact_skeleton_tags(cursor, batch,
+                    relations['labeled_as'], with_history)
+
+        for skeleton_id in batch:
+            yield skeleton_id, [
+                tuple(nodes.get(skeleton_id, ())),
+                tuple(connectors.get(skeleton_id, ())),
+                tags.get(skeleton_id, defaultdict(list))
+            ]
+
+
+def _compact_skeleton_nodes(cursor, skeleton_ids, with_history=False,
+        with_merge_history=True):
+    """Return a dictionary mapping each passed in skeleton ID to a list of
+    node rows.
+    """
+    params = {
+        'skeleton_ids': skeleton_ids
+    }
+
     if not with_history:
         cursor.execute('''
-            SELECT id, parent_id, user_id,
+            SELECT skeleton_id, id, parent_id, user_id,
                 location_x, location_y, location_z,
                 radius, confidence
             FROM treenode
-            WHERE skeleton_id = %s
-        ''', (skeleton_id,))
-
-        nodes = tuple(cursor.fetchall())
+            WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        ''', params)
     else:
-        params = {
-            'skeleton_id': skeleton_id
-        }
         # Get present and historic nodes. If a historic validity range is empty
         # (e.g. due to a change in the same transaction), the edition time is
         # taken for both start and end validity, because this is what actually
         # happened.
         query = '''
             SELECT
+                treenode.skeleton_id,
                 treenode.id,
                 treenode.parent_id,
                 treenode.user_id,
@@ -288,9 +716,10 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True, with_tags=T
                 treenode.edition_time,
                 treenode.creation_time
             FROM treenode
-            WHERE treenode.skeleton_id = %(skeleton_id)s
+            WHERE treenode.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
             UNION ALL
             SELECT
+                treenode__history.skeleton_id,
                 treenode__history.id,
                 treenode__history.parent_id,
                 treenode__history.user_id,
@@ -302,7 +731,7 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True, with_tags=T
                 COALESCE(lower(treenode__history.sys_period), treenode__history.edition_time),
                 COALESCE(upper(treenode__history.sys_period), treenode__history.edition_time)
             FROM treenode__history
-            WHERE treenode__history.skeleton_id = %(skeleton_id)s
+            WHERE treenode__history.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
         '''
 
         if with_merge_history:
@@ -310,6 +739,7 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True, with_tags=T
                 {}
                 UNION ALL
                 SELECT
+                    t.skeleton_id,
                     th.id,
                     th.parent_id,
                     th.user_id,
@@ -323,119 +753,123 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True, with_tags=T
                 FROM treenode__history th
                 JOIN treenode t
                     ON th.id = t.id
-                    AND t.skeleton_id = %(skeleton_id)s
+                    AND t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
                     AND th.skeleton_id <> t.skeleton_id
             '''.format(query)
 
         cursor.execute(query, params)
 
-        nodes = tuple(cursor.fetchall())
+    nodes = defaultdict(list)
+    for row in cursor.fetchall():
+        nodes[row[0]].append(row[1:])
+    return nodes
 
-    if 0 == len(nodes):
-        # Check if the skeleton exists
-        if 0 == ClassInstance.objects.filter(pk=skeleton_id).count():
-            raise Exception("Skeleton #%s doesn't exist" % skeleton_id)
-        # Otherwise returns an empty list of nodes
 
-    connectors = ()
-    tags = defaultdict(list)
+def _compact_skeleton_connectors(cursor, skeleton_ids, relations,
+        with_history=False, with_merge_history=True):
+    """Return a dictionary mapping each passed in skeleton ID to a list of
+    connector link rows. The relation of each link is represented as 0 =
+    presynaptic, 1 = postsynaptic, 2 = gap junction.
+    """
+    # Fetch all connectors with their partner treenode IDs
+    pre = relations['presynaptic_to']
+    post = relations['postsynaptic_to']
+    gj = relations.get('gapjunction_with', -1)
+    relation_index = {pre: 0, post: 1, gj: 2}
+    params = {
+        'skeleton_ids': skeleton_ids,
+        'pre': pre,
+        'post': post,
+        'gj': gj
+    }
+
+    connectors = defaultdict(list)
+    if not with_history:
+        cursor.execute('''
+            SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id, tc.relation_id,
+                c.location_x, c.location_y, c.location_z
+            FROM treenode_connector tc,
+                connector c
+            WHERE tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+            AND tc.connector_id = c.id
+            AND (tc.relation_id = %(pre)s OR tc.relation_id = %(post)s OR tc.relation_id = %(gj)s)
+        ''', params)
 
-    if with_connectors or with_tags:
-        # postgres is caching this query
-        cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
-        relations = dict(cursor.fetchall())
+        for row in cursor.fetchall():
+            connectors[row[0]].append((row[1], row[2], relation_index.get(row[3], -1), row[4], row[5], row[6]))
+    else:
+        # Get present and historic connectors. If a historic validity range
+        # is empty (e.g. due to a change in the same transaction), the
+        # edition time is taken for both start and end validity, because
+        # this is what actually happened.
+        query = '''
+            SELECT links.skeleton_id, links.treenode_id, links.connector_id, links.relation_id,
+                    c.location_x, c.location_y, c.location_z,
+                    links.valid_from, links.valid_to
+            FROM (
+                SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id, tc.relation_id,
+                    tc.edition_time, tc.creation_time
+                FROM treenode_connector tc
+                WHERE tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+                UNION ALL
+                SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id, tc.relation_id,
+                    COALESCE(lower(tc.sys_period), tc.edition_time),
+                    COALESCE(upper(tc.sys_period), tc.edition_time)
+                FROM treenode_connector__history tc
+                WHERE tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+                {}
+            ) links(skeleton_id, treenode_id, connector_id, relation_id, valid_from, valid_to)
+            JOIN connector__with_history c
+                ON links.connector_id = c.id
+            WHERE (links.relation_id = %(pre)s OR links.relation_id = %(post)s OR links.relation_id = %(gj)s)
+        '''
 
-    if with_connectors:
-        # Fetch all connectors with their partner treenode IDs
-        pre = relations['presynaptic_to']
-        post = relations['postsynaptic_to']
-        gj = relations.get('gapjunction_with', -1)
-        relation_index = {pre: 0, post: 1, gj: 2}
-        if not with_history:
-            cursor.execute('''
-                SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
-                    c.location_x, c.location_y, c.location_z
-                FROM treenode_connector tc,
-                    connector c
-                WHERE tc.skeleton_id = %s
-                AND tc.connector_id = c.id
-                AND (tc.relation_id = %s OR tc.relation_id = %s OR tc.relation_id = %s)
-            ''', (skeleton_id, pre, post, gj))
-
-            connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5]) for row in cursor.fetchall())
+        if with_merge_history:
+            query =  query.format('''
+                UNION ALL
+                SELECT tc.skeleton_id, tch.treenode_id, tch.connector_id, tch.relation_id,
+                    COALESCE(lower(tch.sys_period), tch.edition_time),
+                    COALESCE(upper(tch.sys_period), tch.edition_time)
+                FROM treenode_connector__history tch
+                JOIN treenode_connector tc
+                    ON tc.id = tch.id
+                    AND tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+                    AND tch.skeleton_id <> tc.skeleton_id
+            ''')
         else:
-            params = {
-                'skeleton_id': skeleton_id,
-                'pre': pre,
-                'post': post,
-                'gj': gj
-            }
-
-            # Get present and historic connectors. If a historic validity range
-            # is empty (e.g. due to a change in the same transaction), the
-            # edition time is taken for both start and end validity, because
-            # this is what actually happened.
-            query = '''
-                SELECT links.treenode_id, links.connector_id, links.relation_id,
-                        c.location_x, c.location_y, c.location_z,
-                        links.valid_from, links.valid_to
-                FROM (
-                    SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
-                        tc.edition_time, tc.creation_time
-                    FROM treenode_connector tc
-                    WHERE tc.skeleton_id = %(skeleton_id)s
-                    UNION ALL
-                    SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
-                        COALESCE(lower(tc.sys_period), tc.edition_time),
-                        COALESCE(upper(tc.sys_period), tc.edition_time)
-                    FROM treenode_connector__history tc
-                    WHERE tc.skeleton_id = %(skeleton_id)s
-                    {}
-                ) links(treenode_id, connector_id, relation_id, valid_from, valid_to)
-                JOIN connector__with_history c
-                    ON links.connector_id = c.id
-                WHERE (links.relation_id = %(pre)s OR links.relation_id = %(post)s OR links.relation_id = %(gj)s)
-            '''
-
-            if with_merge_history:
-                query =  query.format('''
-                    UNION ALL
-                    SELECT tch.treenode_id, tch.connector_id, tch.relation_id,
-                        COALESCE(lower(tch.sys_period), tch.edition_time),
-                        COALESCE(upper(tch.sys_period), tch.edition_time)
-                    FROM treenode_connector__history tch
-                    JOIN treenode_connector tc
-                        ON tc.id = tch.id
-                        AND tc.skeleton_id = %(skeleton_id)s
-                        AND tch.skeleton_id <> tc.skeleton_id
-                ''')
-            else:
-                query = query.format('')
+            query = query.format('')
 
-            cursor.execute(query, params)
+        cursor.execute(query, params)
 
-            connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6], row[7]) for row in cursor.fetchall())
+        for row in cursor.fetchall():
+            connectors[row[0]].append((row[1], row[2], relation_index.get(row[3], -1), row[4], row[5], row[6], row[7], row[8]))
 
-    if with_tags:
-        history_suffix = '__with_history' if with_history else ''
-        t_history_query = ', tci.edition_time' if with_history else ''
-        # Fetch all node tags
-        cursor.execute('''
-            SELECT c.name, tci.treenode_id
-                   {0}
-            FROM treenode{1} t,
-                 treenode_class_instance{1} tci,
-                 class_instance{1} c
-            WHERE t.skeleton_id = %s
-              AND t.id = tci.treenode_id
-              AND tci.relation_id = %s
-              AND c.id = tci.class_instance_id
-        '''.format(t_history_query, history_suffix), (skeleton_id, relations['labeled_as']))
+    return connectors
 
-        for row in cursor.fetchall():
-            tags[row[0]].append(row[1])
 
-    return [nodes, connectors, tags]
+def _compact_skeleton_tags(cursor, skeleton_ids, labeled_as, with_history=False):
+    """Return a dictionary mapping each passed in skeleton ID to a dictionary
+    mapping tag names to lists of node IDs.
+    """
+    history_suffix = '__with_history' if with_history else ''
+    t_history_query = ', tci.edition_time' if with_history else ''
+    # Fetch all node tags
+    cursor.execute('''
+        SELECT t.skeleton_id, c.name, tci.treenode_id
+               {0}
+        FROM treenode{1} t,
+             treenode_class_instance{1} tci,
+             class_instance{1} c
+        WHERE t.skeleton_id = ANY(%s::bigint[])
+          AND t.id = tci.treenode_id
+          AND tci.relation_id = %s
+          AND c.id = tci.class_instance_id
+    '''.format(t_history_query, history_suffix), (skeleton_ids, labeled_as))
+
+    tags = defaultdict(partial(defaultdict, list))
+    for row in cursor.fetchall():
+        tags[row[0]][row[1]].append(row[2])
+    return tags
 
 
 def _compact_arbor(project_id=None, skeleton_id=None, with_nodes=None,
@@ -498,9 +932,7 @@ def _compact_arbor(project_id=None, skeleton_id=None, with_nodes=None,
             # Otherwise returns an empty list of nodes
 
     if 0 != with_connectors or 0 != with_tags:
-        # postgres is caching this query
-        cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
-        relations = dict(cursor.fetchall())
+        relations = get_relation_to_id_map(project_id, cursor=cursor)
 
     if 0 != with_connectors:
         # Fetch all inputs and outputs
@@ -632,8 +1064,7 @@ def _skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=True, lean=
 
     if 0 == lean: # meaning not lean
         # Text tags
-        cursor.execute("SELECT id FROM relation WHERE project_id=%s AND relation_name='labeled_as'" % int(project_id))
-        labeled_as = cursor.fetchall()[0][0]
+        labeled_as = get_relation_to_id_map(project_id, ('labeled_as',), cursor)['labeled_as']
 
         cursor.execute(
              ''' SELECT treenode_class_instance.treenode_id, class_instance.name
@@ -705,6 +1136,115 @@ def skeleton_with_metadata(request, project_id=None, skeleton_id=None):
     return HttpResponse(json.dumps(_skeleton_for_3d_viewer(skeleton_id, project_id, \
         with_connectors=True, lean=0, all_field=True), separators=(',', ':'), default=default))
 
+class SkeletonMeasurements(object):
+    """Cable length and topology measurements of a single skeleton."""
+
+    def __init__(self):
+        self.n_nodes = 0
+        self.raw_cable = 0
+        self.smooth_cable = 0
+        self.principal_branch_cable = 0
+        self.n_ends = 0
+        self.n_branch = 0
+        self.n_pre = 0
+        self.n_post = 0
+
+
+def _measure_arbors(ids, parent_ids, skeleton_ids, locations):
+    """Measure any number of skeletons at once, based on flat NumPy arrays of
+    node IDs, parent IDs (-1 for root nodes), skeleton IDs and an Nx3 array of
+    node locations. All computations are done on parent index arrays. Returns
+    a dictionary of per skeleton arrays, indexed like the sorted unique
+    skeleton IDs, which are returned as well.
+
+    Raw cable is the sum of all edge lengths. For smoothed cable, each slab
+    node is moved to 0.4 of its own position and 0.6 of the average of its
+    neighbors, weighted by their distance. Root, branch and end nodes don't
+    move. The principal branch runs from the end node farthest away (in
+    edges) from the root to the root.
+    """
+    n = len(ids)
+    skids, skeleton_index = np.unique(skeleton_ids, return_inverse=True)
+    n_skeletons = len(skids)
+
+    # Map parent IDs to array indices
+    order = np.argsort(ids)
+    has_parent = parent_ids != -1
+    parent_index = np.full(n, -1, dtype=np.int64)
+    parent_index[has_parent] = order[np.searchsorted(ids, parent_ids[has_parent],
+            sorter=order)]
+    children = np.flatnonzero(has_parent)
+    parents = parent_index[children]
+
+    # Edge lengths, stored at the child node of each edge
+    distances = np.zeros(n)
+    distances[children] = np.linalg.norm(locations[children] -
+            locations[parents], axis=1)
+
+    n_children = np.bincount(parents, minlength=n)
+    is_root = ~has_parent
+    is_end = (has_parent & (n_children == 0)) | (is_root & (n_children == 1))
+    is_branch = (has_parent & (n_children > 1)) | (is_root & (n_children > 2))
+    is_slab = ~(is_end | is_branch)
+
+    # Distance weighted sum of neighbor locations: children and parent
+    sum_distances = np.bincount(parents, weights=distances[children],
+            minlength=n) + distances
+    weighted = np.zeros((n, 3))
+    for dim in range(3):
+        weighted[:, dim] = np.bincount(parents, minlength=n,
+                weights=distances[children] * locations[children, dim])
+    weighted[children] += distances[children, np.newaxis] * locations[parents]
+    nonzero = sum_distances != 0
+    weighted[nonzero] /= sum_distances[nonzero, np.newaxis]
+
+    smoothed = locations.copy()
+    smoothed[is_slab] = locations[is_slab] * 0.4 + weighted[is_slab] * 0.6
+
+    smooth_distances = np.zeros(n)
+    smooth_distances[children] = np.linalg.norm(smoothed[children] -
+            smoothed[parents], axis=1)
+
+    # Edge count and smoothed cable to root for every node, computed by
+    # repeatedly jumping to the ancestor reached so far.
+    depth = has_parent.astype(np.int64)
+    cable_to_root = smooth_distances.copy()
+    jump = parent_index.copy()
+    active = np.flatnonzero(jump != -1)
+    while len(active):
+        target = jump[active]
+        depth[active] += depth[target]
+        cable_to_root[active] += cable_to_root[target]
+        jump[active] = jump[target]
+        active = active[jump[active] != -1]
+
+    # Find the deepest end node of each skeleton, lower node IDs win ties
+    principal_branch_cable = np.zeros(n_skeletons)
+    leaves = np.flatnonzero(has_parent & (n_children == 0))
+    if len(leaves):
+        leaves = leaves[np.lexsort((ids[leaves], -depth[leaves],
+                skeleton_index[leaves]))]
+        first = np.ones(len(leaves), dtype=bool)
+        first[1:] = skeleton_index[leaves][1:] != skeleton_index[leaves][:-1]
+        deepest = leaves[first]
+        principal_branch_cable[skeleton_index[deepest]] = cable_to_root[deepest]
+
+    def per_skeleton(weights=None, mask=None):
+        index = skeleton_index if mask is None else skeleton_index[mask]
+        if weights is not None and mask is not None:
+            weights = weights[mask]
+        return np.bincount(index, weights=weights, minlength=n_skeletons)
+
+    return skids, {
+        'n_nodes': per_skeleton(),
+        'raw_cable': per_skeleton(distances),
+        'smooth_cable': per_skeleton(smooth_distances),
+        'principal_branch_cable': principal_branch_cable,
+        'n_ends': per_skeleton(mask=is_end),
+        'n_branch': per_skeleton(mask=is_branch),
+    }
+
+
 def _measure_skeletons(skeleton_ids):
     if not skeleton_ids:
         raise Exception("Must provide the ID of at least one skeleton.")
@@ -713,110 +1253,30 @@ def _measure_skeletons(skeleton_ids):
 
     cursor = connection.cursor()
     cursor.execute('''
-    SELECT id, parent_id, skeleton_id, location_x, location_y, location_z
+    SELECT id, COALESCE(parent_id, -1), skeleton_id,
+           location_x, location_y, location_z
     FROM treenode
     WHERE skeleton_id IN (%s)
     ''' % skids_string)
 
-    # TODO should be all done with numpy,
-    # TODO  by partitioning the skeleton into sequences of x,y,z representing the slabs
-    # TODO  and then convolving them.
-
-    class Skeleton():
-        def __init__(self):
-            self.nodes = {}
-            self.raw_cable = 0
-            self.smooth_cable = 0
-            self.principal_branch_cable = 0
-            self.n_ends = 0
-            self.n_branch = 0
-            self.n_pre = 0
-            self.n_post = 0
-
-    class Node():
-        def __init__(self, parent_id, x, y, z):
-            self.parent_id = parent_id
-            self.x = x
-            self.y = y
-            self.z = z
-            self.wx = x # weighted average of itself and neighbors
-            self.wy = y
-            self.wz = z
-            self.children = {} # node ID vs distance
-
-    skeletons = defaultdict(dict) # skeleton ID vs (node ID vs Node)
-    for row in cursor.fetchall():
-        skeleton = skeletons.get(row[2])
-        if not skeleton:
-            skeleton = Skeleton()
-            skeletons[row[2]] = skeleton
-        skeleton.nodes[row[0]] = Node(row[1], row[3], row[4], row[5])
-
-    for skeleton in six.itervalues(skeletons):
-        nodes = skeleton.nodes
-        tree = nx.DiGraph()
-        root = None
-        # Accumulate children
-        for nodeID, node in six.iteritems(nodes):
-            if not node.parent_id:
-                root = nodeID
-                continue
-            tree.add_edge(node.parent_id, nodeID)
-            parent = nodes[node.parent_id]
-            distance = sqrt(  pow(node.x - parent.x, 2)
-                            + pow(node.y - parent.y, 2)
-                            + pow(node.z - parent.z, 2))
-            parent.children[nodeID] = distance
-            # Measure raw cable, given that we have the parent already
-            skeleton.raw_cable += distance
-        # Utilize accumulated children and the distances to them
-        for nodeID, node in six.iteritems(nodes):
-            # Count end nodes and branch nodes
-            n_children = len(node.children)
-            if not node.parent_id:
-                if 1 == n_children:
-                    skeleton.n_ends += 1
-                    continue
-                if n_children > 2:
-                    skeleton.n_branch += 1
-                    continue
-                # Else, if 2 == n_children, the root node is in the middle of the skeleton, being a slab node
-            elif 0 == n_children:
-                skeleton.n_ends += 1
-                continue
-            elif n_children > 1:
-                skeleton.n_branch += 1
-                continue
-            # Compute weighted position for slab nodes only
-            # (root, branch and end nodes do not move)
-            oids = node.children.copy()
-            if node.parent_id:
-                oids[node.parent_id] = skeleton.nodes[node.parent_id].children[nodeID]
-            sum_distances = sum(six.itervalues(oids))
-            wx, wy, wz = 0, 0, 0
-            for oid, distance in six.iteritems(oids):
-                other = skeleton.nodes[oid]
-                w = distance / sum_distances if sum_distances != 0 else 0
-                wx += other.x * w
-                wy += other.y * w
-                wz += other.z * w
-            node.wx = node.x * 0.4 + wx * 0.6
-            node.wy = node.y * 0.4 + wy * 0.6
-            node.wz = node.z * 0.4 + wz * 0.6
-        # Find out nodes that belong to the principal branch
-        principal_branch_nodes = set(sorted(partition(tree, root), key=len)[-1])
-        # Compute smoothed cable length, also for principal branch
-        for nodeID, node in six.iteritems(nodes):
-            if not node.parent_id:
-                # root node
-                continue
-            parent = nodes[node.parent_id]
-            length = sqrt(  pow(node.wx - parent.wx, 2)
-                          + pow(node.wy - parent.wy, 2)
-                          + pow(node.wz - parent.wz, 2))
-            skeleton.smooth_cable += length
-            if nodeID in principal_branch_nodes:
-                skeleton.principal_branch_cable += length
+    rows = cursor.fetchall()
+    skeletons = {}
+    if rows:
+        ids, parent_ids, node_skeleton_ids = (np.array(c, dtype=np.int64)
+                for c in zip(*(r[:3] for r in rows)))
+        locations = np.array([r[3:6] for r in rows], dtype=np.float64)
+        skids, measurements = _measure_arbors(ids, parent_ids,
+                node_skeleton_ids, locations)
+        for i, skid in enumerate(skids.tolist()):
+            skeleton = SkeletonMeasurements()
+            skeleton.n_nodes = int(measurements['n_nodes'][i])
+            skeleton.raw_cable = float(measurements['raw_cable'][i])
+            skeleton.smooth_cable = float(measurements['smooth_cable'][i])
+            skeleton.principal_branch_cable = \
+                    float(measurements['principal_branch_cable'][i])
+            skeleton.n_ends = int(measurements['n_ends'][i])
+            skeleton.n_branch = int(measurements['n_branch'][i])
+            skeletons[skid] = skeleton
 
     # Count inputs
     cursor.execute('''
@@ -830,7 +1290,8 @@ def _measure_skeletons(skeleton_ids):
     ''' % skids_string)
 
     for row in cursor.fetchall():
-        skeletons[row[0]].n_pre = row[1]
+        if row[0] in skeletons:
+            skeletons[row[0]].n_pre = row[1]
 
     # Count outputs
     cursor.execute('''
@@ -849,7 +1310,8 @@ def _measure_skeletons(skeleton_ids):
     ''' % skids_string)
 
     for row in cursor.fetchall():
-        skeletons[row[0]].n_post = row[1]
+        if row[0] in skeletons:
+            skeletons[row[0]].n_post = row[1]
 
     return skeletons
 
@@ -858,8 +1320,8 @@ def _measure_skeletons(skeleton_ids):
 def measure_skeletons(request, project_id=None):
     skeleton_ids = tuple(int(v) for k,v in six.iteritems(request.POST) if k.startswith('skeleton_ids['))
     def asRow(skid, sk):
-        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, len(sk.nodes), sk.n_branch, sk.n_ends, sk.principal_branch_cable)
-    return HttpResponse(json.dumps([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).iteritems()]))
+        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, sk.n_nodes, sk.n_branch, sk.n_ends, sk.principal_branch_cable)
+    return HttpResponse(json.dumps([asRow(skid, sk) for skid, sk in six.iteritems(_measure_skeletons(skeleton_ids))]))
 
 
 def _skeleton_neuroml_cell(skeleton_id, preID, postID):
@@ -946,6 +1408,8 @@ def export_neuroml_level3_v181(request, project_id=None):
         WHERE skeleton_id IN (%s)
         ORDER BY skeleton_id
         ''' % skeleton_strings
+    # Treenodes are read in batches while the response is streamed
+    treenodes = _stream_rows(skeleton_query)
 
     if 0 == mode:
         cursor.execute('''
@@ -969,9 +1433,7 @@ def export_neuroml_level3_v181(request, project_id=None):
                 for post_treenodeID, skID2 in m[postsynaptic_to]:
                     connections[skID1][skID2].append((pre_treenodeID, post_treenodeID))
 
-        cursor.execute(skeleton_query)
-
-        generator = export_NeuroML_Level3.exportMutual(neuron_names, cursor.fetchall(), connections)
+        generator = export_NeuroML_Level3.exportMutual(neuron_names, treenodes, connections)
 
     else:
         if len(skeleton_ids) > 1:
@@ -1002,11 +1464,9 @@ def export_neuroml_level3_v181(request, project_id=None):
         for row in cursor.fetchall():
             inputs[row[0]].append(row[1])
 
-        cursor.execute(skeleton_query)
-
-        generator = export_NeuroML_Level3.exportSingle(neuron_names, cursor.fetchall(), inputs)
+        generator = export_NeuroML_Level3.exportSingle(neuron_names, treenodes, inputs)
 
-    response = HttpResponse(generator, content_type='text/plain')
+    response = StreamingHttpResponse(generator, content_type='text/plain')
     response['Content-Disposition'] = 'attachment; filename=neuronal-circuit.neuroml'
 
     return response
@@ -1018,6 +1478,60 @@ def skeleton_swc(*args, **kwargs):
     return export_skeleton_response(*args, **kwargs)
 
 
+@api_view(['GET', 'POST'])
+@requires_user_role(UserRole.Browse)
+def skeletons_swc(request, project_id=None):
+    """Export multiple skeletons as a zip archive of SWC files.
+
+    The archive contains one file named "<skeleton_id>.swc" for each
+    requested skeleton. Its content is the same as the one of the single
+    skeleton SWC export. The archive is streamed while it is generated from
+    batches of treenodes.
+    ---
+    parameters:
+    - name: skeleton_ids
+      description: |
+        IDs of the skeletons to export.
+      required: true
+      type: array
+      items:
+        type: integer
+      paramType: form
+    - name: linearize_ids
+      description: |
+        Whether node IDs should be replaced by incremental IDs, starting with
+        1 at the root node and counting in breadth-first order.
+      required: false
+      type: boolean
+      defaultValue: "false"
+      paramType: form
+    """
+    project_id = int(project_id)
+    data = request.POST if request.method == 'POST' else request.GET
+    skeleton_ids = get_request_list(data, 'skeleton_ids', map_fn=int)
+    if not skeleton_ids:
+        raise ValueError("Need at least one skeleton ID")
+    # Remove duplicates, but keep the order
+    seen = set()
+    skeleton_ids = [skid for skid in skeleton_ids
+            if not (skid in seen or seen.add(skid))]
+    linearize_ids = data.get('linearize_ids', 'false') == 'true'
+
+    # Make sure all skeletons exist before the response is streamed
+    existing = set(ClassInstance.objects.filter(project_id=project_id,
+            pk__in=skeleton_ids).values_list('id', flat=True))
+    missing = [skid for skid in skeleton_ids if skid not in existing]
+    if missing:
+        raise ValueError("Skeletons don't exist: {}".format(
+                ", ".join(map(str, missing))))
+
+    response = StreamingHttpResponse(_swc_zip_stream(skeleton_ids,
+            linearize_ids), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename=skeletons-swc.zip'
+
+    return response
+
+
 def _export_review_skeleton(project_id=None, skeleton_id=None,
                             subarbor_node_id=None):
     """ Returns a list of segments for the requested skeleton. Each segment
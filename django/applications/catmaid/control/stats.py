@@ -10,20 +10,244 @@ from dateutil import parser as dateparser
 from django.conf import settings
 from django.http import HttpResponse
 from django.db.models.aggregates import Count
-from django.db import connection
+from django.db import connection, transaction
 from django.utils import timezone
 
+from celery.task import periodic_task
+
 from rest_framework.decorators import api_view
 
 from catmaid.control.authentication import requires_user_role
-from catmaid.control.common import get_relation_to_id_map
 from catmaid.models import ClassInstance, Connector, Treenode, User, UserRole, \
         Review, Relation, TreenodeConnector
 
 
-def _process(query, minus1name):
+# The length of the periods of the contribution summary (see the
+# stats_summary_date() database function). Offsets of today's time zones to UTC
+# are multiples of it, days in these time zones therefore consist of whole
+# periods.
+STATS_SUMMARY_PERIOD = timedelta(minutes=15)
+
+# The entries of the contribution summary, i.e. the contributions to projects
+# per project, user and period: existing nodes created in this period and the
+# length of the edges to their parents, nodes of other users last edited in
+# this period, completed synaptic links and reviews. A synaptic link is completed
+# by the younger one of a presynaptic and a postsynaptic link of the same
+# connector. The {created}, {edited}, {linked} and {reviewed} placeholders can
+# restrict the read rows with a join.
+stats_summary_entries_query = '''
+    SELECT project_id, user_id, stats_summary_date(event_time) AS date,
+        sum(n_treenodes)::integer AS n_treenodes,
+        sum(n_edited_treenodes)::integer AS n_edited_treenodes,
+        sum(n_connector_links)::integer AS n_connector_links,
+        sum(n_reviewed_nodes)::integer AS n_reviewed_nodes,
+        sum(cable_length) AS cable_length
+    FROM (
+        SELECT t.project_id, t.user_id, t.creation_time AS event_time,
+            1 AS n_treenodes, 0 AS n_edited_treenodes, 0 AS n_connector_links,
+            0 AS n_reviewed_nodes,
+            COALESCE(sqrt(
+                (t.location_x::double precision - p.location_x) ^ 2 +
+                (t.location_y::double precision - p.location_y) ^ 2 +
+                (t.location_z::double precision - p.location_z) ^ 2), 0)
+                AS cable_length
+        FROM treenode t
+        {created}
+        LEFT JOIN treenode p
+            ON p.id = t.parent_id
+        WHERE (%(project_id)s IS NULL OR t.project_id = %(project_id)s)
+
+        UNION ALL
+
+        SELECT t.project_id, t.editor_id, t.edition_time, 0, 1, 0, 0, 0
+        FROM treenode t
+        {edited}
+        WHERE t.editor_id <> t.user_id
+          AND (%(project_id)s IS NULL OR t.project_id = %(project_id)s)
+
+        UNION ALL
+
+        SELECT t1.project_id, t1.user_id, t1.creation_time, 0, 0, 1, 0, 0
+        FROM treenode_connector t1
+        {linked}
+        JOIN relation r1
+            ON r1.id = t1.relation_id
+        JOIN treenode_connector t2
+            ON t2.connector_id = t1.connector_id
+        JOIN relation r2
+            ON r2.id = t2.relation_id
+        WHERE (%(project_id)s IS NULL OR t1.project_id = %(project_id)s)
+          AND r1.relation_name IN ('presynaptic_to', 'postsynaptic_to')
+          AND r2.relation_name IN ('presynaptic_to', 'postsynaptic_to')
+          AND t1.relation_id <> t2.relation_id
+          AND t1.creation_time > t2.creation_time
+
+        UNION ALL
+
+        SELECT r.project_id, r.reviewer_id, r.review_time, 0, 0, 0, 1, 0
+        FROM review r
+        {reviewed}
+        WHERE (%(project_id)s IS NULL OR r.project_id = %(project_id)s)
+    ) contributions
+    GROUP BY project_id, user_id, date
+'''
+
+stats_summary_columns = '''
+    project_id, user_id, date, n_treenodes, n_edited_treenodes,
+    n_connector_links, n_reviewed_nodes, cable_length
+'''
+
+
+def _stats_summary_entries_query(entries=None):
+    """Return a query for summary entries of the project passed in as
+    project_id parameter or of all projects if it is NULL. If a relation with
+    project_id, user_id and date columns is passed in, only these entries are
+    computed and only rows of their periods are read.
+    """
+    if entries is None:
+        return stats_summary_entries_query.format(created='', edited='',
+                linked='', reviewed='')
+    join = '''
+        JOIN {entries} e
+            ON e.project_id = {alias}.project_id
+           AND e.user_id = {alias}.{user}
+           AND {alias}.{time} >= e.date
+           AND {alias}.{time} < e.date + interval '15 minutes'
+    '''
+    return stats_summary_entries_query.format(
+        created=join.format(entries=entries, alias='t', user='user_id',
+                time='creation_time'),
+        edited=join.format(entries=entries, alias='t', user='editor_id',
+                time='edition_time'),
+        linked=join.format(entries=entries, alias='t1', user='user_id',
+                time='creation_time'),
+        reviewed=join.format(entries=entries, alias='r', user='reviewer_id',
+                time='review_time'))
+
+
+def update_stats_summary(cursor):
+    """Recompute all summary entries that are outdated according to the
+    recorded changes and return their number. Changes of transactions that
+    commit while this runs stay recorded for the next update.
+    """
+    # Updates are serialized, an update with an older snapshot could
+    # otherwise overwrite newer entries. Reading is still possible.
+    cursor.execute('''
+        LOCK TABLE catmaid_stats_summary IN EXCLUSIVE MODE;
+        DROP TABLE IF EXISTS outdated_stats_summary;
+        CREATE TEMPORARY TABLE outdated_stats_summary (
+            project_id integer,
+            user_id integer,
+            date timestamptz
+        ) ON COMMIT DROP;
+    ''')
+    # Changes have to be removed before entries are recomputed, so that
+    # entries read changes of at least all removed changes.
+    cursor.execute('''
+        WITH changes AS (
+            DELETE FROM catmaid_stats_summary_change
+            RETURNING project_id, user_id, date
+        )
+        INSERT INTO outdated_stats_summary
+        SELECT DISTINCT project_id, user_id, date
+        FROM changes
+    ''')
+    n_outdated = cursor.rowcount
+
+    cursor.execute('''
+        DELETE FROM catmaid_stats_summary s
+        USING outdated_stats_summary o
+        WHERE s.project_id = o.project_id
+          AND s.user_id = o.user_id
+          AND s.date = o.date;
+
+        INSERT INTO catmaid_stats_summary ({columns})
+        SELECT {columns}
+        FROM ({entries}) entries;
+    '''.format(columns=stats_summary_columns,
+            entries=_stats_summary_entries_query('outdated_stats_summary')), {
+        'project_id': None,
+    })
+    return n_outdated
+
+
+def rebuild_stats_summary(cursor, project_id=None):
+    """Replace the contribution summary of the passed in project, or of all
+    projects, with a newly computed one. This is needed if changes weren't
+    recorded, e.g. because triggers were disabled during an import. The
+    number of summary entries is returned.
+    """
+    cursor.execute('''
+        LOCK TABLE catmaid_stats_summary IN EXCLUSIVE MODE;
+        DELETE FROM catmaid_stats_summary_change
+        WHERE %(project_id)s IS NULL OR project_id = %(project_id)s;
+        DELETE FROM catmaid_stats_summary
+        WHERE %(project_id)s IS NULL OR project_id = %(project_id)s;
+    ''', {
+        'project_id': project_id,
+    })
+    cursor.execute('''
+        INSERT INTO catmaid_stats_summary ({columns})
+        SELECT {columns}
+        FROM ({entries}) entries
+    '''.format(columns=stats_summary_columns,
+            entries=_stats_summary_entries_query()), {
+        'project_id': project_id,
+    })
+    return cursor.rowcount
+
+
+@periodic_task(run_every=timedelta(seconds=settings.STATS_SUMMARY_UPDATE_INTERVAL))
+def update_stats_summary_task():
+    with transaction.atomic():
+        n_updated = update_stats_summary(connection.cursor())
+    return "Updated %s contribution summary entries" % n_updated
+
+
+def _stats_summary_query(project_id, start_date=None, end_date=None):
+    """Return a query for the contributions to a project per user and period
+    in the passed in time range, along with its parameters. The range is
+    extended to the start of the period that contains the start date. Summary
+    entries that are outdated are computed directly.
+    """
+    if start_date:
+        since_epoch = start_date - datetime(1970, 1, 1, tzinfo=pytz.utc)
+        start_date -= timedelta(seconds=(since_epoch.days * 86400 +
+                since_epoch.seconds) % STATS_SUMMARY_PERIOD.seconds,
+                microseconds=since_epoch.microseconds)
+    outdated = '''(
+        SELECT DISTINCT project_id, user_id, date
+        FROM catmaid_stats_summary_change
+        WHERE project_id = %(project_id)s
+          AND date >= %(start_date)s::timestamptz
+          AND date < %(end_date)s::timestamptz
+    )'''
+    query = '''
+        SELECT {columns}
+        FROM catmaid_stats_summary s
+        WHERE project_id = %(project_id)s
+          AND date >= %(start_date)s::timestamptz
+          AND date < %(end_date)s::timestamptz
+          AND NOT EXISTS (
+            SELECT 1 FROM catmaid_stats_summary_change c
+            WHERE c.project_id = s.project_id
+              AND c.user_id = s.user_id
+              AND c.date = s.date)
+        UNION ALL
+        SELECT {columns}
+        FROM ({entries}) entries
+    '''.format(columns=stats_summary_columns,
+            entries=_stats_summary_entries_query(outdated))
+    return query, {
+        'project_id': int(project_id),
+        'start_date': start_date or '-infinity',
+        'end_date': end_date or 'infinity',
+    }
+
+
+def _process(query, params, minus1name):
     cursor = connection.cursor()
-    cursor.execute(query)
+    cursor.execute(query, params)
 
     # Get name dictonary separately to avoid joining the user table to the
     # treenode table, which in turn improves performance.
@@ -40,23 +264,24 @@ def _process(query, minus1name):
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def stats_nodecount(request, project_id=None):
+    query, params = _stats_summary_query(project_id)
     return _process('''
-    SELECT user_id, count(*)
-    FROM treenode
-    WHERE project_id=%s
+    SELECT user_id, sum(n_treenodes)
+    FROM ({}) summary
     GROUP BY user_id
-    ''' % int(project_id), "*anonymous*")
+    HAVING sum(n_treenodes) > 0
+    '''.format(query), params, "*anonymous*")
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def stats_editor(request, project_id=None):
+    query, params = _stats_summary_query(project_id)
     return _process('''
-    SELECT editor_id, count(editor_id)
-    FROM treenode
-    WHERE project_id=%s
-      AND editor_id != user_id
-    GROUP BY username
-    ''' % int(project_id), "*unedited*")
+    SELECT user_id, sum(n_edited_treenodes)
+    FROM ({}) summary
+    GROUP BY user_id
+    HAVING sum(n_edited_treenodes) > 0
+    '''.format(query), params, "*unedited*")
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -290,90 +515,31 @@ def stats_user_history(request, project_id=None):
             date = (start_date + timedelta(days=i)).strftime("%Y%m%d")
             stats_table[userid][date] = {}
 
-    # Look up all tree nodes for the project in the given date range. Also add
-    # a computed field which is just the day of the last edited date/time.
-    treenode_stats = []
+    # Get the created cable length, completed synaptic links and reviews per
+    # user and day in the requested time zone from the contribution summary.
+    query, params = _stats_summary_query(project_id, start_date_utc,
+            end_date_utc)
+    params['tz'] = time_zone.zone
     cursor = connection.cursor()
-
-    cursor.execute('''
-        SELECT child.uid, child.day, round(sum(edge.length))
-        FROM (
-            SELECT
-                child.user_id AS uid,
-                date_trunc('day', timezone(%(tz)s, child.creation_time)) AS day,
-                child.parent_id,
-                child.location_x,
-                child.location_y,
-                child.location_z
-            FROM treenode child
-            WHERE child.project_id = %(project_id)s
-              AND child.creation_time >= %(start_date)s
-              AND child.creation_time < %(end_date)s
-        ) AS child
-        INNER JOIN LATERAL (
-            SELECT sqrt(pow(child.location_x - parent.location_x, 2)
-                      + pow(child.location_y - parent.location_y, 2)
-                      + pow(child.location_z - parent.location_z, 2)) AS length
-            FROM treenode parent
-            WHERE parent.project_id = %(project_id)s
-              AND parent.id = child.parent_id
-            LIMIT 1
-        ) AS edge ON TRUE
-        GROUP BY child.uid, child.day
-    ''', dict(tz=time_zone.zone, project_id=project_id, start_date=start_date_utc,
-              end_date=end_date_utc))
-
-    treenode_stats = cursor.fetchall()
-
-    relations = get_relation_to_id_map(project_id, cursor=cursor)
-    preId, postId = relations['presynaptic_to'], relations['postsynaptic_to']
-
-    # Retrieve a list of how many completed connector relations a user has
-    # created in a given time frame. A completed connector relation is either
-    # one were a user created both the presynaptic and the postsynaptic side
-    # (one of them in the given time frame) or if a user completes an existing
-    # 'half connection'. To avoid duplicates, only links are counted, where the
-    # second node is younger than the first one
-    cursor.execute('''
-        SELECT t1.user_id, (date_trunc('day', timezone(%s, t1.creation_time))) AS date, count(*)
-        FROM treenode_connector t1
-        JOIN treenode_connector t2 ON t1.connector_id = t2.connector_id
-        WHERE t1.project_id=%s
-        AND t1.creation_time >= %s AND t1.creation_time < %s
-        AND t1.relation_id <> t2.relation_id
-        AND (t1.relation_id = %s OR t1.relation_id = %s)
-        AND (t2.relation_id = %s OR t2.relation_id = %s)
-        AND t1.creation_time > t2.creation_time
-        GROUP BY t1.user_id, date
-    ''', (time_zone.zone, project_id, start_date_utc, end_date_utc, preId, postId, preId, postId))
-    connector_stats = cursor.fetchall()
-
-    # Get review information
     cursor.execute('''
-        SELECT r.reviewer_id, (date_trunc('day', timezone(%(tz)s, r.review_time))) AS date, count(*)
-        FROM review r
-        WHERE r.project_id = %(project_id)s
-        AND r.review_time >= %(start_date)s
-        AND r.review_time < %(end_date)s
-        GROUP BY r.reviewer_id, date
-    ''', dict(tz=time_zone.zone, project_id=project_id, start_date=start_date_utc,
-              end_date=end_date_utc))
-    tree_reviewed_nodes = cursor.fetchall()
-
-    for di in treenode_stats:
-        user_id = str(di[0])
-        date = di[1].strftime('%Y%m%d')
-        stats_table[user_id][date]['new_treenodes'] = di[2]
-
-    for di in connector_stats:
-        user_id = str(di[0])
-        date = di[1].strftime('%Y%m%d')
-        stats_table[user_id][date]['new_connectors'] = di[2]
-
-    for di in tree_reviewed_nodes:
-        user_id = str(di[0])
-        date = di[1].strftime('%Y%m%d')
-        stats_table[user_id][date]['new_reviewed_nodes'] = di[2]
+        SELECT user_id, date_trunc('day', timezone(%(tz)s, date)) AS day,
+            sum(n_treenodes), round(sum(cable_length)),
+            sum(n_connector_links), sum(n_reviewed_nodes)
+        FROM ({}) summary
+        GROUP BY user_id, day
+    '''.format(query), params)
+
+    for user_id, day, n_treenodes, cable_length, n_connector_links, \
+            n_reviewed_nodes in cursor.fetchall():
+        day_stats = stats_table.get(str(user_id), {}).get(day.strftime('%Y%m%d'))
+        if day_stats is None:
+            continue
+        if n_treenodes:
+            day_stats['new_treenodes'] = cable_length
+        if n_connector_links:
+            day_stats['new_connectors'] = n_connector_links
+        if n_reviewed_nodes:
+            day_stats['new_reviewed_nodes'] = n_reviewed_nodes
 
     return HttpResponse(json.dumps({
         'stats_table': stats_table,
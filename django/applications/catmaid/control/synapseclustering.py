@@ -11,6 +11,10 @@ from collections import namedtuple
 
 logger = logging.getLogger(__name__)
 
+# Synapses farther away from a node than this many bandwidths don't contribute
+# to its density, if densities are computed on a tree.
+KERNEL_CUTOFF = 5
+
 try:
     from scipy.sparse.csgraph import dijkstra
 except ImportError:
@@ -18,6 +22,7 @@ except ImportError:
         "Synapse clustering won't be available")
 
 from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.tree_util import Arbor
 from catmaid.models import Treenode, TreenodeConnector, ClassInstance, Relation
 
 
@@ -37,41 +42,57 @@ def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
         The three lists are synchronized by index.
     """
 
-    D, id2index = distanceMatrix( Gwud, synNodes )
+    if isForest( Gwud ):
+        densities, id2index = treeDensities( Gwud, synNodes, h_list )
+    else:
+        densities, id2index = graphDensities( Gwud, synNodes, h_list )
+
+    return climbDensities( densities, id2index, Gwud.neighbors, synNodes,
+            connector_ids, relations, h_list )
+
+def arbor_max_density(arbor, lengths, synNodes, connector_ids, relations, h_list):
+    """ The same as tree_max_density(), but for an Arbor and an array with
+    the length of the edge from each node to its parent (ignored for roots),
+    which avoids converting a graph into a tree.
+    """
+    densities, id2index = arborDensities( arbor, lengths, synNodes, h_list )
+
+    def neighbors( node ):
+        parent = arbor.parent( node )
+        children = arbor.child_ids( node ).tolist()
+        return children if parent is None else [parent] + children
 
+    return climbDensities( densities, id2index, neighbors, synNodes,
+            connector_ids, relations, h_list )
+
+def climbDensities( densities, id2index, neighbors, synNodes, connector_ids,
+        relations, h_list ):
+    """ Group synapses by the local density maximum that is reached from
+    their node by always moving to the neighbor with the highest density.
+    neighbors is a function that returns the neighbors of a node ID.
+    """
     SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
     synapseGroups = {}
 
     for h in h_list:
-        expDh = np.exp(-1 * np.multiply(D, D) / (h * h) )
+        density = densities[h]
 
         targLoc = {}            # targLocs hosts the final destination nodes of the hill climbing
-        densityField = {}            # densityField stores the height of the hill to be climbed
         for startNode in synNodes:
             if startNode not in targLoc:
                 currNode = startNode
                 allOnPath = []
 
-                if startNode not in densityField:
-                    densityField[startNode] = 0
-                    densityField[startNode] = np.sum(expDh[:,id2index[startNode]])
-
                 while True:
                     allOnPath.append(currNode)
 
-                    #Make sure I have densityField of all neighbors for comparison
                     if currNode in targLoc:
                         currNode = targLoc[ currNode ] # Jump right to the end already.
                         break
 
-                    for nn in Gwud.neighbors( currNode ):
-                        if nn not in densityField:
-                            densityField[nn] = 0
-                            densityField[nn] = np.sum(expDh[:,id2index[nn]])
-
                     prevNode = currNode
-                    for nn in Gwud.neighbors( currNode ):
-                        if densityField[nn] > densityField[currNode]:
+                    for nn in neighbors( prevNode ):
+                        if density[id2index[nn]] > density[id2index[currNode]]:
                             currNode = nn
 
                     if currNode == prevNode:
@@ -97,6 +118,133 @@ def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
 
     return synapseGroups
 
+def isForest( G ):
+    """ Whether the undirected nx graph G has no cycles. """
+    return G.number_of_edges() == G.number_of_nodes() - nx.number_connected_components(G)
+
+def graphDensities( G, synNodes, h_list ):
+    """ Compute the synapse density at every node of the nx graph G, for each
+    bandwidth h in h_list. The density at a node is the sum of
+    exp(-d^2 / h^2) over all nodes with synapses, d being the length of the
+    shortest path between both nodes. Returns a dictionary of h vs array of
+    densities and the mapping from node ID to array index. """
+    D, id2index = distanceMatrix( G, synNodes )
+    densities = {}
+    for h in h_list:
+        densities[h] = np.sum(np.exp(-1 * np.multiply(D, D) / (h * h)), axis=0)
+    return densities, id2index
+
+def treeDensities( G, synNodes, h_list, cutoff=KERNEL_CUTOFF ):
+    """ Compute the same densities as graphDensities(), but for a tree (or
+    forest) and without any all-to-all distance matrix. Contributions of
+    synapses farther away from a node than cutoff * h are ignored.
+
+    Paths in a tree are unique, which allows to collect all synapses within
+    the cutoff radius of each node with two passes over all nodes: upwards,
+    each node gets the synapses of its subtree from its children; downwards,
+    each node gets all other synapses from its parent, except for those its
+    parent got from the node itself. All nodes of the same depth are
+    processed at once. Memory use grows with the number of synapses within
+    the cutoff radius of the nodes, not with the number of synapses. """
+    arbor, lengths = treeFromGraph( G )
+    return arborDensities( arbor, lengths, synNodes, h_list, cutoff )
+
+def arborDensities( arbor, lengths, synNodes, h_list, cutoff=KERNEL_CUTOFF ):
+    """ Compute the densities of treeDensities() for an Arbor and an array
+    with the length of the edge from each node to its parent. """
+    n = len(arbor)
+    id2index = {node: i for i, node in enumerate(arbor.node_ids.tolist())}
+    densities = {h: np.zeros(n) for h in h_list}
+    if 0 == n:
+        return densities, id2index
+
+    radius = cutoff * max(h_list)
+    levels = arbor.levels()
+    positions = np.empty(n, dtype=np.int64)
+    for level in levels:
+        positions[level] = np.arange(len(level))
+
+    isSynapse = np.zeros(n, dtype=bool)
+    synIndices = [id2index[node] for node in set(synNodes) if node in id2index]
+    isSynapse[synIndices] = True
+
+    def accumulate(level, nodes, distances):
+        """ Add the density contribution of each distance to its node. """
+        for h in h_list:
+            near = distances <= cutoff * h
+            weights = np.exp(-1 * np.square(distances[near]) / (h * h))
+            densities[h][level] += np.bincount(positions[nodes[near]],
+                    weights=weights, minlength=len(level))
+
+    # Upward pass: each entry of the list of a level relates a node to a
+    # synapse in its subtree (by index), the distance between both and the
+    # child of the node through which the synapse was reached (-1 for the
+    # node itself).
+    up = [None] * len(levels)
+    below = None
+    for depth in range(len(levels) - 1, -1, -1):
+        level = levels[depth]
+        own = level[isSynapse[level]]
+        nodes, sources = [own], [own]
+        distances, vias = [np.zeros(len(own))], [np.full(len(own), -1, dtype=np.int64)]
+        if below is not None:
+            childNodes, childSources, childDistances, _ = below
+            childDistances = childDistances + lengths[childNodes]
+            near = childDistances <= radius
+            nodes.append(arbor.parents[childNodes[near]])
+            sources.append(childSources[near])
+            distances.append(childDistances[near])
+            vias.append(childNodes[near])
+        below = tuple(np.concatenate(a) for a in (nodes, sources, distances, vias))
+        up[depth] = below
+        accumulate(level, below[0], below[2])
+
+    # Downward pass: each node gets the synapses of its parent, except for
+    # the ones in its own subtree.
+    numChildren = arbor.num_children()
+    above = None
+    for depth, level in enumerate(levels):
+        upNodes, upSources, upDistances, upVias = up[depth]
+        up[depth] = None
+        if above is None:
+            nodes, sources, distances = upNodes, upSources, upDistances
+            vias = upVias
+        else:
+            downNodes, downSources, downDistances = above
+            accumulate(level, downNodes, downDistances)
+            nodes = np.concatenate((upNodes, downNodes))
+            sources = np.concatenate((upSources, downSources))
+            distances = np.concatenate((upDistances, downDistances))
+            vias = np.concatenate((upVias, np.full(len(downNodes), -1, dtype=np.int64)))
+        if depth + 1 == len(levels):
+            break
+        # Repeat the entries of each node for each of its children
+        counts = numChildren[nodes]
+        entries = np.repeat(np.arange(len(nodes)), counts)
+        offsets = np.arange(len(entries)) - np.repeat(np.cumsum(counts) - counts, counts)
+        children = arbor.children[arbor.child_offsets[nodes[entries]] + offsets]
+        childDistances = distances[entries] + lengths[children]
+        keep = (vias[entries] != children) & (childDistances <= radius)
+        above = (children[keep], sources[entries][keep], childDistances[keep])
+
+    return densities, id2index
+
+def treeFromGraph( G ):
+    """ Create an Arbor from an undirected nx tree (or forest) and return it
+    along with an array of the lengths of the edges to the parent of each
+    node, taken from the 'weight' edge attribute. """
+    parents = {}
+    for component in nx.connected_components(G):
+        root = next(iter(component))
+        parents[root] = None
+        parents.update(nx.bfs_predecessors(G, root))
+    arbor = Arbor(list(parents.keys()), list(parents.values()))
+    lengths = np.zeros(len(arbor))
+    for i, parent in enumerate(arbor.parents.tolist()):
+        if -1 != parent:
+            lengths[i] = G[arbor.node_ids[i]][arbor.node_ids[parent]].get('weight', 1)
+    return arbor, lengths
+
 def distanceMatrix( G, synNodes ):
     """ Given a nx graph, produce an all to all distance dict via scipy sparse matrix black magic.
      Also, you get in 'id2index' the the mapping from a node id to the index in matrix scaledDistance. """
@@ -2,14 +2,16 @@
 from __future__ import unicode_literals
 
 # A 'tree' is a networkx.DiGraph with a single root node (a node without parents)
+#
+# An 'arbor' is the same kind of tree stored in NumPy arrays, see the Arbor
+# class below. Most functions working on trees are thin adapters around the
+# equivalent Arbor methods.
 
-import six
+import numpy as np
 
-from operator import itemgetter
 from networkx import Graph, DiGraph
-from collections import defaultdict
-from math import sqrt
 from itertools import islice
+from django.db import connection
 from catmaid.models import Treenode
 from six.moves import range
 
@@ -45,29 +47,22 @@ def find_common_ancestor(tree, nodes, ds=None, root_node=None):
     """ Return the node in tree that is the nearest common ancestor to all nodes.
     Assumes that nodes contains at least 1 node.
     Assumes that all nodes are present in tree.
-    Returns a tuple with the ancestor node and its distance to root. """
+    Returns a tuple with the ancestor node and its distance to root, counted
+    like in edge_count_to_root. """
     if 1 == len(nodes):
         return nodes[0], 0
-    distances = ds if ds else edge_count_to_root(tree, root_node=root_node)
-    # Pick the pair with the shortest edge count to root
-    first, second = sorted(six.iteritems({node: distances(node) for node in nodes}), key=itemgetter(1))[:2]
-    # Start from the second, and bring it to an edge count equal to the first
-    while second[1] < first[1]:
-        second = (tree.predecessors_iter(second[0]).next(), second[1] - 1)
-    # Walk parents up for both until finding the common ancestor
-    first = first[0]
-    second = second[0]
-    while first != second:
-        first = tree.predecessors_iter(first).next()
-        second = tree.predecessors_iter(second).next()
-    return first, distances[first]
+    arbor = ds if isinstance(ds, Arbor) else Arbor.from_graph(tree)
+    ancestor = arbor.find_common_ancestor(nodes)
+    return ancestor, int(arbor.depths()[arbor.index(ancestor)]) + 1
 
 def find_common_ancestors(tree, node_groups):
-    distances = edge_count_to_root(tree)
-    return (find_common_ancestor(tree, nodes, ds=distances) for nodes in node_groups)
+    arbor = Arbor.from_graph(tree)
+    return (find_common_ancestor(tree, nodes, ds=arbor) for nodes in node_groups)
 
 def reroot(tree, new_root):
-    """ Reverse in place the direction of the edges from the new_root to root. """
+    """ Reverse in place the direction of the edges from the new_root to root.
+    Only the path to the root is touched, which makes converting the tree into
+    an Arbor unnecessary. """
     parent = next(tree.predecessors_iter(new_root), None)
     if not parent:
         # new_root is already the root
@@ -79,54 +74,23 @@ def reroot(tree, new_root):
         parent = next(tree.predecessors_iter(parent), None)
     tree.add_path(path)
 
-def simplify(tree, keepers):
+def simplify(tree, keepers, arbor=None):
     """ Given a tree and a set of nodes to keep, create a new tree
     where only the nodes to keep and the branch points between them are preserved.
-    WARNING: will reroot the tree at the first of the keepers.
+    If the Arbor of the tree is passed in, it is used instead of the tree.
+    WARNING: will reroot the tree (or else the arbor) at the first of the keepers.
     WARNING: keepers can't be empty. """
     # Ensure no repeats
     keepers = set(keepers)
     # Add all keeper nodes to the minified graph
     mini = Graph()
-    for node in keepers:
-        mini.add_node(node)
-    # Pick the first to be the root node of the tree, removing it
-    root = keepers.pop()
-    reroot(tree, root)
-    # For every keeper node, traverse towards the parent until
-    # finding one that is in the minified graph, or is a branch node
-    children = defaultdict(int)
-    seen_branch_nodes = set(keepers) # a copy
-    paths = []
-    # For all keeper nodes except the root
-    for node in keepers:
-        path = [node]
-        paths.append(path)
-        parent = next(tree.predecessors_iter(node), None)
-        while parent is not None:
-            if parent in mini:
-                # Reached one of the keeper nodes
-                path.append(parent)
-                break
-            elif len(tree.succ[parent]) > 1:
-                # Reached a branch node
-                children[parent] += 1
-                path.append(parent)
-                if parent in seen_branch_nodes:
-                    break
-                seen_branch_nodes.add(parent)
-            parent = next(tree.predecessors_iter(parent), None)
-    for path in paths:
-        # A path starts and ends with desired nodes for the minified tree.
-        # The nodes in the middle of the path are branch nodes
-        # that must be added to mini only if they have been visited more than once.
-        origin = path[0]
-        for i in range(1, len(path) -1):
-            if children[path[i]] > 1:
-                mini.add_edge(origin, path[i])
-                origin = path[i]
-        mini.add_edge(origin, path[-1])
-
+    mini.add_nodes_from(keepers)
+    # Pick the first to be the root node of the tree
+    root = next(iter(keepers))
+    if arbor is None:
+        reroot(tree, root)
+        arbor = Arbor.from_graph(tree)
+    mini.add_edges_from(arbor.simplify(keepers, root))
     return mini
 
 def partition(tree, root_node=None):
@@ -134,22 +98,7 @@ def partition(tree, root_node=None):
     with branch nodes repeated as ends of all sequences except the longest
     one that finishes at the root.
     Each sequence runs from an end node to either the root or a branch node. """
-    distances = edge_count_to_root(tree, root_node=root_node) # distance in number of edges from root
-    seen = set()
-    # Iterate end nodes sorted from highest to lowest distance to root
-    endNodeIDs = (nID for nID in tree.nodes() if 0 == len(tree.successors(nID)))
-    for nodeID in sorted(endNodeIDs, key=distances.get, reverse=True):
-        sequence = [nodeID]
-        parentID = next(tree.predecessors_iter(nodeID), None)
-        while parentID is not None:
-            sequence.append(parentID)
-            if parentID in seen:
-                break
-            seen.add(parentID)
-            parentID = next(tree.predecessors_iter(parentID), None)
-
-        if len(sequence) > 1:
-            yield sequence
+    return iter(Arbor.from_graph(tree).partition())
 
 
 def spanning_tree(tree, preserve):
@@ -158,19 +107,19 @@ def spanning_tree(tree, preserve):
     spanning = DiGraph()
     preserve = set(preserve) # duplicate, will be altered
     if 1 == len(preserve):
-        spanning.add_node(iter(preserve).next())
+        spanning.add_node(next(iter(preserve)))
         return spanning
 
-    if len(tree.successors(find_root(tree))) > 1:
-        tree = tree.copy()
+    arbor = Arbor.from_graph(tree)
+    if len(arbor.child_ids(arbor.root)) > 1:
         # First end node found
-        endNode = (node for node in tree if not next(tree.successors_iter(node), None)).next()
-        reroot(tree, endNode)
+        endNode = next(node for node in tree if not next(tree.successors_iter(node), None))
+        arbor.reroot(endNode)
 
     n_seen = 0
 
     # Start from shortest sequence
-    for seq in sorted(partition(tree), key=len):
+    for seq in sorted(arbor.partition(), key=len):
         path = []
         for node in seq:
             if node in preserve:
@@ -195,7 +144,24 @@ def spanning_tree(tree, preserve):
 def cable_length(tree, locations):
     """ locations: a dictionary of nodeID vs iterable of node position (1d, 2d, 3d, ...)
     Returns the total cable length. """
-    return sum(sqrt(sum(pow(loc2 - loc1, 2) for loc1, loc2 in izip(locations[a], locations[b]))) for a,b in tree.edges_iter())
+    edges = tree.edges()
+    if not edges:
+        return 0.0
+    a = np.array([locations[e[0]] for e in edges], dtype=np.float64)
+    b = np.array([locations[e[1]] for e in edges], dtype=np.float64)
+    return float(np.sqrt(((b - a) ** 2).sum(axis=1)).sum())
+
+def edge_lengths(arbor, locations):
+    """ locations: a dictionary of nodeID vs iterable of node position (x, y, z)
+    Returns an array with the length of the edge from each node of the arbor
+    to its parent, 0 for roots. """
+    positions = np.array([locations[n] for n in arbor.node_ids.tolist()],
+            dtype=np.float64).reshape(-1, 3)
+    lengths = np.zeros(len(arbor))
+    children = np.flatnonzero(arbor.parents != -1)
+    lengths[children] = np.sqrt(((positions[children] -
+            positions[arbor.parents[children]]) ** 2).sum(axis=1))
+    return lengths
 
 
 def lazy_load_trees(skeleton_ids, node_properties):
@@ -212,23 +178,353 @@ def lazy_load_trees(skeleton_ids, node_properties):
     ts = Treenode.objects.filter(skeleton__in=skeleton_ids) \
             .order_by('skeleton') \
             .values_list(*values_list)
+
+    def as_tree(rows):
+        tree = DiGraph()
+        tree.add_nodes_from((t[0], dict(izip(props, islice(t, 3, 3 + len(props)))))
+                for t in rows)
+        # From child to parent
+        tree.add_edges_from((t[0], t[1]) for t in rows if t[1])
+        return tree
+
     skid = None
-    tree = None
-    for t in ts:
+    rows = []
+    for t in ts.iterator():
         if t[2] != skid:
-            if tree:
-                yield (skid, tree)
+            if rows:
+                yield (skid, as_tree(rows))
             # Prepare for the next one
             skid = t[2]
-            tree = DiGraph()
+            rows = []
+        rows.append(t)
+
+    if rows:
+        yield (skid, as_tree(rows))
+
+
+def lazy_load_arbors(skeleton_ids, with_locations=True, batch_size=100):
+    """ Return a lazy collection of (skeleton_id, Arbor) pairs. Nodes are
+    loaded with one query for every <batch_size> skeletons. """
+    skeleton_ids = list(skeleton_ids)
+    cursor = connection.cursor()
+    for i in range(0, len(skeleton_ids), batch_size):
+        cursor.execute('''
+            SELECT id, COALESCE(parent_id, -1), %s skeleton_id
+            FROM treenode
+            WHERE skeleton_id = ANY(%%(skeleton_ids)s::integer[])
+            ORDER BY skeleton_id
+        ''' % ('location_x, location_y, location_z,' if with_locations else ''), {
+            'skeleton_ids': skeleton_ids[i:i + batch_size]
+        })
+        rows = cursor.fetchall()
+        if not rows:
+            continue
+        # IDs are kept as integers, only locations are floats
+        columns = list(izip(*rows))
+        node_ids = np.array(columns[0], dtype=np.int64)
+        parent_ids = np.array(columns[1], dtype=np.int64)
+        locations = np.array(columns[2:5], dtype=np.float64).T \
+                if with_locations else None
+        skids, starts = np.unique(np.array(columns[-1], dtype=np.int64),
+                return_index=True)
+        ends = starts.tolist()[1:] + [len(rows)]
+        for skid, start, end in izip(skids.tolist(), starts.tolist(), ends):
+            yield skid, Arbor(node_ids[start:end], parent_ids[start:end],
+                    locations[start:end] if with_locations else None)
+
+
+class Arbor(object):
+    """ A tree stored in flat NumPy arrays. Nodes are sorted by ID and
+    referenced by their index into these arrays:
+
+    - node_ids: int64 array of node IDs
+    - parents: array with the index of each node's parent, -1 for the root
+    - child_offsets, children: children of node i are
+      children[child_offsets[i]:child_offsets[i + 1]] (a CSR matrix)
+    - locations: optional Nx3 float32 array of node locations
+
+    Depths and ancestor tables are computed with pointer jumping and cached
+    until the arbor is rerooted. Operations that need to visit nodes in
+    topological order process all nodes of the same depth at once.
+    """
+
+    def __init__(self, node_ids, parent_ids, locations=None):
+        """ Create an arbor from node IDs and parent IDs (-1 or None for the
+        root) and optionally an Nx3 array of locations. Parents not contained
+        in node_ids are treated like missing parents. Without nodes, e.g. for
+        a skeleton without treenodes, the arbor is empty. """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        if not isinstance(parent_ids, np.ndarray):
+            parent_ids = [-1 if p is None else p for p in parent_ids]
+        parent_ids = np.asarray(parent_ids, dtype=np.int64)
+        order = np.argsort(node_ids, kind='mergesort')
+        self.node_ids = node_ids[order]
+        parent_ids = parent_ids[order]
+        self.locations = None if locations is None else \
+                np.asarray(locations, dtype=np.float32)[order]
+
+        n = len(self.node_ids)
+        parents = np.searchsorted(self.node_ids, parent_ids)
+        parents[parents == n] = 0
+        found = (parent_ids != -1) & (self.node_ids[parents] == parent_ids)
+        parents[~found] = -1
+        self._set_parents(parents)
+
+    @classmethod
+    def from_rows(cls, rows, with_locations=False):
+        """ Create an arbor from a sequence of (id, parent_id[, x, y, z])
+        tuples. """
+        locations = np.array([r[2:5] for r in rows], dtype=np.float32) \
+                .reshape(-1, 3) if with_locations else None
+        return cls([r[0] for r in rows], [r[1] for r in rows], locations)
+
+    @classmethod
+    def from_cursor(cls, cursor, with_locations=False):
+        """ Create an arbor from the result of a query that selects id,
+        parent_id and optionally location_x, location_y and location_z of
+        treenodes, in this order. """
+        return cls.from_rows(cursor.fetchall(), with_locations)
+
+    @classmethod
+    def from_skeleton(cls, skeleton_id, with_locations=False):
+        """ Load all nodes of a skeleton into a new arbor. """
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT id, parent_id %s
+            FROM treenode
+            WHERE skeleton_id = %%s
+        ''' % (', location_x, location_y, location_z' if with_locations else ''),
+            (skeleton_id,))
+        return cls.from_cursor(cursor, with_locations)
+
+    @classmethod
+    def from_graph(cls, tree, locations=None):
+        """ Create an arbor from a networkx DiGraph with edges from parents to
+        children and an optional dictionary of node ID vs location. """
+        node_ids = np.fromiter(tree.nodes_iter(), dtype=np.int64,
+                count=tree.number_of_nodes())
+        edges = tree.edges()
+        parent_ids = np.full(len(node_ids), -1, dtype=np.int64)
+        if edges:
+            edges = np.array(edges, dtype=np.int64)
+            order = np.argsort(node_ids)
+            parent_ids[order[np.searchsorted(node_ids, edges[:, 1], sorter=order)]] = edges[:, 0]
+        if locations is not None:
+            locations = np.array([locations[n] for n in node_ids], dtype=np.float32)
+        return cls(node_ids, parent_ids, locations)
+
+    def _set_parents(self, parents):
+        n = len(parents)
+        self.parents = parents
+        has_parent = parents != -1
+        order = np.argsort(parents, kind='mergesort')
+        self.children = order[n - np.count_nonzero(has_parent):]
+        self.child_offsets = np.zeros(n + 1, dtype=np.int64)
+        if n:
+            np.cumsum(np.bincount(parents[has_parent], minlength=n),
+                    out=self.child_offsets[1:])
+        self._depths = None
+        self._ancestors = None
+        self._levels = None
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def index(self, node_ids):
+        """ Map a single node ID or an array of node IDs to array indices.
+        Raise a ValueError for unknown node IDs. """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        if 0 == len(self.node_ids) and node_ids.size:
+            raise ValueError("Unknown node ID: {}".format(node_ids))
+        index = np.searchsorted(self.node_ids, node_ids)
+        if np.any(index >= len(self.node_ids)) or \
+                np.any(self.node_ids[np.minimum(index, len(self.node_ids) - 1)] != node_ids):
+            raise ValueError("Unknown node ID: {}".format(node_ids))
+        return index
+
+    @property
+    def root(self):
+        """ The ID of the root node (the first one if there are many). """
+        roots = np.flatnonzero(self.parents == -1)
+        return int(self.node_ids[roots[0]]) if len(roots) else None
+
+    def parent(self, node_id):
+        """ The ID of the parent of a node or None for the root. """
+        p = self.parents[self.index(node_id)]
+        return None if -1 == p else int(self.node_ids[p])
+
+    def child_ids(self, node_id):
+        """ The IDs of all children of a node. """
+        i = self.index(node_id)
+        return self.node_ids[self.children[self.child_offsets[i]:self.child_offsets[i + 1]]]
+
+    def num_children(self):
+        """ Number of children of every node. """
+        return np.diff(self.child_offsets)
+
+    def depths(self):
+        """ Number of edges between every node and its root. """
+        if self._depths is None:
+            self._compute_ancestors()
+        return self._depths
+
+    def _compute_ancestors(self):
+        # Pointer jumping: in each step, every node jumps to the ancestor of
+        # its current ancestor, doubling the distance covered. Roots point to
+        # themselves. The ancestors reached after each step are kept as table
+        # of 2^k-th ancestors.
+        n = len(self.parents)
+        index = np.arange(n)
+        jump = np.where(self.parents == -1, index, self.parents)
+        depths = (self.parents != -1).astype(np.int64)
+        ancestors = [jump]
+        while True:
+            next_jump = jump[jump]
+            if np.array_equal(next_jump, jump):
+                break
+            depths = depths + depths[jump]
+            jump = next_jump
+            ancestors.append(jump)
+        self._depths = depths
+        self._ancestors = ancestors
+
+    def levels(self):
+        """ A list of node index arrays, one for each depth, starting with the
+        roots. """
+        if self._levels is None:
+            depths = self.depths()
+            order = np.argsort(depths, kind='mergesort')
+            bounds = np.cumsum(np.bincount(depths))
+            self._levels = np.split(order, bounds[:-1]) if len(order) else []
+        return self._levels
+
+    def accumulate(self, values, ufunc=np.add):
+        """ Combine the values of all nodes in the subtree of each node with
+        the passed in ufunc, e.g. np.add sums values over subtrees. """
+        result = np.array(values, copy=True)
+        for level in reversed(self.levels()[1:]):
+            ufunc.at(result, self.parents[level], result[level])
+        return result
+
+    def reroot(self, new_root):
+        """ Make the passed in node the new root, reversing the direction of
+        all edges on the path to the old root. """
+        i = int(self.index(new_root))
+        path = [i]
+        parents = self.parents
+        while parents[path[-1]] != -1:
+            path.append(int(parents[path[-1]]))
+        if 1 == len(path):
+            return
+        path = np.array(path)
+        parents = parents.copy()
+        parents[path[1:]] = path[:-1]
+        parents[i] = -1
+        self._set_parents(parents)
+
+    def copy(self):
+        arbor = Arbor.__new__(Arbor)
+        arbor.node_ids = self.node_ids
+        arbor.locations = self.locations
+        arbor._set_parents(self.parents.copy())
+        return arbor
+
+    def partition(self):
+        """ Return a list of node ID sequences (lists), each running from an
+        end node to either the root or a branch node. Branch nodes are
+        repeated as ends of all sequences except the longest one that finishes
+        at the root. Sequences are ordered by the distance of their end node to
+        the root, from high to low. """
+        n = len(self.node_ids)
+        if n < 2:
+            return []
+        depths = self.depths()
+        ends = np.flatnonzero(self.num_children() == 0)
+        # Order end nodes by depth (deepest first) and ID
+        ends = ends[np.lexsort((self.node_ids[ends], -depths[ends]))]
+        # Every node belongs to the sequence of the first end node whose path
+        # to the root contains it, i.e. the lowest rank in its subtree.
+        rank = np.full(n, n, dtype=np.int64)
+        rank[ends] = np.arange(len(ends))
+        rank = self.accumulate(rank, np.minimum)
+        order = np.lexsort((-depths, rank))
+        bounds = np.flatnonzero(np.diff(rank[order])) + 1
+        sequences = []
+        for nodes in np.split(order, bounds):
+            sequence = self.node_ids[nodes].tolist()
+            parent = self.parents[nodes[-1]]
+            if -1 != parent:
+                sequence.append(int(self.node_ids[parent]))
+            if len(sequence) > 1:
+                sequences.append(sequence)
+        return sequences
 
-        fields = {k: v for k,v in izip(props, islice(t, 3, 3 + len(props)))}
-        tree.add_node(t[0], fields)
+    def simplify(self, keepers, root=None):
+        """ Return the edges of a tree that contains only the passed in keeper
+        nodes and the branch nodes between them, each edge connecting a node to
+        its nearest preserved ancestor, as seen from the root keeper. """
+        keepers = self.index(list(keepers))
+        if 0 == len(keepers):
+            return []
+        arbor = self
+        if root is not None:
+            arbor = self.copy()
+            arbor.reroot(root)
+        n = len(arbor.node_ids)
+        is_keeper = np.zeros(n, dtype=np.int64)
+        is_keeper[keepers] = 1
+        has_keeper = arbor.accumulate(is_keeper, np.maximum)
+        with_parent = np.flatnonzero((has_keeper > 0) & (arbor.parents != -1))
+        keeper_children = np.bincount(arbor.parents[with_parent], minlength=n)
+        preserved = (is_keeper > 0) | (keeper_children > 1)
+        # Nearest preserved proper ancestor of every node
+        nearest = np.full(n, -1, dtype=np.int64)
+        for level in arbor.levels()[1:]:
+            parents = arbor.parents[level]
+            nearest[level] = np.where(preserved[parents], parents, nearest[parents])
+        nodes = np.flatnonzero(preserved & (nearest != -1))
+        return list(izip(arbor.node_ids[nodes].tolist(),
+                arbor.node_ids[nearest[nodes]].tolist()))
 
-        if t[1]:
-            # From child to parent
-            tree.add_edge(t[0], t[1])
+    def cable_length(self):
+        """ The sum of all edge lengths. """
+        children = np.flatnonzero(self.parents != -1)
+        locations = self.locations.astype(np.float64)
+        return float(np.sqrt(((locations[children] -
+                locations[self.parents[children]]) ** 2).sum(axis=1)).sum())
 
-    if tree:
-        yield (skid, tree)
+    def find_common_ancestor(self, node_ids):
+        """ Return the ID of the nearest common ancestor of all passed in
+        nodes. """
+        nodes = self.index(list(node_ids))
+        if 0 == len(nodes):
+            raise ValueError("No nodes passed in")
+        depths = self.depths()
+        ancestors = self._ancestors
+        while len(nodes) > 1:
+            # Find the common ancestors of pairs of nodes at once
+            half = len(nodes) // 2
+            a, b = nodes[:half], nodes[half:2 * half]
+            # Bring the deeper node of each pair to the depth of the other one
+            swap = depths[a] < depths[b]
+            a, b = np.where(swap, b, a), np.where(swap, a, b)
+            diff = depths[a] - depths[b]
+            for k, table in enumerate(ancestors):
+                a = np.where((diff >> k) & 1, table[a], a)
+            # Jump up as long as the ancestors differ
+            for table in reversed(ancestors):
+                differ = table[a] != table[b]
+                a = np.where(differ, table[a], a)
+                b = np.where(differ, table[b], b)
+            common = np.where(a != b, ancestors[0][a], a)
+            nodes = np.concatenate((common, nodes[2 * half:]))
+        return int(self.node_ids[nodes[0]])
 
+    def to_graph(self):
+        """ Return a networkx DiGraph with edges from parents to children. """
+        tree = DiGraph()
+        tree.add_nodes_from(self.node_ids.tolist())
+        children = np.flatnonzero(self.parents != -1)
+        tree.add_edges_from(izip(self.node_ids[self.parents[children]].tolist(),
+                self.node_ids[children].tolist()))
+        return tree
@@ -3,7 +3,7 @@ from __future__ import unicode_literals
 
 import itertools
 import math
-import networkx as nx
+import numpy as np
 import re
 import six
 
@@ -23,8 +23,10 @@ from catmaid.control.authentication import requires_user_role, \
 from catmaid.control.common import get_relation_to_id_map, \
         get_class_to_id_map, insert_into_log, _create_relation, get_request_list
 from catmaid.control.neuron import _delete_if_empty
-from catmaid.control.node import _fetch_location, _fetch_locations
+from catmaid.control.node import _fetch_location, _fetch_locations, \
+        invalidate_node_list_cache
 from catmaid.control.link import create_connector_link
+from catmaid.control.tree_util import Arbor
 from catmaid.util import Point3D, is_collinear
 
 
@@ -119,6 +121,8 @@ def create_treenode(request, project_id=None):
     else:
         created_links = []
 
+    invalidate_node_list_cache(project_id, [new_treenode.treenode_id])
+
     return JsonResponse({
         'treenode_id': new_treenode.treenode_id,
         'skeleton_id': new_treenode.skeleton_id,
@@ -237,6 +241,9 @@ def insert_treenode(request, project_id=None):
     else:
         created_links = []
 
+    invalidate_node_list_cache(project_id, [new_treenode.treenode_id],
+            cursor=cursor)
+
     return JsonResponse({
         'treenode_id': new_treenode.treenode_id,
         'skeleton_id': new_treenode.skeleton_id,
@@ -442,8 +449,11 @@ def update_parent(request, project_id=None, treenode_id=None):
         raise Exception("Child node %s is in skeleton %s but parent node %s is in skeleton %s!", \
                         treenode_id, child.skeleton_id, parent_id, parent.skeleton_id)
 
+    # Invalidate cached node lists both for the old and the new edge
+    invalidate_node_list_cache(project_id, [treenode_id])
     child.parent_id = parent_id
     child.save()
+    invalidate_node_list_cache(project_id, [treenode_id])
 
     return JsonResponse({
         'success': True,
@@ -518,6 +528,7 @@ def update_radii(request, project_id=None):
             multinode=True, lock=True, cursor=cursor)
 
     updated_nodes = update_node_radii(treenode_ids, radii, cursor)
+    invalidate_node_list_cache(project_id, treenode_ids, cursor=cursor)
 
     return JsonResponse({
         'success': True,
@@ -537,6 +548,8 @@ def update_radius(request, project_id=None, treenode_id=None):
             node=True, lock=True, cursor=cursor)
 
     def create_update_response(updated_nodes, radius):
+        invalidate_node_list_cache(project_id, list(updated_nodes.keys()),
+                cursor=cursor)
         return JsonResponse({
             'success': True,
             'updated_nodes': updated_nodes,
@@ -650,6 +663,10 @@ def delete_treenode(request, project_id=None):
             treenode_id=treenode_id).values_list('id', 'relation_id',
             'connector_id', 'confidence'))
 
+    # Neighbors and links are needed to invalidate cached node lists and have
+    # to be retrieved before the node is removed.
+    invalidate_node_list_cache(project_id, [treenode_id])
+
     response_on_error = ''
     deleted_neuron = False
     try:
@@ -918,6 +935,7 @@ def update_confidence(request, project_id=None, treenode_id=None):
 
     updated_partners = cursor.fetchall()
     if len(updated_partners) > 0:
+        invalidate_node_list_cache(project_id, [tnid], cursor=cursor)
         location = Location.objects.filter(id=tnid).values_list(
                 'location_x', 'location_y', 'location_z')[0]
         insert_into_log(project_id, request.user.id, "change_confidence",
@@ -939,25 +957,6 @@ def update_confidence(request, project_id=None, treenode_id=None):
     else:
         raise ValueError('Failed to update confidence at treenode %s.' % tnid)
 
-def _skeleton_as_graph(skeleton_id):
-    # Fetch all nodes of the skeleton
-    cursor = connection.cursor()
-    cursor.execute('''
-        SELECT id, parent_id
-        FROM treenode
-        WHERE skeleton_id=%s''', [skeleton_id])
-    # Create a directed graph of the skeleton
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        # row[0]: id
-        # row[1]: parent_id
-        graph.add_node(row[0])
-        if row[1]:
-            # Create directional edge from parent to child
-            graph.add_edge(row[1], row[0])
-    return graph
-
-
 def _find_first_interesting_node(sequence):
     """ Find the first node that:
     1. Has confidence lower than 5
@@ -1002,19 +1001,19 @@ def find_previous_branchnode_or_root(request, project_id=None, treenode_id=None)
         tnid = int(treenode_id)
         alt = 1 == int(request.POST['alt'])
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        arbor = Arbor.from_skeleton(skid)
+        parents = arbor.parents
+        num_children = arbor.num_children()
         # Travel upstream until finding a parent node with more than one child
         # or reaching the root node
         seq = [] # Does not include the starting node tnid
-        while True:
-            parents = graph.predecessors(tnid)
-            if parents: # list of parents is not empty
-                tnid = parents[0] # Can ony have one parent
-                seq.append(tnid)
-                if 1 != len(graph.successors(tnid)):
-                    break # Found a branch node
-            else:
-                break # Found the root node
+        node = arbor.index(tnid)
+        while -1 != parents[node]:
+            node = parents[node]
+            tnid = int(arbor.node_ids[node])
+            seq.append(tnid)
+            if 1 != num_children[node]:
+                break # Found a branch node
 
         if seq and alt:
             tnid = _find_first_interesting_node(seq)
@@ -1029,9 +1028,9 @@ def find_next_branchnode_or_end(request, project_id=None, treenode_id=None):
     try:
         tnid = int(treenode_id)
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        arbor = Arbor.from_skeleton(skid)
 
-        children = graph.successors(tnid)
+        children = arbor.child_ids(tnid).tolist()
         branches = []
         for child_node_id in children:
             # Travel downstream until finding a child node with more than one
@@ -1039,9 +1038,9 @@ def find_next_branchnode_or_end(request, project_id=None, treenode_id=None):
             seq = [child_node_id] # Does not include the starting node tnid
             branch_end = child_node_id
             while True:
-                branch_children = graph.successors(branch_end)
+                branch_children = arbor.child_ids(branch_end)
                 if 1 == len(branch_children):
-                    branch_end = branch_children[0]
+                    branch_end = int(branch_children[0])
                     seq.append(branch_end)
                 else:
                     break # Found an end node or a branch node
@@ -1050,10 +1049,12 @@ def find_next_branchnode_or_end(request, project_id=None, treenode_id=None):
                              _find_first_interesting_node(seq),
                              branch_end])
 
-        # If more than one branch exists, sort based on downstream arbor size.
+        # If more than one branch exists, sort based on downstream arbor size,
+        # measured as number of nodes with children.
         if len(children) > 1:
-            branches.sort(
-                   key=lambda b: len(nx.algorithms.traversal.depth_first_search.dfs_successors(graph, b[0])),
+            arbor_size = arbor.accumulate(
+                    (arbor.num_children() > 0).astype(np.int64))
+            branches.sort(key=lambda b: arbor_size[arbor.index(b[0])],
                    reverse=True)
 
         # Leaf nodes will have no branches
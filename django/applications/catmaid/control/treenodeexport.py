@@ -13,7 +13,9 @@ from django.db.models import Count
 
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map, id_generator
-from catmaid.control.cropping import CropJob, extract_substack, ImageRetrievalError
+from catmaid.control.cropping import CropJob, extract_substack, \
+        extract_substack_array, get_pages, write_tiff, use_numpy_backend, \
+        ImageRetrievalError, TileStats
 from catmaid.models import ClassInstanceClassInstance, TreenodeConnector, \
         Message, User, UserRole, Treenode
 
@@ -24,6 +26,20 @@ from celery.task import task
 treenode_output_path = os.path.join(settings.MEDIA_ROOT,
     settings.MEDIA_TREENODE_SUBDIRECTORY)
 
+def save_slices(crop_job, get_slice_path):
+    """ Extracts the sub-stack of a crop job and saves each of its slices as
+    TIFF file. The path of slice i is returned by get_slice_path(i).
+    """
+    if use_numpy_backend():
+        cropped_stack = extract_substack_array(crop_job)
+        if cropped_stack is None:
+            return
+        for i, page in enumerate(get_pages(crop_job, cropped_stack)):
+            write_tiff(get_slice_path(i), crop_job, [page])
+    else:
+        for i, img in enumerate(extract_substack(crop_job)):
+            img.write(get_slice_path(i))
+
 class SkeletonExportJob:
     """ A container with data needed for exporting things related to skeletons.
     """
@@ -80,6 +96,10 @@ class TreenodeExporter:
         # Store meta data for each node
         self.metadata = {}
 
+        # Tile requests of all nodes. Tiles themselves are cached by the tile
+        # fetcher of the cropping module, which is shared by all jobs.
+        self.tile_stats = TileStats()
+
     def create_message(self, title, message, url):
         msg = Message()
         msg.user = User.objects.get(pk=int(self.job.user.id))
@@ -166,15 +186,15 @@ class TreenodeExporter:
         # Create a single file for each section (instead of a mulipage TIFF)
         crop_self = CropJob(self.job.user, self.job.project_id,
                 self.job.stack_id, x_min, x_max, y_min, y_max, z_min, z_max,
-                rotation_cw, zoom_level, single_channel=True)
-        cropped_stack = extract_substack(crop_self)
+                rotation_cw, zoom_level, single_channel=True,
+                tile_stats=self.tile_stats)
         # Save each file in output path
         output_path = self.create_path(treenode)
-        for i, img in enumerate(cropped_stack):
+        def get_slice_path(i):
             # Save image in output path, named <treenode-id>.tiff
             image_name = "%s.tiff" % treenode.id
-            treenode_image_path = os.path.join(output_path, image_name)
-            img.write(treenode_image_path)
+            return os.path.join(output_path, image_name)
+        save_slices(crop_self, get_slice_path)
 
     def post_process(self, nodes):
         """ Create a meta data file for all the nodes passed (usually all of the
@@ -336,19 +356,19 @@ class ConnectorExporter(TreenodeExporter):
         # Create a single file for each section (instead of a mulipage TIFF)
         crop_self = CropJob(self.job.user, self.job.project_id,
                 self.job.stack_id, x_min, x_max, y_min, y_max, z_min, z_max,
-                rotation_cw, zoom_level, single_channel=True)
-        cropped_stack = extract_substack(crop_self)
+                rotation_cw, zoom_level, single_channel=True,
+                tile_stats=self.tile_stats)
         # Save each file in output path
         connector_path = self.create_path(connector_link)
-        for i, img in enumerate(cropped_stack):
+        def get_slice_path(i):
             # Save image in output path, named after the image center's coordinates,
             # rounded to full integers.
             x = int(connector.location_x + 0.5)
             y = int(connector.location_y + 0.5)
             z = int(z_min + i * crop_self.stacks[0].resolution.z  + 0.5)
             image_name = "%s_%s_%s.tiff" % (x, y, z)
-            connector_image_path = os.path.join(connector_path, image_name)
-            img.write(connector_image_path)
+            return os.path.join(connector_path, image_name)
+        save_slices(crop_self, get_slice_path)
 
     def post_process(self, nodes):
         pass
@@ -420,8 +440,8 @@ def process_export_job(exporter):
     else:
         error_msg = ""
     msg = "Exporting a %s archive finished.%s You can download it from " \
-            "this location: <a href='%s'>%s</a>" % \
-            (exporter.entity_name, error_msg, url, url)
+            "this location: <a href='%s'>%s</a> (%s)." % \
+            (exporter.entity_name, error_msg, url, url, exporter.tile_stats)
     exporter.create_message("Export of %ss finished" % exporter.entity_name,
             msg, url)
 
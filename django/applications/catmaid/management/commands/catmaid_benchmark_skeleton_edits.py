@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import numpy as np
+
+from time import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from catmaid.control.skeleton import DOWNSTREAM_NODES, _reroot_skeleton
+from catmaid.control.tree_util import Arbor
+from catmaid.models import ClassInstance
+
+
+class BenchmarkRollback(Exception):
+    pass
+
+
+class SkeletonEditBenchmark(object):
+    """Splits a skeleton at the node that divides it most evenly, joins both
+    parts again and reroots it at its deepest node and back, with the same
+    statements the tracing tool uses. The skeleton is unchanged afterwards,
+    if all statements succeed.
+    """
+
+    # Triggers that keep skeleton summaries and the skeleton connectivity up
+    # to date.
+    summary_triggers = (
+        ('treenode', 'on_change_treenode_update_summary'),
+        ('treenode', 'on_change_treenode_apply_summary_changes'),
+        ('review', 'on_change_review_update_summary'),
+        ('review', 'on_change_review_apply_summary_changes'),
+        ('treenode_connector', 'on_change_treenode_connector_update_connectivity'),
+        ('treenode_connector', 'on_change_treenode_connector_apply_connectivity_changes'),
+    )
+
+    def __init__(self, skeleton):
+        self.skeleton = skeleton
+        arbor = Arbor.from_skeleton(skeleton.id)
+        if len(arbor) < 2:
+            raise CommandError('Skeleton %s has less than two nodes' % skeleton.id)
+        self.n_nodes = len(arbor)
+
+        sizes = arbor.accumulate(np.ones(len(arbor), dtype=np.int64))
+        sizes[arbor.parents == -1] = 0
+        split = int(np.argmin(np.abs(sizes - len(arbor) / 2.0)))
+        self.split_node = int(arbor.node_ids[split])
+        self.split_parent = int(arbor.node_ids[arbor.parents[split]])
+        self.n_split_nodes = int(sizes[split])
+        self.root = arbor.root
+        self.deepest_node = int(arbor.node_ids[np.argmax(arbor.depths())])
+
+        self.new_skeleton = ClassInstance.objects.create(user=skeleton.user,
+                project_id=skeleton.project_id,
+                class_column_id=skeleton.class_column_id,
+                name='Split of %s' % skeleton.name)
+
+    def run(self, repeat):
+        """Return a dictionary of operation names vs. lists of durations in
+        seconds.
+        """
+        cursor = connection.cursor()
+        timings = {'split': [], 'join': [], 'reroot': []}
+        for _ in range(repeat):
+            start_time = time()
+            self.split(cursor)
+            timings['split'].append(time() - start_time)
+
+            start_time = time()
+            self.join(cursor)
+            timings['join'].append(time() - start_time)
+
+            start_time = time()
+            _reroot_skeleton(self.deepest_node, self.skeleton.project_id)
+            _reroot_skeleton(self.root, self.skeleton.project_id)
+            timings['reroot'].append((time() - start_time) / 2)
+        return timings
+
+    def split(self, cursor):
+        cursor.execute("""
+            {downstream}
+            UPDATE treenode t
+              SET skeleton_id = %(new_skeleton_id)s
+              FROM downstream d
+              WHERE t.id = d.id;
+            UPDATE treenode_connector tc
+              SET skeleton_id = %(new_skeleton_id)s
+              FROM treenode t
+              WHERE tc.skeleton_id = %(skeleton_id)s
+                AND t.id = tc.treenode_id
+                AND t.skeleton_id = %(new_skeleton_id)s;
+            UPDATE review r
+              SET skeleton_id = %(new_skeleton_id)s
+              FROM treenode t
+              WHERE r.skeleton_id = %(skeleton_id)s
+                AND t.id = r.treenode_id
+                AND t.skeleton_id = %(new_skeleton_id)s;
+            UPDATE treenode SET parent_id = NULL WHERE id = %(treenode_id)s;
+            """.format(downstream=DOWNSTREAM_NODES), {
+                'treenode_id': self.split_node,
+                'skeleton_id': self.skeleton.id,
+                'new_skeleton_id': self.new_skeleton.id,
+            })
+
+    def join(self, cursor):
+        cursor.execute("""
+            UPDATE treenode SET skeleton_id = %(skeleton_id)s
+              WHERE skeleton_id = %(new_skeleton_id)s;
+            UPDATE treenode_connector SET skeleton_id = %(skeleton_id)s
+              WHERE skeleton_id = %(new_skeleton_id)s;
+            UPDATE review SET skeleton_id = %(skeleton_id)s
+              WHERE skeleton_id = %(new_skeleton_id)s;
+            UPDATE treenode SET parent_id = %(parent_id)s
+              WHERE id = %(treenode_id)s;
+            """, {
+                'treenode_id': self.split_node,
+                'parent_id': self.split_parent,
+                'skeleton_id': self.skeleton.id,
+                'new_skeleton_id': self.new_skeleton.id,
+            })
+
+
+class Command(BaseCommand):
+    help = "Measure how long splitting, joining and rerooting a large " \
+           "skeleton takes, with and without the triggers that keep skeleton " \
+           "summaries and the skeleton connectivity up to date. All changes " \
+           "are rolled back. Large skeletons can e.g. be created with the " \
+           "catmaid_generate_synthetic_data command."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skeleton_id', dest='skeleton_id', type=int,
+            help='The skeleton to edit')
+        parser.add_argument('--project_id', dest='project_id', type=int,
+            help='Without a skeleton ID, edit the largest skeleton of this project')
+        parser.add_argument('--repeat', dest='repeat', type=int, default=3,
+            help='How often each operation is done')
+
+    def handle(self, *args, **options):
+        skeleton_id = options['skeleton_id']
+        if skeleton_id is None:
+            if options['project_id'] is None:
+                raise CommandError('Either a skeleton ID or a project ID is needed')
+            cursor = connection.cursor()
+            cursor.execute('''
+                SELECT skeleton_id FROM catmaid_skeleton_summary
+                WHERE project_id = %s
+                ORDER BY num_nodes DESC
+                LIMIT 1
+            ''', (options['project_id'],))
+            row = cursor.fetchone()
+            if not row:
+                raise CommandError('Project "%s" has no skeletons' % options['project_id'])
+            skeleton_id = row[0]
+        try:
+            skeleton = ClassInstance.objects.get(pk=skeleton_id)
+        except ClassInstance.DoesNotExist:
+            raise CommandError('Skeleton "%s" does not exist' % skeleton_id)
+        if options['repeat'] < 1:
+            raise CommandError('Each operation needs to be done at least once')
+
+        try:
+            with transaction.atomic():
+                cursor = connection.cursor()
+                # Check references right away, deferred checks would only
+                # happen at the commit, which never comes.
+                cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+                benchmark = SkeletonEditBenchmark(skeleton)
+                self.stdout.write('Splitting %s of %s nodes of skeleton %s' % \
+                        (benchmark.n_split_nodes, benchmark.n_nodes, skeleton.id))
+                with_triggers = benchmark.run(options['repeat'])
+                for table, trigger in benchmark.summary_triggers:
+                    cursor.execute('ALTER TABLE {} DISABLE TRIGGER {}'.format(table, trigger))
+                without_triggers = benchmark.run(options['repeat'])
+                raise BenchmarkRollback()
+        except BenchmarkRollback:
+            pass
+
+        for operation in ('split', 'join', 'reroot'):
+            self.stdout.write('%s: %.3fs (min %.3fs), without summary and '
+                    'connectivity triggers: %.3fs (min %.3fs)' % (operation,
+                    np.mean(with_triggers[operation]), min(with_triggers[operation]),
+                    np.mean(without_triggers[operation]), min(without_triggers[operation])))
@@ -1,14 +1,23 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import json
 import sys
 
-import progressbar
+import numpy as np
 
+from multiprocessing.pool import ThreadPool
+from time import time
+from uuid import uuid4
 from django.core.management.base import BaseCommand, CommandError
-from django.db import connection
+from django.db import connection, transaction
 from catmaid.models import Project
 
+
+# The maximum number of failures that are listed for each check
+MAX_EXAMPLES = 100
+
+
 class Command(BaseCommand):
     help = '''
         Tests the integrity of the specified projects with several sanity checks
@@ -16,15 +25,31 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--project_id', nargs='*', type=int, default=[])
+        parser.add_argument('--workers', dest='workers', type=int, default=1,
+            help='The number of skeleton ID ranges that are checked in parallel')
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+            default=100000, help='The number of treenodes read at a time')
+        parser.add_argument('--report', dest='report', default=None,
+            help='Write the results of all checks as JSON to this file')
 
     def handle(self, *args, **options):
         project_ids = options['project_id']
         if not len(project_ids):
             project_ids = Project.objects.all().values_list('id', flat=True)
 
+        self.workers = max(1, options['workers'])
+        self.batch_size = options['batch_size']
+
         passed = True
+        reports = []
         for project_id in project_ids:
-            passed = passed and self.check_project(project_id)
+            report = self.check_project(project_id)
+            passed = passed and report['passed']
+            reports.append(report)
+
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump({'passed': passed, 'projects': reports}, f, indent=2)
 
         if not passed:
             sys.exit(1)
@@ -32,80 +57,245 @@ class Command(BaseCommand):
     def check_project(self, project_id):
         if not Project.objects.filter(id=project_id).exists():
             raise CommandError('Project with id %s does not exist.' % project_id)
-        project_passed = True
         self.stdout.write('Checking integrity of project %s' % project_id)
 
+        start_time = time()
+        result = check_project_skeletons(project_id, self.workers, self.batch_size)
+        self.stdout.write('Read %s treenodes of %s skeletons in %.1fs' % \
+                (result.n_treenodes, result.n_skeletons, time() - start_time))
+
         self.stdout.write('Check that no connected treenodes are in different skeletons...', ending='')
-        cursor = connection.cursor()
-        cursor.execute('''
-                SELECT tn1.id, tn2.id
-                FROM treenode tn1,
-                     treenode tn2
-                WHERE tn2.id = tn1.parent_id
-                  AND tn1.skeleton_id <> tn2.skeleton_id
-                  AND tn1.project_id = %s
-                ''', (project_id,))
-        if cursor.rowcount == 0:
+        if not result.cross_skeleton:
             self.stdout.write('OK')
         else:
-            project_passed = False
             self.stdout.write('')
-            self.stdout.write('FAILED: found %s rows (should be 0)' % cursor.rowcount)
+            self.stdout.write('FAILED: found %s rows (should be 0)' % result.cross_skeleton)
 
         self.stdout.write('Check that each skeleton has exactly one root node...', ending='')
-        cursor.execute('''
-                SELECT t.skeleton_id, count(*)
-                FROM treenode t
-                WHERE t.parent_id IS NULL
-                  AND t.project_id = %s
-                GROUP BY t.skeleton_id
-                  HAVING count(*) <> 1
-                ''', (project_id,))
-        if cursor.rowcount == 0:
+        if not result.root_count:
             self.stdout.write('OK')
         else:
-            project_passed = False
             self.stdout.write('')
-            self.stdout.write('FAILED: found %s rows (should be 0)' % cursor.rowcount)
+            self.stdout.write('FAILED: found %s rows (should be 0)' % result.root_count)
 
         self.stdout.write('Check that all treenodes in a skeleton are connected to the root node...', ending='')
-        cursor.execute('''
-                SELECT DISTINCT skeleton_id
-                FROM treenode
-                WHERE project_id = %s
-                ''', (project_id,))
-        skeleton_ids = cursor.fetchall()
-        if len(skeleton_ids):
-            self.stdout.write('')
-        test_passed = True
-        with progressbar.ProgressBar(max_value=len(skeleton_ids), redirect_stdout=True) as pbar:
-            for i, skeleton_id in enumerate(skeleton_ids):
-                pbar.update(i)
-                cursor.execute('''
-                        WITH RECURSIVE nodes (id) AS (
-                          SELECT t.id
-                          FROM treenode t
-                          WHERE t.parent_id IS NULL
-                            AND t.skeleton_id = %s
-                          UNION ALL
-                          SELECT t.id
-                          FROM treenode t
-                          JOIN nodes p ON t.parent_id = p.id)
-                        SELECT t.id, t.skeleton_id
-                        FROM treenode t
-                        WHERE t.skeleton_id = %s
-                          AND NOT EXISTS (SELECT n.id FROM nodes n WHERE n.id = t.id);
-                        ''', (skeleton_id, skeleton_id))
-                if cursor.rowcount:
-                    if test_passed:
-                        self.stdout.write('')
-                    test_passed = False
-                    project_passed = False
-                    row = cursor.fetchone()
-                    self.stdout.write('FAILED: node %s in skeleton %s has no path to root' % row)
-        if test_passed:
+        if not result.disconnected:
             self.stdout.write('OK')
+        else:
+            self.stdout.write('')
+            for example in result.examples['disconnected']:
+                self.stdout.write('FAILED: node %s in skeleton %s has no path to root' % \
+                        (example['node_id'], example['skeleton_id']))
+            if result.disconnected > len(result.examples['disconnected']):
+                self.stdout.write('FAILED: %s more nodes have no path to root' % \
+                        (result.disconnected - len(result.examples['disconnected'])))
 
         self.stdout.write('')
 
-        return project_passed
+        return result.as_dict(project_id)
+
+
+class CheckResult(object):
+    """ Counts the failures of the skeleton checks and keeps the first
+    MAX_EXAMPLES failures of each check.
+    """
+
+    checks = ('cross_skeleton', 'root_count', 'disconnected')
+
+    def __init__(self):
+        self.n_treenodes = 0
+        self.n_skeletons = 0
+        self.cross_skeleton = 0
+        self.root_count = 0
+        self.disconnected = 0
+        self.examples = dict((check, []) for check in self.checks)
+
+    def add_examples(self, check, examples):
+        free = MAX_EXAMPLES - len(self.examples[check])
+        self.examples[check].extend(examples[:free])
+
+    def update(self, other):
+        self.n_treenodes += other.n_treenodes
+        self.n_skeletons += other.n_skeletons
+        for check in self.checks:
+            setattr(self, check, getattr(self, check) + getattr(other, check))
+            self.add_examples(check, other.examples[check])
+
+    @property
+    def passed(self):
+        return not any(getattr(self, check) for check in self.checks)
+
+    def as_dict(self, project_id):
+        return {
+            'project_id': project_id,
+            'passed': self.passed,
+            'n_treenodes': self.n_treenodes,
+            'n_skeletons': self.n_skeletons,
+            'checks': dict((check, {
+                'passed': 0 == getattr(self, check),
+                'failures': getattr(self, check),
+                'examples': self.examples[check],
+            }) for check in self.checks),
+        }
+
+
+def check_skeletons(node_ids, parent_ids, skeleton_ids):
+    """ Check a set of complete skeletons, given as three arrays of node IDs,
+    parent IDs (-1 for root nodes) and skeleton IDs. Returns a CheckResult.
+
+    The parent array is a union-find forest already: each node is linked to
+    its parent if both are in the same skeleton. Pointer jumping (replacing
+    each link with the link of the linked node) finds the representative of
+    every node with a logarithmic number of passes over all nodes. Nodes with
+    a root node as representative are connected to it.
+    """
+    result = CheckResult()
+    n = len(node_ids)
+    if 0 == n:
+        return result
+
+    # Find the index of each parent
+    order = np.argsort(node_ids)
+    sorted_ids = node_ids[order]
+    is_root = -1 == parent_ids
+    positions = np.minimum(np.searchsorted(sorted_ids, parent_ids), n - 1)
+    parent_index = order[positions]
+    same_skeleton = ~is_root & (sorted_ids[positions] == parent_ids) & \
+            (skeleton_ids[parent_index] == skeleton_ids)
+    cross_skeleton = ~is_root & ~same_skeleton
+
+    links = np.where(same_skeleton, parent_index, np.arange(n))
+    # Paths can't be longer than n, nodes in cycles don't converge
+    for _ in range(int(np.ceil(np.log2(n))) + 1):
+        next_links = links[links]
+        if np.array_equal(next_links, links):
+            break
+        links = next_links
+    disconnected = ~is_root[links]
+
+    skeletons, first_index = np.unique(skeleton_ids, return_index=True)
+    root_counts = np.bincount(np.searchsorted(skeletons, skeleton_ids[is_root]),
+            minlength=len(skeletons))
+    wrong_root_count = root_counts != 1
+
+    result.n_treenodes = n
+    result.n_skeletons = len(skeletons)
+    result.cross_skeleton = int(np.count_nonzero(cross_skeleton))
+    result.root_count = int(np.count_nonzero(wrong_root_count))
+    result.disconnected = int(np.count_nonzero(disconnected))
+    result.add_examples('cross_skeleton', [{
+        'node_id': int(node_ids[i]),
+        'parent_id': int(parent_ids[i]),
+        'skeleton_id': int(skeleton_ids[i]),
+    } for i in np.flatnonzero(cross_skeleton)[:MAX_EXAMPLES]])
+    result.add_examples('root_count', [{
+        'skeleton_id': int(skeletons[i]),
+        'roots': int(root_counts[i]),
+    } for i in np.flatnonzero(wrong_root_count)[:MAX_EXAMPLES]])
+    result.add_examples('disconnected', [{
+        'node_id': int(node_ids[i]),
+        'skeleton_id': int(skeleton_ids[i]),
+    } for i in np.flatnonzero(disconnected)[:MAX_EXAMPLES]])
+    return result
+
+
+def iterate_skeleton_chunks(project_id, min_skeleton_id, max_skeleton_id,
+        batch_size):
+    """ Read the ID, parent ID and skeleton ID of all treenodes in the passed
+    in range of skeleton IDs, ordered by skeleton, from a server side cursor.
+    Yields tuples of arrays of about batch_size treenodes, which contain only
+    complete skeletons.
+    """
+    with transaction.atomic():
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(
+                name='catmaid_check_{}'.format(uuid4().hex))
+        cursor.itersize = batch_size
+        try:
+            cursor.execute('''
+                SELECT id, COALESCE(parent_id, -1), skeleton_id
+                FROM treenode
+                WHERE project_id = %s
+                  AND skeleton_id BETWEEN %s AND %s
+                ORDER BY skeleton_id
+            ''', (project_id, min_skeleton_id, max_skeleton_id))
+            rows = []
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                rows.extend(batch)
+                # Hold back the last skeleton, it might not be complete yet
+                last_skeleton_id = rows[-1][2]
+                split = len(rows)
+                while split > 0 and rows[split - 1][2] == last_skeleton_id:
+                    split -= 1
+                if split > 0:
+                    yield to_arrays(rows[:split])
+                    rows = rows[split:]
+            if rows:
+                yield to_arrays(rows)
+        finally:
+            cursor.close()
+
+
+def to_arrays(rows):
+    data = np.array(rows, dtype=np.int64).reshape((-1, 3))
+    return data[:, 0], data[:, 1], data[:, 2]
+
+
+def check_skeleton_range(project_id, min_skeleton_id, max_skeleton_id,
+        batch_size, own_connection=False):
+    """ Check all skeletons in the passed in range of skeleton IDs and return
+    a CheckResult.
+    """
+    result = CheckResult()
+    try:
+        for node_ids, parent_ids, skeleton_ids in iterate_skeleton_chunks(
+                project_id, min_skeleton_id, max_skeleton_id, batch_size):
+            result.update(check_skeletons(node_ids, parent_ids, skeleton_ids))
+    finally:
+        if own_connection:
+            # Workers run in their own threads with their own connection
+            connection.close()
+    return result
+
+
+def check_project_skeletons(project_id, workers=1, batch_size=100000):
+    """ Check that the treenodes of each skeleton in the passed in project
+    belong to the same skeleton as their parent, that each skeleton has
+    exactly one root and that all treenodes are connected to it. All
+    treenodes are read once, skeleton by skeleton. With more than one worker,
+    ranges of skeleton IDs are checked in parallel. Returns a CheckResult.
+    """
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT min(skeleton_id), max(skeleton_id)
+        FROM treenode
+        WHERE project_id = %s
+    ''', (project_id,))
+    min_skeleton_id, max_skeleton_id = cursor.fetchone()
+    result = CheckResult()
+    if min_skeleton_id is None:
+        return result
+
+    # Split the skeleton IDs into equally large ranges
+    bounds = np.linspace(min_skeleton_id, max_skeleton_id + 1,
+            workers + 1).astype(np.int64)
+    ranges = [(int(bounds[i]), int(bounds[i + 1]) - 1) for i in range(workers)
+            if bounds[i + 1] > bounds[i]]
+
+    if len(ranges) > 1 and not connection.in_atomic_block:
+        pool = ThreadPool(len(ranges))
+        try:
+            results = pool.map(lambda r: check_skeleton_range(project_id,
+                    r[0], r[1], batch_size, True), ranges)
+        finally:
+            pool.close()
+    else:
+        results = [check_skeleton_range(project_id, r[0], r[1], batch_size)
+                for r in ranges]
+
+    for r in results:
+        result.update(r)
+    return result
@@ -1,11 +1,19 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import gzip
+import json
+import os
 import six
 
+from collections import OrderedDict
 from itertools import chain
+from multiprocessing.pool import ThreadPool
+from uuid import uuid4
 from django.core import serializers
 from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
 from catmaid.control.tracing import check_tracing_setup
 from catmaid.models import Class, ClassInstance, ClassInstanceClassInstance, \
          Relation, Connector, Project, Treenode, TreenodeConnector
@@ -20,7 +28,14 @@ class Exporter():
         self.export_annotations = options['export_annotations']
         self.export_tags = options['export_tags']
         self.required_annotations = options['required_annotations']
-        self.target_file = 'export_pid_%s.json' % project.id
+        self.stream = options.get('stream', False)
+        self.columnar = options.get('columnar', False)
+        self.jobs = max(1, options.get('jobs') or 1)
+        self.batch_size = options.get('batch_size') or 10000
+        if self.columnar:
+            self.target_file = 'export_pid_%s' % project.id
+        else:
+            self.target_file = 'export_pid_%s.json' % project.id
 
         self.show_traceback = True
         self.format = 'json'
@@ -180,6 +195,13 @@ class Exporter():
         try:
             self.collect_data()
 
+            if self.columnar:
+                self.write_columnar()
+                return
+            if self.stream:
+                self.write_json_stream()
+                return
+
             data = list(chain(*self.to_serialize))
 
             CurrentSerializer = serializers.get_serializer(self.format)
@@ -191,6 +213,138 @@ class Exporter():
                 raise
             raise CommandError("Unable to serialize database: %s" % e)
 
+    def write_json_stream(self):
+        """ Writes all collected objects in the format of Django's JSON
+        serializer, but without indentation and one object at a time. Rows are
+        read from server side cursors in batches, which keeps memory use
+        constant.
+        """
+        encoder = DjangoJSONEncoder()
+        with transaction.atomic(), open(self.target_file, "w") as out:
+            out.write('[')
+            separator = '\n'
+            for queryset in self.to_serialize:
+                model = queryset.model
+                label = model._meta.label_lower
+                fields = model._meta.concrete_fields
+                for row in stream_queryset(queryset, self.batch_size):
+                    obj = OrderedDict((('model', label), ('pk', None),
+                            ('fields', OrderedDict())))
+                    for field, value in zip(fields, row):
+                        if field.primary_key:
+                            obj['pk'] = value
+                        elif field.serialize:
+                            obj['fields'][field.name] = value
+                    out.write(separator)
+                    out.write(encoder.encode(obj))
+                    separator = ',\n'
+            out.write('\n]\n')
+
+    def write_columnar(self):
+        """ Writes the collected objects of each model as gzip compressed CSV
+        file into the target directory, using PostgreSQL's COPY. Each table is
+        written by its own job, up to self.jobs tables in parallel. A file
+        named manifest.json lists the written tables in the order in which
+        they have to be imported.
+        """
+        if not os.path.exists(self.target_file):
+            os.makedirs(self.target_file)
+
+        querysets = OrderedDict()
+        for queryset in self.to_serialize:
+            querysets.setdefault(queryset.model, []).append(queryset)
+
+        # Parallel jobs need their own transactions, which can only share a
+        # snapshot with a transaction that was started here.
+        parallel = self.jobs > 1 and not connection.in_atomic_block
+        with transaction.atomic():
+            snapshot = None
+            cursor = connection.cursor()
+            if parallel:
+                # Let all jobs see the same state of the database
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                cursor.execute('SELECT pg_export_snapshot()')
+                snapshot = cursor.fetchone()[0]
+
+            def write(item):
+                return self.write_table(item[0], item[1], snapshot)
+
+            if snapshot:
+                pool = ThreadPool(min(self.jobs, len(querysets)))
+                try:
+                    tables = pool.map(write, querysets.items())
+                finally:
+                    pool.close()
+            else:
+                tables = [write(item) for item in querysets.items()]
+
+        manifest = {
+            'format': 'catmaid-columnar',
+            'version': 1,
+            'project_id': self.project.id,
+            'tables': tables,
+        }
+        with open(os.path.join(self.target_file, 'manifest.json'), 'w') as out:
+            json.dump(manifest, out, indent=self.indent)
+
+    def write_table(self, model, querysets, snapshot=None):
+        """ Write the rows of all passed in querysets of one model into a
+        single gzip compressed CSV file and return its manifest entry. If a
+        snapshot is passed in, a new transaction is started with it, which
+        allows to run this in its own thread.
+        """
+        columns = [f.column for f in model._meta.concrete_fields]
+        file_name = '%s.csv.gz' % model._meta.label_lower
+        path = os.path.join(self.target_file, file_name)
+        try:
+            with transaction.atomic():
+                cursor = connection.cursor()
+                if snapshot:
+                    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                    cursor.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+                with gzip.open(path, 'wb') as out:
+                    for n, queryset in enumerate(querysets):
+                        sql, params = queryset.values_list(*[f.attname for f in
+                                model._meta.concrete_fields]).query.sql_with_params()
+                        query = cursor.mogrify(sql, params)
+                        if isinstance(query, bytes):
+                            query = query.decode('utf-8')
+                        # Only the first query writes a header
+                        cursor.copy_expert('COPY ({}) TO STDOUT WITH (FORMAT csv{})'.format(
+                                query, ', HEADER' if 0 == n else ''), out)
+        finally:
+            if snapshot:
+                # Jobs run in their own threads with their own connection
+                connection.close()
+
+        print("Exported table %s" % model._meta.db_table)
+        return {
+            'model': model._meta.label_lower,
+            'file': file_name,
+            'columns': columns,
+        }
+
+
+def stream_queryset(queryset, batch_size=10000):
+    """ Yield the rows of a queryset as tuples of all concrete field values of
+    its model. Rows are read from a server side cursor, batch_size rows at a
+    time. This needs to be called in a transaction.
+    """
+    fields = queryset.model._meta.concrete_fields
+    sql, params = queryset.values_list(*[f.attname for f in fields]) \
+            .query.sql_with_params()
+    connection.ensure_connection()
+    cursor = connection.connection.cursor(
+            name='catmaid_export_{}'.format(uuid4().hex))
+    cursor.itersize = batch_size
+    try:
+        cursor.execute(sql, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+
+
 class Command(BaseCommand):
     """ Call e.g. like
         ./manage.py catmaid_export_data --source 1 --required-annotation "Kenyon cells"
@@ -220,6 +374,17 @@ class Command(BaseCommand):
             action='append', help='Name a required annotation for exported skeletons.')
         parser.add_argument('--connector-placeholders', dest='connector_placeholders',
             action='store_true', help='Should placeholder nodes be exported')
+        parser.add_argument('--stream', dest='stream', default=False,
+            action='store_true', help='Write compact JSON while reading rows '
+            'in batches, which keeps memory use constant')
+        parser.add_argument('--columnar', dest='columnar', default=False,
+            action='store_true', help='Write one compressed CSV file per '
+            'table into a directory, which can be imported with '
+            'catmaid_import_data --bulk')
+        parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+            help='The number of tables to export in parallel in columnar mode')
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+            default=10000, help='The number of rows read at a time when streaming')
 
     def ask_for_project(self, title):
         """ Return a valid project object.
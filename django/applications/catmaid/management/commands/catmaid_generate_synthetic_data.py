@@ -0,0 +1,558 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import numpy as np
+
+from time import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from guardian.shortcuts import assign_perm
+from catmaid.control.skeleton import rebuild_skeleton_connectivity
+from catmaid.control.stats import rebuild_stats_summary
+from catmaid.control.tracing import setup_tracing
+from catmaid.fields import Double3D, Integer3D
+from catmaid.management.commands.catmaid_import_data import \
+        BulkFileImporter, to_copy_text
+from catmaid.management.commands.catmaid_rebuild_edge_table import \
+        rebuild_edge_tables
+from catmaid.management.commands.catmaid_rebuild_skeleton_summary import \
+        rebuild_skeleton_summary
+from catmaid.models import Class, Project, ProjectStack, Relation, Stack, User
+
+
+# Tags that are added to random nodes
+LABELS = ('ends', 'uncertain end', 'uncertain continuation', 'soma', 'TODO',
+        'microtubules end')
+
+
+def generate_arbor(rng, n_nodes, spacing, branch_probability=0.02):
+    """Return the parent indices (-1 for the root) and the positions relative
+    to the root of a random arbor with the passed in number of nodes. Each
+    node continues the segment of the node before it or, with the passed in
+    probability, branches off a random earlier node. Segments grow into their
+    own random direction and neighboring nodes are <spacing> apart.
+    """
+    parents = np.arange(-1, n_nodes - 1, dtype=np.int64)
+    branches = np.flatnonzero(rng.random_sample(n_nodes) < branch_probability)
+    branches = branches[branches > 1]
+    parents[branches] = (rng.random_sample(len(branches)) * branches).astype(np.int64)
+
+    is_start = parents != np.arange(-1, n_nodes - 1)
+    is_start[0] = True
+    segment = np.cumsum(is_start) - 1
+    starts = np.flatnonzero(is_start)
+
+    directions = rng.normal(size=(len(starts), 3))
+    steps = directions[segment] / np.linalg.norm(directions, axis=1)[segment, np.newaxis]
+    steps += 0.3 * rng.normal(size=(n_nodes, 3))
+    steps *= spacing / np.linalg.norm(steps, axis=1)[:, np.newaxis]
+    steps[0] = 0
+
+    # The position of each node relative to the parent of the first node of
+    # its segment.
+    offsets = np.concatenate((np.zeros((1, 3)), np.cumsum(steps, axis=0)))
+    relative = offsets[1:] - offsets[starts][segment]
+
+    # The position of the parent of each segment's first node is the sum of
+    # these relative positions along the path to the root, which is computed
+    # for all segments at once by pointer jumping.
+    base = np.zeros((len(starts), 3))
+    base[1:] = relative[parents[starts[1:]]]
+    ancestor = np.full(len(starts), -1, dtype=np.int64)
+    ancestor[1:] = segment[parents[starts[1:]]]
+    while (ancestor >= 0).any():
+        has_ancestor = ancestor >= 0
+        base = base + np.where(has_ancestor[:, np.newaxis], base[ancestor], 0)
+        ancestor = np.where(has_ancestor, ancestor[ancestor], -1)
+
+    return parents, base[segment] + relative
+
+
+def to_copy_column(values, n_rows):
+    """Return the COPY text representation of a column of rows. Values are
+    either a single value that is used for all rows, a list or a numpy array.
+    """
+    if isinstance(values, np.ndarray):
+        if values.dtype.kind == 'f':
+            return np.char.mod('%.3f', values).tolist()
+        if values.dtype.kind in 'iu':
+            return np.char.mod('%d', values).tolist()
+        if values.dtype.kind == 'M':
+            return np.datetime_as_string(values, timezone='UTC').tolist()
+        return values.tolist()
+    if isinstance(values, list):
+        return values
+    if isinstance(values, np.datetime64):
+        values = np.datetime_as_string(values, timezone='UTC')
+    return [to_copy_text(values)] * n_rows
+
+
+def copy_columns(cursor, table, columns):
+    """Insert rows into a table with COPY. Columns are passed as a list of
+    (name, values) pairs.
+    """
+    n_rows = max(len(v) for _, v in columns if isinstance(v, (list, np.ndarray)))
+    if not n_rows:
+        return
+    text = [to_copy_column(values, n_rows) for _, values in columns]
+    data = io.BytesIO(('\n'.join('\t'.join(row) for row in zip(*text)) + '\n').encode('utf-8'))
+    cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(table,
+            ', '.join(name for name, _ in columns)), data)
+
+
+class SyntheticDataGenerator(object):
+    """Creates a new tracing project with random skeletons, synapses, tags,
+    reviews and annotations. All rows are written with COPY in batches of
+    skeletons, without the triggers that update derived data for each row.
+    Edge tables, skeleton summaries and the skeleton connectivity are rebuilt
+    for the new project at the end. Some nodes are edited afterwards, with all
+    triggers enabled, to create history rows.
+    """
+
+    # Triggers that are disabled while rows are written
+    deferred_triggers = BulkFileImporter.deferred_triggers + (
+        ('class_instance_class_instance',
+                'on_change_annotation_link_update_hierarchy_version'),
+    )
+
+    def __init__(self, users, options):
+        self.users = users
+        self.user_ids = np.array([u.id for u in users])
+        self.options = options
+        self.rng = np.random.RandomState(options['seed'])
+        self.now = np.datetime64(timezone.now().replace(tzinfo=None), 's')
+
+    @transaction.atomic
+    def generate(self):
+        cursor = connection.cursor()
+        # Check references at the end of each COPY, deferred checks of
+        # millions of rows would have to be remembered until the commit.
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        for table, trigger in self.deferred_triggers:
+            cursor.execute('ALTER TABLE {} DISABLE TRIGGER {}'.format(table, trigger))
+
+        self.create_project()
+        self.plan()
+        self.write_annotations(cursor)
+        self.start_time = time()
+        batch_size = self.options['batch_size']
+        for first in range(0, self.n_skeletons, batch_size):
+            self.write_skeletons(cursor, first, min(first + batch_size, self.n_skeletons))
+        for first in range(0, self.n_connectors, batch_size * 10):
+            self.write_postsynaptic_links(cursor, first,
+                    min(first + batch_size * 10, self.n_connectors))
+
+        for table, trigger in self.deferred_triggers:
+            cursor.execute('ALTER TABLE {} ENABLE TRIGGER {}'.format(table, trigger))
+        start_time = time()
+        rebuild_edge_tables(cursor, self.project.id)
+        rebuild_skeleton_summary(cursor, self.project.id)
+        rebuild_skeleton_connectivity(cursor, self.project.id)
+        cursor.execute('''
+            INSERT INTO catmaid_annotation_hierarchy_version (project_id, version)
+            VALUES (%(project_id)s, nextval('catmaid_annotation_hierarchy_version_seq'))
+            ON CONFLICT (project_id) DO UPDATE SET version = EXCLUDED.version
+        ''', {
+            'project_id': self.project.id
+        })
+        print("Rebuilt edge tables, skeleton summaries and connectivity in %.1fs" % \
+                (time() - start_time))
+
+        self.edit_nodes(cursor)
+        # Changes weren't recorded for the contribution summary while
+        # triggers were disabled.
+        rebuild_stats_summary(cursor, self.project.id)
+        for table in ('treenode', 'connector', 'treenode_connector',
+                'class_instance', 'class_instance_class_instance',
+                'treenode_class_instance', 'review', 'treenode_edge',
+                'treenode_connector_edge', 'connector_geom'):
+            cursor.execute('ANALYZE {}'.format(table))
+
+        return self.project
+
+    def create_project(self):
+        """Create a new project with a stack that covers the generated data
+        and set it up for tracing.
+        """
+        options = self.options
+        user = self.users[0]
+        self.project = Project.objects.create(title=options['title'])
+        extent = np.array(options['extent'])
+        resolution = np.array(options['resolution'])
+        dimension = np.ceil(extent / resolution).astype(int)
+        stack = Stack.objects.create(title=options['title'],
+                dimension=Integer3D(*dimension.tolist()),
+                resolution=Double3D(*resolution.tolist()))
+        ProjectStack.objects.create(project=self.project, stack=stack)
+        setup_tracing(self.project.id, user)
+        for u in self.users:
+            for perm in ('can_browse', 'can_annotate'):
+                assign_perm(perm, u, self.project)
+
+        self.classes = dict(Class.objects.filter(project=self.project) \
+                .values_list('class_name', 'id'))
+        self.relations = dict(Relation.objects.filter(project=self.project) \
+                .values_list('relation_name', 'id'))
+        for name in ('annotation', 'neuron', 'skeleton', 'label'):
+            if name not in self.classes:
+                self.classes[name] = Class.objects.create(project=self.project,
+                        user=user, class_name=name).id
+        if 'annotated_with' not in self.relations:
+            self.relations['annotated_with'] = Relation.objects.create(
+                    project=self.project, user=user,
+                    relation_name='annotated_with').id
+
+    def reserve_ids(self, sequence, n):
+        """Reserve <n> consecutive IDs of a sequence and return the first one.
+        """
+        cursor = connection.cursor()
+        cursor.execute("SELECT nextval(%s)", (sequence,))
+        first = cursor.fetchone()[0]
+        if n > 1:
+            cursor.execute("SELECT setval(%s, %s)", (sequence, first + n - 1))
+        return first
+
+    def plan(self):
+        """Decide on the size, owner and start time of all skeletons and
+        reserve the IDs of all nodes, connectors and class instances.
+        """
+        options = self.options
+        rng = self.rng
+        n = self.n_skeletons = options['skeletons']
+
+        # Node counts are log-normally distributed, many skeletons are small
+        # fragments and few are large neurons.
+        sigma = 1.0
+        mu = np.log(options['nodes']) - sigma ** 2 / 2
+        self.node_counts = np.maximum(1, np.round(
+                rng.lognormal(mu, sigma, n))).astype(np.int64)
+        self.node_offsets = np.concatenate(([0], np.cumsum(self.node_counts)[:-1]))
+        self.connector_counts = rng.poisson(options['connectors'], n)
+        self.connector_offsets = np.concatenate(([0], np.cumsum(self.connector_counts)[:-1]))
+        self.n_nodes = int(self.node_counts.sum())
+        self.n_connectors = int(self.connector_counts.sum())
+
+        self.owners = self.user_ids[rng.randint(len(self.user_ids), size=n)]
+        days = np.timedelta64(options['days'], 'D').astype('timedelta64[s]')
+        self.start_times = self.now - (rng.random_sample(n) * days.astype(np.int64)) \
+                .astype('timedelta64[s]')
+        self.somata = rng.random_sample((n, 3)) * options['extent']
+
+        self.first_node_id = self.reserve_ids('location_id_seq', self.n_nodes)
+        self.first_connector_id = self.reserve_ids('location_id_seq', self.n_connectors)
+        n_annotations = options['annotations']
+        first_ci_id = self.reserve_ids('concept_id_seq',
+                2 * n + n_annotations + len(LABELS))
+        self.skeleton_ids = first_ci_id + np.arange(n)
+        self.neuron_ids = first_ci_id + n + np.arange(n)
+        self.annotation_ids = first_ci_id + 2 * n + np.arange(n_annotations)
+        self.label_ids = first_ci_id + 2 * n + n_annotations + np.arange(len(LABELS))
+
+        # The pre-synaptic skeleton and creation time of each connector are
+        # needed for its post-synaptic links.
+        self.connector_skeletons = np.repeat(np.arange(n), self.connector_counts)
+        self.connector_times = np.empty(self.n_connectors, dtype='datetime64[s]')
+
+        print("Generating %s skeletons with %s nodes and %s connectors" % \
+                (n, self.n_nodes, self.n_connectors))
+
+    def write_annotations(self, cursor):
+        """Write tags and annotations. Some annotations are annotated with
+        other annotations to form a hierarchy.
+        """
+        rng = self.rng
+        n_annotations = len(self.annotation_ids)
+        user_id = self.user_ids[0]
+        copy_columns(cursor, 'class_instance', [
+            ('id', np.concatenate((self.annotation_ids, self.label_ids))),
+            ('user_id', user_id),
+            ('project_id', self.project.id),
+            ('class_id', np.array([self.classes['annotation']] * n_annotations +
+                    [self.classes['label']] * len(LABELS))),
+            ('name', ['annotation %s' % i for i in range(n_annotations)] + list(LABELS)),
+            ('creation_time', self.now),
+            ('edition_time', self.now),
+        ])
+
+        meta = np.flatnonzero(rng.random_sample(n_annotations) < 0.1)
+        meta = meta[meta > 0]
+        copy_columns(cursor, 'class_instance_class_instance', [
+            ('user_id', user_id),
+            ('project_id', self.project.id),
+            ('relation_id', self.relations['annotated_with']),
+            ('class_instance_a', self.annotation_ids[meta]),
+            ('class_instance_b', self.annotation_ids[
+                    (rng.random_sample(len(meta)) * meta).astype(np.int64)]),
+            ('creation_time', self.now),
+            ('edition_time', self.now),
+        ])
+
+    def write_skeletons(self, cursor, first, last):
+        """Write the skeletons with the passed in index range along with their
+        neurons, nodes, connectors, pre-synaptic links, tags and reviews.
+        """
+        options = self.options
+        rng = self.rng
+        skeletons = np.arange(first, last)
+        skeleton_ids = self.skeleton_ids[skeletons]
+        neuron_ids = self.neuron_ids[skeletons]
+        owners = self.owners[skeletons]
+        start_times = self.start_times[skeletons]
+        project_id = self.project.id
+
+        copy_columns(cursor, 'class_instance', [
+            ('id', np.concatenate((skeleton_ids, neuron_ids))),
+            ('user_id', np.concatenate((owners, owners))),
+            ('project_id', project_id),
+            ('class_id', np.repeat([self.classes['skeleton'],
+                    self.classes['neuron']], len(skeletons))),
+            ('name', ['skeleton %s' % i for i in skeleton_ids] +
+                    ['neuron %s' % i for i in neuron_ids]),
+            ('creation_time', np.concatenate((start_times, start_times))),
+            ('edition_time', np.concatenate((start_times, start_times))),
+        ])
+
+        n_annotations = len(self.annotation_ids)
+        if n_annotations:
+            counts = np.minimum(n_annotations, 1 + rng.poisson(1, len(skeletons)))
+            pairs = np.unique(np.repeat(np.arange(len(skeletons)), counts) *
+                    n_annotations + rng.randint(n_annotations, size=counts.sum()))
+            annotated = pairs // n_annotations
+        else:
+            pairs = annotated = np.array([], dtype=np.int64)
+        copy_columns(cursor, 'class_instance_class_instance', [
+            ('user_id', np.concatenate((owners, owners[annotated]))),
+            ('project_id', project_id),
+            ('relation_id', np.concatenate((
+                    np.repeat(self.relations['model_of'], len(skeletons)),
+                    np.repeat(self.relations['annotated_with'], len(pairs))))),
+            ('class_instance_a', np.concatenate((skeleton_ids, neuron_ids[annotated]))),
+            ('class_instance_b', np.concatenate((neuron_ids,
+                    self.annotation_ids[pairs % max(1, n_annotations)]))),
+            ('creation_time', np.concatenate((start_times, start_times[annotated]))),
+            ('edition_time', np.concatenate((start_times, start_times[annotated]))),
+        ])
+
+        # Nodes of each skeleton are created one after another
+        extent = np.array(options['extent'])
+        z_resolution = options['resolution'][2]
+        node_ids, parent_ids, positions, node_skeletons = [], [], [], []
+        for i in skeletons:
+            parents, arbor = generate_arbor(rng, self.node_counts[i],
+                    options['node_spacing'])
+            first_id = self.first_node_id + self.node_offsets[i]
+            node_ids.append(first_id + np.arange(len(parents)))
+            parent_ids.append(np.where(parents < 0, -1, first_id + parents))
+            positions.append(arbor + self.somata[i])
+            node_skeletons.append(np.repeat(i, len(parents)))
+        node_ids = np.concatenate(node_ids)
+        parent_ids = np.concatenate(parent_ids)
+        positions = np.clip(np.concatenate(positions), 0, extent)
+        positions[:, 2] = np.round(positions[:, 2] / z_resolution) * z_resolution
+        node_skeletons = np.concatenate(node_skeletons)
+        node_times = np.minimum(self.now, self.start_times[node_skeletons] +
+                (node_ids - self.first_node_id - self.node_offsets[node_skeletons]) *
+                np.timedelta64(20, 's'))
+        node_users = self.owners[node_skeletons]
+
+        copy_columns(cursor, 'treenode', [
+            ('id', node_ids),
+            ('user_id', node_users),
+            ('editor_id', node_users),
+            ('project_id', project_id),
+            ('creation_time', node_times),
+            ('edition_time', node_times),
+            ('location_x', positions[:, 0]),
+            ('location_y', positions[:, 1]),
+            ('location_z', positions[:, 2]),
+            ('parent_id', np.where(parent_ids < 0, '\\N',
+                    np.char.mod('%d', parent_ids)).tolist()),
+            ('radius', -1.0),
+            ('confidence', 5),
+            ('skeleton_id', self.skeleton_ids[node_skeletons]),
+        ])
+
+        # Connectors are placed next to a random pre-synaptic node of their
+        # skeleton.
+        connector_skeletons = np.repeat(skeletons, self.connector_counts[skeletons])
+        first_connector = self.connector_offsets[first]
+        connector_ids = self.first_connector_id + first_connector + \
+                np.arange(len(connector_skeletons))
+        pre_nodes = self.node_offsets[connector_skeletons] - self.node_offsets[first] + \
+                (rng.random_sample(len(connector_skeletons)) *
+                        self.node_counts[connector_skeletons]).astype(np.int64)
+        connector_positions = np.clip(positions[pre_nodes] + rng.normal(
+                scale=options['node_spacing'], size=(len(pre_nodes), 3)), 0, extent)
+        connector_positions[:, 2] = positions[pre_nodes, 2]
+        connector_times = node_times[pre_nodes]
+        connector_users = node_users[pre_nodes]
+        self.connector_times[first_connector:first_connector + len(connector_ids)] = \
+                connector_times
+
+        copy_columns(cursor, 'connector', [
+            ('id', connector_ids),
+            ('user_id', connector_users),
+            ('editor_id', connector_users),
+            ('project_id', project_id),
+            ('creation_time', connector_times),
+            ('edition_time', connector_times),
+            ('location_x', connector_positions[:, 0]),
+            ('location_y', connector_positions[:, 1]),
+            ('location_z', connector_positions[:, 2]),
+            ('confidence', 5),
+        ])
+        copy_columns(cursor, 'treenode_connector', [
+            ('user_id', connector_users),
+            ('project_id', project_id),
+            ('creation_time', connector_times),
+            ('edition_time', connector_times),
+            ('relation_id', self.relations['presynaptic_to']),
+            ('treenode_id', node_ids[pre_nodes]),
+            ('connector_id', connector_ids),
+            ('skeleton_id', self.skeleton_ids[connector_skeletons]),
+            ('confidence', 5),
+        ])
+
+        tagged = np.flatnonzero(rng.random_sample(len(node_ids)) < options['tag_fraction'])
+        copy_columns(cursor, 'treenode_class_instance', [
+            ('user_id', node_users[tagged]),
+            ('project_id', project_id),
+            ('creation_time', node_times[tagged]),
+            ('edition_time', node_times[tagged]),
+            ('relation_id', self.relations['labeled_as']),
+            ('treenode_id', node_ids[tagged]),
+            ('class_instance_id', self.label_ids[rng.randint(len(LABELS),
+                    size=len(tagged))]),
+        ])
+
+        # All nodes of reviewed skeletons are reviewed by a single reviewer
+        # within a month after their creation.
+        reviewed = rng.random_sample(len(skeletons)) < options['review_fraction']
+        reviewers = self.user_ids[rng.randint(len(self.user_ids), size=len(skeletons))]
+        reviewed_nodes = np.flatnonzero(reviewed[node_skeletons - first])
+        copy_columns(cursor, 'review', [
+            ('project_id', project_id),
+            ('reviewer_id', reviewers[node_skeletons[reviewed_nodes] - first]),
+            ('review_time', np.minimum(self.now, node_times[reviewed_nodes] +
+                    (rng.random_sample(len(reviewed_nodes)) * 30 * 86400) \
+                            .astype('timedelta64[s]'))),
+            ('skeleton_id', self.skeleton_ids[node_skeletons[reviewed_nodes]]),
+            ('treenode_id', node_ids[reviewed_nodes]),
+        ])
+
+        print("Wrote %s of %s skeletons (%.1fs)" % (last, self.n_skeletons,
+                time() - self.start_time))
+
+    def write_postsynaptic_links(self, cursor, first, last):
+        """Link each connector with the passed in index range to random nodes
+        of other skeletons.
+        """
+        rng = self.rng
+        n = self.n_skeletons
+        if n < 2:
+            return
+        connectors = np.arange(first, last)
+        counts = 1 + rng.poisson(1.5, len(connectors))
+        connectors = np.repeat(connectors, counts)
+        partners = (self.connector_skeletons[connectors] + 1 +
+                rng.randint(n - 1, size=len(connectors))) % n
+        nodes = self.node_offsets[partners] + (rng.random_sample(len(connectors)) *
+                self.node_counts[partners]).astype(np.int64)
+        _, unique = np.unique(connectors * self.n_nodes + nodes, return_index=True)
+        connectors, partners, nodes = connectors[unique], partners[unique], nodes[unique]
+
+        copy_columns(cursor, 'treenode_connector', [
+            ('user_id', self.owners[partners]),
+            ('project_id', self.project.id),
+            ('creation_time', self.connector_times[connectors]),
+            ('edition_time', self.connector_times[connectors]),
+            ('relation_id', self.relations['postsynaptic_to']),
+            ('treenode_id', self.first_node_id + nodes),
+            ('connector_id', self.first_connector_id + connectors),
+            ('skeleton_id', self.skeleton_ids[partners]),
+            ('confidence', 5),
+        ])
+
+    def edit_nodes(self, cursor):
+        """Move a random fraction of all nodes slightly, with all triggers
+        enabled, which creates history rows for them.
+        """
+        fraction = self.options['edit_fraction']
+        if not fraction:
+            return
+        cursor.execute('SELECT setseed(%s)', (self.rng.random_sample() * 2 - 1,))
+        cursor.execute('''
+            UPDATE treenode
+            SET location_x = location_x + (random() - 0.5) * %(distance)s,
+                location_y = location_y + (random() - 0.5) * %(distance)s,
+                editor_id = (%(user_ids)s::integer[])[1 + floor(random() * %(n_users)s)]
+            WHERE project_id = %(project_id)s
+              AND random() < %(fraction)s
+        ''', {
+            'distance': self.options['node_spacing'] / 2.0,
+            'user_ids': self.user_ids.tolist(),
+            'n_users': len(self.user_ids),
+            'project_id': self.project.id,
+            'fraction': fraction,
+        })
+        print("Edited %s nodes" % cursor.rowcount)
+
+
+class Command(BaseCommand):
+    help = "Create a new tracing project with a configurable number of random " \
+           "skeletons, connectors, tags, reviews and annotations. The " \
+           "database can then be used as template for performance tests. " \
+           "Node and connector IDs are reserved before any data is written, " \
+           "no other tracing should happen in the database meanwhile."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', dest='user', required=True,
+            help='The ID of the owner of the project')
+        parser.add_argument('--users', dest='users', nargs='+', default=[],
+            help='The IDs of additional users that own skeletons and review')
+        parser.add_argument('--title', dest='title',
+            default='Synthetic connectome', help='The title of the new project')
+        parser.add_argument('--skeletons', dest='skeletons', type=int,
+            default=1000, help='The number of skeletons')
+        parser.add_argument('--nodes', dest='nodes', type=float, default=1000,
+            help='The mean number of nodes per skeleton')
+        parser.add_argument('--connectors', dest='connectors', type=float,
+            default=50, help='The mean number of pre-synaptic connectors per skeleton')
+        parser.add_argument('--annotations', dest='annotations', type=int,
+            default=100, help='The number of annotations neurons are annotated with')
+        parser.add_argument('--tag-fraction', dest='tag_fraction', type=float,
+            default=0.01, help='The fraction of nodes that are tagged')
+        parser.add_argument('--review-fraction', dest='review_fraction',
+            type=float, default=0.2, help='The fraction of skeletons that are reviewed')
+        parser.add_argument('--edit-fraction', dest='edit_fraction', type=float,
+            default=0.01, help='The fraction of nodes that are edited after '
+            'their creation, which creates history rows')
+        parser.add_argument('--node-spacing', dest='node_spacing', type=float,
+            default=200, help='The distance between neighboring nodes in nm')
+        parser.add_argument('--extent', dest='extent', type=float, nargs=3,
+            default=[100000, 100000, 50000], help='The size of the volume '
+            'skeletons are placed in, in nm')
+        parser.add_argument('--resolution', dest='resolution', type=float,
+            nargs=3, default=[4, 4, 40], help='The resolution of the stack '
+            'of the project in nm, nodes are placed on its sections')
+        parser.add_argument('--days', dest='days', type=int, default=365,
+            help='The number of days over which skeletons have been created')
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+            default=100, help='The number of skeletons that are written at once')
+        parser.add_argument('--seed', dest='seed', type=int, default=0,
+            help='The seed of the random number generator')
+
+    def handle(self, *args, **options):
+        if options['skeletons'] < 1:
+            raise CommandError('At least one skeleton is needed')
+        try:
+            users = [User.objects.get(pk=int(user_id)) for user_id in
+                    [options['user']] + options['users']]
+        except (ValueError, User.DoesNotExist):
+            raise CommandError('Users must be given as valid user IDs')
+
+        generator = SyntheticDataGenerator(users, options)
+        project = generator.generate()
+        print("Created project with ID %s" % project.id)
@@ -1,12 +1,86 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import gzip
+import io
+import json
+import os
+import re
+import six
+
+from collections import OrderedDict
+from datetime import date, datetime
+from time import time
+from django.apps import apps
 from django.core import serializers
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connection, transaction
 from catmaid.control.annotationadmin import copy_annotations
+from catmaid.control.node import invalidate_node_list_cache
+from catmaid.control.skeleton import rebuild_skeleton_connectivity
+from catmaid.control.stats import rebuild_stats_summary
+from catmaid.management.commands.catmaid_rebuild_edge_table import \
+        rebuild_edge_tables
+from catmaid.management.commands.catmaid_rebuild_skeleton_summary import \
+        rebuild_skeleton_summary
 from catmaid.models import Project, User
 
+
+def iterate_json_array(stream, chunk_size=65536):
+    """ Yield the elements of the JSON array in the passed in file-like object
+    one by one, reading only chunk_size characters at a time. This allows to
+    read files that don't fit into memory.
+    """
+    decoder = json.JSONDecoder()
+    separators = re.compile(r'[\s,]*')
+    buffer = ''
+    position = 0
+    in_array = False
+    while True:
+        chunk = stream.read(chunk_size)
+        buffer = buffer[position:] + chunk
+        position = 0
+        while True:
+            position = separators.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            if not in_array:
+                if buffer[position] != '[':
+                    raise ValueError("Expected a JSON array")
+                in_array = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                element, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # The element isn't complete yet, read more data
+                if not chunk:
+                    raise
+                break
+            yield element
+        if not chunk:
+            raise ValueError("Unexpected end of JSON data")
+
+
+def to_copy_text(value):
+    """ Return the representation of a value in PostgreSQL's COPY text
+    format.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, float):
+        # The string representation loses precision in Python 2
+        return repr(value)
+    if isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    return six.text_type(value).replace('\\', '\\\\').replace('\t', '\\t') \
+            .replace('\n', '\\n').replace('\r', '\\r')
+
+
 class FileImporter:
     def __init__(self, source, target, user, options):
         self.source = source
@@ -28,21 +102,31 @@ class FileImporter:
         # Read the file and import data
         with open(self.source, "r") as data:
             for deserialized_object in serializers.deserialize(self.format, data):
-                # Override project to match target project
-                if hasattr(deserialized_object.object, 'project'):
-                    deserialized_object.object.project = self.target
-                # Override user
-                if self.user:
-                    if hasattr(deserialized_object.object, 'user_id'):
-                        deserialized_object.object.user = self.user
-                    if hasattr(deserialized_object.object, 'reviewer_id'):
-                        deserialized_object.object.reviewer = self.user
-                    if hasattr(deserialized_object.object, 'editor_id'):
-                        deserialized_object.object.editor = self.user
-
+                self.override_fields(deserialized_object.object)
                 deserialized_object.save()
 
-        # Reset counters to current maximum IDs
+        invalidate_node_list_cache(self.target.id)
+        self.reset_sequences(cursor)
+
+    def override_fields(self, obj):
+        """ Override the project and, if wanted, the user fields of a
+        deserialized object.
+        """
+        # Override project to match target project
+        if hasattr(obj, 'project'):
+            obj.project = self.target
+        # Override user
+        if self.user:
+            if hasattr(obj, 'user_id'):
+                obj.user = self.user
+            if hasattr(obj, 'reviewer_id'):
+                obj.reviewer = self.user
+            if hasattr(obj, 'editor_id'):
+                obj.editor = self.user
+
+    def reset_sequences(self, cursor):
+        """ Reset counters to current maximum IDs.
+        """
         cursor.execute('''
             SELECT setval('concept_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
             FROM concept;
@@ -51,6 +135,240 @@ class FileImporter:
         ''')
 
 
+class BulkFileImporter(FileImporter):
+    """ Imports a JSON export file by streaming it and loading the rows of
+    each model with PostgreSQL's COPY into a staging table. Directories with
+    one compressed CSV file per table, written by catmaid_export_data
+    --columnar, are copied into staging tables directly. Project and user
+    IDs are replaced in SQL when the staged rows are inserted into the actual
+    tables. Instead of updating edge tables, skeleton summaries, skeleton
+    connectivity and contribution summaries for every imported row, they are
+    rebuilt for the target project once at the end. Imported links don't
+    reset the reviews of their nodes. Like with the regular import, existing
+    rows with the same ID are updated. If these rows belonged to other
+    projects, those are rebuilt as well.
+
+    Disabling the triggers takes an ACCESS EXCLUSIVE lock on the treenode,
+    connector, treenode_connector and review tables, which blocks all reads
+    and writes of these tables in all projects until the import is
+    committed.
+    """
+
+    # Field types that can be written in COPY text format as they are
+    # represented in JSON export files.
+    copyable_field_types = set(('AutoField', 'BigAutoField', 'BigIntegerField',
+        'BooleanField', 'CharField', 'DateField', 'DateTimeField', 'FloatField',
+        'ForeignKey', 'IntegerField', 'OneToOneField', 'PositiveIntegerField',
+        'SmallIntegerField', 'TextField'))
+
+    # Triggers that update derived data for each row, these are disabled
+    # during the import.
+    deferred_triggers = (
+        ('treenode', 'on_insert_treenode_update_edges'),
+        ('treenode', 'on_edit_treenode_update_edges'),
+        ('treenode', 'on_edit_treenode_update_treenode_connector_edges'),
+        ('treenode', 'on_change_treenode_update_summary'),
+        ('connector', 'on_insert_connector_update_connector_geom'),
+        ('connector', 'on_edit_connector_update_treenode_connector_edges'),
+        ('treenode_connector', 'on_insert_treenode_connector_update_edges'),
+        ('treenode_connector', 'on_edit_treenode_connector_update_edges'),
+        ('treenode_connector', 'on_change_treenode_connector_update_connectivity'),
+        ('treenode_connector', 'on_create_treenode_connector_check_review'),
+        ('review', 'on_change_review_update_summary'),
+        ('treenode', 'on_change_treenode_update_stats_summary'),
+        ('treenode_connector', 'on_change_treenode_connector_update_stats_summary'),
+        ('review', 'on_change_review_update_stats_summary'),
+    )
+
+    user_columns = ('user_id', 'reviewer_id', 'editor_id')
+
+    def __init__(self, source, target, user, options):
+        FileImporter.__init__(self, source, target, user, options)
+        self.batch_size = options.get('batch_size') or 10000
+
+    @transaction.atomic
+    def import_data(self):
+        cursor = connection.cursor()
+        # Defer all constraint checks
+        cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+        for table, trigger in self.deferred_triggers:
+            cursor.execute('ALTER TABLE {} DISABLE TRIGGER {}'.format(table, trigger))
+
+        # Staged rows by model, in the order models appear in the file
+        self.staged = OrderedDict()
+        # Other projects that contained rows which are updated by the import
+        self.changed_projects = set()
+        self.start_time = time()
+        if os.path.isdir(self.source):
+            self.stage_columnar(cursor)
+        else:
+            self.stage_json(cursor)
+
+        for model in self.staged:
+            self.insert_staged_rows(cursor, model)
+
+        # Triggers can't be enabled while deferred constraint checks of
+        # their tables are still pending.
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        for table, trigger in self.deferred_triggers:
+            cursor.execute('ALTER TABLE {} ENABLE TRIGGER {}'.format(table, trigger))
+        start_time = time()
+        # Derived rows of updated objects are still stored with their old
+        # project. These projects are rebuilt first, so that rebuilding the
+        # target doesn't collide with them.
+        for project_id in sorted(self.changed_projects) + [self.target.id]:
+            rebuild_edge_tables(cursor, project_id)
+            rebuild_skeleton_summary(cursor, project_id)
+            rebuild_skeleton_connectivity(cursor, project_id)
+            rebuild_stats_summary(cursor, project_id)
+            invalidate_node_list_cache(project_id)
+        print("Rebuilt edge tables, skeleton summaries, connectivity and "
+                "contribution summaries in %.1fs" % (time() - start_time))
+
+        self.reset_sequences(cursor)
+
+    def stage_json(self, cursor):
+        """ Copy all objects of a JSON export file into staging tables.
+        """
+        n_read = 0
+        with io.open(self.source, 'r', encoding='utf-8') as data:
+            for element in iterate_json_array(data):
+                self.stage(cursor, element)
+                n_read += 1
+                if 0 == n_read % (10 * self.batch_size):
+                    self.report("Read %s objects" % n_read, n_read)
+        for model, rows in six.iteritems(self.staged):
+            self.copy_rows(cursor, model, rows)
+        self.report("Read %s objects" % n_read, n_read)
+
+    def stage_columnar(self, cursor):
+        """ Copy the compressed CSV files of a columnar export directory, as
+        written by catmaid_export_data --columnar, into staging tables.
+        """
+        with open(os.path.join(self.source, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        if 'catmaid-columnar' != manifest.get('format'):
+            raise CommandError("Unknown export format: %s" % manifest.get('format'))
+        for table in manifest['tables']:
+            model = apps.get_model(table['model'])
+            self.create_staging_table(cursor, model)
+            self.staged[model] = []
+            columns = ', '.join(connection.ops.quote_name(c) for c in table['columns'])
+            with gzip.open(os.path.join(self.source, table['file']), 'rb') as data:
+                cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv, HEADER)'.format(
+                        self.staging_table(model), columns), data)
+            self.report("Read table %s" % model._meta.db_table, cursor.rowcount)
+
+    def report(self, message, n_rows):
+        elapsed = time() - self.start_time
+        print("%s (%.0f rows/s)" % (message, n_rows / max(elapsed, 0.001)))
+
+    def is_copyable(self, model):
+        return all(f.get_internal_type() in self.copyable_field_types
+                for f in model._meta.concrete_fields)
+
+    def stage(self, cursor, element):
+        """ Queue a serialized object for being copied into the staging table
+        of its model. Objects of models that can't be copied are saved
+        directly.
+        """
+        model = apps.get_model(element['model'])
+        if not self.is_copyable(model):
+            for deserialized_object in serializers.deserialize('python', [element]):
+                self.override_fields(deserialized_object.object)
+                deserialized_object.save()
+            return
+
+        rows = self.staged.get(model)
+        if rows is None:
+            rows = self.staged[model] = []
+            self.create_staging_table(cursor, model)
+
+        fields = element['fields']
+        row = []
+        for f in model._meta.concrete_fields:
+            if f.primary_key:
+                value = element['pk']
+            elif f.name in fields:
+                value = fields[f.name]
+            else:
+                value = f.get_default()
+            row.append(to_copy_text(value))
+        rows.append('\t'.join(row))
+
+        if len(rows) >= self.batch_size:
+            self.copy_rows(cursor, model, rows)
+
+    def create_staging_table(self, cursor, model):
+        cursor.execute('''
+            CREATE TEMPORARY TABLE {} (LIKE {} INCLUDING DEFAULTS)
+            ON COMMIT DROP
+        '''.format(self.staging_table(model), model._meta.db_table))
+
+    def copy_rows(self, cursor, model, rows):
+        """ Copy the passed in rows into the staging table of their model and
+        empty the list of rows.
+        """
+        if not rows:
+            return
+        data = io.BytesIO(('\n'.join(rows) + '\n').encode('utf-8'))
+        cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(
+                self.staging_table(model), ', '.join(self.columns(model))), data)
+        del rows[:]
+
+    def insert_staged_rows(self, cursor, model):
+        """ Insert the staged rows of the passed in model into its table,
+        while replacing project and user IDs. Existing rows with the same ID
+        are updated.
+        """
+        start_time = time()
+        columns = self.columns(model)
+        pk_column = connection.ops.quote_name(model._meta.pk.column)
+        if any('project_id' == f.column for f in model._meta.concrete_fields):
+            cursor.execute('''
+                SELECT DISTINCT t.project_id
+                FROM {table} t
+                JOIN {staging_table} s
+                    ON s.{pk} = t.{pk}
+                WHERE t.project_id <> %s
+            '''.format(table=connection.ops.quote_name(model._meta.db_table),
+                staging_table=self.staging_table(model), pk=pk_column),
+                (self.target.id,))
+            self.changed_projects.update(r[0] for r in cursor.fetchall())
+        values = []
+        for column in (f.column for f in model._meta.concrete_fields):
+            if 'project_id' == column:
+                values.append('%(project_id)s')
+            elif self.user and column in self.user_columns:
+                values.append('%(user_id)s')
+            else:
+                values.append(connection.ops.quote_name(column))
+        cursor.execute('''
+            INSERT INTO {table} ({columns})
+            SELECT DISTINCT ON ({pk}) {values}
+            FROM {staging_table}
+            ORDER BY {pk}
+            ON CONFLICT ({pk}) DO UPDATE SET {updates}
+        '''.format(table=connection.ops.quote_name(model._meta.db_table),
+            columns=', '.join(columns), pk=pk_column, values=', '.join(values),
+            staging_table=self.staging_table(model),
+            updates=', '.join('{0} = EXCLUDED.{0}'.format(c)
+                    for c in columns if c != pk_column)), {
+                'project_id': self.target.id,
+                'user_id': self.user.id if self.user else None,
+            })
+        n_rows = cursor.rowcount
+        print("Imported %s rows into table %s (%.0f rows/s)" % (n_rows,
+                model._meta.db_table, n_rows / max(time() - start_time, 0.001)))
+
+    def staging_table(self, model):
+        return 'import_' + model._meta.db_table
+
+    def columns(self, model):
+        return [connection.ops.quote_name(f.column)
+                for f in model._meta.concrete_fields]
+
+
 class InternalImporter:
     def __init__(self, source, target, user, options):
         self.source = source
@@ -90,6 +408,14 @@ class Command(BaseCommand):
             action='store_true', help='Import tags from source')
         parser.add_argument('--notags', dest='import_tags',
             action='store_false', help='Don\'t import tags from source')
+        parser.add_argument('--bulk', dest='bulk', default=False,
+            action='store_true', help='Import files with COPY into staging '
+            'tables and rebuild edge tables at the end, which is much faster '
+            'for large files. Node and connector tables of all projects are '
+            'locked exclusively until the import is done.')
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+            default=10000, help='The number of rows per model that is held '
+            'in memory during a bulk import')
 
     def ask_for_project(self, title):
         """ Return a valid project object.
@@ -156,8 +482,12 @@ class Command(BaseCommand):
                 Importer = InternalImporter
             except ValueError:
                 source = options['source']
-                print("Using file importer")
-                Importer = FileImporter
+                if options['bulk'] or os.path.isdir(source):
+                    print("Using bulk file importer")
+                    Importer = BulkFileImporter
+                else:
+                    print("Using file importer")
+                    Importer = FileImporter
         else:
             source = self.ask_for_project('source')
 
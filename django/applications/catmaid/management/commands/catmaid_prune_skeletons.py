@@ -6,6 +6,7 @@ import catmaid
 
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connection, transaction
+from catmaid.control.node import invalidate_node_list_cache
 from catmaid.models import Project
 
 
@@ -53,6 +54,8 @@ class Command(BaseCommand):
                 cursor.execute("SELECT * FROM prune_skeletons(%s, %s)", [project.id, dryrun])
                 results = cursor.fetchone()
                 num_deleted_nodes = results[0]
+                if not dryrun:
+                    invalidate_node_list_cache(project.id)
             except Project.DoesNotExist:
                 raise CommandError('Project "%s" does not exist' % project_id)
 
@@ -2,13 +2,146 @@
 from __future__ import unicode_literals
 
 import os
+import re
 import catmaid
 
+from multiprocessing.pool import ThreadPool
+from time import time
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connection, transaction
 from catmaid.models import Project
 
 
+# The edge tables, their geometry column and the table they are derived from
+EDGE_TABLES = (
+    ('treenode_edge', 'edge', 'treenode'),
+    ('treenode_connector_edge', 'edge', 'treenode_connector'),
+    ('connector_geom', 'geom', 'connector'),
+)
+GEOMETRY_COLUMNS = dict((t[0], t[1]) for t in EDGE_TABLES)
+
+# Queries for the expected rows of each edge table. The rows of treenode and
+# connector edges are selected by skeleton ID, connector geometries by
+# connector ID.
+EXPECTED_ROWS = {
+    'treenode_edge': '''
+        SELECT t.id, t.project_id, ST_MakeLine(
+            ST_MakePoint(t.location_x, t.location_y, t.location_z),
+            ST_MakePoint(COALESCE(p.location_x, t.location_x),
+                         COALESCE(p.location_y, t.location_y),
+                         COALESCE(p.location_z, t.location_z)))
+        FROM treenode t
+        LEFT JOIN treenode p ON p.id = t.parent_id
+        WHERE t.skeleton_id BETWEEN %(min_id)s AND %(max_id)s
+          AND (%(project_ids)s::integer[] IS NULL
+            OR t.project_id = ANY(%(project_ids)s::integer[]))
+    ''',
+    'treenode_connector_edge': '''
+        SELECT tc.id, tc.project_id, ST_MakeLine(
+            ST_MakePoint(t.location_x, t.location_y, t.location_z),
+            ST_MakePoint(c.location_x, c.location_y, c.location_z))
+        FROM treenode_connector tc
+        JOIN treenode t ON t.id = tc.treenode_id
+        JOIN connector c ON c.id = tc.connector_id
+        WHERE tc.skeleton_id BETWEEN %(min_id)s AND %(max_id)s
+          AND (%(project_ids)s::integer[] IS NULL
+            OR tc.project_id = ANY(%(project_ids)s::integer[]))
+    ''',
+    'connector_geom': '''
+        SELECT c.id, c.project_id,
+            ST_MakePoint(c.location_x, c.location_y, c.location_z)
+        FROM connector c
+        WHERE c.id BETWEEN %(min_id)s AND %(max_id)s
+          AND (%(project_ids)s::integer[] IS NULL
+            OR c.project_id = ANY(%(project_ids)s::integer[]))
+    ''',
+}
+
+MAX_ID = 2**63 - 1
+
+# While edge tables are rebuilt online, the IDs of changed treenodes,
+# connectors and links are logged by temporary triggers, so that only their
+# edges have to be repaired before the tables are swapped.
+CHANGE_LOG_SETUP = '''
+    CREATE UNLOGGED TABLE edge_table_rebuild_log (
+        source_table text NOT NULL,
+        id bigint NOT NULL
+    );
+
+    CREATE OR REPLACE FUNCTION log_edge_table_rebuild_change()
+    RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            INSERT INTO edge_table_rebuild_log VALUES (TG_TABLE_NAME, OLD.id);
+            RETURN OLD;
+        END IF;
+        INSERT INTO edge_table_rebuild_log VALUES (TG_TABLE_NAME, NEW.id);
+        IF TG_OP = 'UPDATE' THEN
+            IF OLD.id <> NEW.id THEN
+                INSERT INTO edge_table_rebuild_log VALUES (TG_TABLE_NAME, OLD.id);
+            END IF;
+        END IF;
+        RETURN NEW;
+    END;
+    $$;
+
+    CREATE TRIGGER on_change_treenode_log_edge_table_rebuild
+    AFTER INSERT OR UPDATE OR DELETE ON treenode
+    FOR EACH ROW EXECUTE PROCEDURE log_edge_table_rebuild_change();
+
+    CREATE TRIGGER on_change_connector_log_edge_table_rebuild
+    AFTER INSERT OR UPDATE OR DELETE ON connector
+    FOR EACH ROW EXECUTE PROCEDURE log_edge_table_rebuild_change();
+
+    CREATE TRIGGER on_change_treenode_connector_log_edge_table_rebuild
+    AFTER INSERT OR UPDATE OR DELETE ON treenode_connector
+    FOR EACH ROW EXECUTE PROCEDURE log_edge_table_rebuild_change();
+'''
+
+CHANGE_LOG_TEARDOWN = '''
+    DROP TRIGGER IF EXISTS on_change_treenode_log_edge_table_rebuild
+        ON treenode;
+    DROP TRIGGER IF EXISTS on_change_connector_log_edge_table_rebuild
+        ON connector;
+    DROP TRIGGER IF EXISTS on_change_treenode_connector_log_edge_table_rebuild
+        ON treenode_connector;
+    DROP FUNCTION IF EXISTS log_edge_table_rebuild_change();
+    DROP TABLE IF EXISTS edge_table_rebuild_log;
+'''
+
+# The IDs of the edge table rows that depend on the logged changes. Treenode
+# edges also depend on the location of the parent, connector edges on their
+# treenode and connector.
+CHANGED_ROWS = {
+    'treenode_edge': '''
+        SELECT id FROM edge_table_rebuild_log
+        WHERE source_table = 'treenode'
+        UNION
+        SELECT t.id FROM treenode t
+        JOIN edge_table_rebuild_log l
+            ON l.id = t.parent_id AND l.source_table = 'treenode'
+    ''',
+    'treenode_connector_edge': '''
+        SELECT id FROM edge_table_rebuild_log
+        WHERE source_table = 'treenode_connector'
+        UNION
+        SELECT tc.id FROM treenode_connector tc
+        JOIN edge_table_rebuild_log l
+            ON l.id = tc.treenode_id AND l.source_table = 'treenode'
+        UNION
+        SELECT tc.id FROM treenode_connector tc
+        JOIN edge_table_rebuild_log l
+            ON l.id = tc.connector_id AND l.source_table = 'connector'
+    ''',
+    'connector_geom': '''
+        SELECT id FROM edge_table_rebuild_log
+        WHERE source_table = 'connector'
+    ''',
+}
+
+
 class DryRunRollback(Exception):
     pass
 
@@ -21,8 +154,20 @@ class Command(BaseCommand):
             default=False, help='Don\'t actually apply changes')
         parser.add_argument('--project_id', dest='project_id', nargs='+',
             help='Rebuild edge tables for these projects')
+        parser.add_argument('--online', action='store_true', dest='online',
+            default=False, help='Build new edge tables in the background and '
+            'swap them with the current ones when done. Tracing is only '
+            'blocked for a final verification.')
+        parser.add_argument('--incremental', action='store_true',
+            dest='incremental', default=False, help='Only repair rows that '
+            'are missing, obsolete or disagree with treenodes and connectors')
+        parser.add_argument('--workers', dest='workers', type=int, default=4,
+            help='The number of database connections used in online and '
+            'incremental mode')
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+            default=100000, help='The approximate number of treenodes per '
+            'batch in online and incremental mode')
 
-    @transaction.atomic
     def handle(self, *args, **options):
         project_ids = options['project_id']
         if not project_ids:
@@ -41,6 +186,20 @@ class Command(BaseCommand):
             self.stdout.write('Canceled on user request')
             return
 
+        if options['online'] or options['incremental']:
+            if project_ids:
+                project_ids = [int(pid) for pid in project_ids]
+                for project_id in project_ids:
+                    if not Project.objects.filter(pk=project_id).exists():
+                        raise CommandError('Project "%s" does not exist' % project_id)
+            rebuilder = EdgeTableRebuilder(project_ids, options['workers'],
+                    options['batch_size'], dryrun, self.stdout)
+            if options['online']:
+                rebuilder.rebuild_online()
+            else:
+                rebuilder.repair()
+            return
+
         cursor = connection.cursor()
 
         try:
@@ -58,61 +217,10 @@ class Command(BaseCommand):
                             cursor.execute("SELECT count(*) FROM connector_geom WHERE project_id = %s",
                                            (project.id,))
                             num_existing_c_geoms = cursor.fetchone()[0]
-                            # Clear edge table
-                            cursor.execute('DELETE FROM treenode_edge WHERE project_id = %s',
-                                           (project_id,))
-                            cursor.execute('DELETE FROM treenode_connector_edge WHERE project_id = %s',
-                                           (project_id,))
-                            cursor.execute('DELETE FROM connector_geom WHERE project_id = %s',
-                                           (project_id,))
                             self.stdout.write('Deleted edge information for project "%s": '
                                     '%s treenode edges, %s connector edges, %s connectors' % \
                                     (project_id, num_existing_tn_edges, num_existing_c_edges, num_existing_c_geoms))
-
-                            # Add edges of available treenodes
-                            cursor.execute('''
-                                INSERT INTO treenode_edge (id, project_id, edge) (
-                                    SELECT c.id, c.project_id, ST_MakeLine(
-                                    ST_MakePoint(c.location_x, c.location_y, c.location_z),
-                                    ST_MakePoint(p.location_x, p.location_y, p.location_z))
-                                    FROM treenode c JOIN treenode p ON c.parent_id = p.id
-                                    WHERE c.parent_id IS NOT NULL AND c.project_id = %s)''',
-                                (project_id,))
-                            # Add self referencing adges for all root nodes
-                            cursor.execute('''
-                                INSERT INTO treenode_edge (id, project_id, edge) (
-                                    SELECT r.id, r.project_id, ST_MakeLine(
-                                    ST_MakePoint(r.location_x, r.location_y, r.location_z),
-                                    ST_MakePoint(r.location_x, r.location_y, r.location_z))
-                                    FROM treenode r
-                                    WHERE r.parent_id IS NULL AND r.project_id = %s)''',
-                                (project_id,))
-
-                            # Add connector edge
-                            cursor.execute('''
-                                INSERT INTO treenode_connector_edge
-                                        SELECT
-                                            tc.id,
-                                            tc.project_id,
-                                            ST_MakeLine(
-                                                ST_MakePoint(t.location_x, t.location_y, t.location_z),
-                                                ST_MakePoint(c.location_x, c.location_y, c.location_z))
-                                        FROM treenode_connector tc, treenode t, connector c
-                                        WHERE t.id = tc.treenode_id
-                                          AND c.id = tc.connector_id
-                                          AND tc.project_id = %s;
-                            ''', (project_id,))
-
-                            # Add connector geometries
-                            cursor.execute('''
-                                    INSERT INTO connector_geom
-                                        SELECT
-                                            c.id,
-                                            c.project_id,
-                                            ST_MakePoint(c.location_x, c.location_y, c.location_z)
-                                        FROM connector c
-                                        WHERE c.project_id = %s;
-                            ''', (project_id,))
+                            rebuild_edge_tables(cursor, project.id)
 
                             cursor.execute("SELECT count(*) FROM treenode_edge WHERE project_id = %s",
                                            (project.id,))
@@ -205,3 +313,377 @@ class Command(BaseCommand):
 
         except DryRunRollback:
             self.stdout.write('Dry run completed')
+
+
+def rebuild_edge_tables(cursor, project_id):
+    """Replace the treenode edges, connector edges and connector geometries
+    of the passed in project with newly computed ones.
+    """
+    # Clear edge table
+    cursor.execute('DELETE FROM treenode_edge WHERE project_id = %s',
+                   (project_id,))
+    cursor.execute('DELETE FROM treenode_connector_edge WHERE project_id = %s',
+                   (project_id,))
+    cursor.execute('DELETE FROM connector_geom WHERE project_id = %s',
+                   (project_id,))
+
+    # Add edges of available treenodes
+    cursor.execute('''
+        INSERT INTO treenode_edge (id, project_id, edge) (
+            SELECT c.id, c.project_id, ST_MakeLine(
+            ST_MakePoint(c.location_x, c.location_y, c.location_z),
+            ST_MakePoint(p.location_x, p.location_y, p.location_z))
+            FROM treenode c JOIN treenode p ON c.parent_id = p.id
+            WHERE c.parent_id IS NOT NULL AND c.project_id = %s)''',
+        (project_id,))
+    # Add self referencing adges for all root nodes
+    cursor.execute('''
+        INSERT INTO treenode_edge (id, project_id, edge) (
+            SELECT r.id, r.project_id, ST_MakeLine(
+            ST_MakePoint(r.location_x, r.location_y, r.location_z),
+            ST_MakePoint(r.location_x, r.location_y, r.location_z))
+            FROM treenode r
+            WHERE r.parent_id IS NULL AND r.project_id = %s)''',
+        (project_id,))
+
+    # Add connector edge
+    cursor.execute('''
+        INSERT INTO treenode_connector_edge
+                SELECT
+                    tc.id,
+                    tc.project_id,
+                    ST_MakeLine(
+                        ST_MakePoint(t.location_x, t.location_y, t.location_z),
+                        ST_MakePoint(c.location_x, c.location_y, c.location_z))
+                FROM treenode_connector tc, treenode t, connector c
+                WHERE t.id = tc.treenode_id
+                  AND c.id = tc.connector_id
+                  AND tc.project_id = %s;
+    ''', (project_id,))
+
+    # Add connector geometries
+    cursor.execute('''
+            INSERT INTO connector_geom
+                SELECT
+                    c.id,
+                    c.project_id,
+                    ST_MakePoint(c.location_x, c.location_y, c.location_z)
+                FROM connector c
+                WHERE c.project_id = %s;
+    ''', (project_id,))
+
+
+class EdgeTableRebuilder(object):
+    """ Rebuilds or repairs the edge tables of some or all projects in
+    batches of skeleton (or connector) ID ranges, which are processed by
+    multiple database connections in parallel. Each batch is committed on its
+    own, no long running transaction is needed.
+    """
+
+    def __init__(self, project_ids=None, workers=4, batch_size=100000,
+            dryrun=False, stdout=None):
+        self.project_ids = project_ids or None
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.dryrun = dryrun
+        self.stdout = stdout
+
+    def log(self, message):
+        if self.stdout:
+            self.stdout.write(message)
+
+    def get_batches(self, cursor):
+        """ Return a list of (table, min ID, max ID) batches, which cover all
+        expected rows of all edge tables.
+        """
+        params = {
+            'project_ids': self.project_ids,
+            'batch_size': self.batch_size,
+        }
+        # Split skeletons into contiguous ID ranges of about batch_size
+        # treenodes, based on the skeleton summary. Skeletons that aren't
+        # summarized yet are still covered.
+        cursor.execute('''
+            SELECT max(skeleton_id)
+            FROM (
+                SELECT skeleton_id, sum(num_nodes) OVER (
+                    ORDER BY skeleton_id) / %(batch_size)s AS batch
+                FROM catmaid_skeleton_summary
+                WHERE %(project_ids)s::integer[] IS NULL
+                   OR project_id = ANY(%(project_ids)s::integer[])
+            ) s
+            GROUP BY batch
+            ORDER BY 1
+        ''', params)
+        skeleton_ranges = contiguous_ranges([r[0] for r in cursor.fetchall()])
+
+        # Split connector IDs into equally wide ranges
+        cursor.execute('''
+            SELECT min(id), max(id), count(*)
+            FROM connector
+            WHERE %(project_ids)s::integer[] IS NULL
+               OR project_id = ANY(%(project_ids)s::integer[])
+        ''', params)
+        min_id, max_id, n_connectors = cursor.fetchone()
+        upper_bounds = []
+        if n_connectors:
+            n_ranges = (n_connectors + self.batch_size - 1) // self.batch_size
+            width = (max_id - min_id) // n_ranges + 1
+            upper_bounds = [min_id + i * width - 1 for i in range(1, n_ranges)]
+        connector_ranges = contiguous_ranges(upper_bounds)
+
+        batches = []
+        for min_id, max_id in skeleton_ranges:
+            batches.append(('treenode_edge', min_id, max_id))
+            batches.append(('treenode_connector_edge', min_id, max_id))
+        for min_id, max_id in connector_ranges:
+            batches.append(('connector_geom', min_id, max_id))
+        return batches
+
+    def run_parallel(self, fn, items):
+        """ Call fn for each item with up to self.workers database
+        connections in parallel and return the results.
+        """
+        def run(item):
+            try:
+                return fn(connection.cursor(), *item)
+            finally:
+                # Every thread has its own connection
+                connection.close()
+
+        if self.workers > 1 and len(items) > 1:
+            pool = ThreadPool(min(self.workers, len(items)))
+            try:
+                return pool.map(run, items)
+            finally:
+                pool.close()
+        return [fn(connection.cursor(), *item) for item in items]
+
+    def repair(self):
+        """ Delete, add or update only the rows of all edge tables that are
+        obsolete, missing or disagree with their treenodes and connectors.
+        """
+        start_time = time()
+        cursor = connection.cursor()
+        for table, geom_column, source_table in EDGE_TABLES:
+            n_deleted = delete_obsolete_rows(cursor, table, source_table,
+                    self.project_ids, self.dryrun)
+            self.log('Found %s obsolete rows in %s' % (n_deleted, table))
+
+        batches = self.get_batches(cursor)
+        counts = self.run_parallel(lambda c, table, min_id, max_id:
+                repair_rows(c, table, table, min_id, max_id,
+                    self.project_ids, self.dryrun), batches)
+
+        for table, geom_column, source_table in EDGE_TABLES:
+            n_repaired = sum(n for (t, _, _), n in zip(batches, counts) if t == table)
+            self.log('Found %s missing or outdated rows in %s' % (n_repaired, table))
+        self.log('Repaired edge tables in %.1fs' % (time() - start_time))
+
+    def rebuild_online(self):
+        """ Build a shadow copy of each edge table without indices, create
+        the indices of the original table on it and swap both tables. Rows of
+        projects that aren't rebuilt are copied. Changes made while the shadow
+        tables are built are logged by triggers and only their rows are
+        repaired in a final pass, which blocks writes to treenodes and
+        connectors.
+        """
+        cursor = connection.cursor()
+        # Creating the triggers waits for running transactions that change
+        # treenodes or connectors, all later changes are logged.
+        cursor.execute(CHANGE_LOG_TEARDOWN)
+        cursor.execute(CHANGE_LOG_SETUP)
+        try:
+            self.build_shadow_tables(cursor)
+        finally:
+            cursor.execute(CHANGE_LOG_TEARDOWN)
+
+    def build_shadow_tables(self, cursor):
+        """ Build and index the shadow tables, apply logged changes and swap
+        them with the edge tables.
+        """
+        start_time = time()
+        for table, geom_column, source_table in EDGE_TABLES:
+            cursor.execute('''
+                DROP TABLE IF EXISTS {0}_shadow;
+                CREATE TABLE {0}_shadow (LIKE {0} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+            '''.format(table))
+            if self.project_ids:
+                cursor.execute('''
+                    INSERT INTO {0}_shadow SELECT * FROM {0}
+                    WHERE project_id <> ALL(%s::integer[])
+                '''.format(table), (self.project_ids,))
+
+        batches = self.get_batches(cursor)
+        counts = self.run_parallel(self.build_batch, batches)
+        self.log('Built %s rows in %s batches in %.1fs' % (sum(counts),
+                len(batches), time() - start_time))
+
+        # Indices are created after the data is in place, which is much
+        # faster than updating them for every row.
+        start_time = time()
+        indices = []
+        for table, geom_column, source_table in EDGE_TABLES:
+            indices.extend(get_shadow_indices(cursor, table))
+        self.run_parallel(lambda c, name, sql: c.execute(sql), indices)
+        for table, geom_column, source_table in EDGE_TABLES:
+            cursor.execute('''
+                SELECT conname FROM pg_constraint
+                WHERE conrelid = %s::regclass AND contype = 'p'
+            ''', (table,))
+            for (name,) in cursor.fetchall():
+                cursor.execute('''
+                    ALTER TABLE {0}_shadow ADD CONSTRAINT {1}_shadow
+                    PRIMARY KEY USING INDEX {1}_shadow
+                '''.format(table, name))
+            cursor.execute('ANALYZE {}_shadow'.format(table))
+        self.log('Created %s indices in %.1fs' % (len(indices), time() - start_time))
+
+        if self.dryrun:
+            for table, geom_column, source_table in EDGE_TABLES:
+                cursor.execute('DROP TABLE {}_shadow'.format(table))
+            self.log('Dry run completed, shadow tables were removed')
+            return
+
+        start_time = time()
+        with transaction.atomic():
+            # Block changes to treenodes and connectors until the new tables
+            # are in place.
+            cursor.execute('''
+                LOCK TABLE treenode, connector, treenode_connector IN SHARE MODE;
+                LOCK TABLE treenode_edge, treenode_connector_edge, connector_geom
+                    IN ACCESS EXCLUSIVE MODE;
+            ''')
+            # Rows of projects that aren't rebuilt were copied and need
+            # these changes as well, which is why all projects are repaired.
+            for table, geom_column, source_table in EDGE_TABLES:
+                cursor.execute(CHANGED_ROWS[table])
+                ids = [r[0] for r in cursor.fetchall()]
+                n_changed = 0
+                if ids:
+                    n_changed += delete_obsolete_rows(cursor, table + '_shadow',
+                            source_table, None, ids=ids)
+                    n_changed += repair_rows(cursor, table, table + '_shadow',
+                            0, MAX_ID, None, ids=ids)
+                self.log('Applied %s changes made during the rebuild to %s' % \
+                        (n_changed, table))
+
+            for table, geom_column, source_table in EDGE_TABLES:
+                cursor.execute('''
+                    SELECT indexname FROM pg_indexes WHERE tablename = %s
+                ''', (table,))
+                index_names = [r[0] for r in cursor.fetchall()]
+                cursor.execute('''
+                    DROP TABLE {0};
+                    ALTER TABLE {0}_shadow RENAME TO {0};
+                '''.format(table))
+                for name in index_names:
+                    cursor.execute('ALTER INDEX {0}_shadow RENAME TO {0}'.format(name))
+        self.log('Swapped edge tables in %.1fs' % (time() - start_time))
+
+    def build_batch(self, cursor, table, min_id, max_id):
+        """ Insert the expected rows of one batch into the shadow table of the
+        passed in edge table and return their number.
+        """
+        cursor.execute('''
+            INSERT INTO {0}_shadow (id, project_id, {1}) {2}
+        '''.format(table, GEOMETRY_COLUMNS[table], EXPECTED_ROWS[table]), {
+            'min_id': min_id,
+            'max_id': max_id,
+            'project_ids': self.project_ids,
+        })
+        return cursor.rowcount
+
+
+def contiguous_ranges(upper_bounds):
+    """ Return a list of (min ID, max ID) ranges that are separated by the
+    passed in sorted upper bounds and that cover all positive IDs.
+    """
+    ranges = []
+    lower_bound = 0
+    for upper_bound in upper_bounds:
+        if upper_bound >= lower_bound:
+            ranges.append((lower_bound, upper_bound))
+            lower_bound = upper_bound + 1
+    ranges.append((lower_bound, MAX_ID))
+    return ranges
+
+
+def delete_obsolete_rows(cursor, table, source_table, project_ids, dryrun=False,
+        ids=None):
+    """ Delete rows of an edge table, whose treenode, connector or link
+    doesn't exist anymore in the same project and return their number. If
+    IDs are passed in, only these rows are checked.
+    """
+    where = '''
+        WHERE (%(project_ids)s::integer[] IS NULL
+            OR e.project_id = ANY(%(project_ids)s::integer[]))
+          AND (%(ids)s::bigint[] IS NULL
+            OR e.id = ANY(%(ids)s::bigint[]))
+          AND NOT EXISTS (
+            SELECT 1 FROM {source_table} s
+            WHERE s.id = e.id AND s.project_id = e.project_id)
+    '''.format(source_table=source_table)
+    params = {
+        'project_ids': project_ids,
+        'ids': ids,
+    }
+    if dryrun:
+        cursor.execute('SELECT count(*) FROM {} e '.format(table) + where, params)
+        return cursor.fetchone()[0]
+    cursor.execute('DELETE FROM {} e '.format(table) + where, params)
+    return cursor.rowcount
+
+
+def repair_rows(cursor, table, target_table, min_id, max_id, project_ids,
+        dryrun=False, ids=None):
+    """ Add the expected rows of the passed in edge table and ID range to the
+    target table, if they are missing or differ, and return their number.
+    Geometries are compared exactly, including Z. If IDs are passed in, only
+    these rows are checked.
+    """
+    geom_column = GEOMETRY_COLUMNS[table]
+    changed_rows = '''
+        SELECT x.id, x.project_id, x.geom
+        FROM ({0}) x(id, project_id, geom)
+        LEFT JOIN {1} e ON e.id = x.id
+        WHERE (%(ids)s::bigint[] IS NULL OR x.id = ANY(%(ids)s::bigint[]))
+          AND (e.id IS NULL
+            OR e.project_id <> x.project_id
+            OR ST_AsEWKB(e.{2}) <> ST_AsEWKB(x.geom))
+    '''.format(EXPECTED_ROWS[table], target_table, geom_column)
+    params = {
+        'min_id': min_id,
+        'max_id': max_id,
+        'project_ids': project_ids,
+        'ids': ids,
+    }
+    if dryrun:
+        cursor.execute('SELECT count(*) FROM ({}) c'.format(changed_rows), params)
+        return cursor.fetchone()[0]
+    cursor.execute('''
+        INSERT INTO {0} (id, project_id, {1}) {2}
+        ON CONFLICT (id) DO UPDATE
+        SET project_id = EXCLUDED.project_id, {1} = EXCLUDED.{1}
+    '''.format(target_table, geom_column, changed_rows), params)
+    return cursor.rowcount
+
+
+def get_shadow_indices(cursor, table):
+    """ Return (name, SQL) tuples, which create a copy of each index of the
+    passed in table on its shadow table. Copies are named like the original
+    index, with "_shadow" appended.
+    """
+    cursor.execute('''
+        SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s
+    ''', (table,))
+    indices = []
+    pattern = re.compile(r'^(CREATE (?:UNIQUE )?INDEX) (\S+) ON ((?:\S+\.)?)(\S+) (.*)$')
+    for name, definition in cursor.fetchall():
+        match = pattern.match(definition)
+        if not match:
+            raise CommandError('Unexpected index definition: %s' % definition)
+        create, _, schema, _, rest = match.groups()
+        indices.append((name, '{} {}_shadow ON {}{}_shadow {}'.format(
+                create, name, schema, table, rest)))
+    return indices
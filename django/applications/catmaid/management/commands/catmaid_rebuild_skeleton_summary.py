@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from catmaid.models import Project
+
+
+class DryRunRollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = 'Rebuild the skeleton summary tables (node count, cable length, ' \
+           'root node, last edition time and review counts) from scratch ' \
+           'for all skeletons in the specified projects.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dryrun', action='store_true', dest='dryrun',
+            default=False, help='Don\'t actually apply changes')
+        parser.add_argument('--project_id', dest='project_id', nargs='+',
+            help='Rebuild skeleton summaries for these projects')
+
+    def handle(self, *args, **options):
+        project_ids = options['project_id']
+        if project_ids:
+            project_ids = [int(pid) for pid in project_ids]
+            for project_id in project_ids:
+                if not Project.objects.filter(pk=project_id).exists():
+                    raise CommandError('Project "%s" does not exist' % project_id)
+        else:
+            self.stdout.write('Since no project IDs were given, all projects will be updated')
+            project_ids = list(Project.objects.all().values_list('id', flat=True))
+
+        dryrun = options['dryrun']
+        if dryrun:
+            self.stdout.write('DRY RUN - no changes will be made')
+
+        try:
+            with transaction.atomic():
+                cursor = connection.cursor()
+                # Block concurrent tracing and reviewing in the rebuilt
+                # projects, changes would otherwise get lost.
+                cursor.execute('LOCK TABLE treenode, review IN SHARE MODE')
+                for project_id in project_ids:
+                    num_skeletons = rebuild_skeleton_summary(cursor, project_id)
+                    self.stdout.write('Rebuilt summary of %s skeletons in '
+                            'project "%s"' % (num_skeletons, project_id))
+
+                if dryrun:
+                    # For a dry run, cancel the transaction by raising an exception
+                    raise DryRunRollback()
+
+                self.stdout.write('Successfully rebuilt skeleton summaries')
+        except DryRunRollback:
+            self.stdout.write('Dry run completed')
+
+
+def rebuild_skeleton_summary(cursor, project_id):
+    """Replace the summaries of all skeletons in the passed in project with
+    newly computed ones and return the number of summarized skeletons.
+    """
+    cursor.execute('''
+        DELETE FROM catmaid_skeleton_summary WHERE project_id = %(project_id)s;
+        DELETE FROM catmaid_skeleton_review_summary WHERE project_id = %(project_id)s;
+
+        INSERT INTO catmaid_skeleton_summary (skeleton_id, project_id,
+            num_nodes, cable_length, root_node_id, last_edition_time)
+        SELECT t.skeleton_id, t.project_id, count(*),
+            COALESCE(sum(sqrt(
+                (t.location_x::double precision - p.location_x) ^ 2 +
+                (t.location_y::double precision - p.location_y) ^ 2 +
+                (t.location_z::double precision - p.location_z) ^ 2)), 0),
+            max(CASE WHEN t.parent_id IS NULL THEN t.id END),
+            max(t.edition_time)
+        FROM treenode t
+        LEFT JOIN treenode p
+            ON p.id = t.parent_id
+        WHERE t.project_id = %(project_id)s
+        GROUP BY t.skeleton_id, t.project_id;
+
+        INSERT INTO catmaid_skeleton_review_summary (skeleton_id, reviewer_id,
+            project_id, num_reviewed_nodes)
+        SELECT r.skeleton_id, r.reviewer_id, r.project_id,
+            count(DISTINCT r.treenode_id)
+        FROM review r
+        WHERE r.project_id = %(project_id)s
+        GROUP BY r.skeleton_id, r.reviewer_id, r.project_id;
+
+        INSERT INTO catmaid_skeleton_summary AS ss (skeleton_id, project_id,
+            num_reviewed_nodes)
+        SELECT r.skeleton_id, r.project_id, count(DISTINCT r.treenode_id)
+        FROM review r
+        WHERE r.project_id = %(project_id)s
+        GROUP BY r.skeleton_id, r.project_id
+        ON CONFLICT (skeleton_id)
+        DO UPDATE SET num_reviewed_nodes = EXCLUDED.num_reviewed_nodes;
+    ''', {
+        'project_id': project_id
+    })
+
+    cursor.execute('''
+        SELECT count(*) FROM catmaid_skeleton_summary
+        WHERE project_id = %(project_id)s
+    ''', {
+        'project_id': project_id
+    })
+    return cursor.fetchone()[0]
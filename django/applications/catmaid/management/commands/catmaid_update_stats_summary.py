@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from catmaid.control.stats import rebuild_stats_summary, update_stats_summary
+from catmaid.models import Project
+
+
+class Command(BaseCommand):
+    help = 'Recompute all entries of the contribution summary used by the ' \
+           'statistics widget that are outdated by changes. With ' \
+           '--rebuild, the summary is recomputed from scratch, which is ' \
+           'needed if changes weren\'t recorded, e.g. because triggers ' \
+           'were disabled.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', dest='rebuild',
+            default=False, help='Recompute the summary from scratch')
+        parser.add_argument('--project_id', dest='project_id', nargs='+',
+            help='Only rebuild the summary of these projects')
+
+    def handle(self, *args, **options):
+        project_ids = options['project_id']
+        if project_ids:
+            if not options['rebuild']:
+                raise CommandError('Projects can only be selected with --rebuild')
+            project_ids = [int(pid) for pid in project_ids]
+            for project_id in project_ids:
+                if not Project.objects.filter(pk=project_id).exists():
+                    raise CommandError('Project "%s" does not exist' % project_id)
+
+        with transaction.atomic():
+            cursor = connection.cursor()
+            if options['rebuild']:
+                for project_id in project_ids or [None]:
+                    n_rows = rebuild_stats_summary(cursor, project_id)
+                    self.stdout.write('Rebuilt %s summary entries%s' % (n_rows,
+                            ' of project "%s"' % project_id if project_id else ''))
+            n_rows = update_stats_summary(cursor)
+            self.stdout.write('Recomputed %s outdated summary entries' % n_rows)
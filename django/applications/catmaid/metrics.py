@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import atexit
+import errno
+import fcntl
+import glob
+import json
+import os
+import re
+import six
+import socket
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+from time import time
+
+from django.conf import settings
+
+
+# Upper bounds of histogram buckets for request durations (in seconds) and
+# response sizes (in Bytes).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+        10.0, float('inf'))
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, float('inf'))
+
+_metrics_file = re.compile(r'^metrics-(.+)-(\d+)\.json$')
+
+# The file with the summed up metrics of all exited processes
+AGGREGATE_FILE = 'metrics-aggregate.json'
+
+
+class MetricsStore(object):
+    """Cumulative counters and histograms of the current process. Metrics are
+    identified by their name and labels. If a directory is given, the metrics
+    are written to a file in it at most every <flush_interval> seconds, so that
+    the metrics of all processes of a server can be aggregated. When the
+    process exits, its metrics are added to the aggregate of all exited
+    processes, so that the reported counters don't decrease. Files are named
+    after host and process, the directory can therefore be shared by multiple
+    hosts.
+    """
+
+    def __init__(self, directory=None, flush_interval=10):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.last_flush = time()
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [buckets, [0] * len(buckets), 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[1][i] += 1
+                    break
+            histogram[2] += value
+
+    def snapshot(self):
+        with self.lock:
+            return to_snapshot(self.counters, self.histograms)
+
+    @property
+    def path(self):
+        return metrics_file_path(self.directory, os.getpid())
+
+    def maybe_flush(self):
+        if self.directory and time() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Replace the metrics file of this process with the current metrics.
+        """
+        self.last_flush = time()
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        own_path = self.path
+        if own_path != getattr(self, '_registered_path', None):
+            # Forked processes register their own file
+            self._registered_path = own_path
+            atexit.register(self.exit)
+        os.rename(path, own_path)
+
+    def exit(self):
+        """Add the final metrics of this process to the aggregate."""
+        try:
+            self.flush()
+            mark_process_dead(os.getpid(), self.directory)
+        except (IOError, OSError):
+            # The directory is gone
+            pass
+
+    def collect(self):
+        """Return the metrics of this process merged with the last written
+        metrics of all other processes and the aggregate of exited processes.
+        """
+        snapshots = [self.snapshot()]
+        if self.directory:
+            own_path = self.path
+            hostname = socket.gethostname()
+            paths = glob.glob(os.path.join(self.directory, 'metrics-*.json'))
+            for path in paths:
+                match = _metrics_file.match(os.path.basename(path))
+                if match and match.group(1) == hostname and \
+                        not is_process_alive(int(match.group(2))):
+                    # Files of processes that were killed are left behind.
+                    # Processes of other hosts are checked by their host.
+                    mark_process_dead(int(match.group(2)), self.directory)
+            # Exited processes are moved to the aggregate while the lock is
+            # held, reading with the lock counts each of them exactly once.
+            with metrics_lock(self.directory, fcntl.LOCK_SH):
+                for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+                    name = os.path.basename(path)
+                    if path == own_path or not (name == AGGREGATE_FILE or
+                            _metrics_file.match(name)):
+                        continue
+                    snapshot = read_snapshot(path)
+                    if snapshot is not None:
+                        snapshots.append(snapshot)
+        return merge_snapshots(snapshots)
+
+
+def metrics_file_path(directory, pid, hostname=None):
+    """Return the path of the metrics file of a process."""
+    return os.path.join(directory, 'metrics-%s-%s.json' % (
+            hostname or socket.gethostname(), pid))
+
+
+@contextmanager
+def metrics_lock(directory, operation=fcntl.LOCK_EX):
+    """Lock the aggregate of a metrics directory for all processes."""
+    with open(os.path.join(directory, 'metrics.lock'), 'a') as f:
+        fcntl.flock(f, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_snapshot(path):
+    """Return the metrics snapshot in the passed in file or None if it
+    doesn't exist (anymore).
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def is_process_alive(pid):
+    """Return whether a process with the passed in ID exists on this host."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def mark_process_dead(pid, directory=None):
+    """Add the last written metrics of an exited process of this host to the
+    aggregate of all exited processes and remove its metrics file. This is
+    done automatically when a process exits normally. Servers that kill
+    workers can call this from a hook for exited workers, e.g. gunicorn's
+    child_exit. All metrics are cumulative counters and histograms, which are
+    kept in the aggregate, so that they never decrease.
+    """
+    if directory is None:
+        directory = getattr(settings, 'METRICS_DIRECTORY', None)
+    if not directory:
+        return
+    path = metrics_file_path(directory, pid)
+    aggregate_path = os.path.join(directory, AGGREGATE_FILE)
+    with metrics_lock(directory):
+        snapshot = read_snapshot(path)
+        if snapshot is None:
+            return
+        snapshots = [snapshot]
+        aggregate = read_snapshot(aggregate_path)
+        if aggregate is not None:
+            snapshots.append(aggregate)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(to_snapshot(*merge_snapshots(snapshots)), f)
+        os.rename(tmp_path, aggregate_path)
+        os.remove(path)
+
+
+def to_snapshot(counters, histograms):
+    """Return counters and histograms by name and labels in the JSON
+    serializable form of metrics files.
+    """
+    return {
+        'counters': [[name, list(labels), value] for (name, labels), value
+                in six.iteritems(counters)],
+        'histograms': [[name, list(labels), list(h[0]), list(h[1]), h[2]]
+                for (name, labels), h in six.iteritems(histograms)],
+    }
+
+
+def merge_snapshots(snapshots):
+    """Sum up the counters and histograms of multiple snapshots."""
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(l) for l in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, buckets, counts, total in snapshot['histograms']:
+            key = (name, tuple(tuple(l) for l in labels))
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = [buckets, list(counts), total]
+            else:
+                merged[1] = [a + b for a, b in zip(merged[1], counts)]
+                merged[2] += total
+    return counters, histograms
+
+
+def _escape(value):
+    return six.text_type(value).replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels) + '}'
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def render_metrics(counters, histograms):
+    """Return metrics in Prometheus' text exposition format."""
+    lines = []
+    types = {}
+    for (name, labels), value in sorted(counters.items()):
+        if name not in types:
+            types[name] = 'counter'
+            lines.append('# TYPE %s counter' % name)
+        lines.append('%s%s %r' % (name, _format_labels(labels), value))
+    for (name, labels), (buckets, counts, total) in sorted(histograms.items()):
+        if name not in types:
+            types[name] = 'histogram'
+            lines.append('# TYPE %s histogram' % name)
+        cumulative = 0
+        for bound, count in zip(buckets, counts):
+            cumulative += count
+            lines.append('%s_bucket%s %s' % (name, _format_labels(labels,
+                    (('le', _format_bound(bound)),)), cumulative))
+        lines.append('%s_sum%s %r' % (name, _format_labels(labels), total))
+        lines.append('%s_count%s %s' % (name, _format_labels(labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_metrics_store():
+    """Return the metrics store of this process."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = MetricsStore(getattr(settings, 'METRICS_DIRECTORY', None),
+                        getattr(settings, 'METRICS_FLUSH_INTERVAL', 10))
+    return _store
+
+
+def record_request(view, status, duration, n_queries, sql_time, size):
+    """Add a handled request to the metrics of its view."""
+    store = get_metrics_store()
+    labels = (('view', view),)
+    store.inc('catmaid_requests_total', labels + (('status', six.text_type(status)),))
+    store.observe('catmaid_request_duration_seconds', labels, duration,
+            LATENCY_BUCKETS)
+    store.inc('catmaid_request_sql_queries_total', labels, n_queries)
+    store.inc('catmaid_request_sql_seconds_total', labels, sql_time)
+    if size is not None:
+        store.observe('catmaid_response_size_bytes', labels, size, SIZE_BUCKETS)
+    store.maybe_flush()
+
+
+def count_cache_access(cache, hit):
+    """Count a hit or miss of one of CATMAID's caches."""
+    store = get_metrics_store()
+    store.inc('catmaid_cache_requests_total', (('cache', cache),
+            ('result', 'hit' if hit else 'miss')))
+    store.maybe_flush()
@@ -7,6 +7,7 @@ import logging
 
 from traceback import format_exc
 from datetime import datetime
+from time import time
 
 from django.http import JsonResponse
 from django.conf import settings
@@ -15,6 +16,10 @@ from guardian.utils import get_anonymous_user
 
 from rest_framework.authentication import TokenAuthentication
 
+from catmaid.metrics import record_request
+from catmaid.profiling import QueryCounter, QueryProfile, explain, \
+        profile_queries, record_sql_histogram
+
 from six import StringIO
 
 
@@ -159,6 +164,16 @@ class ProfilingMiddleware(object):
     containing the original data and the profile. Optionally, if the request has
     a field called 'profile-to-disk', the profile is saved to a file in /tmp,
     with a name following the pattern 'catmaid-hostaddress-timestamp.profile'.
+
+    All SQL statements of the request are recorded as well and returned in the
+    'sql' field, grouped by their normalized text with their count, total and
+    maximum time and number of returned rows. If the request has a field called
+    'profile-explain', the N slowest SELECT statements (default: 1) are
+    executed again with EXPLAIN (ANALYZE, BUFFERS) and their plans are returned
+    in the 'explain' field. If PROFILING_SQL_HISTOGRAM_CACHE is set to the name
+    of a Django cache, SQL time and query count of all profiled requests are
+    aggregated into histograms per view, which are returned in the
+    'sql_histogram' field.
     """
 
     def __init__(self, get_response):
@@ -174,26 +189,74 @@ class ProfilingMiddleware(object):
     def __call__(self, request):
         profile = 'profile' in request.GET or 'profile' in request.POST
 
-        if profile:
-            request.profiler = cProfile.Profile()
-            request.profiler.enable()
-
-        response = self.get_response(request)
-
-        if profile:
-            request.profiler.disable()
-            s = StringIO()
-            sortby = getattr(request, 'profile-sorting', 'cumulative')
-            ps = pstats.Stats(request.profiler, stream=s).sort_stats(sortby)
-            ps.print_stats()
-            response = JsonResponse({
-                'content': response.content,
-                'profile': s.getvalue()
-            })
-
-            if hasattr(request, 'profile-to-disk'):
-                labels = (request.META['REMOTE_ADDR'], datetime.now())
-                request.profiler.dump_stats('/tmp/catmaid-%s-%s.profile' % labels)
+        if not profile:
+            return self.get_response(request)
+
+        request.profiler = cProfile.Profile()
+        request.profiler.enable()
+        with profile_queries(QueryProfile()) as query_profile:
+            response = self.get_response(request)
+        request.profiler.disable()
+
+        s = StringIO()
+        sortby = getattr(request, 'profile-sorting', 'cumulative')
+        ps = pstats.Stats(request.profiler, stream=s).sort_stats(sortby)
+        ps.print_stats()
+        result = {
+            'content': response.content,
+            'profile': s.getvalue(),
+            'sql': query_profile.as_json(),
+        }
+
+        n_explain = request.GET.get('profile-explain',
+                request.POST.get('profile-explain'))
+        if n_explain is not None:
+            n_explain = int(n_explain) if n_explain else 1
+            result['explain'] = [{
+                'sql': sql,
+                'plan': explain(*slowest),
+            } for sql, slowest in query_profile.slowest(n_explain)]
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        view_name = resolver_match.view_name if resolver_match else request.path
+        histogram = record_sql_histogram(view_name, query_profile)
+        if histogram:
+            result['sql_histogram'] = histogram
+
+        response = JsonResponse(result)
+
+        if hasattr(request, 'profile-to-disk'):
+            labels = (request.META['REMOTE_ADDR'], datetime.now())
+            request.profiler.dump_stats('/tmp/catmaid-%s-%s.profile' % labels)
+
+        return response
+
+
+class MetricsMiddleware(object):
+    """Record the duration, the number and time of SQL queries and the
+    response size of every request for the metrics of its view, which are
+    available in Prometheus' text format from the /metrics endpoint.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time()
+        with profile_queries(QueryCounter()) as queries:
+            response = self.get_response(request)
+        duration = time() - start
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        view_name = resolver_match.view_name if resolver_match else 'unresolved'
+        if response.has_header('Content-Length'):
+            size = int(response['Content-Length'])
+        elif not response.streaming:
+            size = len(response.content)
+        else:
+            size = None
+        record_request(view_name, response.status_code, duration,
+                queries.n_queries, queries.time, size)
 
         return response
 
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+forward = """
+    -- Number of connector mediated link pairs between two skeletons. For each
+    -- pair of treenode_connector links on the same connector, the link pair
+    -- is counted once in each direction, grouped by the skeletons and
+    -- relations of both links and their minimum confidence. This is what
+    -- e.g. the connectivity widget and graph widget would otherwise need to
+    -- compute by joining treenode_connector with itself.
+    CREATE TABLE catmaid_skeleton_connectivity (
+        project_id integer NOT NULL,
+        skeleton_a integer NOT NULL,
+        relation_a integer NOT NULL,
+        skeleton_b integer NOT NULL,
+        relation_b integer NOT NULL,
+        confidence smallint NOT NULL,
+        count integer NOT NULL,
+        PRIMARY KEY (skeleton_a, relation_a, skeleton_b, relation_b, confidence)
+    );
+
+    CREATE INDEX catmaid_skeleton_connectivity_skeleton_b_index
+        ON catmaid_skeleton_connectivity (skeleton_b);
+
+    CREATE INDEX catmaid_skeleton_connectivity_project_index
+        ON catmaid_skeleton_connectivity (project_id);
+
+    INSERT INTO catmaid_skeleton_connectivity
+        SELECT tc1.project_id, tc1.skeleton_id, tc1.relation_id,
+            tc2.skeleton_id, tc2.relation_id,
+            LEAST(tc1.confidence, tc2.confidence), count(*)
+        FROM treenode_connector tc1
+        JOIN treenode_connector tc2
+            ON tc1.connector_id = tc2.connector_id
+            AND tc1.id <> tc2.id
+        WHERE tc1.skeleton_id IS NOT NULL
+          AND tc2.skeleton_id IS NOT NULL
+        GROUP BY tc1.project_id, tc1.skeleton_id, tc1.relation_id,
+            tc2.skeleton_id, tc2.relation_id,
+            LEAST(tc1.confidence, tc2.confidence);
+
+    -- Add (sign = 1) or remove (sign = -1) the link pairs formed by the passed
+    -- in link and all other links of its connector.
+    CREATE FUNCTION update_skeleton_connectivity(link treenode_connector,
+            sign integer) RETURNS void
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        IF link.skeleton_id IS NULL THEN
+            RETURN;
+        END IF;
+
+        WITH link_pair AS (
+            SELECT link.skeleton_id AS skeleton_a, link.relation_id AS relation_a,
+                tc.skeleton_id AS skeleton_b, tc.relation_id AS relation_b,
+                LEAST(link.confidence, tc.confidence) AS confidence
+            FROM treenode_connector tc
+            WHERE tc.connector_id = link.connector_id
+              AND tc.id <> link.id
+              AND tc.skeleton_id IS NOT NULL
+            UNION ALL
+            SELECT tc.skeleton_id, tc.relation_id,
+                link.skeleton_id, link.relation_id,
+                LEAST(link.confidence, tc.confidence)
+            FROM treenode_connector tc
+            WHERE tc.connector_id = link.connector_id
+              AND tc.id <> link.id
+              AND tc.skeleton_id IS NOT NULL
+        )
+        INSERT INTO catmaid_skeleton_connectivity AS sc (project_id, skeleton_a,
+            relation_a, skeleton_b, relation_b, confidence, count)
+        SELECT link.project_id, lp.skeleton_a, lp.relation_a, lp.skeleton_b,
+            lp.relation_b, lp.confidence, sign * count(*)
+        FROM link_pair lp
+        GROUP BY lp.skeleton_a, lp.relation_a, lp.skeleton_b, lp.relation_b,
+            lp.confidence
+        ON CONFLICT (skeleton_a, relation_a, skeleton_b, relation_b, confidence)
+        DO UPDATE SET count = sc.count + EXCLUDED.count;
+
+        IF sign < 0 THEN
+            DELETE FROM catmaid_skeleton_connectivity sc
+            WHERE sc.count <= 0
+              AND (sc.skeleton_a = link.skeleton_id OR sc.skeleton_b = link.skeleton_id);
+        END IF;
+    END;
+    $$;
+
+    -- Link changes are handled in BEFORE triggers, because these see the
+    -- changes of links processed earlier by the same statement, but not the
+    -- change of the current link. Each link change is applied as difference
+    -- to this state. Concurrent changes of links of the same connector are
+    -- serialized by locking the connector.
+    CREATE FUNCTION on_change_treenode_connector_update_connectivity() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM 1 FROM connector WHERE id = NEW.connector_id FOR UPDATE;
+            PERFORM update_skeleton_connectivity(NEW, 1);
+            RETURN NEW;
+        ELSIF TG_OP = 'DELETE' THEN
+            PERFORM 1 FROM connector WHERE id = OLD.connector_id FOR UPDATE;
+            PERFORM update_skeleton_connectivity(OLD, -1);
+            RETURN OLD;
+        ELSIF OLD.skeleton_id IS DISTINCT FROM NEW.skeleton_id OR
+              OLD.relation_id <> NEW.relation_id OR
+              OLD.connector_id <> NEW.connector_id OR
+              OLD.confidence <> NEW.confidence THEN
+            PERFORM 1 FROM connector
+            WHERE id IN (OLD.connector_id, NEW.connector_id)
+            ORDER BY id
+            FOR UPDATE;
+            PERFORM update_skeleton_connectivity(OLD, -1);
+            PERFORM update_skeleton_connectivity(NEW, 1);
+        END IF;
+        RETURN NEW;
+    END;
+    $$;
+
+    CREATE TRIGGER on_change_treenode_connector_update_connectivity
+        BEFORE INSERT OR UPDATE OR DELETE ON treenode_connector
+        FOR EACH ROW EXECUTE PROCEDURE on_change_treenode_connector_update_connectivity();
+"""
+
+backward = """
+    DROP TRIGGER on_change_treenode_connector_update_connectivity ON treenode_connector;
+    DROP FUNCTION on_change_treenode_connector_update_connectivity();
+    DROP FUNCTION update_skeleton_connectivity(treenode_connector, integer);
+    DROP TABLE catmaid_skeleton_connectivity;
+"""
+
+
+class Migration(migrations.Migration):
+    """Materialize the number of synaptic (and other connector mediated)
+    connections between skeletons and keep it up to date with triggers.
+    """
+
+    dependencies = [
+        ('catmaid', '0021_recreate_history_view_after_auth_user_update'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward)
+    ]
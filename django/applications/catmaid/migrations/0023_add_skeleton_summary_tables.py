@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+forward = """
+    -- Per skeleton summary information, which would otherwise need to be
+    -- computed by aggregating over all treenodes and reviews of a skeleton.
+    -- The cable length is the sum of the lengths of all parent edges of
+    -- existing nodes whose parent exists as well. The number of reviewed nodes
+    -- counts each node with at least one review once.
+    CREATE TABLE catmaid_skeleton_summary (
+        skeleton_id integer PRIMARY KEY,
+        project_id integer NOT NULL,
+        num_nodes integer NOT NULL DEFAULT 0,
+        cable_length double precision NOT NULL DEFAULT 0,
+        root_node_id bigint,
+        num_reviewed_nodes integer NOT NULL DEFAULT 0,
+        last_edition_time timestamptz
+    );
+
+    CREATE INDEX catmaid_skeleton_summary_project_index
+        ON catmaid_skeleton_summary (project_id);
+
+    -- The number of distinct nodes each reviewer reviewed in a skeleton.
+    CREATE TABLE catmaid_skeleton_review_summary (
+        skeleton_id integer NOT NULL,
+        reviewer_id integer NOT NULL,
+        project_id integer NOT NULL,
+        num_reviewed_nodes integer NOT NULL DEFAULT 0,
+        PRIMARY KEY (skeleton_id, reviewer_id)
+    );
+
+    CREATE INDEX catmaid_skeleton_review_summary_project_reviewer_index
+        ON catmaid_skeleton_review_summary (project_id, reviewer_id);
+
+    INSERT INTO catmaid_skeleton_summary (skeleton_id, project_id, num_nodes,
+        cable_length, root_node_id, last_edition_time)
+    SELECT t.skeleton_id, t.project_id, count(*),
+        COALESCE(sum(sqrt(
+            (t.location_x::double precision - p.location_x) ^ 2 +
+            (t.location_y::double precision - p.location_y) ^ 2 +
+            (t.location_z::double precision - p.location_z) ^ 2)), 0),
+        max(CASE WHEN t.parent_id IS NULL THEN t.id END),
+        max(t.edition_time)
+    FROM treenode t
+    LEFT JOIN treenode p
+        ON p.id = t.parent_id
+    GROUP BY t.skeleton_id, t.project_id;
+
+    INSERT INTO catmaid_skeleton_review_summary (skeleton_id, reviewer_id,
+        project_id, num_reviewed_nodes)
+    SELECT r.skeleton_id, r.reviewer_id, r.project_id,
+        count(DISTINCT r.treenode_id)
+    FROM review r
+    GROUP BY r.skeleton_id, r.reviewer_id, r.project_id;
+
+    INSERT INTO catmaid_skeleton_summary AS ss (skeleton_id, project_id,
+        num_reviewed_nodes)
+    SELECT r.skeleton_id, r.project_id, count(DISTINCT r.treenode_id)
+    FROM review r
+    GROUP BY r.skeleton_id, r.project_id
+    ON CONFLICT (skeleton_id)
+    DO UPDATE SET num_reviewed_nodes = EXCLUDED.num_reviewed_nodes;
+
+    -- Add the passed in differences to the summary of a skeleton. Summaries
+    -- without nodes and reviews are removed.
+    CREATE FUNCTION update_skeleton_summary(skid integer, pid integer,
+            node_delta integer, cable_delta double precision,
+            review_delta integer, edit_time timestamptz) RETURNS void
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        INSERT INTO catmaid_skeleton_summary AS ss (skeleton_id, project_id,
+            num_nodes, cable_length, num_reviewed_nodes, last_edition_time)
+        VALUES (skid, pid, node_delta, cable_delta, review_delta, edit_time)
+        ON CONFLICT (skeleton_id) DO UPDATE
+        SET num_nodes = ss.num_nodes + EXCLUDED.num_nodes,
+            cable_length = ss.cable_length + EXCLUDED.cable_length,
+            num_reviewed_nodes = ss.num_reviewed_nodes + EXCLUDED.num_reviewed_nodes,
+            last_edition_time = GREATEST(ss.last_edition_time, EXCLUDED.last_edition_time);
+
+        IF node_delta < 0 OR review_delta < 0 THEN
+            DELETE FROM catmaid_skeleton_summary
+            WHERE skeleton_id = skid
+              AND num_nodes <= 0
+              AND num_reviewed_nodes <= 0;
+        END IF;
+    END;
+    $$;
+
+    -- The length of the edge between a node and its parent or zero if the
+    -- node has no (existing) parent.
+    CREATE FUNCTION treenode_parent_edge_length(node treenode)
+            RETURNS double precision
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        RETURN COALESCE((
+            SELECT sqrt((node.location_x::double precision - p.location_x) ^ 2 +
+                        (node.location_y::double precision - p.location_y) ^ 2 +
+                        (node.location_z::double precision - p.location_z) ^ 2)
+            FROM treenode p
+            WHERE p.id = node.parent_id), 0);
+    END;
+    $$;
+
+    -- Add (sign = 1) or remove (sign = -1) the edges between the passed in
+    -- node and its existing children to the summaries of the children's
+    -- skeletons.
+    CREATE FUNCTION update_skeleton_summary_child_edges(node treenode,
+            sign integer) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+    DECLARE
+        child_edges record;
+    BEGIN
+        FOR child_edges IN
+            SELECT c.skeleton_id, c.project_id, sum(sqrt(
+                (c.location_x::double precision - node.location_x) ^ 2 +
+                (c.location_y::double precision - node.location_y) ^ 2 +
+                (c.location_z::double precision - node.location_z) ^ 2)) AS length
+            FROM treenode c
+            WHERE c.parent_id = node.id
+            GROUP BY c.skeleton_id, c.project_id
+        LOOP
+            PERFORM update_skeleton_summary(child_edges.skeleton_id,
+                child_edges.project_id, 0, sign * child_edges.length, 0, now());
+        END LOOP;
+    END;
+    $$;
+
+    -- Like the connectivity triggers, treenode changes are handled in BEFORE
+    -- triggers, which see the changes of all rows processed earlier by the
+    -- same statement. Each change is applied as difference to this state,
+    -- which makes this work for e.g. joins, splits and reroots, which change
+    -- many nodes with a single statement.
+    CREATE FUNCTION on_change_treenode_update_summary() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM update_skeleton_summary(NEW.skeleton_id, NEW.project_id, 1,
+                treenode_parent_edge_length(NEW), 0, NEW.edition_time);
+            PERFORM update_skeleton_summary_child_edges(NEW, 1);
+            IF NEW.parent_id IS NULL THEN
+                UPDATE catmaid_skeleton_summary SET root_node_id = NEW.id
+                WHERE skeleton_id = NEW.skeleton_id;
+            END IF;
+            RETURN NEW;
+        ELSIF TG_OP = 'DELETE' THEN
+            IF OLD.parent_id IS NULL THEN
+                UPDATE catmaid_skeleton_summary SET root_node_id = NULL
+                WHERE skeleton_id = OLD.skeleton_id AND root_node_id = OLD.id;
+            END IF;
+            PERFORM update_skeleton_summary_child_edges(OLD, -1);
+            PERFORM update_skeleton_summary(OLD.skeleton_id, OLD.project_id, -1,
+                -treenode_parent_edge_length(OLD), 0, now());
+            RETURN OLD;
+        ELSIF OLD.skeleton_id <> NEW.skeleton_id OR
+              OLD.parent_id IS DISTINCT FROM NEW.parent_id OR
+              OLD.location_x <> NEW.location_x OR
+              OLD.location_y <> NEW.location_y OR
+              OLD.location_z <> NEW.location_z THEN
+            IF OLD.parent_id IS NULL THEN
+                UPDATE catmaid_skeleton_summary SET root_node_id = NULL
+                WHERE skeleton_id = OLD.skeleton_id AND root_node_id = OLD.id;
+            END IF;
+            IF OLD.skeleton_id = NEW.skeleton_id THEN
+                PERFORM update_skeleton_summary(NEW.skeleton_id, NEW.project_id,
+                    0, treenode_parent_edge_length(NEW) -
+                    treenode_parent_edge_length(OLD), 0, now());
+            ELSE
+                PERFORM update_skeleton_summary(NEW.skeleton_id,
+                    NEW.project_id, 1, treenode_parent_edge_length(NEW), 0, now());
+                PERFORM update_skeleton_summary(OLD.skeleton_id,
+                    OLD.project_id, -1, -treenode_parent_edge_length(OLD), 0, now());
+            END IF;
+            IF OLD.location_x <> NEW.location_x OR
+               OLD.location_y <> NEW.location_y OR
+               OLD.location_z <> NEW.location_z THEN
+                PERFORM update_skeleton_summary_child_edges(OLD, -1);
+                PERFORM update_skeleton_summary_child_edges(NEW, 1);
+            END IF;
+            IF NEW.parent_id IS NULL THEN
+                UPDATE catmaid_skeleton_summary SET root_node_id = NEW.id
+                WHERE skeleton_id = NEW.skeleton_id;
+            END IF;
+        ELSE
+            UPDATE catmaid_skeleton_summary SET last_edition_time = now()
+            WHERE skeleton_id = NEW.skeleton_id;
+        END IF;
+        RETURN NEW;
+    END;
+    $$;
+
+    CREATE TRIGGER on_change_treenode_update_summary
+        BEFORE INSERT OR UPDATE OR DELETE ON treenode
+        FOR EACH ROW EXECUTE PROCEDURE on_change_treenode_update_summary();
+
+    -- Add (sign = 1) or remove (sign = -1) the passed in review to the
+    -- summaries of its skeleton, unless another review of the same node
+    -- is already counted.
+    CREATE FUNCTION update_skeleton_review_summary(r review, sign integer)
+            RETURNS void
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM review
+            WHERE treenode_id = r.treenode_id
+              AND skeleton_id = r.skeleton_id
+              AND reviewer_id = r.reviewer_id
+              AND id <> r.id) THEN
+            INSERT INTO catmaid_skeleton_review_summary AS srs (skeleton_id,
+                reviewer_id, project_id, num_reviewed_nodes)
+            VALUES (r.skeleton_id, r.reviewer_id, r.project_id, sign)
+            ON CONFLICT (skeleton_id, reviewer_id) DO UPDATE
+            SET num_reviewed_nodes = srs.num_reviewed_nodes + EXCLUDED.num_reviewed_nodes;
+
+            IF sign < 0 THEN
+                DELETE FROM catmaid_skeleton_review_summary
+                WHERE skeleton_id = r.skeleton_id
+                  AND reviewer_id = r.reviewer_id
+                  AND num_reviewed_nodes <= 0;
+            END IF;
+        END IF;
+
+        IF NOT EXISTS (
+            SELECT 1 FROM review
+            WHERE treenode_id = r.treenode_id
+              AND skeleton_id = r.skeleton_id
+              AND id <> r.id) THEN
+            PERFORM update_skeleton_summary(r.skeleton_id, r.project_id, 0, 0,
+                sign, NULL);
+        END IF;
+    END;
+    $$;
+
+    -- Concurrent reviews of the same node are serialized by locking the node.
+    CREATE FUNCTION on_change_review_update_summary() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM 1 FROM treenode WHERE id = NEW.treenode_id FOR UPDATE;
+            PERFORM update_skeleton_review_summary(NEW, 1);
+            RETURN NEW;
+        ELSIF TG_OP = 'DELETE' THEN
+            PERFORM 1 FROM treenode WHERE id = OLD.treenode_id FOR UPDATE;
+            PERFORM update_skeleton_review_summary(OLD, -1);
+            RETURN OLD;
+        ELSIF OLD.skeleton_id <> NEW.skeleton_id OR
+              OLD.treenode_id <> NEW.treenode_id OR
+              OLD.reviewer_id <> NEW.reviewer_id THEN
+            PERFORM 1 FROM treenode
+            WHERE id IN (OLD.treenode_id, NEW.treenode_id)
+            ORDER BY id
+            FOR UPDATE;
+            PERFORM update_skeleton_review_summary(OLD, -1);
+            PERFORM update_skeleton_review_summary(NEW, 1);
+        END IF;
+        RETURN NEW;
+    END;
+    $$;
+
+    CREATE TRIGGER on_change_review_update_summary
+        BEFORE INSERT OR UPDATE OR DELETE ON review
+        FOR EACH ROW EXECUTE PROCEDURE on_change_review_update_summary();
+"""
+
+backward = """
+    DROP TRIGGER on_change_review_update_summary ON review;
+    DROP FUNCTION on_change_review_update_summary();
+    DROP FUNCTION update_skeleton_review_summary(review, integer);
+    DROP TRIGGER on_change_treenode_update_summary ON treenode;
+    DROP FUNCTION on_change_treenode_update_summary();
+    DROP FUNCTION update_skeleton_summary_child_edges(treenode, integer);
+    DROP FUNCTION treenode_parent_edge_length(treenode);
+    DROP FUNCTION update_skeleton_summary(integer, integer, integer,
+        double precision, integer, timestamptz);
+    DROP TABLE catmaid_skeleton_review_summary;
+    DROP TABLE catmaid_skeleton_summary;
+"""
+
+
+class Migration(migrations.Migration):
+    """Maintain per skeleton node counts, cable length, root node, last
+    edition time and review counts in summary tables, which are kept up to
+    date with triggers.
+    """
+
+    dependencies = [
+        ('catmaid', '0022_add_skeleton_connectivity_table'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward)
+    ]
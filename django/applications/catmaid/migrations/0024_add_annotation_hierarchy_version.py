@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+forward = """
+    -- A version number of the annotation hierarchy (annotations annotated
+    -- with other annotations) of each project. Versions are taken from a
+    -- sequence, which makes sure a version is never used twice, not even if
+    -- a transaction that changed the hierarchy is rolled back.
+    CREATE SEQUENCE catmaid_annotation_hierarchy_version_seq;
+
+    CREATE TABLE catmaid_annotation_hierarchy_version (
+        project_id integer PRIMARY KEY,
+        version bigint NOT NULL
+    );
+
+    CREATE FUNCTION on_change_annotation_link_update_hierarchy_version()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        links class_instance_class_instance[];
+        link class_instance_class_instance;
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            links := ARRAY[NEW];
+        ELSIF TG_OP = 'DELETE' THEN
+            links := ARRAY[OLD];
+        ELSE
+            links := ARRAY[OLD, NEW];
+        END IF;
+
+        FOREACH link IN ARRAY links LOOP
+            -- Only annotated_with links of annotations are part of the
+            -- hierarchy. Links of class instances that don't exist anymore
+            -- (e.g. during cascading deletes) are expected to be part of it.
+            IF EXISTS (
+                SELECT 1 FROM relation r
+                WHERE r.id = link.relation_id
+                  AND r.relation_name = 'annotated_with')
+              AND NOT EXISTS (
+                SELECT 1 FROM class_instance ci
+                JOIN class c ON c.id = ci.class_id
+                WHERE ci.id = link.class_instance_a
+                  AND c.class_name <> 'annotation') THEN
+                INSERT INTO catmaid_annotation_hierarchy_version
+                    (project_id, version)
+                VALUES (link.project_id,
+                    nextval('catmaid_annotation_hierarchy_version_seq'))
+                ON CONFLICT (project_id) DO UPDATE
+                SET version = EXCLUDED.version;
+                EXIT;
+            END IF;
+        END LOOP;
+
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_change_annotation_link_update_hierarchy_version
+        AFTER INSERT OR UPDATE OR DELETE ON class_instance_class_instance
+        FOR EACH ROW EXECUTE PROCEDURE
+        on_change_annotation_link_update_hierarchy_version();
+"""
+
+backward = """
+    DROP TRIGGER on_change_annotation_link_update_hierarchy_version
+        ON class_instance_class_instance;
+    DROP FUNCTION on_change_annotation_link_update_hierarchy_version();
+    DROP TABLE catmaid_annotation_hierarchy_version;
+    DROP SEQUENCE catmaid_annotation_hierarchy_version_seq;
+"""
+
+
+class Migration(migrations.Migration):
+    """Keep a version number of the annotation hierarchy of each project up to
+    date with a trigger. This allows to cache sub-annotations in-process and
+    to invalidate them when the hierarchy changes.
+    """
+
+    dependencies = [
+        ('catmaid', '0023_add_skeleton_summary_tables'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward)
+    ]
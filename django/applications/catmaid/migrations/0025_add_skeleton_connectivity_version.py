@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+forward = """
+    -- The ID of the last transaction that changed the connectivity of each
+    -- skeleton. In-process copies of the connectivity graph remember the
+    -- oldest transaction that was still running when they were loaded
+    -- (txid_snapshot_xmin) and only need to reload skeletons changed by this
+    -- or later transactions.
+    CREATE TABLE catmaid_skeleton_connectivity_version (
+        skeleton_id integer PRIMARY KEY,
+        project_id integer NOT NULL,
+        txid bigint NOT NULL
+    );
+
+    CREATE INDEX catmaid_skeleton_connectivity_version_project_txid_index
+        ON catmaid_skeleton_connectivity_version (project_id, txid);
+
+    CREATE FUNCTION on_change_skeleton_connectivity_update_version()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        connection catmaid_skeleton_connectivity;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            connection := OLD;
+        ELSE
+            connection := NEW;
+        END IF;
+
+        -- Each connection is stored in both directions, updating skeleton_a
+        -- is therefore enough.
+        INSERT INTO catmaid_skeleton_connectivity_version AS v
+            (skeleton_id, project_id, txid)
+        VALUES (connection.skeleton_a, connection.project_id, txid_current())
+        ON CONFLICT (skeleton_id) DO UPDATE
+        SET txid = EXCLUDED.txid, project_id = EXCLUDED.project_id
+        WHERE v.txid <> EXCLUDED.txid;
+
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_change_skeleton_connectivity_update_version
+        AFTER INSERT OR UPDATE OR DELETE ON catmaid_skeleton_connectivity
+        FOR EACH ROW EXECUTE PROCEDURE
+        on_change_skeleton_connectivity_update_version();
+"""
+
+backward = """
+    DROP TRIGGER on_change_skeleton_connectivity_update_version
+        ON catmaid_skeleton_connectivity;
+    DROP FUNCTION on_change_skeleton_connectivity_update_version();
+    DROP TABLE catmaid_skeleton_connectivity_version;
+"""
+
+
+class Migration(migrations.Migration):
+    """Track which transaction changed the connectivity of a skeleton last, so
+    that cached connectivity graphs can be updated incrementally.
+    """
+
+    dependencies = [
+        ('catmaid', '0024_add_annotation_hierarchy_version'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward)
+    ]
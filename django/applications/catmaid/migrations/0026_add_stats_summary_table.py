@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+forward = """
+    -- The contributions of each user to a project per quarter hour: existing
+    -- nodes created in this period and the cable length to their parents,
+    -- nodes of other users last edited in this period, completed synaptic
+    -- links and reviews. The offsets of today's time zones to UTC are
+    -- multiples of 15 minutes, summarizing per quarter hour rather than per
+    -- day therefore allows to report days in these time zones, including
+    -- ones like UTC+5:30 or UTC+5:45.
+    CREATE TABLE catmaid_stats_summary (
+        project_id integer NOT NULL,
+        user_id integer NOT NULL,
+        date timestamptz NOT NULL,
+        n_treenodes integer NOT NULL DEFAULT 0,
+        n_edited_treenodes integer NOT NULL DEFAULT 0,
+        n_connector_links integer NOT NULL DEFAULT 0,
+        n_reviewed_nodes integer NOT NULL DEFAULT 0,
+        cable_length double precision NOT NULL DEFAULT 0,
+        PRIMARY KEY (project_id, user_id, date)
+    );
+
+    CREATE INDEX catmaid_stats_summary_project_date_index
+        ON catmaid_stats_summary (project_id, date);
+
+    -- The project, user and period of summary entries that are outdated,
+    -- because treenodes, links or reviews changed. Triggers add an entry for
+    -- each change, which is visible once its transaction committed. Outdated
+    -- summary entries are recomputed and their changes removed periodically.
+    -- Until then, they are computed when reading the summary.
+    CREATE TABLE catmaid_stats_summary_change (
+        project_id integer NOT NULL,
+        user_id integer NOT NULL,
+        date timestamptz NOT NULL
+    );
+
+    CREATE INDEX catmaid_stats_summary_change_project_date_index
+        ON catmaid_stats_summary_change (project_id, date);
+
+    -- Outdated summary entries are recomputed from the rows created, edited
+    -- or reviewed in their period.
+    CREATE INDEX treenode_connector_creation_time_index
+        ON treenode_connector (creation_time);
+    CREATE INDEX review_review_time_index
+        ON review (review_time);
+
+    -- The start of the summary period that contains the passed in time.
+    -- Unlike date_trunc, this doesn't depend on the session's time zone.
+    CREATE FUNCTION stats_summary_date(t timestamptz) RETURNS timestamptz
+    LANGUAGE sql IMMUTABLE
+    AS $$
+        SELECT to_timestamp(floor(extract(epoch FROM t) / 900) * 900);
+    $$;
+
+    CREATE FUNCTION log_stats_summary_change(pid integer, uid integer,
+            change_time timestamptz) RETURNS void
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        INSERT INTO catmaid_stats_summary_change (project_id, user_id, date)
+        VALUES (pid, uid, stats_summary_date(change_time));
+    END;
+    $$;
+
+    -- The created nodes and cable length are counted for the creator of a
+    -- node, edits for its last editor if this isn't the creator. The cable
+    -- length depends on the parent, moved nodes therefore also change the
+    -- summary of their children.
+    CREATE FUNCTION on_change_treenode_update_stats_summary() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM log_stats_summary_change(NEW.project_id, NEW.user_id,
+                NEW.creation_time);
+            IF NEW.editor_id <> NEW.user_id THEN
+                PERFORM log_stats_summary_change(NEW.project_id,
+                    NEW.editor_id, NEW.edition_time);
+            END IF;
+        ELSIF TG_OP = 'DELETE' THEN
+            PERFORM log_stats_summary_change(OLD.project_id, OLD.user_id,
+                OLD.creation_time);
+            IF OLD.editor_id <> OLD.user_id THEN
+                PERFORM log_stats_summary_change(OLD.project_id,
+                    OLD.editor_id, OLD.edition_time);
+            END IF;
+        ELSE
+            IF OLD.project_id <> NEW.project_id OR
+                    OLD.user_id <> NEW.user_id OR
+                    OLD.creation_time <> NEW.creation_time OR
+                    OLD.parent_id IS DISTINCT FROM NEW.parent_id OR
+                    OLD.location_x <> NEW.location_x OR
+                    OLD.location_y <> NEW.location_y OR
+                    OLD.location_z <> NEW.location_z THEN
+                PERFORM log_stats_summary_change(OLD.project_id, OLD.user_id,
+                    OLD.creation_time);
+                PERFORM log_stats_summary_change(NEW.project_id, NEW.user_id,
+                    NEW.creation_time);
+            END IF;
+            IF OLD.project_id <> NEW.project_id OR
+                    OLD.user_id <> NEW.user_id OR
+                    OLD.editor_id <> NEW.editor_id OR
+                    OLD.edition_time <> NEW.edition_time THEN
+                IF OLD.editor_id <> OLD.user_id THEN
+                    PERFORM log_stats_summary_change(OLD.project_id,
+                        OLD.editor_id, OLD.edition_time);
+                END IF;
+                IF NEW.editor_id <> NEW.user_id THEN
+                    PERFORM log_stats_summary_change(NEW.project_id,
+                        NEW.editor_id, NEW.edition_time);
+                END IF;
+            END IF;
+            IF OLD.location_x <> NEW.location_x OR
+                    OLD.location_y <> NEW.location_y OR
+                    OLD.location_z <> NEW.location_z THEN
+                INSERT INTO catmaid_stats_summary_change (project_id, user_id, date)
+                SELECT DISTINCT c.project_id, c.user_id,
+                    stats_summary_date(c.creation_time)
+                FROM treenode c
+                WHERE c.parent_id = NEW.id;
+            END IF;
+        END IF;
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_change_treenode_update_stats_summary
+        AFTER INSERT OR UPDATE OR DELETE ON treenode
+        FOR EACH ROW EXECUTE PROCEDURE on_change_treenode_update_stats_summary();
+
+    -- Whether a synaptic link completes a connection depends on the other
+    -- links of its connector, whose summaries are therefore changed as well.
+    CREATE FUNCTION on_change_treenode_connector_update_stats_summary()
+            RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        IF TG_OP = 'UPDATE' THEN
+            IF OLD.project_id = NEW.project_id AND
+                    OLD.user_id = NEW.user_id AND
+                    OLD.creation_time = NEW.creation_time AND
+                    OLD.connector_id = NEW.connector_id AND
+                    OLD.relation_id = NEW.relation_id THEN
+                RETURN NULL;
+            END IF;
+        END IF;
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM log_stats_summary_change(OLD.project_id, OLD.user_id,
+                OLD.creation_time);
+            INSERT INTO catmaid_stats_summary_change (project_id, user_id, date)
+            SELECT DISTINCT tc.project_id, tc.user_id,
+                stats_summary_date(tc.creation_time)
+            FROM treenode_connector tc
+            WHERE tc.connector_id = OLD.connector_id;
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            INSERT INTO catmaid_stats_summary_change (project_id, user_id, date)
+            SELECT DISTINCT tc.project_id, tc.user_id,
+                stats_summary_date(tc.creation_time)
+            FROM treenode_connector tc
+            WHERE tc.connector_id = NEW.connector_id;
+        END IF;
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_change_treenode_connector_update_stats_summary
+        AFTER INSERT OR UPDATE OR DELETE ON treenode_connector
+        FOR EACH ROW EXECUTE PROCEDURE
+        on_change_treenode_connector_update_stats_summary();
+
+    CREATE FUNCTION on_change_review_update_stats_summary() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        IF TG_OP = 'UPDATE' THEN
+            IF OLD.project_id = NEW.project_id AND
+                    OLD.reviewer_id = NEW.reviewer_id AND
+                    OLD.review_time = NEW.review_time THEN
+                RETURN NULL;
+            END IF;
+        END IF;
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM log_stats_summary_change(OLD.project_id, OLD.reviewer_id,
+                OLD.review_time);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            PERFORM log_stats_summary_change(NEW.project_id, NEW.reviewer_id,
+                NEW.review_time);
+        END IF;
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_change_review_update_stats_summary
+        AFTER INSERT OR UPDATE OR DELETE ON review
+        FOR EACH ROW EXECUTE PROCEDURE on_change_review_update_stats_summary();
+
+    -- All summary entries are missing initially. They are computed by the
+    -- first summary update.
+    INSERT INTO catmaid_stats_summary_change (project_id, user_id, date)
+    SELECT project_id, user_id, stats_summary_date(creation_time)
+    FROM treenode
+    UNION
+    SELECT project_id, editor_id, stats_summary_date(edition_time)
+    FROM treenode
+    WHERE editor_id <> user_id
+    UNION
+    SELECT project_id, user_id, stats_summary_date(creation_time)
+    FROM treenode_connector
+    UNION
+    SELECT project_id, reviewer_id, stats_summary_date(review_time)
+    FROM review;
+"""
+
+backward = """
+    DROP TRIGGER on_change_review_update_stats_summary ON review;
+    DROP FUNCTION on_change_review_update_stats_summary();
+    DROP TRIGGER on_change_treenode_connector_update_stats_summary
+        ON treenode_connector;
+    DROP FUNCTION on_change_treenode_connector_update_stats_summary();
+    DROP TRIGGER on_change_treenode_update_stats_summary ON treenode;
+    DROP FUNCTION on_change_treenode_update_stats_summary();
+    DROP FUNCTION log_stats_summary_change(integer, integer, timestamptz);
+    DROP FUNCTION stats_summary_date(timestamptz);
+    DROP INDEX review_review_time_index;
+    DROP INDEX treenode_connector_creation_time_index;
+    DROP TABLE catmaid_stats_summary_change;
+    DROP TABLE catmaid_stats_summary;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add a per user and quarter hour summary of contributions to projects,
+    which is used by the statistics widget instead of aggregating over all
+    nodes. Triggers record which entries are outdated.
+    """
+
+    dependencies = [
+        ('catmaid', '0025_add_skeleton_connectivity_version'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward)
+    ]
@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+forward = """
+    -- Changes of skeleton summaries and skeleton connectivity are computed
+    -- by the row triggers as before, but queued in these tables instead of
+    -- being applied right away. Statement triggers apply all queued changes
+    -- of their transaction at the end of each statement, aggregated per
+    -- skeleton or pair of skeletons. Joins, splits and reroots change
+    -- thousands of rows with a single statement, which otherwise updates the
+    -- same summary rows thousands of times. Queued changes don't outlive
+    -- their statement, the tables are therefore unlogged.
+    CREATE UNLOGGED TABLE catmaid_skeleton_summary_change (
+        id bigserial PRIMARY KEY,
+        txid bigint NOT NULL DEFAULT txid_current(),
+        skeleton_id integer NOT NULL,
+        project_id integer NOT NULL,
+        num_nodes integer NOT NULL DEFAULT 0,
+        cable_length double precision NOT NULL DEFAULT 0,
+        num_reviewed_nodes integer NOT NULL DEFAULT 0,
+        last_edition_time timestamptz,
+        -- Root node changes are applied in the order they were queued: a
+        -- new root node or a root node that isn't root anymore.
+        root_node_id bigint,
+        old_root_node_id bigint
+    );
+
+    CREATE INDEX catmaid_skeleton_summary_change_txid_index
+        ON catmaid_skeleton_summary_change (txid);
+
+    CREATE UNLOGGED TABLE catmaid_skeleton_review_summary_change (
+        txid bigint NOT NULL DEFAULT txid_current(),
+        skeleton_id integer NOT NULL,
+        reviewer_id integer NOT NULL,
+        project_id integer NOT NULL,
+        num_reviewed_nodes integer NOT NULL
+    );
+
+    CREATE INDEX catmaid_skeleton_review_summary_change_txid_index
+        ON catmaid_skeleton_review_summary_change (txid);
+
+    CREATE UNLOGGED TABLE catmaid_skeleton_connectivity_change (
+        txid bigint NOT NULL DEFAULT txid_current(),
+        project_id integer NOT NULL,
+        skeleton_a integer NOT NULL,
+        relation_a integer NOT NULL,
+        skeleton_b integer NOT NULL,
+        relation_b integer NOT NULL,
+        confidence smallint NOT NULL,
+        count integer NOT NULL
+    );
+
+    CREATE INDEX catmaid_skeleton_connectivity_change_txid_index
+        ON catmaid_skeleton_connectivity_change (txid);
+
+    CREATE OR REPLACE FUNCTION update_skeleton_summary(skid integer,
+            pid integer, node_delta integer, cable_delta double precision,
+            review_delta integer, edit_time timestamptz) RETURNS void
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        INSERT INTO catmaid_skeleton_summary_change (skeleton_id, project_id,
+            num_nodes, cable_length, num_reviewed_nodes, last_edition_time)
+        VALUES (skid, pid, node_delta, cable_delta, review_delta, edit_time);
+    END;
+    $$;
+
+    CREATE OR REPLACE FUNCTION on_change_treenode_update_summary()
+            RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM update_skeleton_summary(NEW.skeleton_id, NEW.project_id, 1,
+                treenode_parent_edge_length(NEW), 0, NEW.edition_time);
+            PERFORM update_skeleton_summary_child_edges(NEW, 1);
+            IF NEW.parent_id IS NULL THEN
+                INSERT INTO catmaid_skeleton_summary_change (skeleton_id,
+                    project_id, root_node_id)
+                VALUES (NEW.skeleton_id, NEW.project_id, NEW.id);
+            END IF;
+            RETURN NEW;
+        ELSIF TG_OP = 'DELETE' THEN
+            IF OLD.parent_id IS NULL THEN
+                INSERT INTO catmaid_skeleton_summary_change (skeleton_id,
+                    project_id, old_root_node_id)
+                VALUES (OLD.skeleton_id, OLD.project_id, OLD.id);
+            END IF;
+            PERFORM update_skeleton_summary_child_edges(OLD, -1);
+            PERFORM update_skeleton_summary(OLD.skeleton_id, OLD.project_id, -1,
+                -treenode_parent_edge_length(OLD), 0, now());
+            RETURN OLD;
+        ELSIF OLD.skeleton_id <> NEW.skeleton_id OR
+              OLD.parent_id IS DISTINCT FROM NEW.parent_id OR
+              OLD.location_x <> NEW.location_x OR
+              OLD.location_y <> NEW.location_y OR
+              OLD.location_z <> NEW.location_z THEN
+            IF OLD.parent_id IS NULL THEN
+                INSERT INTO catmaid_skeleton_summary_change (skeleton_id,
+                    project_id, old_root_node_id)
+                VALUES (OLD.skeleton_id, OLD.project_id, OLD.id);
+            END IF;
+            IF OLD.skeleton_id = NEW.skeleton_id THEN
+                PERFORM update_skeleton_summary(NEW.skeleton_id, NEW.project_id,
+                    0, treenode_parent_edge_length(NEW) -
+                    treenode_parent_edge_length(OLD), 0, now());
+            ELSE
+                PERFORM update_skeleton_summary(NEW.skeleton_id,
+                    NEW.project_id, 1, treenode_parent_edge_length(NEW), 0, now());
+                PERFORM update_skeleton_summary(OLD.skeleton_id,
+                    OLD.project_id, -1, -treenode_parent_edge_length(OLD), 0, now());
+            END IF;
+            IF OLD.location_x <> NEW.location_x OR
+               OLD.location_y <> NEW.location_y OR
+               OLD.location_z <> NEW.location_z THEN
+                PERFORM update_skeleton_summary_child_edges(OLD, -1);
+                PERFORM update_skeleton_summary_child_edges(NEW, 1);
+            END IF;
+            IF NEW.parent_id IS NULL THEN
+                INSERT INTO catmaid_skeleton_summary_change (skeleton_id,
+                    project_id, root_node_id)
+                VALUES (NEW.skeleton_id, NEW.project_id, NEW.id);
+            END IF;
+        ELSE
+            PERFORM update_skeleton_summary(NEW.skeleton_id, NEW.project_id,
+                0, 0, 0, now());
+        END IF;
+        RETURN NEW;
+    END;
+    $$;
+
+    CREATE OR REPLACE FUNCTION update_skeleton_review_summary(r review,
+            sign integer) RETURNS void
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM review
+            WHERE treenode_id = r.treenode_id
+              AND skeleton_id = r.skeleton_id
+              AND reviewer_id = r.reviewer_id
+              AND id <> r.id) THEN
+            INSERT INTO catmaid_skeleton_review_summary_change (skeleton_id,
+                reviewer_id, project_id, num_reviewed_nodes)
+            VALUES (r.skeleton_id, r.reviewer_id, r.project_id, sign);
+        END IF;
+
+        IF NOT EXISTS (
+            SELECT 1 FROM review
+            WHERE treenode_id = r.treenode_id
+              AND skeleton_id = r.skeleton_id
+              AND id <> r.id) THEN
+            PERFORM update_skeleton_summary(r.skeleton_id, r.project_id, 0, 0,
+                sign, NULL);
+        END IF;
+    END;
+    $$;
+
+    CREATE OR REPLACE FUNCTION update_skeleton_connectivity(
+            link treenode_connector, sign integer) RETURNS void
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        IF link.skeleton_id IS NULL THEN
+            RETURN;
+        END IF;
+
+        WITH link_pair AS (
+            SELECT link.skeleton_id AS skeleton_a, link.relation_id AS relation_a,
+                tc.skeleton_id AS skeleton_b, tc.relation_id AS relation_b,
+                LEAST(link.confidence, tc.confidence) AS confidence
+            FROM treenode_connector tc
+            WHERE tc.connector_id = link.connector_id
+              AND tc.id <> link.id
+              AND tc.skeleton_id IS NOT NULL
+            UNION ALL
+            SELECT tc.skeleton_id, tc.relation_id,
+                link.skeleton_id, link.relation_id,
+                LEAST(link.confidence, tc.confidence)
+            FROM treenode_connector tc
+            WHERE tc.connector_id = link.connector_id
+              AND tc.id <> link.id
+              AND tc.skeleton_id IS NOT NULL
+        )
+        INSERT INTO catmaid_skeleton_connectivity_change (project_id,
+            skeleton_a, relation_a, skeleton_b, relation_b, confidence, count)
+        SELECT link.project_id, lp.skeleton_a, lp.relation_a, lp.skeleton_b,
+            lp.relation_b, lp.confidence, sign * count(*)
+        FROM link_pair lp
+        GROUP BY lp.skeleton_a, lp.relation_a, lp.skeleton_b, lp.relation_b,
+            lp.confidence;
+    END;
+    $$;
+
+    -- Apply the queued summary changes of the current transaction. Rows are
+    -- upserted in key order, which avoids deadlocks between concurrent
+    -- statements that change the same skeletons. Root node changes need the
+    -- summaries to exist and are applied afterwards. Summaries without nodes
+    -- and reviews are removed.
+    CREATE FUNCTION apply_skeleton_summary_changes() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+    DECLARE
+        root_change record;
+    BEGIN
+        INSERT INTO catmaid_skeleton_summary AS ss (skeleton_id, project_id,
+            num_nodes, cable_length, num_reviewed_nodes, last_edition_time)
+        SELECT c.skeleton_id, max(c.project_id), sum(c.num_nodes),
+            sum(c.cable_length), sum(c.num_reviewed_nodes),
+            max(c.last_edition_time)
+        FROM catmaid_skeleton_summary_change c
+        WHERE c.txid = txid_current()
+        GROUP BY c.skeleton_id
+        ORDER BY c.skeleton_id
+        ON CONFLICT (skeleton_id) DO UPDATE
+        SET num_nodes = ss.num_nodes + EXCLUDED.num_nodes,
+            cable_length = ss.cable_length + EXCLUDED.cable_length,
+            num_reviewed_nodes = ss.num_reviewed_nodes + EXCLUDED.num_reviewed_nodes,
+            last_edition_time = GREATEST(ss.last_edition_time, EXCLUDED.last_edition_time);
+
+        FOR root_change IN
+            SELECT c.skeleton_id, c.root_node_id, c.old_root_node_id
+            FROM catmaid_skeleton_summary_change c
+            WHERE c.txid = txid_current()
+              AND (c.root_node_id IS NOT NULL OR c.old_root_node_id IS NOT NULL)
+            ORDER BY c.id
+        LOOP
+            IF root_change.root_node_id IS NOT NULL THEN
+                UPDATE catmaid_skeleton_summary
+                SET root_node_id = root_change.root_node_id
+                WHERE skeleton_id = root_change.skeleton_id;
+            ELSE
+                UPDATE catmaid_skeleton_summary SET root_node_id = NULL
+                WHERE skeleton_id = root_change.skeleton_id
+                  AND root_node_id = root_change.old_root_node_id;
+            END IF;
+        END LOOP;
+
+        DELETE FROM catmaid_skeleton_summary ss
+        USING catmaid_skeleton_summary_change c
+        WHERE c.txid = txid_current()
+          AND ss.skeleton_id = c.skeleton_id
+          AND ss.num_nodes <= 0
+          AND ss.num_reviewed_nodes <= 0;
+
+        DELETE FROM catmaid_skeleton_summary_change
+        WHERE txid = txid_current();
+
+        INSERT INTO catmaid_skeleton_review_summary AS srs (skeleton_id,
+            reviewer_id, project_id, num_reviewed_nodes)
+        SELECT c.skeleton_id, c.reviewer_id, max(c.project_id),
+            sum(c.num_reviewed_nodes)
+        FROM catmaid_skeleton_review_summary_change c
+        WHERE c.txid = txid_current()
+        GROUP BY c.skeleton_id, c.reviewer_id
+        HAVING sum(c.num_reviewed_nodes) <> 0
+        ORDER BY c.skeleton_id, c.reviewer_id
+        ON CONFLICT (skeleton_id, reviewer_id) DO UPDATE
+        SET num_reviewed_nodes = srs.num_reviewed_nodes + EXCLUDED.num_reviewed_nodes;
+
+        DELETE FROM catmaid_skeleton_review_summary srs
+        USING catmaid_skeleton_review_summary_change c
+        WHERE c.txid = txid_current()
+          AND srs.skeleton_id = c.skeleton_id
+          AND srs.reviewer_id = c.reviewer_id
+          AND srs.num_reviewed_nodes <= 0;
+
+        DELETE FROM catmaid_skeleton_review_summary_change
+        WHERE txid = txid_current();
+
+        RETURN NULL;
+    END;
+    $$;
+
+    -- Reviews change skeleton summaries as well. Cascading deletes of
+    -- reviews run as separate statements, whose changes are applied by
+    -- whichever statement trigger runs first.
+    CREATE TRIGGER on_change_treenode_apply_summary_changes
+        AFTER INSERT OR UPDATE OR DELETE ON treenode
+        FOR EACH STATEMENT EXECUTE PROCEDURE apply_skeleton_summary_changes();
+
+    CREATE TRIGGER on_change_review_apply_summary_changes
+        AFTER INSERT OR UPDATE OR DELETE ON review
+        FOR EACH STATEMENT EXECUTE PROCEDURE apply_skeleton_summary_changes();
+
+    -- Apply the queued connectivity changes of the current transaction. Link
+    -- pairs whose changes cancel out, e.g. of links that are moved to
+    -- another node of the same skeleton, are left alone.
+    CREATE FUNCTION apply_skeleton_connectivity_changes() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        INSERT INTO catmaid_skeleton_connectivity AS sc (project_id, skeleton_a,
+            relation_a, skeleton_b, relation_b, confidence, count)
+        SELECT max(c.project_id), c.skeleton_a, c.relation_a, c.skeleton_b,
+            c.relation_b, c.confidence, sum(c.count)
+        FROM catmaid_skeleton_connectivity_change c
+        WHERE c.txid = txid_current()
+        GROUP BY c.skeleton_a, c.relation_a, c.skeleton_b, c.relation_b,
+            c.confidence
+        HAVING sum(c.count) <> 0
+        ORDER BY c.skeleton_a, c.relation_a, c.skeleton_b, c.relation_b,
+            c.confidence
+        ON CONFLICT (skeleton_a, relation_a, skeleton_b, relation_b, confidence)
+        DO UPDATE SET count = sc.count + EXCLUDED.count;
+
+        DELETE FROM catmaid_skeleton_connectivity sc
+        USING catmaid_skeleton_connectivity_change c
+        WHERE c.txid = txid_current()
+          AND sc.skeleton_a = c.skeleton_a
+          AND sc.relation_a = c.relation_a
+          AND sc.skeleton_b = c.skeleton_b
+          AND sc.relation_b = c.relation_b
+          AND sc.confidence = c.confidence
+          AND sc.count <= 0;
+
+        DELETE FROM catmaid_skeleton_connectivity_change
+        WHERE txid = txid_current();
+
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_change_treenode_connector_apply_connectivity_changes
+        AFTER INSERT OR UPDATE OR DELETE ON treenode_connector
+        FOR EACH STATEMENT EXECUTE PROCEDURE
+        apply_skeleton_connectivity_changes();
+"""
+
+backward = """
+    DROP TRIGGER on_change_treenode_connector_apply_connectivity_changes
+        ON treenode_connector;
+    DROP FUNCTION apply_skeleton_connectivity_changes();
+    DROP TRIGGER on_change_review_apply_summary_changes ON review;
+    DROP TRIGGER on_change_treenode_apply_summary_changes ON treenode;
+    DROP FUNCTION apply_skeleton_summary_changes();
+
+    CREATE OR REPLACE FUNCTION update_skeleton_connectivity(
+            link treenode_connector, sign integer) RETURNS void
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        IF link.skeleton_id IS NULL THEN
+            RETURN;
+        END IF;
+
+        WITH link_pair AS (
+            SELECT link.skeleton_id AS skeleton_a, link.relation_id AS relation_a,
+                tc.skeleton_id AS skeleton_b, tc.relation_id AS relation_b,
+                LEAST(link.confidence, tc.confidence) AS confidence
+            FROM treenode_connector tc
+            WHERE tc.connector_id = link.connector_id
+              AND tc.id <> link.id
+              AND tc.skeleton_id IS NOT NULL
+            UNION ALL
+            SELECT tc.skeleton_id, tc.relation_id,
+                link.skeleton_id, link.relation_id,
+                LEAST(link.confidence, tc.confidence)
+            FROM treenode_connector tc
+            WHERE tc.connector_id = link.connector_id
+              AND tc.id <> link.id
+              AND tc.skeleton_id IS NOT NULL
+        )
+        INSERT INTO catmaid_skeleton_connectivity AS sc (project_id, skeleton_a,
+            relation_a, skeleton_b, relation_b, confidence, count)
+        SELECT link.project_id, lp.skeleton_a, lp.relation_a, lp.skeleton_b,
+            lp.relation_b, lp.confidence, sign * count(*)
+        FROM link_pair lp
+        GROUP BY lp.skeleton_a, lp.relation_a, lp.skeleton_b, lp.relation_b,
+            lp.confidence
+        ON CONFLICT (skeleton_a, relation_a, skeleton_b, relation_b, confidence)
+        DO UPDATE SET count = sc.count + EXCLUDED.count;
+
+        IF sign < 0 THEN
+            DELETE FROM catmaid_skeleton_connectivity sc
+            WHERE sc.count <= 0
+              AND (sc.skeleton_a = link.skeleton_id OR sc.skeleton_b = link.skeleton_id);
+        END IF;
+    END;
+    $$;
+
+    CREATE OR REPLACE FUNCTION update_skeleton_review_summary(r review,
+            sign integer) RETURNS void
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM review
+            WHERE treenode_id = r.treenode_id
+              AND skeleton_id = r.skeleton_id
+              AND reviewer_id = r.reviewer_id
+              AND id <> r.id) THEN
+            INSERT INTO catmaid_skeleton_review_summary AS srs (skeleton_id,
+                reviewer_id, project_id, num_reviewed_nodes)
+            VALUES (r.skeleton_id, r.reviewer_id, r.project_id, sign)
+            ON CONFLICT (skeleton_id, reviewer_id) DO UPDATE
+            SET num_reviewed_nodes = srs.num_reviewed_nodes + EXCLUDED.num_reviewed_nodes;
+
+            IF sign < 0 THEN
+                DELETE FROM catmaid_skeleton_review_summary
+                WHERE skeleton_id = r.skeleton_id
+                  AND reviewer_id = r.reviewer_id
+                  AND num_reviewed_nodes <= 0;
+            END IF;
+        END IF;
+
+        IF NOT EXISTS (
+            SELECT 1 FROM review
+            WHERE treenode_id = r.treenode_id
+              AND skeleton_id = r.skeleton_id
+              AND id <> r.id) THEN
+            PERFORM update_skeleton_summary(r.skeleton_id, r.project_id, 0, 0,
+                sign, NULL);
+        END IF;
+    END;
+    $$;
+
+    CREATE OR REPLACE FUNCTION on_change_treenode_update_summary()
+            RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM update_skeleton_summary(NEW.skeleton_id, NEW.project_id, 1,
+                treenode_parent_edge_length(NEW), 0, NEW.edition_time);
+            PERFORM update_skeleton_summary_child_edges(NEW, 1);
+            IF NEW.parent_id IS NULL THEN
+                UPDATE catmaid_skeleton_summary SET root_node_id = NEW.id
+                WHERE skeleton_id = NEW.skeleton_id;
+            END IF;
+            RETURN NEW;
+        ELSIF TG_OP = 'DELETE' THEN
+            IF OLD.parent_id IS NULL THEN
+                UPDATE catmaid_skeleton_summary SET root_node_id = NULL
+                WHERE skeleton_id = OLD.skeleton_id AND root_node_id = OLD.id;
+            END IF;
+            PERFORM update_skeleton_summary_child_edges(OLD, -1);
+            PERFORM update_skeleton_summary(OLD.skeleton_id, OLD.project_id, -1,
+                -treenode_parent_edge_length(OLD), 0, now());
+            RETURN OLD;
+        ELSIF OLD.skeleton_id <> NEW.skeleton_id OR
+              OLD.parent_id IS DISTINCT FROM NEW.parent_id OR
+              OLD.location_x <> NEW.location_x OR
+              OLD.location_y <> NEW.location_y OR
+              OLD.location_z <> NEW.location_z THEN
+            IF OLD.parent_id IS NULL THEN
+                UPDATE catmaid_skeleton_summary SET root_node_id = NULL
+                WHERE skeleton_id = OLD.skeleton_id AND root_node_id = OLD.id;
+            END IF;
+            IF OLD.skeleton_id = NEW.skeleton_id THEN
+                PERFORM update_skeleton_summary(NEW.skeleton_id, NEW.project_id,
+                    0, treenode_parent_edge_length(NEW) -
+                    treenode_parent_edge_length(OLD), 0, now());
+            ELSE
+                PERFORM update_skeleton_summary(NEW.skeleton_id,
+                    NEW.project_id, 1, treenode_parent_edge_length(NEW), 0, now());
+                PERFORM update_skeleton_summary(OLD.skeleton_id,
+                    OLD.project_id, -1, -treenode_parent_edge_length(OLD), 0, now());
+            END IF;
+            IF OLD.location_x <> NEW.location_x OR
+               OLD.location_y <> NEW.location_y OR
+               OLD.location_z <> NEW.location_z THEN
+                PERFORM update_skeleton_summary_child_edges(OLD, -1);
+                PERFORM update_skeleton_summary_child_edges(NEW, 1);
+            END IF;
+            IF NEW.parent_id IS NULL THEN
+                UPDATE catmaid_skeleton_summary SET root_node_id = NEW.id
+                WHERE skeleton_id = NEW.skeleton_id;
+            END IF;
+        ELSE
+            UPDATE catmaid_skeleton_summary SET last_edition_time = now()
+            WHERE skeleton_id = NEW.skeleton_id;
+        END IF;
+        RETURN NEW;
+    END;
+    $$;
+
+    CREATE OR REPLACE FUNCTION update_skeleton_summary(skid integer,
+            pid integer, node_delta integer, cable_delta double precision,
+            review_delta integer, edit_time timestamptz) RETURNS void
+    LANGUAGE plpgsql
+    AS $$BEGIN
+        INSERT INTO catmaid_skeleton_summary AS ss (skeleton_id, project_id,
+            num_nodes, cable_length, num_reviewed_nodes, last_edition_time)
+        VALUES (skid, pid, node_delta, cable_delta, review_delta, edit_time)
+        ON CONFLICT (skeleton_id) DO UPDATE
+        SET num_nodes = ss.num_nodes + EXCLUDED.num_nodes,
+            cable_length = ss.cable_length + EXCLUDED.cable_length,
+            num_reviewed_nodes = ss.num_reviewed_nodes + EXCLUDED.num_reviewed_nodes,
+            last_edition_time = GREATEST(ss.last_edition_time, EXCLUDED.last_edition_time);
+
+        IF node_delta < 0 OR review_delta < 0 THEN
+            DELETE FROM catmaid_skeleton_summary
+            WHERE skeleton_id = skid
+              AND num_nodes <= 0
+              AND num_reviewed_nodes <= 0;
+        END IF;
+    END;
+    $$;
+
+    DROP TABLE catmaid_skeleton_connectivity_change;
+    DROP TABLE catmaid_skeleton_review_summary_change;
+    DROP TABLE catmaid_skeleton_summary_change;
+"""
+
+
+class Migration(migrations.Migration):
+    """Queue the skeleton summary and connectivity changes of each row and
+    apply them once per statement, aggregated per skeleton. This makes joins,
+    splits and reroots of large skeletons update each summary row only once.
+    """
+
+    dependencies = [
+        ('catmaid', '0026_add_stats_summary_table'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward)
+    ]
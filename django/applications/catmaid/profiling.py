@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+
+from contextlib import contextmanager
+from time import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, transaction, DatabaseError
+from django.db.backends.utils import CursorWrapper
+
+
+# Upper bounds of the histogram buckets of the SQL time (in ms) and the number
+# of queries of requests.
+SQL_TIME_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+        10000, float('inf'))
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf'))
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|%s")
+_whitespace = re.compile(r'\s+')
+_lists = re.compile(r'\?(?:\s*,\s*\?)+')
+_rows = re.compile(r'(\([^()]*\))(?:\s*,\s*\1)+')
+_quoted = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+_explainable = re.compile(r'^\s*(SELECT|WITH)\b', re.IGNORECASE)
+# Further statements, data modifying CTEs, row locks and sequence changes,
+# which can't be executed again without side effects.
+_side_effects = re.compile(r';\s*\S|\b(INSERT|UPDATE|DELETE|TRUNCATE|'
+        r'nextval|setval|pg_advisory_\w+)\b|\bFOR\s+(KEY\s+)?SHARE\b',
+        re.IGNORECASE)
+
+
+def normalize_sql(sql):
+    """Return the passed in SQL statement with all parameters and literals
+    replaced by '?' and lists of them collapsed. Statements that only differ
+    in their parameters have the same normalized text.
+    """
+    sql = _literals.sub('?', sql)
+    sql = _whitespace.sub(' ', sql).strip()
+    sql = _lists.sub('?, ...', sql)
+    return _rows.sub(r'\1, ...', sql)
+
+
+class QueryProfile(object):
+    """Collects the time and the number of returned rows of SQL statements,
+    grouped by their normalized text. The slowest execution of each statement
+    is remembered, so that it can be explained later.
+    """
+
+    def __init__(self):
+        self.n_queries = 0
+        self.time = 0.0
+        self.statements = {}
+
+    def add(self, sql, params, duration, rows):
+        self.n_queries += 1
+        self.time += duration
+        key = normalize_sql(sql)
+        statement = self.statements.get(key)
+        if statement is None:
+            statement = self.statements[key] = {
+                'count': 0,
+                'time': 0.0,
+                'max_time': 0.0,
+                'rows': 0,
+            }
+        statement['count'] += 1
+        statement['time'] += duration
+        if rows > 0:
+            statement['rows'] += rows
+        if duration >= statement['max_time']:
+            statement['max_time'] = duration
+            statement['slowest'] = (sql, params)
+
+    def slowest(self, n):
+        """Return the normalized text and the slowest execution of the <n>
+        statements with the longest single execution time.
+        """
+        statements = sorted(self.statements.items(),
+                key=lambda s: s[1]['max_time'], reverse=True)
+        return [(key, s['slowest']) for key, s in statements[:n]]
+
+    def as_json(self):
+        statements = [{
+            'sql': key,
+            'count': s['count'],
+            'time': s['time'],
+            'max_time': s['max_time'],
+            'rows': s['rows'],
+        } for key, s in self.statements.items()]
+        statements.sort(key=lambda s: s['time'], reverse=True)
+        return {
+            'n_queries': self.n_queries,
+            'time': self.time,
+            'statements': statements,
+        }
+
+
+class QueryCounter(object):
+    """Counts SQL statements and their total time, which is cheap enough to
+    be done for every request.
+    """
+
+    def __init__(self):
+        self.n_queries = 0
+        self.time = 0.0
+
+    def add(self, sql, params, duration, rows):
+        self.n_queries += 1
+        self.time += duration
+
+
+class ProfilingCursorWrapper(CursorWrapper):
+    """A cursor that adds each executed statement to a profile.
+    """
+
+    def __init__(self, cursor, db, profile):
+        super(ProfilingCursorWrapper, self).__init__(cursor, db)
+        self.profile = profile
+
+    def execute(self, sql, params=None):
+        start = time()
+        try:
+            return super(ProfilingCursorWrapper, self).execute(sql, params)
+        finally:
+            self.profile.add(sql, params, time() - start, self.cursor.rowcount)
+
+    def executemany(self, sql, param_list):
+        start = time()
+        try:
+            return super(ProfilingCursorWrapper, self).executemany(sql, param_list)
+        finally:
+            self.profile.add(sql, None, time() - start, self.cursor.rowcount)
+
+
+@contextmanager
+def profile_queries(profile):
+    """Add all statements that are executed with cursors of any database
+    connection of the current thread to the passed in profile. The cursors
+    Django creates are wrapped, which keeps its query logging intact and
+    allows nested profiles.
+    """
+    installed = []
+    for db in connections.all():
+        for name in ('make_cursor', 'make_debug_cursor'):
+            make_cursor = getattr(db, name)
+            def wrap_cursor(cursor, db=db, make_cursor=make_cursor):
+                return ProfilingCursorWrapper(make_cursor(cursor), db, profile)
+            installed.append((db, name, db.__dict__.get(name)))
+            setattr(db, name, wrap_cursor)
+    try:
+        yield profile
+    finally:
+        for db, name, previous in reversed(installed):
+            if previous:
+                setattr(db, name, previous)
+            else:
+                delattr(db, name)
+
+
+def is_explainable(sql):
+    """Return whether the passed in SQL is a single SELECT statement, which
+    can be executed again without side effects. String literals and quoted
+    identifiers are ignored.
+    """
+    unquoted = _quoted.sub("''", sql)
+    return bool(_explainable.match(unquoted)) and \
+            not _side_effects.search(unquoted)
+
+
+def explain(sql, params, using='default'):
+    """Return the plan of a SELECT statement along with its actual run time
+    and buffer usage. The statement is executed again for this, in a
+    transaction or savepoint that is rolled back. Other statements, including
+    multiple statements in one string and SELECTs that lock or modify rows,
+    aren't explained and None is returned for them.
+    """
+    if not is_explainable(sql):
+        return None
+    try:
+        with transaction.atomic(using=using):
+            cursor = connections[using].cursor()
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            transaction.set_rollback(True, using=using)
+    except DatabaseError as e:
+        plan = 'Could not explain statement: %s' % e
+    return plan
+
+
+def get_sql_histogram_cache():
+    cache_name = getattr(settings, 'PROFILING_SQL_HISTOGRAM_CACHE', None)
+    return caches[cache_name] if cache_name else None
+
+
+def _bucket(value, bounds):
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            return i
+
+
+def record_sql_histogram(view_name, profile):
+    """Add the SQL time and query count of a profiled request to the
+    histograms of its view in the cache configured as
+    PROFILING_SQL_HISTOGRAM_CACHE and return the updated histograms. Per
+    statement totals are aggregated as well. Updates from concurrent requests
+    can get lost, which is acceptable for profiling.
+    """
+    cache = get_sql_histogram_cache()
+    if cache is None:
+        return None
+    key = 'sql-histogram:%s' % view_name
+    histogram = cache.get(key) or {
+        'n_requests': 0,
+        'time_buckets': SQL_TIME_BUCKETS[:-1],
+        'time': [0] * len(SQL_TIME_BUCKETS),
+        'query_count_buckets': QUERY_COUNT_BUCKETS[:-1],
+        'query_count': [0] * len(QUERY_COUNT_BUCKETS),
+        'statements': {},
+    }
+    histogram['n_requests'] += 1
+    histogram['time'][_bucket(profile.time * 1000, SQL_TIME_BUCKETS)] += 1
+    histogram['query_count'][_bucket(profile.n_queries, QUERY_COUNT_BUCKETS)] += 1
+    for key_sql, s in profile.statements.items():
+        total = histogram['statements'].setdefault(key_sql, {
+            'count': 0,
+            'time': 0.0,
+            'max_time': 0.0,
+            'rows': 0,
+        })
+        total['count'] += s['count']
+        total['time'] += s['time']
+        total['max_time'] = max(total['max_time'], s['max_time'])
+        total['rows'] += s['rows']
+    cache.set(key, histogram, None)
+    return histogram
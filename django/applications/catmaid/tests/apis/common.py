@@ -8,6 +8,8 @@ from django.test.client import Client
 from guardian.shortcuts import assign_perm
 from guardian.management import create_anonymous_user
 
+from catmaid.control.circles import clear_synapse_graph_cache
+from catmaid.control.common import clear_id_map_caches
 from catmaid.models import Project, Treenode, User
 from catmaid.tests.common import init_consistent_data
 
@@ -47,6 +49,10 @@ class CatmaidApiTestCase(TestCase):
         permissions to modify an existing test project.
         """
         self.client = Client()
+        # Cached relation and class IDs and synapse graphs can be outdated
+        # after a rollback
+        clear_id_map_caches()
+        clear_synapse_graph_cache()
 
 
     def fake_authentication(self, username='test2', password='test', add_default_permissions=False):
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import re
+
+from django.test.utils import override_settings
+
+from .common import CatmaidApiTestCase
+
+
+class MetricsApiTests(CatmaidApiTestCase):
+    @override_settings(METRICS_USERS=('test2',))
+    def test_request_metrics(self):
+        self.fake_authentication()
+        response = self.client.get('/%d/stats/nodecount' % self.test_project_id)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode('utf-8')
+        self.assertTrue(re.search(r'^catmaid_requests_total\{view="[^"]*'
+                r'stats_nodecount",status="200"\} [1-9]', content, re.MULTILINE))
+        self.assertTrue(re.search(r'^catmaid_request_duration_seconds_count\{'
+                r'view="[^"]*stats_nodecount"\} [1-9]', content, re.MULTILINE))
+        self.assertTrue(re.search(r'^catmaid_request_sql_queries_total\{'
+                r'view="[^"]*stats_nodecount"\} [1-9]', content, re.MULTILINE))
+        self.assertIn('# TYPE catmaid_response_size_bytes histogram', content)
+
+    def test_metrics_access(self):
+        # Requests from localhost, e.g. through a proxy, need permissions, too
+        response = self.client.get('/metrics', REMOTE_ADDR='127.0.0.1')
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual('PermissionError', parsed_response['type'])
+
+        self.fake_authentication()
+        response = self.client.get('/metrics')
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual('PermissionError', parsed_response['type'])
+
+        self.fake_authentication('admin')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
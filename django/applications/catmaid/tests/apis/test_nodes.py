@@ -4,8 +4,11 @@ from __future__ import unicode_literals
 import json
 import six
 
+from django.core.cache import caches
 from django.db import connection
+from django.test.utils import override_settings
 
+from catmaid.control import columnar
 from catmaid.models import Connector, Treenode
 from catmaid.state import make_nocheck_state
 
@@ -489,3 +492,83 @@ class NodesApiTests(CatmaidApiTestCase):
         self.assertEqual({}, parsed_response[2])
         self.assertEqual(False, parsed_response[3])
         self.assertEqual(expected_rel_response, parsed_response[4])
+
+
+    @override_settings(NODE_LIST_CACHE='default', NODE_LIST_CACHE_GRID=(1000, 1000, 100),
+            CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_node_list_cache(self):
+        self.fake_authentication()
+        caches['default'].clear()
+
+        query = {
+            'z1': 0,
+            'top': 4625,
+            'left': 2860,
+            'right': 12625,
+            'bottom': 8075,
+            'z2': 9,
+        }
+        response = self.client.post('/%d/node/list' % self.test_project_id, query)
+        self.assertEqual(response.status_code, 200)
+        first_response = json.loads(response.content.decode('utf-8'))
+
+        # The same view should be answered from the cache
+        response = self.client.post('/%d/node/list' % self.test_project_id, query)
+        self.assertEqual(response.status_code, 200)
+        second_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(first_response, second_response)
+
+        # A slightly different view in the same grid cells is queried with its
+        # own bounding box, it doesn't get the nodes of the first one.
+        query['right'] = 3000
+        response = self.client.post('/%d/node/list' % self.test_project_id, query)
+        self.assertEqual(response.status_code, 200)
+        third_response = json.loads(response.content.decode('utf-8'))
+        self.assertLess(len(third_response[0]), len(first_response[0]))
+
+        response = self.client.get('/%d/node/list/cache-stats' % self.test_project_id)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual({'hits': 1, 'misses': 2}, parsed_response)
+
+
+    def test_node_list_binary(self):
+        self.fake_authentication()
+
+        query = {
+            'z1': 0,
+            'top': 4625,
+            'left': 2860,
+            'right': 12625,
+            'bottom': 8075,
+            'z2': 9,
+        }
+        response = self.client.post('/%d/node/list' % self.test_project_id, query)
+        self.assertEqual(response.status_code, 200)
+        treenodes, connectors, labels, limit_reached, relation_map = \
+                json.loads(response.content.decode('utf-8'))
+
+        query['format'] = 'binary'
+        response = self.client.post('/%d/node/list' % self.test_project_id, query)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], columnar.CONTENT_TYPE)
+        result = columnar.decode(response.content)
+
+        binary_treenodes = result['tables']['treenodes']
+        six.assertCountEqual(self, [t[0] for t in treenodes],
+                binary_treenodes['id'].tolist())
+        six.assertCountEqual(self, [-1 if t[1] is None else t[1] for t in treenodes],
+                binary_treenodes['parent_id'].tolist())
+        six.assertCountEqual(self, [t[7] for t in treenodes],
+                binary_treenodes['skeleton_id'].tolist())
+        binary_connectors = result['tables']['connectors']
+        six.assertCountEqual(self, [c[0] for c in connectors],
+                binary_connectors['id'].tolist())
+        binary_links = result['tables']['connector_links']
+        six.assertCountEqual(self, [(c[0], l[0], l[1]) for c in connectors for l in c[7]],
+                zip(binary_links['connector_id'].tolist(),
+                    binary_links['treenode_id'].tolist(),
+                    binary_links['relation_id'].tolist()))
+        self.assertEqual(limit_reached, result['data']['node_limit_reached'])
+        self.assertEqual(relation_map, result['data']['relation_map'])
@@ -5,19 +5,23 @@ import json
 import re
 import six
 import platform
+import zipfile
 
+from django.db import connection
 from django.shortcuts import get_object_or_404
 from guardian.shortcuts import assign_perm
 
 from catmaid.models import ClassInstance, ClassInstanceClassInstance
 from catmaid.models import Log, Review, Treenode, TreenodeConnector
 from catmaid.models import ReviewerWhitelist
+from catmaid.control.skeleton import DOWNSTREAM_NODES, _reroot_skeleton
+from catmaid.state import make_nocheck_state
 
 from .common import CatmaidApiTestCase
 
 from unittest import skipIf
 
-from six import StringIO
+from six import BytesIO, StringIO
 
 # Some skeleton back-end functionality is not available if PyPy is used. This
 # variable is used to skip the respective tests (which otherwise would fail).
@@ -183,6 +187,38 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.assertEqual(expected_result, parsed_response)
 
 
+    def test_split_skeleton_links_and_reviews(self):
+        self.fake_authentication()
+
+        old_skeleton_id = 235
+        downstream_ids = [279]
+        while True:
+            children = list(Treenode.objects.filter(parent_id__in=downstream_ids)
+                    .exclude(id__in=downstream_ids).values_list('id', flat=True))
+            if not children:
+                break
+            downstream_ids.extend(children)
+
+        response = self.client.post(
+            '/%d/skeleton/split' % (self.test_project_id,),
+            {'treenode_id': 279, 'upstream_annotation_map': '{}', 'downstream_annotation_map': '{}'})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        new_skeleton_id = parsed_response['new_skeleton_id']
+
+        six.assertCountEqual(self, downstream_ids, Treenode.objects.filter(
+                skeleton_id=new_skeleton_id).values_list('id', flat=True))
+        self.assertTrue(Treenode.objects.filter(
+                skeleton_id=old_skeleton_id).exists())
+
+        # Links and reviews have the skeleton ID of their treenode
+        for model in (TreenodeConnector, Review):
+            for skeleton_id in (old_skeleton_id, new_skeleton_id):
+                self.assertFalse(model.objects.filter(skeleton_id=skeleton_id)
+                        .exclude(treenode__skeleton_id=skeleton_id).exists())
+        self.assertTrue(TreenodeConnector.objects.filter(
+                skeleton_id=new_skeleton_id).exists())
+
     def test_split_skeleton_annotations(self):
         self.fake_authentication()
 
@@ -771,6 +807,8 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.fake_authentication()
 
         new_root = 407
+        confidences = dict(Treenode.objects.filter(id__in=(405, 407))
+                .values_list('id', 'confidence'))
 
         count_logs = lambda: Log.objects.all().count()
         log_count = count_logs()
@@ -794,6 +832,136 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         assertHasParent(377, 405)
         assertHasParent(407, None)
 
+        # Edge confidences move along with the reversed edges, the new root
+        # has maximum confidence.
+        self.assertEqual(confidences[407],
+                Treenode.objects.get(id=405).confidence)
+        self.assertEqual(5, Treenode.objects.get(id=407).confidence)
+
+
+    def test_reroot_skeleton_with_cycle(self):
+        # Link the root to a leaf, so that parent links form a cycle
+        root = Treenode.objects.get(skeleton_id=373, parent=None)
+        cursor = connection.cursor()
+        cursor.execute('''
+            UPDATE treenode SET parent_id = 407 WHERE id = %s
+        ''', (root.id,))
+        parents = dict(Treenode.objects.filter(skeleton_id=373)
+                .values_list('id', 'parent_id'))
+
+        self.assertRaises(Exception, _reroot_skeleton, 405,
+                self.test_project_id)
+        self.assertEqual(parents, dict(Treenode.objects.filter(skeleton_id=373)
+                .values_list('id', 'parent_id')))
+
+        # Collecting downstream nodes ends as well
+        cursor.execute(DOWNSTREAM_NODES + '''
+            SELECT count(*) FROM downstream
+        ''', {'treenode_id': 405})
+        self.assertEqual(len(parents), cursor.fetchone()[0])
+
+
+    def assertSkeletonSummaryIsConsistent(self):
+        """Compare the skeleton summary tables with summaries computed from
+        treenode and review.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+            WITH recomputed AS (
+                SELECT t.skeleton_id, t.project_id, count(*)::integer,
+                    round(COALESCE(sum(sqrt(
+                        (t.location_x::double precision - p.location_x) ^ 2 +
+                        (t.location_y::double precision - p.location_y) ^ 2 +
+                        (t.location_z::double precision - p.location_z) ^ 2)), 0)::numeric, 3),
+                    max(CASE WHEN t.parent_id IS NULL THEN t.id END),
+                    (SELECT count(DISTINCT r.treenode_id)::integer FROM review r
+                     WHERE r.skeleton_id = t.skeleton_id)
+                FROM treenode t
+                LEFT JOIN treenode p
+                    ON p.id = t.parent_id
+                GROUP BY t.skeleton_id, t.project_id
+            ), materialized AS (
+                SELECT skeleton_id, project_id, num_nodes,
+                    round(cable_length::numeric, 3), root_node_id,
+                    num_reviewed_nodes
+                FROM catmaid_skeleton_summary
+            )
+            (SELECT * FROM recomputed EXCEPT SELECT * FROM materialized)
+            UNION ALL
+            (SELECT * FROM materialized EXCEPT SELECT * FROM recomputed)
+        """)
+        self.assertEqual([], cursor.fetchall())
+
+        cursor.execute("""
+            WITH recomputed AS (
+                SELECT skeleton_id, reviewer_id, project_id,
+                    count(DISTINCT treenode_id)::integer
+                FROM review
+                GROUP BY skeleton_id, reviewer_id, project_id
+            ), materialized AS (
+                SELECT skeleton_id, reviewer_id, project_id, num_reviewed_nodes
+                FROM catmaid_skeleton_review_summary
+            )
+            (SELECT * FROM recomputed EXCEPT SELECT * FROM materialized)
+            UNION ALL
+            (SELECT * FROM materialized EXCEPT SELECT * FROM recomputed)
+        """)
+        self.assertEqual([], cursor.fetchall())
+
+
+    def test_skeleton_summary_tables(self):
+        self.fake_authentication()
+        self.assertSkeletonSummaryIsConsistent()
+
+        response = self.client.post(
+                '/%d/node/%d/reviewed' % (self.test_project_id, 253))
+        self.assertEqual(response.status_code, 200)
+        self.assertSkeletonSummaryIsConsistent()
+
+        response = self.client.post(
+                '/%d/skeletons/review-status' % self.test_project_id, {
+                    'skeleton_ids[0]': 235,
+                    'user_ids[0]': self.test_user_id
+                })
+        self.assertEqual(response.status_code, 200)
+        self.assertJSONEqual(response.content.decode('utf-8'), {'235': [28, 1]})
+
+        response = self.client.post(
+            '/%d/skeleton/split' % (self.test_project_id,),
+            {'treenode_id': 279, 'upstream_annotation_map': '{}', 'downstream_annotation_map': '{}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertSkeletonSummaryIsConsistent()
+
+        response = self.client.post('/%d/treenode/create' % self.test_project_id, {
+            'x': 5,
+            'y': 10,
+            'z': 15,
+            'confidence': 5,
+            'parent_id': 237,
+            'radius': 2})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        new_treenode_id = parsed_response['treenode_id']
+        self.assertSkeletonSummaryIsConsistent()
+
+        response = self.client.post(
+                '/%d/skeleton/reroot' % self.test_project_id,
+                {'treenode_id': 407})
+        self.assertEqual(response.status_code, 200)
+        self.assertSkeletonSummaryIsConsistent()
+
+        response = self.client.post(
+                '/%d/treenode/delete' % self.test_project_id,
+                {'treenode_id': new_treenode_id, 'state': make_nocheck_state()})
+        self.assertEqual(response.status_code, 200)
+        self.assertSkeletonSummaryIsConsistent()
+
+        response = self.client.get(
+                '/%d/skeleton/%d/node_count' % (self.test_project_id, 373))
+        self.assertEqual(response.status_code, 200)
+        self.assertJSONEqual(response.content.decode('utf-8'),
+                {'count': 5, 'skeleton_id': 373})
+
 
     def test_review_status(self):
         self.fake_authentication()
@@ -971,6 +1139,42 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.compare_swc_data(response.content.decode('utf-8'), swc_output_for_skeleton_235)
 
 
+    def test_swc_file_streamed(self):
+        self.fake_authentication()
+        url = '/%d/skeleton/235/swc' % (self.test_project_id,)
+        for linearize_ids in ('false', 'true'):
+            response = self.client.get(url, {'linearize_ids': linearize_ids})
+            self.assertEqual(response.status_code, 200)
+            expected_swc = response.content.decode('utf-8')
+
+            response = self.client.get(url, {'linearize_ids': linearize_ids,
+                    'stream': 'true'})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            swc = b''.join(response.streaming_content).decode('utf-8')
+            self.assertEqual(swc, expected_swc)
+
+
+    def test_swc_zip_archive(self):
+        self.fake_authentication()
+        url = '/%d/skeletons/swc' % (self.test_project_id,)
+        response = self.client.post(url, {'skeleton_ids': [373, 235]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        archive = zipfile.ZipFile(BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(archive.namelist(), ['373.swc', '235.swc'])
+        for skeleton_id in (373, 235):
+            expected_response = self.client.get('/%d/skeleton/%d/swc' % (
+                    self.test_project_id, skeleton_id))
+            self.assertEqual(archive.read('%d.swc' % skeleton_id).decode('utf-8'),
+                    expected_response.content.decode('utf-8'))
+
+        response = self.client.post(url, {'skeleton_ids': [235, 999999]})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertIn('error', parsed_response)
+
+
     def assert_skeletons_by_node_labels(self, label_ids, expected_response):
         self.fake_authentication()
         url = '/{}/skeletons/node-labels'.format(self.test_project_id)
@@ -1008,3 +1212,137 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         expected_result = [[351, [1, 235]], [2342, [373]]]
         self.assert_skeletons_by_node_labels([2342, 351], expected_result)
 
+
+
+    def test_measure_skeletons(self):
+        self.fake_authentication()
+        response = self.client.post(
+                '/%d/skeletons/measure' % self.test_project_id, {
+                    'skeleton_ids[0]': 235,
+                    'skeleton_ids[1]': 373,
+                })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        parsed_response = {r[0]: r for r in parsed_response}
+        # Skeleton ID, raw cable, smooth cable, inputs, outputs, nodes,
+        # branches, ends, principal branch cable
+        expected_result = {
+            235: [235, 11243, 10640, 0, 3, 28, 2, 4, 7391.129118],
+            373: [373, 2345, 2324, 2, 0, 5, 0, 2, 1705.858546],
+        }
+        self.assertEqual(sorted(expected_result.keys()),
+                sorted(parsed_response.keys()))
+        for skid, expected in six.iteritems(expected_result):
+            result = parsed_response[skid]
+            self.assertEqual(expected[:8], result[:8])
+            self.assertAlmostEqual(expected[8], result[8], places=4)
+
+
+    def test_compact_skeletons(self):
+        self.fake_authentication()
+        skeleton_ids = [373, 235]
+        response = self.client.post(
+                '/%d/skeletons/compact-detail' % self.test_project_id, {
+                    'skeleton_ids': skeleton_ids,
+                    'with_connectors': 'true',
+                    'with_tags': 'true',
+                })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        six.assertCountEqual(self, ['373', '235'], parsed_response.keys())
+
+        # Every skeleton should be the same as if it was requested individually
+        for skeleton_id in skeleton_ids:
+            response = self.client.get(
+                    '/%d/skeletons/%d/compact-detail' % (self.test_project_id, skeleton_id), {
+                        'with_connectors': 'true',
+                        'with_tags': 'true',
+                    })
+            self.assertEqual(response.status_code, 200)
+            expected_result = json.loads(response.content.decode('utf-8'))
+            result = parsed_response[str(skeleton_id)]
+            six.assertCountEqual(self, expected_result[0], result[0])
+            six.assertCountEqual(self, expected_result[1], result[1])
+            self.assertEqual(expected_result[2], result[2])
+
+
+    def test_compact_skeletons_nonexistent(self):
+        self.fake_authentication()
+        response = self.client.post(
+                '/%d/skeletons/compact-detail' % self.test_project_id, {
+                    'skeleton_ids': [373, 999999],
+                })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertIn('error', parsed_response)
+
+
+    def assertSkeletonConnectivityIsConsistent(self):
+        """Compare the materialized skeleton connectivity with the one computed
+        from treenode_connector.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+            WITH recomputed AS (
+                SELECT tc1.project_id, tc1.skeleton_id, tc1.relation_id,
+                    tc2.skeleton_id, tc2.relation_id,
+                    LEAST(tc1.confidence, tc2.confidence), count(*)::integer
+                FROM treenode_connector tc1
+                JOIN treenode_connector tc2
+                    ON tc1.connector_id = tc2.connector_id
+                    AND tc1.id <> tc2.id
+                GROUP BY 1, 2, 3, 4, 5, 6
+            ), materialized AS (
+                SELECT project_id, skeleton_a, relation_a, skeleton_b,
+                    relation_b, confidence, count
+                FROM catmaid_skeleton_connectivity
+            )
+            (SELECT * FROM recomputed EXCEPT SELECT * FROM materialized)
+            UNION ALL
+            (SELECT * FROM materialized EXCEPT SELECT * FROM recomputed)
+        """)
+        self.assertEqual([], cursor.fetchall())
+
+
+    def test_skeleton_connectivity_table(self):
+        self.fake_authentication()
+        self.assertSkeletonConnectivityIsConsistent()
+
+        # Split off the part of skeleton 235 with links to connectors 356 and
+        # 421, which are shared with skeletons 361 and 373.
+        response = self.client.post(
+            '/%d/skeleton/split' % (self.test_project_id,),
+            {'treenode_id': 279, 'upstream_annotation_map': '{}', 'downstream_annotation_map': '{}'})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        new_skeleton_id = parsed_response['new_skeleton_id']
+        self.assertSkeletonConnectivityIsConsistent()
+
+        response = self.client.post(
+                '/%d/skeletons/connectivity' % self.test_project_id, {
+                    'source_skeleton_ids[0]': new_skeleton_id,
+                    'boolean_op': 'OR'
+                })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        six.assertCountEqual(self, ['361', '373'], parsed_response['outgoing'].keys())
+
+        # Add a link to another connector and remove it again
+        response = self.client.post(
+                '/%d/link/create' % self.test_project_id, {
+                    'from_id': 237,
+                    'to_id': 432,
+                    'link_type': 'postsynaptic_to',
+                    'state': make_nocheck_state()
+                })
+        self.assertEqual(response.status_code, 200)
+        self.assertSkeletonConnectivityIsConsistent()
+
+        response = self.client.post(
+                '/%d/link/delete' % self.test_project_id, {
+                    'connector_id': 432,
+                    'treenode_id': 237,
+                    'state': make_nocheck_state()
+                })
+        self.assertEqual(response.status_code, 200)
+        self.assertSkeletonConnectivityIsConsistent()
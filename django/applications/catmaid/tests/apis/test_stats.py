@@ -3,6 +3,11 @@ from __future__ import unicode_literals
 
 import json
 
+from django.db import connection
+
+from catmaid.control.stats import rebuild_stats_summary, update_stats_summary
+from catmaid.models import Treenode, User
+
 from .common import CatmaidApiTestCase
 
 
@@ -37,3 +42,165 @@ class StatsApiTests(CatmaidApiTestCase):
         }
         parsed_response = json.loads(response.content.decode('utf-8'))
         self.assertEqual(expected_result, parsed_response)
+
+
+    def test_stats_summary_update(self):
+        """Statistics don't change when recent contributions are added to the
+        contribution summary or when it is rebuilt.
+        """
+        self.fake_authentication()
+
+        def get_stats():
+            stats = []
+            for url in ('nodecount', 'editor'):
+                response = self.client.get('/%d/stats/%s' % (self.test_project_id, url))
+                self.assertEqual(response.status_code, 200)
+                parsed_response = json.loads(response.content.decode('utf-8'))
+                stats.append(sorted(zip(parsed_response['users'],
+                        parsed_response['values'])))
+            response = self.client.get('/%d/stats/user-history' % (self.test_project_id,), {
+                'start_date': '2011-09-01',
+                'end_date': '2011-12-31',
+                'time_zone': 'UTC',
+            })
+            self.assertEqual(response.status_code, 200)
+            stats.append(json.loads(response.content.decode('utf-8')))
+            return stats
+
+        # Without an update, all contributions are read directly
+        expected_stats = get_stats()
+        history = expected_stats[2]['stats_table']
+        self.assertTrue(any('new_treenodes' in day for user in history.values()
+                for day in user.values()))
+        self.assertTrue(any('new_connectors' in day for user in history.values()
+                for day in user.values()))
+
+        cursor = connection.cursor()
+        self.assertLess(0, update_stats_summary(cursor))
+        cursor.execute('''
+            SELECT sum(n_treenodes) FROM catmaid_stats_summary
+            WHERE project_id = %s
+        ''', (self.test_project_id,))
+        self.assertEqual(Treenode.objects.filter(project=self.test_project_id).count(),
+                cursor.fetchone()[0])
+        self.assertEqual(expected_stats, get_stats())
+
+        # A second update has no changes to add
+        self.assertEqual(0, update_stats_summary(cursor))
+
+        rebuild_stats_summary(cursor, self.test_project_id)
+        self.assertEqual(expected_stats, get_stats())
+
+
+    def test_stats_user_history_time_zone(self):
+        """Contributions are reported for the day they were made on, also in
+        time zones whose offset to UTC isn't a whole number of hours.
+        """
+        self.fake_authentication()
+        parent = Treenode.objects.filter(project=self.test_project_id).first()
+        node = Treenode.objects.create(project_id=self.test_project_id,
+                user_id=self.test_user_id, editor_id=self.test_user_id,
+                skeleton_id=parent.skeleton_id, parent=parent,
+                location_x=parent.location_x + 10, location_y=parent.location_y,
+                location_z=parent.location_z, radius=-1)
+        # This is 00:10 on October 11 in India (UTC+5:30)
+        cursor = connection.cursor()
+        cursor.execute('''
+            UPDATE treenode SET creation_time = '2016-10-10 18:40:00+00'
+            WHERE id = %s
+        ''', (node.id,))
+
+        def get_history():
+            response = self.client.get('/%d/stats/user-history' % (self.test_project_id,), {
+                'start_date': '2016-10-10',
+                'end_date': '2016-10-11',
+                'time_zone': 'Asia/Kolkata',
+            })
+            self.assertEqual(response.status_code, 200)
+            parsed_response = json.loads(response.content.decode('utf-8'))
+            return parsed_response['stats_table'][str(self.test_user_id)]
+
+        # Both for outdated and for updated summary entries
+        for update in (False, True):
+            if update:
+                update_stats_summary(cursor)
+            history = get_history()
+            self.assertEqual({}, history['20161010'])
+            self.assertEqual(10, history['20161011'].get('new_treenodes'))
+
+
+    def test_stats_summary_changes(self):
+        """Node counts and edits are the ones of existing nodes, also after
+        nodes were edited repeatedly or deleted.
+        """
+        self.fake_authentication()
+        names = dict(User.objects.values_list('id', 'username'))
+        cursor = connection.cursor()
+
+        def get_stats(url):
+            response = self.client.get('/%d/stats/%s' % (self.test_project_id, url))
+            self.assertEqual(response.status_code, 200)
+            parsed_response = json.loads(response.content.decode('utf-8'))
+            return sorted(zip(parsed_response['users'], parsed_response['values']))
+
+        def get_expected_stats():
+            cursor.execute('''
+                SELECT user_id, count(*)
+                FROM treenode
+                WHERE project_id = %s
+                GROUP BY user_id
+            ''', (self.test_project_id,))
+            nodecount = sorted(('%s (%d)' % (names[uid], n), n)
+                    for uid, n in cursor.fetchall())
+            cursor.execute('''
+                SELECT editor_id, count(editor_id)
+                FROM treenode
+                WHERE project_id = %s
+                  AND editor_id <> user_id
+                GROUP BY editor_id
+            ''', (self.test_project_id,))
+            editor = sorted(('%s (%d)' % (names[uid], n), n)
+                    for uid, n in cursor.fetchall())
+            return nodecount, editor
+
+        def assertStatsAreCurrent():
+            nodecount, editor = get_expected_stats()
+            self.assertEqual(nodecount, get_stats('nodecount'))
+            self.assertEqual(editor, get_stats('editor'))
+
+        update_stats_summary(cursor)
+        assertStatsAreCurrent()
+
+        # Edit a node of another user twice
+        node = Treenode.objects.filter(project=self.test_project_id) \
+                .exclude(user=self.test_user_id).first()
+        for i in range(2):
+            cursor.execute('''
+                UPDATE treenode
+                SET editor_id = %s, edition_time = clock_timestamp(),
+                    location_x = location_x + 1
+                WHERE id = %s
+            ''', (self.test_user_id, node.id))
+            assertStatsAreCurrent()
+            update_stats_summary(cursor)
+            assertStatsAreCurrent()
+
+        # Delete a leaf node without links, labels and reviews
+        cursor.execute('''
+            DELETE FROM treenode
+            WHERE id = (
+                SELECT t.id FROM treenode t
+                WHERE t.project_id = %(project_id)s
+                  AND NOT EXISTS (SELECT 1 FROM treenode c WHERE c.parent_id = t.id)
+                  AND NOT EXISTS (SELECT 1 FROM treenode_connector tc
+                                  WHERE tc.treenode_id = t.id)
+                  AND NOT EXISTS (SELECT 1 FROM review r WHERE r.treenode_id = t.id)
+                  AND NOT EXISTS (SELECT 1 FROM treenode_class_instance tci
+                                  WHERE tci.treenode_id = t.id)
+                ORDER BY t.id
+                LIMIT 1)
+        ''', {'project_id': self.test_project_id})
+        self.assertEqual(1, cursor.rowcount)
+        assertStatsAreCurrent()
+        update_stats_summary(cursor)
+        assertStatsAreCurrent()
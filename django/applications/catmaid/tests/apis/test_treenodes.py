@@ -6,6 +6,7 @@ import six
 
 from django.shortcuts import get_object_or_404
 
+from catmaid.control import columnar
 from catmaid.control.common import get_relation_to_id_map, get_class_to_id_map
 from catmaid.models import ClassInstance, ClassInstanceClassInstance, Log
 from catmaid.models import Treenode, TreenodeClassInstance, TreenodeConnector
@@ -354,6 +355,27 @@ class TreenodesApiTests(CatmaidApiTestCase):
         six.assertCountEqual(self, parsed_response[1], expected_response[1])
         self.assertEqual(parsed_response[2], expected_response[2])
 
+    def test_compact_skeleton_binary(self):
+        self.fake_authentication()
+
+        skeleton_id = 373
+        response = self.client.get(
+                '/%d/skeletons/%d/compact-detail' % (self.test_project_id, skeleton_id),
+                {'with_connectors': 'true', 'with_tags': 'true', 'format': 'binary'})
+        self.assertEqual(response.status_code, 200)
+        result = columnar.decode(b''.join(response.streaming_content))
+
+        nodes = result['tables']['nodes']
+        six.assertCountEqual(self, [377, 403, 405, 407, 409], nodes['id'].tolist())
+        six.assertCountEqual(self, [-1, 377, 377, 405, 407], nodes['parent_id'].tolist())
+        connectors = result['tables']['connectors']
+        six.assertCountEqual(self, [(377, 356, 1), (409, 421, 1)],
+                zip(connectors['treenode_id'].tolist(),
+                    connectors['connector_id'].tolist(),
+                    connectors['relation'].tolist()))
+        self.assertEqual({"uncertain end": [403]}, result['data']['tags'])
+
+
 
     def test_delete_root_treenode_with_children_failure(self):
         self.fake_authentication()
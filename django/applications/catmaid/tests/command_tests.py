@@ -1,12 +1,25 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from django.core import serializers
 from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
 from django.test.client import Client
 from django.utils.six import StringIO
 from guardian.shortcuts import assign_perm
-from catmaid.models import Class, ClassInstance, Project, User, Treenode
+from catmaid.management.commands.catmaid_export_data import Exporter
+from catmaid.management.commands.catmaid_rebuild_edge_table import \
+        EDGE_TABLES, MAX_ID, EdgeTableRebuilder, contiguous_ranges, \
+        delete_obsolete_rows, repair_rows
+from catmaid.models import Class, ClassInstance, Connector, Project, \
+        Relation, Review, User, Treenode, TreenodeConnector
 
 
 class PruneSkeletonsTest(TestCase):
@@ -42,6 +55,381 @@ class PruneSkeletonsTest(TestCase):
         call_command('catmaid_prune_skeletons', project_id=[p.project.id], stdout=out)
         self.assertIn('Deleted 4 nodes in project "%s"' % p.project.id, out.getvalue())
 
+class BulkImportTest(TestCase):
+    """
+    Test the bulk mode of CATMAID's import management command.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="test", password="test",
+                                        is_superuser=True)
+
+    def test_bulk_import(self):
+        """
+        Export a skeleton to a file and import it into a new project. All
+        objects should be moved to the new project and have edges.
+        """
+        p = TestProject(self.user)
+        skid = p.create_neuron()
+        root = p.create_node(0, 0, 0, None, skid)
+        n1 = p.create_node(0, 0, 10, root.id, skid)
+        n2 = p.create_node(0, 0, 20, n1.id, skid)
+
+        fd, path = tempfile.mkstemp(suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                serializers.serialize('json', [p.class_map['skeleton'], skid,
+                        root, n1, n2], indent=2, stream=f)
+            target = Project.objects.create(title="Bulk import target")
+            call_command('catmaid_import_data', source=path,
+                    target=target.id, user=self.user.id, bulk=True)
+        finally:
+            os.remove(path)
+
+        imported_nodes = Treenode.objects.filter(project=target)
+        self.assertEqual(set([root.id, n1.id, n2.id]),
+                set(imported_nodes.values_list('id', flat=True)))
+        self.assertEqual(1, ClassInstance.objects.filter(project=target).count())
+        n2_imported = imported_nodes.get(id=n2.id)
+        self.assertEqual(n1.id, n2_imported.parent_id)
+        self.assertEqual(20, n2_imported.location_z)
+
+        # Edge tables are rebuilt for the target project
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT id FROM treenode_edge WHERE project_id = %s
+        ''', (target.id,))
+        self.assertEqual(set([root.id, n1.id, n2.id]),
+                set(r[0] for r in cursor.fetchall()))
+
+        # The source project lost the imported objects and its derived data
+        cursor.execute('''
+            SELECT count(*) FROM treenode_edge WHERE project_id = %s
+        ''', (p.project.id,))
+        self.assertEqual(0, cursor.fetchone()[0])
+        cursor.execute('''
+            SELECT project_id, num_nodes FROM catmaid_skeleton_summary
+            WHERE skeleton_id = %s
+        ''', (skid.id,))
+        self.assertEqual([(target.id, 3)], cursor.fetchall())
+
+    def test_bulk_import_derived_data(self):
+        """
+        Import two synaptically connected and reviewed skeletons with deferred
+        constraint checks and triggers. Their connectivity, review summaries
+        and contributions should be rebuilt and their reviews kept.
+        """
+        p = TestProject(self.user)
+        relations = [Relation.objects.create(user=self.user, project=p.project,
+                relation_name=name, uri='', description='')
+                for name in ('presynaptic_to', 'postsynaptic_to')]
+        pre_skid, post_skid = p.create_neuron(), p.create_neuron()
+        pre_root = p.create_node(0, 0, 0, None, pre_skid)
+        pre_node = p.create_node(0, 0, 10, pre_root.id, pre_skid)
+        post_root = p.create_node(10, 0, 0, None, post_skid)
+        connector = Connector.objects.create(user=self.user, editor=self.user,
+                project=p.project, location_x=5, location_y=0, location_z=10)
+        links = [TreenodeConnector.objects.create(user=self.user,
+                project=p.project, relation=relation, treenode=node,
+                connector=connector, skeleton_id=node.skeleton_id)
+                for relation, node in zip(relations, (pre_node, post_root))]
+        review = Review.objects.create(project=p.project, reviewer=self.user,
+                skeleton=pre_skid, treenode=pre_node)
+
+        fd, path = tempfile.mkstemp(suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                serializers.serialize('json', [p.class_map['skeleton']] +
+                        relations + [pre_skid, post_skid, pre_root, pre_node,
+                        post_root, connector] + links + [review],
+                        indent=2, stream=f)
+            target = Project.objects.create(title="Bulk import target")
+            call_command('catmaid_import_data', source=path,
+                    target=target.id, user=self.user.id, bulk=True)
+        finally:
+            os.remove(path)
+
+        self.assertEqual(2, TreenodeConnector.objects.filter(project=target).count())
+        self.assertTrue(Review.objects.filter(id=review.id, project=target).exists())
+
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT skeleton_a, skeleton_b, count
+            FROM catmaid_skeleton_connectivity
+            WHERE project_id = %s
+        ''', (target.id,))
+        self.assertEqual(sorted([(pre_skid.id, post_skid.id, 1),
+                (post_skid.id, pre_skid.id, 1)]), sorted(cursor.fetchall()))
+        cursor.execute('''
+            SELECT skeleton_id, reviewer_id, num_reviewed_nodes
+            FROM catmaid_skeleton_review_summary
+            WHERE project_id = %s
+        ''', (target.id,))
+        self.assertEqual([(pre_skid.id, self.user.id, 1)], cursor.fetchall())
+        cursor.execute('''
+            SELECT sum(n_treenodes), sum(n_reviewed_nodes)
+            FROM catmaid_stats_summary
+            WHERE project_id = %s
+        ''', (target.id,))
+        self.assertEqual((3, 1), cursor.fetchone())
+
+class StreamingExportTest(TestCase):
+    """
+    Test the streaming and columnar modes of CATMAID's export management
+    command.
+    """
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        self.project = Project.objects.get(pk=3)
+        self.user = User.objects.get(username='test0')
+        self.target_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.target_dir)
+
+    def create_exporter(self, **options):
+        options.update({
+            'export_treenodes': True,
+            'export_connectors': True,
+            'export_annotations': True,
+            'export_tags': True,
+            'required_annotations': None,
+        })
+        return Exporter(self.project, options)
+
+    def test_json_stream(self):
+        exporter = self.create_exporter()
+        exporter.target_file = os.path.join(self.target_dir, 'regular.json')
+        exporter.export()
+        streaming_exporter = self.create_exporter(stream=True, batch_size=5)
+        streaming_exporter.target_file = os.path.join(self.target_dir, 'streamed.json')
+        streaming_exporter.export()
+
+        def load(path):
+            with open(path, 'r') as f:
+                return sorted(json.load(f), key=lambda o: (o['model'], o['pk']))
+
+        expected = load(exporter.target_file)
+        self.assertTrue(len(expected) > 0)
+        self.assertEqual(expected, load(streaming_exporter.target_file))
+
+    def test_columnar_export_and_import(self):
+        exporter = self.create_exporter(columnar=True)
+        exporter.target_file = os.path.join(self.target_dir, 'export')
+        exporter.export()
+
+        with open(os.path.join(exporter.target_file, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        tables = dict((t['model'], t) for t in manifest['tables'])
+        self.assertIn('catmaid.treenode', tables)
+        path = os.path.join(exporter.target_file, tables['catmaid.treenode']['file'])
+        with gzip.open(path, 'rb') as f:
+            lines = f.read().decode('utf-8').splitlines()
+        n_treenodes = Treenode.objects.filter(project=self.project).count()
+        # One header line and one line per treenode
+        self.assertEqual(n_treenodes + 1, len(lines))
+        self.assertEqual(tables['catmaid.treenode']['columns'], lines[0].split(','))
+
+        # Importing the export moves all treenodes into the target project
+        target = Project.objects.create(title="Columnar import target")
+        call_command('catmaid_import_data', source=exporter.target_file,
+                target=target.id, user=self.user.id)
+        self.assertEqual(n_treenodes, Treenode.objects.filter(project=target).count())
+        self.assertEqual(0, Treenode.objects.filter(project=self.project).count())
+
+class EdgeTableRebuildTest(TestCase):
+    """
+    Test the online and incremental modes of CATMAID's edge table rebuild
+    management command.
+    """
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        self.project_id = 3
+
+    def get_edges(self):
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT id, project_id, ST_AsText(edge) FROM treenode_edge
+            UNION ALL
+            SELECT id, project_id, ST_AsText(edge) FROM treenode_connector_edge
+            UNION ALL
+            SELECT id, project_id, ST_AsText(geom) FROM connector_geom
+            ORDER BY 1
+        ''')
+        return cursor.fetchall()
+
+    def test_contiguous_ranges(self):
+        self.assertEqual([(0, 10), (11, 20), (21, 2**63 - 1)],
+                contiguous_ranges([10, 20]))
+
+    def test_incremental_repair(self):
+        expected_edges = self.get_edges()
+        cursor = connection.cursor()
+        cursor.execute('''
+            UPDATE treenode_edge SET edge = ST_MakeLine(
+                ST_MakePoint(0, 0, 0), ST_MakePoint(1, 1, 1))
+            WHERE id = (SELECT min(id) FROM treenode_edge
+                        WHERE project_id = %(project_id)s);
+            DELETE FROM treenode_edge
+            WHERE id = (SELECT max(id) FROM treenode_edge
+                        WHERE project_id = %(project_id)s);
+            DELETE FROM connector_geom
+            WHERE id = (SELECT min(id) FROM connector_geom
+                        WHERE project_id = %(project_id)s);
+            INSERT INTO treenode_connector_edge (id, project_id, edge)
+            VALUES (-1, %(project_id)s, ST_MakeLine(ST_MakePoint(0, 0, 0),
+                    ST_MakePoint(1, 1, 1)));
+        ''', {'project_id': self.project_id})
+        self.assertNotEqual(expected_edges, self.get_edges())
+
+        EdgeTableRebuilder([self.project_id], workers=1, batch_size=10).repair()
+        self.assertEqual(expected_edges, self.get_edges())
+
+    def test_online_rebuild(self):
+        expected_edges = self.get_edges()
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT indexname FROM pg_indexes
+            WHERE tablename = 'treenode_edge' ORDER BY indexname
+        ''')
+        expected_indices = cursor.fetchall()
+        cursor.execute('DELETE FROM treenode_edge')
+
+        EdgeTableRebuilder([self.project_id], workers=1, batch_size=10).rebuild_online()
+        self.assertEqual(expected_edges, self.get_edges())
+        cursor.execute('''
+            SELECT indexname FROM pg_indexes
+            WHERE tablename = 'treenode_edge' ORDER BY indexname
+        ''')
+        self.assertEqual(expected_indices, cursor.fetchall())
+
+    def test_online_rebuild_with_changes(self):
+        rebuilder = EdgeTableRebuilder([self.project_id], workers=1, batch_size=10)
+        build_batch = rebuilder.build_batch
+        cursor = connection.cursor()
+
+        def build_batch_and_trace(c, table, min_id, max_id):
+            # Move all nodes after each batch, the built rows are outdated
+            n_rows = build_batch(c, table, min_id, max_id)
+            cursor.execute('''
+                UPDATE treenode SET location_x = location_x + 1
+                WHERE project_id = %(project_id)s;
+                UPDATE connector SET location_y = location_y + 1
+                WHERE project_id = %(project_id)s;
+            ''', {'project_id': self.project_id})
+            return n_rows
+
+        rebuilder.build_batch = build_batch_and_trace
+        rebuilder.rebuild_online()
+
+        for table, geom_column, source_table in EDGE_TABLES:
+            self.assertEqual(0, delete_obsolete_rows(cursor, table,
+                    source_table, None, dryrun=True))
+            self.assertEqual(0, repair_rows(cursor, table, table, 0, MAX_ID,
+                    None, dryrun=True))
+        cursor.execute("SELECT to_regclass('edge_table_rebuild_log')")
+        self.assertEqual(None, cursor.fetchone()[0])
+
+class SyntheticDataTest(TestCase):
+    """
+    Test CATMAID's synthetic data generator management command.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="test", password="test",
+                                        is_superuser=True)
+
+    def test_generate_synthetic_data(self):
+        call_command('catmaid_generate_synthetic_data', user=self.user.id,
+                skeletons=10, nodes=20, connectors=3, annotations=5,
+                edit_fraction=0.5, batch_size=3)
+        project = Project.objects.get(title='Synthetic connectome')
+
+        params = {'project_id': project.id}
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT count(*), count(DISTINCT skeleton_id),
+                count(*) FILTER (WHERE parent_id IS NULL)
+            FROM treenode WHERE project_id = %(project_id)s
+        ''', params)
+        n_nodes, n_skeletons, n_roots = cursor.fetchone()
+        self.assertEqual(10, n_skeletons)
+        self.assertEqual(10, n_roots)
+
+        # Edge tables and skeleton summaries are rebuilt
+        cursor.execute('''
+            SELECT count(*) FROM treenode_edge
+            WHERE project_id = %(project_id)s
+        ''', params)
+        self.assertEqual(n_nodes, cursor.fetchone()[0])
+        cursor.execute('''
+            SELECT count(*), sum(num_nodes) FROM catmaid_skeleton_summary
+            WHERE project_id = %(project_id)s
+        ''', params)
+        self.assertEqual((10, n_nodes), cursor.fetchone())
+
+        # The skeleton connectivity counts all pairs of links of a connector
+        cursor.execute('''
+            SELECT count(*) FROM treenode_connector tc1
+            JOIN treenode_connector tc2
+                ON tc1.connector_id = tc2.connector_id AND tc1.id <> tc2.id
+            WHERE tc1.project_id = %(project_id)s
+        ''', params)
+        n_pairs = cursor.fetchone()[0]
+        self.assertLess(0, n_pairs)
+        cursor.execute('''
+            SELECT sum(count) FROM catmaid_skeleton_connectivity
+            WHERE project_id = %(project_id)s
+        ''', params)
+        self.assertEqual(n_pairs, cursor.fetchone()[0])
+
+        # Some nodes have been edited after their creation
+        cursor.execute('''
+            SELECT count(*) FROM treenode
+            WHERE project_id = %(project_id)s
+              AND edition_time > creation_time
+        ''', params)
+        self.assertLess(0, cursor.fetchone()[0])
+
+class SkeletonEditBenchmarkTest(TestCase):
+    """
+    Test CATMAID's skeleton edit benchmark management command.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="test", password="test",
+                                        is_superuser=True)
+
+    def test_benchmark_skeleton_edits(self):
+        """
+        Split, join and reroot the largest skeleton of a synthetic project.
+        All changes should be rolled back.
+        """
+        call_command('catmaid_generate_synthetic_data', user=self.user.id,
+                skeletons=3, nodes=50, connectors=5, annotations=0)
+        project = Project.objects.get(title='Synthetic connectome')
+
+        def summaries():
+            cursor = connection.cursor()
+            cursor.execute('''
+                SELECT skeleton_id, num_nodes, cable_length, root_node_id,
+                    num_reviewed_nodes
+                FROM catmaid_skeleton_summary
+                WHERE project_id = %(project_id)s
+                ORDER BY skeleton_id;
+            ''', {'project_id': project.id})
+            return cursor.fetchall()
+
+        before = summaries()
+        out = StringIO()
+        call_command('catmaid_benchmark_skeleton_edits', project_id=project.id,
+                repeat=1, stdout=out)
+        for operation in ('split', 'join', 'reroot'):
+            self.assertIn('%s: ' % operation, out.getvalue())
+        self.assertEqual(before, summaries())
+
 class TestProject():
     """
     Create a new project, assign brows and annotate permissions to the test
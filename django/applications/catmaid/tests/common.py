@@ -6,6 +6,8 @@ from django.test import TestCase
 from django.test.client import Client
 from catmaid.apps import get_system_user
 from catmaid.models import Project, User
+from catmaid.control.circles import clear_synapse_graph_cache
+from catmaid.control.common import clear_id_map_caches
 from catmaid.control.project import validate_project_setup
 
 
@@ -42,6 +44,10 @@ class CatmaidTestCase(TestCase):
 
     def setUp(self):
         self.client = Client()
+        # Cached relation and class IDs and synapse graphs can be outdated
+        # after a rollback
+        clear_id_map_caches()
+        clear_synapse_graph_cache()
 
     def fake_authentication(self):
         self.client.login(username='temporary', password='temporary')
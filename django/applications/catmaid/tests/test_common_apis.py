@@ -5,17 +5,20 @@ import json
 import six
 
 from django.contrib.auth.models import Permission
+from django.core.cache import caches
 from django.db import connection, transaction
 from django.http import HttpResponse
 from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
-from guardian.shortcuts import assign_perm
+from django.test.utils import override_settings
+from guardian.shortcuts import assign_perm, remove_perm
 from guardian.utils import get_anonymous_user
 from guardian.management import create_anonymous_user
 
+from catmaid.control.authentication import check_user_role
 from catmaid.control.project import validate_project_setup
 from catmaid.fields import Double3D, Integer3D
-from catmaid.models import Project, Stack, ProjectStack, StackMirror
+from catmaid.models import Project, Stack, ProjectStack, StackMirror, UserRole
 from catmaid.models import ClassInstance, Log
 from catmaid.models import Treenode, Connector, User
 from catmaid.models import TreenodeClassInstance, ClassInstanceClassInstance
@@ -566,6 +569,29 @@ class PermissionTests(TestCase):
             # currently not assigned any permissions
             self.assertJSONEqual(response.content.decode('utf-8'), [{},[]])
 
+    @override_settings(PERMISSION_CACHE='default', CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    })
+    def test_permission_cache(self):
+        caches['default'].clear()
+        anon_user = get_anonymous_user()
+        p = Project.objects.get(pk=self.test_project_id)
+
+        self.assertFalse(check_user_role(anon_user, p, UserRole.Browse))
+        # A cached result doesn't require any queries
+        with self.assertNumQueries(0):
+            self.assertFalse(check_user_role(anon_user, p.id, UserRole.Browse))
+
+        # Changing permissions invalidates the cache
+        assign_perm('can_browse', anon_user, p)
+        self.assertTrue(check_user_role(anon_user, p, UserRole.Browse))
+        self.assertFalse(check_user_role(anon_user, p, UserRole.Annotate))
+
+        remove_perm('can_browse', anon_user, p)
+        self.assertFalse(check_user_role(anon_user, p, UserRole.Browse))
+
     def test_can_browse_access(self):
         # Give anonymous user browse permissions for the test project
         anon_user = get_anonymous_user()
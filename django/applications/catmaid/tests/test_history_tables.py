@@ -202,6 +202,16 @@ class HistoryTableTests(TransactionTestCase):
         'treenode_connector_edge',
         'connector_geom',
         'catmaid_transaction_info',
+        'catmaid_skeleton_connectivity',
+        'catmaid_skeleton_summary',
+        'catmaid_skeleton_review_summary',
+        'catmaid_annotation_hierarchy_version',
+        'catmaid_skeleton_connectivity_version',
+        'catmaid_stats_summary',
+        'catmaid_stats_summary_change',
+        'catmaid_skeleton_summary_change',
+        'catmaid_skeleton_review_summary_change',
+        'catmaid_skeleton_connectivity_change',
 
         # Regular unversioned non-CATMAID tables
         'djkombu_queue',
@@ -1,13 +1,44 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import json
+import networkx as nx
+import numpy as np
+import os
+import shutil
+import six
+import tempfile
+import zipfile
+
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection
 from django.http.request import QueryDict
-from catmaid.control.common import get_request_list
+from catmaid.control.circles import SynapseGraph
+from catmaid.control.common import ID_MAP_VERSION_KEY, get_class_to_id_map, \
+        get_request_list, get_relation_to_id_map
+from catmaid.control.cropping import TileCache, TileFetcher, TileStats, \
+        rotate_array, tile_ranges
+from catmaid.management.commands.catmaid_check_db_integrity import \
+        check_skeletons
+from catmaid.management.commands.catmaid_generate_synthetic_data import \
+        generate_arbor
+from catmaid.management.commands.catmaid_import_data import \
+        iterate_json_array
 from catmaid.models import Project, Class, Relation, ClassInstance, \
     ClassInstanceClassInstance
-from catmaid.control.neuron_annotations import delete_annotation_if_unused
+from catmaid.control.neuron_annotations import AnnotationHierarchy, \
+        delete_annotation_if_unused, get_sub_annotation_ids
+from catmaid.control.skeletonexport import _StreamingZipArchive
+from catmaid.control.synapseclustering import arbor_max_density, \
+        tree_max_density, treeDensities
+from catmaid.metrics import LATENCY_BUCKETS, MetricsStore, mark_process_dead, \
+        metrics_file_path, render_metrics
+from catmaid.profiling import QueryProfile, explain, is_explainable, \
+        normalize_sql, profile_queries
+from catmaid.control.tree_util import Arbor, edge_lengths, lazy_load_arbors
 from catmaid.tests.common import CatmaidTestCase
 
 
@@ -35,10 +66,323 @@ class InternalApiTestsNoDB(TestCase):
         self.assertEqual(get_request_list(q4, 'a'), [['1', '2', '3']])
         self.assertEqual(get_request_list(q4, 'a', map_fn=int), [[1, 2, 3]])
 
+    def test_arbor(self):
+        # Root 1 with branch node 2, which has leaves 3 and 5 (via 4)
+        arbor = Arbor.from_rows([
+            (4, 2, 0, 2, 0), (1, None, 0, 0, 0), (3, 2, 1, 1, 0),
+            (5, 4, 0, 3, 0), (2, 1, 0, 1, 0)], with_locations=True)
+        self.assertEqual(1, arbor.root)
+        self.assertEqual(2, arbor.parent(4))
+        self.assertEqual([3, 4], arbor.child_ids(2).tolist())
+        self.assertEqual([0, 1, 2, 2, 3], arbor.depths().tolist())
+        self.assertAlmostEqual(4.0, arbor.cable_length())
+        self.assertEqual([[5, 4, 2, 1], [3, 2]], arbor.partition())
+        self.assertEqual(2, arbor.find_common_ancestor([3, 5]))
+        self.assertEqual(1, arbor.find_common_ancestor([1, 3, 5]))
+        six.assertCountEqual(self, [(3, 5)], arbor.simplify([3, 5], 5))
+        six.assertCountEqual(self, [(2, 5), (1, 2), (3, 2)],
+                arbor.simplify([1, 3, 5], 5))
+        self.assertRaises(ValueError, arbor.index, 6)
+
+        arbor.reroot(5)
+        self.assertEqual(5, arbor.root)
+        self.assertEqual([None, 5, 4, 2, 2], [arbor.parent(n) for n in (5, 4, 2, 1, 3)])
+        self.assertEqual([[1, 2, 4, 5], [3, 2]], arbor.partition())
+
+    def test_empty_arbor(self):
+        arbor = Arbor.from_rows([], with_locations=True)
+        self.assertEqual(0, len(arbor))
+        self.assertEqual(None, arbor.root)
+        self.assertEqual([], arbor.depths().tolist())
+        self.assertEqual([], arbor.partition())
+        self.assertEqual(0.0, arbor.cable_length())
+        self.assertEqual([], arbor.simplify([]))
+        self.assertRaises(ValueError, arbor.index, 1)
+        self.assertRaises(ValueError, arbor.reroot, 1)
+        self.assertRaises(ValueError, arbor.find_common_ancestor, [])
+
+    def test_tree_synapse_densities(self):
+        # Path 1-2-3-4-5 with a branch from 3 to 6, synapses at 1, 5 and 6
+        tree = nx.Graph()
+        tree.add_weighted_edges_from([(1, 2, 1000), (2, 3, 500), (3, 4, 200),
+            (4, 5, 1500), (3, 6, 800)])
+        synapses = [1, 5, 6, 6]
+        h_list = [300, 1000, 5000]
+        densities, id2index = treeDensities(tree, synapses, h_list, cutoff=100)
+        for h in h_list:
+            for node in tree.nodes():
+                distances = nx.single_source_dijkstra_path_length(tree, node)
+                expected = sum(np.exp(-distances[s] ** 2 / float(h) ** 2)
+                        for s in set(synapses))
+                self.assertAlmostEqual(expected, densities[h][id2index[node]])
+
+        # With a cutoff, only synapses within cutoff * h contribute
+        densities, id2index = treeDensities(tree, synapses, [1000], cutoff=2)
+        self.assertAlmostEqual(1, densities[1000][id2index[5]])
+        self.assertAlmostEqual(np.exp(-1) + np.exp(-1.3 ** 2),
+                densities[1000][id2index[2]])
+
+        # Each synapse is its own group for small bandwidths, all of them end
+        # up in a single group for large ones.
+        groups = tree_max_density(tree, synapses, [10, 11, 12, 13],
+                ['a', 'b', 'c', 'd'], [300, 100000])
+        six.assertCountEqual(self, [[1], [5], [6, 6]],
+                [g.node_ids for g in six.itervalues(groups[300])])
+        self.assertEqual(1, len(groups[100000]))
+
+        # Arbors with edge lengths from locations give the same groups
+        arbor = Arbor([1, 2, 3, 4, 5, 6], [None, 1, 2, 3, 4, 3])
+        locations = {1: (0, 0, 0), 2: (1000, 0, 0), 3: (1000, 500, 0),
+                4: (1000, 500, 200), 5: (1000, 2000, 200), 6: (1800, 500, 0)}
+        lengths = edge_lengths(arbor, locations)
+        self.assertEqual([0, 1000, 500, 200, 1500, 800], lengths.tolist())
+        arbor_groups = arbor_max_density(arbor, lengths, synapses,
+                [10, 11, 12, 13], ['a', 'b', 'c', 'd'], [300, 100000])
+        for h in (300, 100000):
+            six.assertCountEqual(self,
+                    [(g.local_max, g.node_ids) for g in six.itervalues(groups[h])],
+                    [(g.local_max, g.node_ids) for g in six.itervalues(arbor_groups[h])])
+
+    def test_tile_cache(self):
+        cache = TileCache(10)
+        cache.add('a', b'1234')
+        cache.add('b', b'1234')
+        self.assertEqual(b'1234', cache.get('a'))
+        # Adding c evicts the least recently used tile b
+        cache.add('c', b'1234')
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(b'1234', cache.get('a'))
+        self.assertEqual(8, cache.size)
+        # Tiles larger than the cache aren't cached
+        cache.add('d', b'12345678901')
+        self.assertEqual(None, cache.get('d'))
+
+        class FakeFetcher(TileFetcher):
+            def download(self, url):
+                return url.encode('utf-8')
+
+        fetcher = FakeFetcher(max_workers=2, cache_size=100)
+        stats = TileStats()
+        tiles = fetcher.fetch_all(['t1', 't2', 't1'], stats)
+        self.assertEqual({'t1': b't1', 't2': b't2'}, tiles)
+        tiles = fetcher.fetch_all(['t2', 't3'], stats)
+        self.assertEqual({'t2': b't2', 't3': b't3'}, tiles)
+        self.assertEqual({'fetched': 3, 'cache_hits': 1, 'bytes_fetched': 6,
+            'bytes_from_cache': 2}, stats.as_dict())
+
+    def test_crop_array_helpers(self):
+        self.assertEqual([(0, 100, 256, 0), (1, 0, 256, 156), (2, 0, 188, 412)],
+                list(tile_ranges(100, 700, 256)))
+        self.assertEqual([], list(tile_ranges(10, 10, 256)))
+
+        stack = np.arange(72, dtype=np.uint8).reshape((2, 1, 6, 6))
+        self.assertTrue(np.array_equal(stack, rotate_array(stack, 0.0, 6, 6)))
+        # Rotations by multiples of 90 degree are counter-clockwise
+        self.assertTrue(np.array_equal(np.rot90(stack, 1, axes=(2, 3)),
+                rotate_array(stack, 90.0, 6, 6)))
+        self.assertTrue(np.array_equal(np.rot90(stack, 2, axes=(2, 3)),
+                rotate_array(stack, 180.0, 6, 6)))
+
+    def test_json_array_iteration(self):
+        elements = [{'model': 'catmaid.treenode', 'pk': i,
+            'fields': {'name': 'a, [b]} "c"', 'values': [1, {'d': ']'}]}}
+            for i in range(20)]
+        data = json.dumps(elements, indent=2)
+        for chunk_size in (1, 7, 100000):
+            self.assertEqual(elements, list(iterate_json_array(
+                    six.StringIO(data), chunk_size)))
+        self.assertEqual([], list(iterate_json_array(six.StringIO(' [ ] '))))
+        with self.assertRaises(ValueError):
+            list(iterate_json_array(six.StringIO('[{"a": 1},'), 4))
+
+    def test_skeleton_integrity_checks(self):
+        # Skeleton 10 is valid, skeleton 20 has a cycle, skeleton 30 has two
+        # roots and skeleton 40 is attached to skeleton 10.
+        rows = np.array([
+            (1, -1, 10), (2, 1, 10), (3, 2, 10), (4, 2, 10),
+            (5, -1, 20), (6, 5, 20), (7, 8, 20), (8, 7, 20),
+            (9, -1, 30), (11, -1, 30),
+            (12, 2, 40), (13, 12, 40)])
+        result = check_skeletons(rows[:4, 0], rows[:4, 1], rows[:4, 2])
+        self.assertTrue(result.passed)
+        self.assertEqual(4, result.n_treenodes)
+
+        result = check_skeletons(rows[:, 0], rows[:, 1], rows[:, 2])
+        self.assertFalse(result.passed)
+        self.assertEqual(4, result.n_skeletons)
+        self.assertEqual([{'node_id': 12, 'parent_id': 2, 'skeleton_id': 40}],
+                result.examples['cross_skeleton'])
+        self.assertEqual([{'skeleton_id': 30, 'roots': 2},
+                {'skeleton_id': 40, 'roots': 0}], result.examples['root_count'])
+        self.assertEqual([7, 8, 12, 13], [e['node_id'] for e in
+                result.examples['disconnected']])
+
+    def test_annotation_hierarchy(self):
+        # Annotation 1 annotates 2 and 3, 3 annotates 4, 4 and 5 annotate
+        # each other.
+        hierarchy = AnnotationHierarchy(7, [(1, 2), (1, 3), (3, 4), (4, 5),
+                (5, 4)])
+        self.assertEqual(7, hierarchy.version)
+        self.assertEqual(frozenset([4, 5]), hierarchy.get_sub_annotation_ids(4))
+        self.assertEqual(frozenset([2, 3, 4, 5]),
+                hierarchy.get_sub_annotation_ids(1))
+        self.assertEqual(frozenset([4, 5]), hierarchy.get_sub_annotation_ids(5))
+        self.assertEqual(frozenset(), hierarchy.get_sub_annotation_ids(2))
+        self.assertEqual(frozenset(), hierarchy.get_sub_annotation_ids(42))
+
+    def test_synapse_graph(self):
+        # 10 -> 20 (3 synapses), 10 -> 30 (1), 30 -> 20 (2), 20 -> 40 (5)
+        graph = SynapseGraph([10, 10, 30, 20], [20, 30, 20, 40], [3, 1, 2, 5])
+        self.assertEqual([10, 20, 30, 40], graph.skeleton_ids.tolist())
+        frontier = graph.indices([10, 30, 50])
+        self.assertEqual([10, 30], graph.skeleton_ids[frontier].tolist())
+
+        sources, targets = graph.expand(frontier, 2)
+        self.assertEqual([(10, 20), (30, 20)], list(zip(
+                graph.skeleton_ids[sources].tolist(),
+                graph.skeleton_ids[targets].tolist())))
+        targets, sources = graph.expand(graph.indices([20]), 1, incoming=True)
+        six.assertCountEqual(self, [10, 30],
+                graph.skeleton_ids[sources].tolist())
+        self.assertEqual(0, len(graph.expand(frontier, float('inf'))[0]))
+
+        # Replace all edges of skeleton 30
+        graph = graph.update([30], np.array([40]), np.array([30]),
+                np.array([7]), 2)
+        self.assertEqual(2, graph.watermark)
+        six.assertCountEqual(self, [(10, 20, 3), (20, 40, 5), (40, 30, 7)],
+                zip(graph.sources.tolist(), graph.targets.tolist(),
+                    graph.counts.tolist()))
+
+    def test_generate_arbor(self):
+        rng = np.random.RandomState(0)
+        parents, positions = generate_arbor(rng, 1000, 200.0, 0.05)
+        self.assertEqual((1000, 3), positions.shape)
+        self.assertTrue(check_skeletons(np.arange(1000), parents,
+                np.zeros(1000)).passed)
+        self.assertTrue((parents[1:] < np.arange(1, 1000)).all())
+        self.assertTrue(np.allclose(200.0, np.linalg.norm(
+                positions[1:] - positions[parents[1:]], axis=1)))
+        # Some nodes are branch points
+        self.assertLess(1, np.sum(np.bincount(parents[1:]) > 1))
+
+        parents, positions = generate_arbor(rng, 1, 200.0)
+        self.assertEqual([-1], parents.tolist())
+        self.assertEqual([[0, 0, 0]], positions.tolist())
+
+    def test_sql_normalization(self):
+        self.assertEqual('SELECT id FROM treenode t1 WHERE t1.id IN (?, ...) '
+                'AND name = ? AND z > ?', normalize_sql('''
+                    SELECT id FROM treenode t1
+                    WHERE t1.id IN (%s, %s, %s) AND name = 'it''s' AND z > 2.5
+                '''))
+        self.assertEqual('INSERT INTO t (a, b) VALUES (?, ...), ...',
+                normalize_sql('INSERT INTO t (a, b) VALUES (%(a)s, %(b)s), '
+                    '(%s, %s), (1, 2)'))
+
+    def test_explainable_statements(self):
+        self.assertTrue(is_explainable('SELECT id FROM t WHERE id = %s'))
+        self.assertTrue(is_explainable("""
+            WITH x AS (SELECT 1) SELECT * FROM x WHERE name = 'delete;it'
+        """))
+        self.assertTrue(is_explainable('SELECT id FROM t;'))
+        self.assertFalse(is_explainable('UPDATE t SET x = 1'))
+        self.assertFalse(is_explainable("""
+            BEGIN;
+            DELETE FROM t WHERE id = 1;
+        """))
+        self.assertFalse(is_explainable('SELECT 1; DELETE FROM t'))
+        self.assertFalse(is_explainable("""
+            WITH d AS (DELETE FROM t RETURNING id) SELECT count(*) FROM d
+        """))
+        self.assertFalse(is_explainable('SELECT id FROM t FOR UPDATE'))
+        self.assertFalse(is_explainable('SELECT id FROM t FOR KEY SHARE'))
+        self.assertFalse(is_explainable("SELECT nextval('t_id_seq')"))
+
+    def test_query_profile(self):
+        profile = QueryProfile()
+        profile.add('SELECT id FROM t WHERE id = %s', [1], 0.01, 1)
+        profile.add('SELECT id FROM t WHERE id = %s', [2], 0.03, 1)
+        profile.add('UPDATE t SET x = 1', None, 0.02, -1)
+        result = profile.as_json()
+        self.assertEqual(3, result['n_queries'])
+        self.assertAlmostEqual(0.06, result['time'])
+        self.assertEqual(['SELECT id FROM t WHERE id = ?', 'UPDATE t SET x = ?'],
+                [s['sql'] for s in result['statements']])
+        self.assertEqual(2, result['statements'][0]['count'])
+        self.assertEqual(2, result['statements'][0]['rows'])
+        self.assertAlmostEqual(0.03, result['statements'][0]['max_time'])
+        self.assertEqual(0, result['statements'][1]['rows'])
+        self.assertEqual([('SELECT id FROM t WHERE id = ?',
+                ('SELECT id FROM t WHERE id = %s', [2]))], profile.slowest(1))
+
+    def test_zip64_archive(self):
+        archive = _StreamingZipArchive()
+        # Pretend the archive is large and has many members
+        archive.ZIP64_LIMIT = 100
+        archive.FILECOUNT_LIMIT = 2
+        data = []
+        for i in range(4):
+            data.append(archive.start_member('{}.swc'.format(i)))
+            data.append(archive.write('1 0 1 2 3 0 -1\n'.encode('utf-8')))
+            data.append(archive.end_member())
+        data.append(archive.close())
+
+        zip_file = zipfile.ZipFile(six.BytesIO(b''.join(data)))
+        self.assertIsNone(zip_file.testzip())
+        self.assertEqual(['0.swc', '1.swc', '2.swc', '3.swc'], zip_file.namelist())
+        self.assertEqual(b'1 0 1 2 3 0 -1\n', zip_file.read('3.swc'))
+
+        archive.start_member('large.swc')
+        self.assertRaises(ValueError, archive.write, b'1' * 1000)
+
+    def test_metrics_store(self):
+        directory = tempfile.mkdtemp()
+        try:
+            labels = (('view', 'node_list'),)
+            store = MetricsStore(directory, flush_interval=0)
+            store.inc('catmaid_requests_total', labels)
+            store.observe('catmaid_request_duration_seconds', labels, 0.02,
+                    LATENCY_BUCKETS)
+            store.flush()
+            # Pretend the written metrics are from another process
+            os.rename(store.path, metrics_file_path(directory, os.getppid()))
+            store.inc('catmaid_requests_total', labels, 2)
+            store.observe('catmaid_request_duration_seconds', labels, 20,
+                    LATENCY_BUCKETS)
+
+            counters, histograms = store.collect()
+            self.assertEqual(4, counters[('catmaid_requests_total', labels)])
+            buckets, counts, total = histograms[
+                    ('catmaid_request_duration_seconds', labels)]
+            self.assertEqual(2, counts[2])
+            self.assertEqual(1, counts[-1])
+            self.assertAlmostEqual(20.04, total)
+
+            text = render_metrics(counters, histograms)
+            self.assertIn('# TYPE catmaid_requests_total counter\n'
+                    'catmaid_requests_total{view="node_list"} 4\n', text)
+            self.assertIn('catmaid_request_duration_seconds_bucket{'
+                    'view="node_list",le="0.025"} 2\n', text)
+            self.assertIn('catmaid_request_duration_seconds_bucket{'
+                    'view="node_list",le="+Inf"} 3\n', text)
+            self.assertIn('catmaid_request_duration_seconds_count{'
+                    'view="node_list"} 3\n', text)
+
+            # Metrics of exited processes are kept
+            mark_process_dead(os.getppid(), directory)
+            self.assertFalse(os.path.exists(
+                    metrics_file_path(directory, os.getppid())))
+            counters, histograms = store.collect()
+            self.assertEqual(4, counters[('catmaid_requests_total', labels)])
+        finally:
+            shutil.rmtree(directory)
+
 class InternalApiTests(CatmaidTestCase):
     fixtures = ['catmaid_testdata']
 
     def setUp(self):
+        super(InternalApiTests, self).setUp()
         self.test_user = User.objects.get(username="test0")
         self.test_project = Project.objects.get(id=3)
 
@@ -103,3 +447,134 @@ class InternalApiTests(CatmaidTestCase):
         self.assertFalse(ClassInstance.objects.filter(id=annotation_a.id).exists())
         self.assertFalse(ClassInstance.objects.filter(id=annotation_b.id).exists())
         self.assertFalse(ClassInstance.objects.filter(id=annotation_c.id).exists())
+
+    def test_sub_annotation_cache(self):
+        relations = get_relation_to_id_map(self.test_project.id)
+        classes = get_class_to_id_map(self.test_project.id)
+        annotation_a = ClassInstance.objects.create(project=self.test_project,
+                user=self.test_user, class_column_id=classes['annotation'],
+                name="A")
+        annotation_b = ClassInstance.objects.create(project=self.test_project,
+                user=self.test_user, class_column_id=classes['annotation'],
+                name="B")
+        key = frozenset([annotation_a.id])
+
+        sub_annotations = get_sub_annotation_ids(self.test_project.id, [key],
+                relations, classes)
+        self.assertEqual({key: []}, sub_annotations)
+
+        # A cached hierarchy only needs its version to be checked
+        with self.assertNumQueries(1):
+            sub_annotations = get_sub_annotation_ids(self.test_project.id,
+                    [key], relations, classes)
+            self.assertEqual({key: []}, sub_annotations)
+
+        # Annotating B with A invalidates the cached hierarchy
+        link = ClassInstanceClassInstance.objects.create(
+                project=self.test_project, user=self.test_user,
+                class_instance_a=annotation_b, class_instance_b=annotation_a,
+                relation_id=relations['annotated_with'])
+        sub_annotations = get_sub_annotation_ids(self.test_project.id, [key],
+                relations, classes)
+        self.assertEqual({key: [annotation_b.id]}, sub_annotations)
+
+        link.delete()
+        sub_annotations = get_sub_annotation_ids(self.test_project.id, [key],
+                relations, classes)
+        self.assertEqual({key: []}, sub_annotations)
+
+    def test_relation_id_map_cache(self):
+        relations = get_relation_to_id_map(self.test_project.id)
+        self.assertIn('annotated_with', relations)
+
+        # Cached maps don't require queries
+        with self.assertNumQueries(0):
+            cached_relations = get_relation_to_id_map(self.test_project.id)
+            self.assertEqual(relations, cached_relations)
+            constrained_relations = get_relation_to_id_map(self.test_project.id,
+                    ('annotated_with',))
+            self.assertEqual({'annotated_with': relations['annotated_with']},
+                    constrained_relations)
+
+        # Missing relations are loaded only once
+        with self.assertNumQueries(1):
+            for i in range(2):
+                self.assertEqual({}, get_relation_to_id_map(self.test_project.id,
+                        ('missing_relation',)))
+
+        # New relations invalidate the cache
+        relation = Relation.objects.create(project=self.test_project,
+                user=self.test_user, relation_name='test_relation')
+        relations = get_relation_to_id_map(self.test_project.id)
+        self.assertEqual(relation.id, relations.get('test_relation'))
+
+        relation.delete()
+        relations = get_relation_to_id_map(self.test_project.id)
+        self.assertNotIn('test_relation', relations)
+
+        # Changes made with raw SQL are picked up once cached maps expire
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE relation SET relation_name = 'renamed_relation'
+            WHERE id = %s
+        """, (relations['annotated_with'],))
+        self.assertIn('annotated_with', get_relation_to_id_map(self.test_project.id))
+        with override_settings(ID_MAP_CACHE_TIMEOUT=-1):
+            relations = get_relation_to_id_map(self.test_project.id)
+        self.assertIn('renamed_relation', relations)
+        self.assertNotIn('annotated_with', relations)
+
+    @override_settings(ID_MAP_CACHE='default', CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_shared_id_map_version(self):
+        caches['default'].clear()
+        classes = get_class_to_id_map(self.test_project.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(classes, get_class_to_id_map(self.test_project.id))
+
+        # Another process invalidated the maps of the project by changing
+        # their version in the shared cache.
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE class SET class_name = 'renamed_class'
+            WHERE id = %s
+        """, (classes['skeleton'],))
+        caches['default'].set(ID_MAP_VERSION_KEY.format(self.test_project.id),
+                'other-version', None)
+        classes = get_class_to_id_map(self.test_project.id)
+        self.assertIn('renamed_class', classes)
+        self.assertNotIn('skeleton', classes)
+
+    def test_arbor_loading(self):
+        arbor = Arbor.from_skeleton(373, with_locations=True)
+        self.assertEqual([377, 403, 405, 407, 409], arbor.node_ids.tolist())
+        self.assertEqual(377, arbor.root)
+        self.assertEqual([[409, 407, 405, 377], [403, 377]], arbor.partition())
+        self.assertEqual(377, arbor.find_common_ancestor([403, 409]))
+
+        arbors = dict(lazy_load_arbors([235, 373], batch_size=1))
+        six.assertCountEqual(self, [235, 373], arbors.keys())
+        self.assertEqual(28, len(arbors[235]))
+        self.assertEqual(237, arbors[235].root)
+        self.assertAlmostEqual(arbor.cable_length(), arbors[373].cable_length())
+
+    def test_query_profiling(self):
+        with profile_queries(QueryProfile()) as profile:
+            list(Project.objects.filter(id=self.test_project.id))
+            cursor = connection.cursor()
+            cursor.execute('SELECT id FROM treenode WHERE skeleton_id = %s',
+                    (373,))
+            cursor.execute('SELECT id FROM treenode WHERE skeleton_id = %s',
+                    (235,))
+        self.assertEqual(3, profile.n_queries)
+        statement = profile.statements['SELECT id FROM treenode WHERE skeleton_id = ?']
+        self.assertEqual(2, statement['count'])
+        self.assertEqual(5 + 28, statement['rows'])
+
+        # Statements after profiling aren't recorded
+        connection.cursor().execute('SELECT 1')
+        self.assertEqual(3, profile.n_queries)
+
+        sql, params = profile.statements['SELECT id FROM treenode WHERE skeleton_id = ?']['slowest']
+        self.assertIn('actual time', explain(sql, params))
+        self.assertIsNone(explain('UPDATE treenode SET radius = 0', None))
@@ -19,7 +19,7 @@ from catmaid.control import (authentication, user, log, message, client, common,
         cropping, data_view, ontology, classification, notifications, roi,
         clustering, volume, flytem, dvid, useranalytics, user_evaluation,
         search, graphexport, transaction, graph2, circles, analytics, review,
-        wiringdiagram, object, treenodetable)
+        wiringdiagram, object, treenodetable, metrics)
 
 from catmaid.views import CatmaidView
 from catmaid.history import record_request_action as record_view
@@ -126,6 +126,11 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/stats/user-activity$', stats.stats_user_activity),
 ]
 
+# Server metrics
+urlpatterns += [
+    url(r'^metrics$', metrics.metrics),
+]
+
 # Annotations
 urlpatterns += [
     url(r'^(?P<project_id>\d+)/annotations/$', annotations.list_annotations),
@@ -200,6 +205,7 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/node/nearest$', node.node_nearest),
     url(r'^(?P<project_id>\d+)/node/update$', record_view("nodes.update_location")(node.node_update)),
     url(r'^(?P<project_id>\d+)/node/list$', node.node_list_tuples),
+    url(r'^(?P<project_id>\d+)/node/list/cache-stats$', node.node_list_cache_stats),
     url(r'^(?P<project_id>\d+)/node/get_location$', node.get_location),
     url(r'^(?P<project_id>\d+)/node/user-info$', node.user_info),
     url(r'^(?P<project_id>\d+)/nodes/find-labels$', node.find_labels),
@@ -276,6 +282,8 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/skeleton/connectors-by-partner$', skeletonexport.skeleton_connectors_by_partner),
     url(r'^(?P<project_id>\d+)/skeletons/partners-by-connector$', skeletonexport.partners_by_connector),
     url(r'^(?P<project_id>\d+)/skeletons/(?P<skeleton_id>\d+)/compact-detail$', skeletonexport.compact_skeleton_detail),
+    url(r'^(?P<project_id>\d+)/skeletons/compact-detail$', skeletonexport.compact_skeletons),
+    url(r'^(?P<project_id>\d+)/skeletons/swc$', skeletonexport.skeletons_swc),
     # Marked as deprecated, but kept for backwards compatibility
     url(r'^(?P<project_id>\d+)/(?P<skeleton_id>\d+)/(?P<with_connectors>\d)/(?P<with_tags>\d)/compact-skeleton$', skeletonexport.compact_skeleton),
 ]
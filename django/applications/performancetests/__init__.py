@@ -3,9 +3,15 @@ from __future__ import unicode_literals
 
 import sys
 import gc
+import time
+import bisect
+import random
 import timeit
 import subprocess
 import compileall
+import numpy as np
+
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 
@@ -128,8 +134,112 @@ class PerformanceTest(object):
         Run the CATMAID performance tests and return a list of results and a
         list of repeats for every run.
         """
-        from django.test.utils import setup_test_environment, \
-            teardown_test_environment
+        db_name, old_db_name = self.setup_test_db()
+
+        # Test all views
+        self.log("Testing all %s views" % len(views))
+        results = []
+        repeat_results = [[] for i in range(repeats)]
+        for v in views:
+            # Ideally the DB cluster would be stopped here, OS caches would be
+            # dropped (http://linux-mm.org/Drop_Caches) and then the DB cluster
+            # would be restarted.
+            results.append(self.test(v))
+            for r in range(repeats):
+                repeat_results[r].append(self.test(v))
+
+        self.teardown_test_db(db_name, old_db_name)
+
+        return results, repeat_results
+
+    def run_load_tests(self, views, client_counts, duration=30,
+            think_time=1.0, seed=None):
+        """
+        Simulate concurrent clients, each of which requests randomly chosen
+        views for <duration> seconds. Views are chosen according to their
+        weight. Between two requests, each client waits for an exponentially
+        distributed think time with the passed in mean (in seconds). Every
+        client runs in its own thread and uses its own database connection.
+        All numbers of clients in client_counts are tested one after another.
+        Returns a list with one LoadTestLevel for each client count.
+        """
+        weights = [max(0.0, v.weight) for v in views]
+        if not sum(weights):
+            raise ValueError('At least one view needs a positive weight')
+
+        db_name, old_db_name = self.setup_test_db()
+        version = get_version()
+
+        levels = []
+        try:
+            for n_clients in client_counts:
+                self.log("Testing %s views with %s concurrent clients for %ss" % \
+                        (len(views), n_clients, duration))
+                levels.append(self.run_load_level(views, weights, n_clients,
+                        duration, think_time, seed, version))
+        finally:
+            self.teardown_test_db(db_name, old_db_name)
+
+        return levels
+
+    def run_load_level(self, views, weights, n_clients, duration, think_time,
+            seed, version):
+        """
+        Run <n_clients> concurrent clients for <duration> seconds and return
+        a LoadTestLevel.
+        """
+        cumulative_weights = np.cumsum(weights).tolist()
+        start = timeit.default_timer()
+        deadline = start + duration
+
+        def run_client(index):
+            from django.db import connection
+            from django.test.client import Client
+            rng = random.Random(None if seed is None else seed + index)
+            client = Client()
+            client.login(username=self.username, password=self.password)
+            samples = []
+            try:
+                while timeit.default_timer() < deadline:
+                    choice = rng.random() * cumulative_weights[-1]
+                    view_index = bisect.bisect_right(cumulative_weights, choice)
+                    request_start = timeit.default_timer()
+                    response = self.request(client, views[view_index])
+                    latency_ms = (timeit.default_timer() - request_start) * 1000
+                    samples.append((view_index, latency_ms, response.status_code))
+                    if think_time > 0:
+                        time.sleep(max(0, min(rng.expovariate(1.0 / think_time),
+                                deadline - timeit.default_timer())))
+            finally:
+                # Each thread has its own database connection
+                connection.close()
+            return samples
+
+        pool = ThreadPool(n_clients)
+        try:
+            client_samples = pool.map(run_client, range(n_clients))
+        finally:
+            pool.close()
+        elapsed = timeit.default_timer() - start
+
+        samples = [s for cs in client_samples for s in cs]
+        results = []
+        for view_index, view in enumerate(views):
+            view_samples = [s for s in samples if s[0] == view_index]
+            if view_samples:
+                results.append(summarize_samples(view, view_samples,
+                        n_clients, elapsed, version))
+
+        return LoadTestLevel(n_clients, elapsed, results,
+                [s[1] for s in samples])
+
+    def setup_test_db(self):
+        """
+        Create a test database from the template database, use it for all
+        further requests and log in. Returns the name of the test database and
+        the name of the original database.
+        """
+        from django.test.utils import setup_test_environment
         setup_test_environment()
 
         # Make sure all python code is compiled to not include this timing
@@ -155,18 +265,13 @@ class PerformanceTest(object):
         self.connection.ensure_connection()
         self.client.login(username=self.username, password=self.password)
 
-        # Test all views
-        self.log("Testing all %s views" % len(views))
-        results = []
-        repeat_results = [[] for i in range(repeats)]
-        for v in views:
-            # Ideally the DB cluster would be stopped here, OS caches would be
-            # dropped (http://linux-mm.org/Drop_Caches) and then the DB cluster
-            # would be restarted.
-            results.append(self.test(v))
-            for r in range(repeats):
-                repeat_results[r].append(self.test(v))
+        return db_name, old_db_name
 
+    def teardown_test_db(self, db_name, old_db_name):
+        """
+        Restore the original database and drop the test database.
+        """
+        from django.test.utils import teardown_test_environment
         teardown_test_environment()
 
         # Restore the original database name
@@ -176,7 +281,17 @@ class PerformanceTest(object):
         self.connection.ensure_connection()
         self.drop_db(self.connection.cursor(), db_name)
 
-        return results, repeat_results
+    def request(self, client, view):
+        """
+        Request the given view with the passed in client and return the
+        response.
+        """
+        if view.method == 'GET':
+            return client.get(view.url, view.data)
+        elif view.method == 'POST':
+            return client.post(view.url, view.data)
+        else:
+            raise ValueError('Unknown view method: %s' % view.method)
 
     def test(self, view):
         """
@@ -187,18 +302,12 @@ class PerformanceTest(object):
         gc.disable()
         try:
             start = timeit.default_timer()
-            if view.method == 'GET':
-                response = self.client.get(view.url, view.data)
-            elif view.method == 'POST':
-                response = self.client.post(view.url, view.data)
-            else:
-                raise ValueError('Unknown view method: %s' % view.method)
-
+            response = self.request(self.client, view)
             end = timeit.default_timer()
             # Return result in milliseconds
             time_ms = (end - start) * 1000
             # Try to get version information
-            version = subprocess.check_output(['git', 'describe'])
+            version = get_version()
 
             from .models import TestResult
             return TestResult(view=view, time=time_ms, result=response,
@@ -206,3 +315,64 @@ class PerformanceTest(object):
         finally:
             if gc_old:
                 gc.enable()
+
+
+class LoadTestLevel(object):
+    """
+    The results of a load test with a particular number of concurrent
+    clients: one TestResult per requested view and the latencies of all
+    requests in milliseconds.
+    """
+
+    def __init__(self, n_clients, elapsed, results, latencies):
+        self.n_clients = n_clients
+        self.elapsed = elapsed
+        self.results = results
+        self.n_requests = len(latencies)
+        self.throughput = self.n_requests / elapsed if elapsed > 0 else 0.0
+        if latencies:
+            self.p50, self.p95, self.p99 = np.percentile(latencies,
+                    [50, 95, 99]).tolist()
+        else:
+            self.p50 = self.p95 = self.p99 = None
+
+
+def get_version():
+    """
+    Return the output of "git describe" for the current working directory.
+    """
+    return subprocess.check_output(['git', 'describe'])
+
+
+def summarize_samples(view, samples, n_clients, elapsed, version):
+    """
+    Create a TestResult for a view from a list of (view index, latency,
+    status code) samples collected during a load test of <elapsed> seconds.
+    The result code is the highest status code returned.
+    """
+    from .models import TestResult
+    latencies = [s[1] for s in samples]
+    status_codes = [s[2] for s in samples]
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]).tolist()
+    return TestResult(view=view, time=float(np.mean(latencies)),
+            result_code=max(status_codes), version=version,
+            result='%s requests, status codes: %s' % (len(samples),
+                ', '.join('%s: %s' % (c, status_codes.count(c))
+                          for c in sorted(set(status_codes)))),
+            concurrency=n_clients, n_requests=len(samples), p50=p50, p95=p95,
+            p99=p99, throughput=len(samples) / elapsed if elapsed > 0 else 0.0)
+
+
+def find_saturation_point(levels, min_gain=0.1):
+    """
+    Return the load test level (of a list ordered by number of clients)
+    after which throughput doesn't increase anymore by at least <min_gain>
+    (relative to the previous level).
+    """
+    saturation = None
+    for level in levels:
+        if saturation is not None and \
+                level.throughput < saturation.throughput * (1 + min_gain):
+            break
+        saturation = level
+    return saturation
@@ -23,14 +23,14 @@ def trimmed_result(obj):
     return "%s ..." % obj.result[:last_character]
 
 class TestViewAdmin(admin.ModelAdmin):
-    list_display = ('url', 'method', 'data', 'creation_time')
+    list_display = ('url', 'method', 'data', 'weight', 'creation_time')
     search_fields = ('url', 'method', 'data')
     actions = (duplicate_action,)
 
 
 class TestResultAdmin(admin.ModelAdmin):
     list_display = ('view', 'creation_time', 'time', 'result_code',
-                    trimmed_result)
+                    'concurrency', 'p95', 'throughput', trimmed_result)
     search_fields = ('view', 'result_code', 'result')
     order_by = ('creation_time',)
 
@@ -8,7 +8,7 @@ from django.db import connection
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
-from performancetests import PerformanceTest
+from performancetests import PerformanceTest, find_saturation_point
 from performancetests.models import TestView
 
 
@@ -19,6 +19,20 @@ class Command(BaseCommand):
         parser.add_argument('--dont-save', dest='saveresults',
             default=True, action='store_false',
             help='Don\'t save generated test results to the database')
+        parser.add_argument('--clients', dest='clients', type=int, default=0,
+            help='Run a load test with this many concurrent clients instead '
+            'of timing views one at a time')
+        parser.add_argument('--ramp', dest='ramp', default=False,
+            action='store_true', help='Run the load test with 1, 2, 4, ... '
+            'clients up to the number of clients and report the saturation '
+            'point')
+        parser.add_argument('--duration', dest='duration', type=float,
+            default=30, help='The number of seconds each load test level runs')
+        parser.add_argument('--think-time', dest='think_time', type=float,
+            default=1.0, help='The mean time in seconds a client waits '
+            'between two requests (exponentially distributed)')
+        parser.add_argument('--seed', dest='seed', type=int, default=None,
+            help='A seed for the random view selection and think times')
 
     def handle(self, *args, **options):
         # Make sure we have all neaded parameters available
@@ -42,6 +56,10 @@ class Command(BaseCommand):
             self.stdout.write('No test views found')
             return
 
+        if options['clients'] > 0:
+            self.run_load_tests(test, views, options)
+            return
+
         n_repeat = getattr(settings, 'PERFORMANCETESTS_TEST_REPEAT', 0)
         n_skip = getattr(settings, 'PERFORMANCETESTS_TEST_SKIP', 0)
 
@@ -82,3 +100,39 @@ class Command(BaseCommand):
             self.stdout.write('Saved all results')
         else:
             self.stdout.write('Did not save results')
+
+    def run_load_tests(self, test, views, options):
+        n_clients = options['clients']
+        if options['ramp']:
+            client_counts = []
+            c = 1
+            while c < n_clients:
+                client_counts.append(c)
+                c *= 2
+            client_counts.append(n_clients)
+        else:
+            client_counts = [n_clients]
+
+        levels = test.run_load_tests(views, client_counts, options['duration'],
+                options['think_time'], options['seed'])
+
+        for level in levels:
+            self.stdout.write("Clients: %s Requests: %s Throughput: %.1f/s "
+                "p50: %s p95: %s p99: %s" % (level.n_clients, level.n_requests,
+                level.throughput, level.p50, level.p95, level.p99))
+            for r in level.results:
+                self.stdout.write("  URL: %s Time: %sms N: %s p50: %sms p95: %sms "
+                    "p99: %sms Throughput: %.1f/s" % (r.view.url, r.time,
+                    r.n_requests, r.p50, r.p95, r.p99, r.throughput))
+                if options['saveresults']:
+                    r.save()
+
+        if len(levels) > 1:
+            saturation = find_saturation_point(levels)
+            self.stdout.write("Throughput saturates at %s clients (%.1f requests/s)" % \
+                    (saturation.n_clients, saturation.throughput))
+
+        if options['saveresults']:
+            self.stdout.write('Saved all results')
+        else:
+            self.stdout.write('Did not save results')
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# DDL triggers aren't yet implemented for CATMAID's history tracking. Therefore,
+# the history tables have to be updated manually.
+
+add_history_columns = """
+    DO $$
+    BEGIN
+    EXECUTE format(
+        'ALTER TABLE %1$s '
+        'ADD COLUMN weight double precision',
+        get_history_table_name('performancetests_testview'::regclass));
+    EXECUTE format(
+        'ALTER TABLE %1$s '
+        'ADD COLUMN concurrency integer, '
+        'ADD COLUMN n_requests integer, '
+        'ADD COLUMN p50 double precision, '
+        'ADD COLUMN p95 double precision, '
+        'ADD COLUMN p99 double precision, '
+        'ADD COLUMN throughput double precision',
+        get_history_table_name('performancetests_testresult'::regclass));
+    END
+    $$;
+"""
+
+remove_history_columns = """
+    DO $$
+    BEGIN
+    EXECUTE format(
+        'ALTER TABLE %1$s '
+        'DROP COLUMN weight',
+        get_history_table_name('performancetests_testview'::regclass));
+    EXECUTE format(
+        'ALTER TABLE %1$s '
+        'DROP COLUMN concurrency, '
+        'DROP COLUMN n_requests, '
+        'DROP COLUMN p50, '
+        'DROP COLUMN p95, '
+        'DROP COLUMN p99, '
+        'DROP COLUMN throughput',
+        get_history_table_name('performancetests_testresult'::regclass));
+    END
+    $$;
+"""
+
+
+class Migration(migrations.Migration):
+    """Store the weight of a test view in load tests and the latency
+    percentiles and throughput of concurrent test results.
+    """
+
+    dependencies = [
+        ('performancetests', '0003_update_history_tables'),
+    ]
+
+    operations = [
+        migrations.RunSQL(add_history_columns, remove_history_columns),
+        migrations.AddField(
+            model_name='testview',
+            name='weight',
+            field=models.FloatField(default=1.0, help_text='How often this view is requested in load tests, relative to other views.'),
+        ),
+        migrations.AddField(
+            model_name='testresult',
+            name='concurrency',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='testresult',
+            name='n_requests',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='testresult',
+            name='p50',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='testresult',
+            name='p95',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='testresult',
+            name='p99',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='testresult',
+            name='throughput',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -15,6 +15,8 @@ class TestView(models.Model):
     url = models.TextField()
     data = JSONField(blank=True, default={})
     creation_time = models.DateTimeField(default=timezone.now)
+    weight = models.FloatField(default=1.0, help_text='How often this view '
+            'is requested in load tests, relative to other views.')
 
     def __unicode__(self):
         return "%s %s" % (self.method, self.url)
@@ -24,6 +26,7 @@ class TestView(models.Model):
             view_id = self.id,
             view_method = self.method,
             view_data = self.data,
+            view_weight = self.weight,
             creation_time = self.creation_time.strftime('%Y-%m-%dT%H:%M:%S')
         )
 
@@ -31,7 +34,9 @@ class TestView(models.Model):
 class TestResult(models.Model):
     """
     Represents the result of test of the given view. It expects a time and a
-    result.
+    result. Results of load tests are based on many requests by concurrent
+    clients: time is the mean latency, along with latency percentiles and the
+    throughput of the view in requests per second.
     """
     view = models.ForeignKey(TestView, on_delete=models.CASCADE)
     time = models.FloatField()
@@ -39,6 +44,12 @@ class TestResult(models.Model):
     result = models.TextField()
     creation_time = models.DateTimeField(default=timezone.now)
     version = models.CharField(blank=True, max_length=50)
+    concurrency = models.IntegerField(default=1)
+    n_requests = models.IntegerField(default=1)
+    p50 = models.FloatField(blank=True, null=True)
+    p95 = models.FloatField(blank=True, null=True)
+    p99 = models.FloatField(blank=True, null=True)
+    throughput = models.FloatField(blank=True, null=True)
 
     def __unicode__(self):
         return "%s (Time: %sms Status: %s)" % (self.view, self.time, self.result_code)
@@ -52,6 +63,12 @@ class TestResult(models.Model):
             result = self.result,
             creation_time = self.creation_time.strftime('%Y-%m-%dT%H:%M:%S'),
             version = self.version,
+            concurrency = self.concurrency,
+            n_requests = self.n_requests,
+            p50 = self.p50,
+            p95 = self.p95,
+            p99 = self.p99,
+            throughput = self.throughput,
         )
 
 
@@ -3,4 +3,21 @@ from __future__ import unicode_literals
 
 from django.test import TestCase
 
-# Create your tests here.
+from performancetests import LoadTestLevel, find_saturation_point
+
+
+class LoadTestTests(TestCase):
+
+    def test_saturation_point(self):
+        latencies = [float(i) for i in range(1, 101)]
+        level = LoadTestLevel(4, 10.0, [], latencies)
+        self.assertEqual(100, level.n_requests)
+        self.assertAlmostEqual(10.0, level.throughput)
+        self.assertAlmostEqual(50.5, level.p50)
+        self.assertAlmostEqual(95.05, level.p95)
+
+        # Throughput grows by less than 10% from 4 to 8 clients
+        levels = [LoadTestLevel(n, 1.0, [], [1.0] * r) for n, r in
+                ((1, 10), (2, 19), (4, 30), (8, 32), (16, 40))]
+        self.assertEqual(4, find_saturation_point(levels).n_clients)
+        self.assertEqual(16, find_saturation_point(levels, min_gain=0).n_clients)
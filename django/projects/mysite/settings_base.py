@@ -49,6 +49,7 @@ MANAGERS = ADMINS
 USE_I18N = True
 
 MIDDLEWARE = [
+    'catmaid.middleware.MetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -210,6 +211,71 @@ ROI_AUTO_CREATE_IMAGE = False
 # result; that will be between 1x and 2x this value.
 NODE_LIST_MAXIMUM_COUNT = 3500
 
+# Responses of the spatial node query (node/list) can be cached on the server
+# side, which helps if many users look at the same areas. To enable this, set
+# NODE_LIST_CACHE to the name of a cache configured in Django's CACHES setting.
+# If more than one worker process is used, this has to be a cache shared
+# between processes (e.g. memcached). Responses are cached per bounding box and
+# versioned per cell of a grid with the cell size defined in
+# NODE_LIST_CACHE_GRID (X, Y and Z in project space). Edits invalidate all
+# cached responses intersecting the grid cells they touch. Queries that
+# span more than NODE_LIST_CACHE_MAX_CELLS grid cells aren't cached. Cached
+# responses expire after NODE_LIST_CACHE_TIMEOUT seconds. CATMAID's management
+# commands invalidate the cache of projects they change, but other direct
+# database changes only become visible once cached responses expire.
+NODE_LIST_CACHE = None
+NODE_LIST_CACHE_GRID = (4096, 4096, 200)
+NODE_LIST_CACHE_MAX_CELLS = 64
+NODE_LIST_CACHE_TIMEOUT = 300
+
+# The number of skeletons that are queried together when multiple skeletons
+# are requested in their compact representation at once.
+COMPACT_SKELETON_BATCH_SIZE = 500
+
+# Streamed exports (e.g. SWC and NeuroML) read treenodes through server side
+# cursors. This is the number of rows fetched from such a cursor at once.
+STREAMING_EXPORT_BATCH_SIZE = 10000
+
+# Project permissions of users are checked for most requests. To cache them
+# across requests, set PERMISSION_CACHE to the name of a cache configured in
+# Django's CACHES setting. Cached permissions are invalidated when permissions
+# or group memberships change and expire after PERMISSION_CACHE_TIMEOUT
+# seconds. With a cache that isn't shared between processes (like the local
+# memory cache), other processes can use outdated permissions until they
+# expire. Within a request, permissions are always only checked once.
+PERMISSION_CACHE = None
+PERMISSION_CACHE_TIMEOUT = 60
+
+# Relation and class name to ID maps of projects are cached in each process
+# for ID_MAP_CACHE_TIMEOUT seconds. Changes made through Django models
+# invalidate them right away in the same process. To invalidate them in other
+# processes as well, set ID_MAP_CACHE to the name of a cache configured in
+# Django's CACHES setting that is shared between processes (e.g. memcached).
+# Changes made with raw SQL are only picked up after the timeout.
+ID_MAP_CACHE = None
+ID_MAP_CACHE_TIMEOUT = 60
+
+# If the ProfilingMiddleware is used, the SQL time and query count of profiled
+# requests can be aggregated into histograms per view. To enable this, set
+# PROFILING_SQL_HISTOGRAM_CACHE to the name of a cache configured in Django's
+# CACHES setting. Histograms are kept until the cache is cleared, use a
+# persistent cache (e.g. a database cache) to keep them across restarts.
+PROFILING_SQL_HISTOGRAM_CACHE = None
+
+# The MetricsMiddleware records the duration, SQL query count and time and
+# response size of all requests per view, along with hit rates of CATMAID's
+# caches. They are available in Prometheus' text format from /metrics to
+# superusers and to the users named in METRICS_USERS, who can use an API token
+# to scrape them. Each process keeps its own metrics. To aggregate the metrics
+# of all processes (e.g. uWSGI workers), set METRICS_DIRECTORY to a writable
+# directory, in which each process stores its metrics at most every
+# METRICS_FLUSH_INTERVAL seconds. The metrics of exited processes are added to
+# an aggregate file in it, so that counters don't decrease. Files are named
+# after host and process ID, the directory can be shared by multiple hosts.
+METRICS_DIRECTORY = None
+METRICS_FLUSH_INTERVAL = 10
+METRICS_USERS = ()
+
 # Default importer tile width, tile height and tile source type
 IMPORTER_DEFAULT_DATA_SOURCE = 'filesystem'
 IMPORTER_DEFAULT_TILE_WIDTH = 512
@@ -231,6 +297,19 @@ MEDIA_TREENODE_SUBDIRECTORY = 'treenode_archives'
 # than this. This defaults to 50 Megabyte.
 GENERATED_FILES_MAXIMUM_SIZE = 52428800
 
+# Image tiles for the cropping tool and the treenode and connector export are
+# fetched by TILE_FETCH_WORKERS threads per process, using persistent HTTP
+# connections. Fetched tiles are kept in an LRU cache of TILE_CACHE_SIZE Bytes
+# (default: 256 Megabyte), which is shared by all jobs of a process.
+TILE_FETCH_WORKERS = 8
+TILE_FETCH_TIMEOUT = 30
+TILE_CACHE_SIZE = 268435456
+
+# Crop jobs and the treenode and connector archive export compose their output
+# with NumPy and write TIFF files directly ('numpy', the default). Set this to
+# 'graphicsmagick' to use the previous pgmagick based implementation.
+CROPPING_BACKEND = 'numpy'
+
 # The maximum allowed size in bytes for files uploaded for import as skeletons.
 # The default is 5 megabytes.
 IMPORTED_SKELETON_FILE_MAXIMUM_SIZE = 5242880
@@ -246,9 +325,16 @@ NEW_USER_DEFAULT_GROUPS = []
 CELERY_IMPORTS = (
     'catmaid.control.cropping',
     'catmaid.control.roi',
+    'catmaid.control.stats',
     'catmaid.control.treenodeexport',
 )
 
+# The statistics widget reads per user contributions from a summary table.
+# Entries that are outdated by changes are recomputed by a periodic Celery task
+# every STATS_SUMMARY_UPDATE_INTERVAL seconds (if Celery runs in beat mode).
+# Until then, they are computed when they are read.
+STATS_SUMMARY_UPDATE_INTERVAL = 3600
+
 # We use django-pipeline to compress and reference JavaScript and CSS files. To
 # make Pipeline integrate with staticfiles (and therefore collecstatic calls)
 # the STATICFILES_STORAGE variable has to be set to: